@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 """The main file of Salvo."""
 import argparse
+import functools
 import logging
+import os
 import sys
+import time
+from typing import Optional
 
+from src.lib.common import (change_points, cost_accounting, metrics_export, results_db, trace,
+                            tree_compare)
 from src.lib.job_control_loader import load_control_doc
-from src.lib import run_benchmark
+from src.lib import (constants, execution_plan, job_server, run_benchmark, source_manager)
+from src.lib.docker_management import docker_image
+
+import api.analysis_pb2 as proto_analysis
+import api.control_pb2 as proto_control
 
 LOGFORMAT = "%(asctime)s: %(process)d [ %(levelname)-5s] [%(module)-5s] %(message)s"
 
@@ -36,11 +46,494 @@ def setup_options() -> argparse.Namespace:
   parser = argparse.ArgumentParser(description="Salvo Benchmark Runner")
   parser.add_argument('--job',
                       dest='jobcontrol',
-                      help='specify the location for the job control json document')
+                      help='specify the location for the job control json document. The "results" '
+                      'commands use its results database and options')
+  parser.add_argument('--plan',
+                      action='store_true',
+                      help='print the steps of the job and their estimated durations without '
+                      'building or running anything')
+
+  commands = parser.add_subparsers(dest='command')
+  results = commands.add_parser('results', help='inspect the recorded benchmark results')
+  results_commands = results.add_subparsers(dest='results_command')
+  query = results_commands.add_parser('query', help='print the results matching all criteria')
+  query.add_argument('--db',
+                     dest='database',
+                     help='specify the results database. The default is the database of the '
+                     'job control document given with --job')
+  query.add_argument('--test', default='', help='the test, or a pattern with "*"')
+  query.add_argument('--metric', default='', help='the metric, or a pattern with "*"')
+  query.add_argument('--commit',
+                     dest='commits',
+                     action='append',
+                     help='a commit hash or tag of the results. May be repeated')
+  query.add_argument('--last-commits',
+                     type=int,
+                     default=0,
+                     help='only return the results of the most recently recorded commits')
+  query.add_argument('--since-days',
+                     type=float,
+                     default=0.0,
+                     help='only return the results recorded in the last days')
+  query.add_argument('--limit', type=int, default=0, help='the largest number of results')
+  changes = results_commands.add_parser('changes',
+                                        help='print the commits where the recorded metrics changed')
+  changes.add_argument('--db',
+                       dest='database',
+                       help='specify the results database. The default is the database of the '
+                       'job control document given with --job')
+  changes.add_argument('--test', default='', help='the test, or a pattern with "*"')
+  changes.add_argument('--metric',
+                       dest='metrics',
+                       action='append',
+                       help='a metric, or a pattern with "*". May be repeated')
+  changes.add_argument('--host-profile',
+                       default='',
+                       help='only analyze the results of this host configuration')
+  changes.add_argument('--penalty-factor',
+                       type=float,
+                       default=0.0,
+                       help='the cost of a change point, as a multiple of the noise variance')
+  changes.add_argument('--permutations',
+                       type=int,
+                       default=0,
+                       help='the number of permutations testing each change point')
+  changes.add_argument('--significance',
+                       type=float,
+                       default=0.0,
+                       help='the p-value below which a change point is reported')
+  percentiles = results_commands.add_parser(
+      'percentiles', help='print the percentiles of the runs matching all criteria, pooled')
+  percentiles.add_argument('--db',
+                           dest='database',
+                           help='specify the results database. The default is the database of the '
+                           'job control document given with --job')
+  percentiles.add_argument('--histogram',
+                           default='benchmark_http_client.latency_2xx',
+                           help='the NightHawk histogram. The default is the latency of the 2xx '
+                           'responses')
+  percentiles.add_argument('--test', default='', help='the test, or a pattern with "*"')
+  percentiles.add_argument('--commit',
+                           dest='commits',
+                           action='append',
+                           help='a commit hash or tag of the runs. May be repeated')
+  percentiles.add_argument('--host-profile',
+                           default='',
+                           help='only pool the runs of this host configuration')
+  percentiles.add_argument('--since-days',
+                           type=float,
+                           default=0.0,
+                           help='only pool the runs recorded in the last days')
+  percentiles.add_argument('--percentile',
+                           dest='percentiles',
+                           type=float,
+                           action='append',
+                           help='a percentile to print. May be repeated. The default is 50, 90, 99 '
+                           'and 99.9')
+  export = results_commands.add_parser(
+      'export', help='export the recorded results as OpenMetrics text or to remote-write')
+  export.add_argument('--db',
+                      dest='database',
+                      help='specify the results database. The default is the database of the '
+                      'job control document given with --job')
+  export.add_argument('--test', default='', help='the test, or a pattern with "*"')
+  export.add_argument('--metric', default='', help='the metric, or a pattern with "*"')
+  export.add_argument('--commit',
+                      dest='commits',
+                      action='append',
+                      help='a commit hash or tag of the results. May be repeated')
+  export.add_argument('--since-days',
+                      type=float,
+                      default=0.0,
+                      help='only export the results recorded in the last days')
+  export.add_argument('--output',
+                      default='',
+                      help='write the OpenMetrics text to this file instead of the standard output')
+  export.add_argument('--remote-write',
+                      dest='remote_write_url',
+                      default='',
+                      help='push the results to this Prometheus remote-write endpoint')
+  export.add_argument('--batch-size',
+                      type=int,
+                      default=0,
+                      help='the largest number of samples sent in one remote-write request')
+  compare = commands.add_parser('compare',
+                                help='compare the results of the tests of two output directories')
+  compare.add_argument('baseline_dir', help='the output directory of the baseline')
+  compare.add_argument('candidate_dir', help='the output directory of the candidate')
+  compare.add_argument('--metric',
+                       dest='metrics',
+                       action='append',
+                       help='a metric, or a pattern with "*". May be repeated')
+  compare.add_argument('--significance',
+                       type=float,
+                       default=tree_compare.DEFAULT_SIGNIFICANCE,
+                       help='the p-value, adjusted for the number of comparisons, below which a '
+                       'change is flagged')
+  compare.add_argument('--min-change',
+                       type=float,
+                       default=tree_compare.DEFAULT_MIN_CHANGE,
+                       help='the smallest relative change flagged, since a single run per '
+                       'directory does not measure the variation between runs')
+  compare.add_argument('--workers',
+                       type=int,
+                       default=0,
+                       help='the number of processes parsing the results. The default is the '
+                       'number of processors')
+  compare.add_argument('--csv', default='', help='also write the comparison to this CSV file')
+  compare.add_argument('--json', default='', help='also write the comparison to this JSON file')
+  serve = commands.add_parser('serve',
+                              help='run the jobs submitted over HTTP, keeping the source trees and '
+                              'the build cache warm between jobs')
+  serve.add_argument('--address',
+                     default=job_server.DEFAULT_ADDRESS,
+                     help='the address on which the server listens. The default only accepts '
+                     'local clients')
+  serve.add_argument('--port',
+                     type=int,
+                     default=job_server.DEFAULT_PORT,
+                     help='the port on which the server listens')
+  serve.add_argument('--cache-dir',
+                     default=os.path.join(os.getenv('SALVO_HOMEDIR', constants.SALVO_TMP),
+                                          'server'),
+                     help='the directory holding the build cache kept between jobs')
   # TODO: Add an option to generate a default job Control JSON/YAML
   return parser.parse_args()
 
 
+def write_trace(output_dir: str, wall_time: float) -> None:
+  """Write the phases recorded during the job and log the time spent in each.
+
+  Args:
+    output_dir: The output directory of the job. The trace is written to
+      a subdirectory of this location
+    wall_time: The duration of the job in seconds
+  """
+  trace_name = "salvo_trace_{timestamp}.json".format(timestamp=time.strftime('%Y%m%d_%H%M%S'))
+  trace.write_chrome_trace(os.path.join(output_dir, trace.TRACE_DIRECTORY, trace_name))
+
+  bar = '=' * 20
+  log.info(f"Time spent per phase:\n{bar}\n"
+           f"{trace.format_summary(trace.get_spans(), wall_time)}\n{bar}")
+
+
+def print_plan(job_control: proto_control.JobControl) -> int:
+  """Print the steps the job would perform without executing them.
+
+  Args:
+    job_control: The job control document to plan
+
+  Returns:
+    0 if the plan was determined, 1 otherwise
+  """
+  planner = execution_plan.ExecutionPlanner(job_control)
+  try:
+    plan = planner.create_plan()
+  except execution_plan.ExecutionPlanError as plan_error:
+    log.error(f"Unable to plan the job: {plan_error}")
+    return 1
+
+  print(execution_plan.format_plan(plan, planner.get_estimates()))
+  return 0
+
+
+def get_results_database(args: argparse.Namespace, job_control: proto_control.JobControl) -> str:
+  """Return the results database given on the command line, or that of the job control document.
+
+  Args:
+    args: The parsed "results" command line
+    job_control: The job control document given with "--job"
+
+  Returns:
+    the path of the database, or an empty string if it does not exist
+  """
+  database_path = args.database
+  if not database_path and args.jobcontrol:
+    database_path = results_db.get_database_path(job_control.results_database,
+                                                 job_control.environment.output_dir)
+
+  if not database_path or not os.path.exists(database_path):
+    log.error("No results database found. Use \"--db\" or \"--job\" to specify it")
+    return ''
+  return database_path
+
+
+def load_results_job(args: argparse.Namespace) -> Optional[proto_control.JobControl]:
+  """Load the job control document of a "results" command line.
+
+  Returns:
+    the document given with "--job", an empty document if none is given, or
+    None if it cannot be loaded
+  """
+  if not args.jobcontrol:
+    return proto_control.JobControl()
+
+  job_control = load_control_doc(args.jobcontrol)
+  if job_control is None:
+    log.error(f"Unable to load or parse job control: {args.jobcontrol}")
+  return job_control
+
+
+def query_results(args: argparse.Namespace) -> int:
+  """Print the recorded results matching the criteria of the command line.
+
+  Args:
+    args: The parsed "results query" command line
+
+  Returns:
+    0 if the results were queried, 1 otherwise
+  """
+  job_control = load_results_job(args)
+  if job_control is None:
+    return 1
+  database_path = get_results_database(args, job_control)
+  if not database_path:
+    return 1
+
+  since = time.time() - args.since_days * 86400 if args.since_days else 0.0
+  try:
+    with results_db.ResultsDatabase(database_path) as database:
+      results = database.query(test=args.test,
+                               metric=args.metric,
+                               commits=args.commits,
+                               last_commits=args.last_commits,
+                               since=since,
+                               limit=args.limit)
+  except results_db.ResultsDatabaseError as database_error:
+    log.error(str(database_error))
+    return 1
+
+  print(results_db.format_results(results))
+  return 0
+
+
+def detect_changes(args: argparse.Namespace) -> int:
+  """Print the commits where the recorded metrics changed.
+
+  The change point options of the job control document given with "--job"
+  are used, and overridden by those of the command line.
+
+  Args:
+    args: The parsed "results changes" command line
+
+  Returns:
+    0 if the history was analyzed, 1 otherwise
+  """
+  job_control = load_results_job(args)
+  if job_control is None:
+    return 1
+  database_path = get_results_database(args, job_control)
+  if not database_path:
+    return 1
+
+  options = proto_analysis.ChangePointOptions()
+  options.CopyFrom(job_control.change_points)
+  if args.metrics:
+    options.ClearField('metrics')
+    options.metrics.extend(args.metrics)
+  options.penalty_factor = args.penalty_factor or options.penalty_factor
+  options.permutations = args.permutations or options.permutations
+  options.significance = args.significance or options.significance
+
+  try:
+    with results_db.ResultsDatabase(database_path) as database:
+      detected = change_points.analyze_database(database, options, args.host_profile, args.test)
+  except results_db.ResultsDatabaseError as database_error:
+    log.error(str(database_error))
+    return 1
+
+  print(change_points.format_change_points(detected))
+  return 0
+
+
+def print_percentiles(args: argparse.Namespace) -> int:
+  """Print the percentiles of the runs matching the criteria of the command line, pooled.
+
+  The percentiles are computed from the sketches of the runs, so they are
+  within the relative accuracy of the sketches of the pooled samples.
+
+  Args:
+    args: The parsed "results percentiles" command line
+
+  Returns:
+    0 if the percentiles were computed, 1 otherwise
+  """
+  job_control = load_results_job(args)
+  if job_control is None:
+    return 1
+  database_path = get_results_database(args, job_control)
+  if not database_path:
+    return 1
+
+  since = time.time() - args.since_days * 86400 if args.since_days else 0.0
+  try:
+    with results_db.ResultsDatabase(database_path) as database:
+      sketch, runs = database.merge_sketches(args.histogram,
+                                             test=args.test,
+                                             commits=args.commits,
+                                             host_profile=args.host_profile,
+                                             since=since)
+  except results_db.ResultsDatabaseError as database_error:
+    log.error(str(database_error))
+    return 1
+
+  if not runs:
+    log.error(f"No recorded run matches the criteria for [{args.histogram}]")
+    return 1
+
+  print(f"{args.histogram}: {sketch.get_count():.0f} samples of {runs} test runs, "
+        f"mean {sketch.get_mean():g}s")
+  for percentile in args.percentiles or [50, 90, 99, 99.9]:
+    print(f"  p{percentile:<8g} {sketch.get_quantile(percentile / 100):g}s")
+  return 0
+
+
+def export_results(args: argparse.Namespace) -> int:
+  """Export the recorded results matching the criteria of the command line.
+
+  The results are written as OpenMetrics text, and pushed to the
+  remote-write endpoint of the command line or of the job control document
+  given with "--job", if any.
+
+  Args:
+    args: The parsed "results export" command line
+
+  Returns:
+    0 if the results were exported, 1 otherwise
+  """
+  job_control = load_results_job(args)
+  if job_control is None:
+    return 1
+  database_path = get_results_database(args, job_control)
+  if not database_path:
+    return 1
+
+  options = job_control.metrics_export
+  since = time.time() - args.since_days * 86400 if args.since_days else 0.0
+  try:
+    with results_db.ResultsDatabase(database_path) as database:
+      samples = metrics_export.samples_from_results(
+          database.query(test=args.test, metric=args.metric, commits=args.commits, since=since))
+
+    if args.output:
+      metrics_export.write_openmetrics(samples, args.output)
+    elif not args.remote_write_url:
+      print(metrics_export.format_openmetrics(samples), end='')
+
+    remote_write_url = args.remote_write_url or options.remote_write_url
+    if remote_write_url:
+      metrics_export.RemoteWriter(remote_write_url, args.batch_size or options.batch_size,
+                                  options.timeout_seconds).push(samples)
+  except (results_db.ResultsDatabaseError, metrics_export.MetricsExportError) as export_error:
+    log.error(str(export_error))
+    return 1
+  return 0
+
+
+def compare_trees(args: argparse.Namespace) -> int:
+  """Print the changes of the metrics of the tests found in two output directories.
+
+  Args:
+    args: The parsed "compare" command line
+
+  Returns:
+    0 if the directories were compared, 1 otherwise
+  """
+  try:
+    baseline, candidate = tree_compare.load_trees(args.baseline_dir, args.candidate_dir,
+                                                  args.workers)
+    unmatched = {
+        args.baseline_dir: sorted(set(baseline) - set(candidate)),
+        args.candidate_dir: sorted(set(candidate) - set(baseline)),
+    }
+    for output_dir, tests in unmatched.items():
+      if tests:
+        log.warning(f"{len(tests)} tests are only found in [{output_dir}]")
+    if not set(baseline) & set(candidate):
+      log.error("The output directories have no test in common")
+      return 1
+
+    deltas = tree_compare.compare_trees(baseline, candidate, args.metrics, args.significance,
+                                        args.min_change)
+    if args.csv:
+      tree_compare.write_csv(deltas, args.csv)
+    if args.json:
+      tree_compare.write_json(deltas, args.json, unmatched)
+  except tree_compare.TreeCompareError as compare_error:
+    log.error(str(compare_error))
+    return 1
+
+  print(tree_compare.format_deltas(deltas))
+  return 0
+
+
+def run_job(job_control: proto_control.JobControl,
+            source_cache: Optional[source_manager.SourceCache] = None) -> int:
+  """Execute the benchmark given the contents of the job control document.
+
+  The trace and the run manifest are written even if the job fails, since
+  the time and resources spent before the failure are still of interest.
+
+  Args:
+    job_control: The job control document to execute
+    source_cache: The source trees and build cache kept between the jobs of
+      a Salvo server, if any
+
+  Returns:
+    0 if every benchmark completed, 1 otherwise
+  """
+  # The phases and the usage of an earlier job run by a server are not
+  # part of this job
+  trace.reset()
+  cost_accounting.reset()
+  if source_cache:
+    source_cache.start_job()
+
+  start = time.perf_counter()
+  try:
+    with trace.span('salvo'):
+      benchmark = run_benchmark.BenchmarkRunner(job_control, source_cache)
+      benchmark.execute()
+  finally:
+    wall_time = time.perf_counter() - start
+    write_trace(job_control.environment.output_dir, wall_time)
+    cost_accounting.write_manifest(job_control.environment.output_dir, wall_time)
+
+  if benchmark.get_failures():
+    log.error(f"{len(benchmark.get_failures())} benchmarks were aborted")
+    return 1
+  return 0
+
+
+def serve_jobs(args: argparse.Namespace) -> int:
+  """Run the jobs submitted over HTTP until interrupted.
+
+  The source trees, the build cache and the docker client are kept between
+  jobs, so that only the first job fetches and builds from scratch.
+
+  Args:
+    args: The parsed "serve" command line
+
+  Returns:
+    0 once the server is interrupted
+  """
+  source_cache = source_manager.SourceCache(args.cache_dir)
+  docker_image.share_client()
+  job_queue = job_server.JobQueue(functools.partial(run_job, source_cache=source_cache))
+  server = job_server.JobServer(job_queue, args.address, args.port)
+  log.info(f"Accepting jobs on http://{args.address}:{server.get_port()}/jobs")
+
+  job_queue.start()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    log.info("Stopping once the running job is finished")
+  finally:
+    server.server_close()
+    job_queue.stop()
+  return 0
+
+
 def main() -> int:
   """Driver module for benchmark.
 
@@ -53,6 +546,22 @@ def main() -> int:
   args = setup_options()
   setup_logging()
 
+  if args.command == 'results':
+    if args.results_command == 'query':
+      return query_results(args)
+    if args.results_command == 'changes':
+      return detect_changes(args)
+    if args.results_command == 'percentiles':
+      return print_percentiles(args)
+    if args.results_command == 'export':
+      return export_results(args)
+    print("No results command specified.  Use \"results --help\" for usage")
+    return 1
+  if args.command == 'compare':
+    return compare_trees(args)
+  if args.command == 'serve':
+    return serve_jobs(args)
+
   if not args.jobcontrol:
     print("No job control document specified.  Use \"--help\" for usage")
     return 1
@@ -65,11 +574,10 @@ def main() -> int:
   bar = '=' * 20
   log.debug(f"Job definition:\n{bar}\n{job_control}\n{bar}\n")
 
-  # Execute the benchmark given the contents of the job control file
-  benchmark = run_benchmark.BenchmarkRunner(job_control)
-  benchmark.execute()
+  if args.plan:
+    return print_plan(job_control)
 
-  return 0
+  return run_job(job_control)
 
 
 if __name__ == '__main__':
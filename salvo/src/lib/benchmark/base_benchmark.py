@@ -1,10 +1,13 @@
 """Base Benchmark object module that contains common methods for all benchmarks."""
 import abc
-import os
 import logging
-from typing import List, Union
+import subprocess
+from typing import Dict, List, Optional, Union
 
-from src.lib.docker_management import (docker_image, docker_volume)
+from src.lib import (cmd_exec, execution_context, source_manager)
+from src.lib.common import (resource_limits, watchdog)
+from src.lib.docker_management import (container_pool, docker_image, docker_volume)
+from src.lib.profiling import (cpu_profiler, heap_profiler)
 import api.control_pb2 as proto_control
 import api.image_pb2 as proto_image
 import api.source_pb2 as proto_source
@@ -12,7 +15,7 @@ import api.env_pb2 as proto_env
 
 log = logging.getLogger(__name__)
 
-_VARIABLES_TO_CLEAR_AND_RESTORE = [
+_VARIABLES_TO_CLEAR = [
     'RUNFILES_MANIFEST_FILE'  # This variable is set by the outer bazel
     # invocation and negatively impacts invoking
     # bazel to run the scavenging benchmark
@@ -38,16 +41,33 @@ class BenchmarkError(Exception):
   """Errror raised in a benchmark for an unresolvable condition."""
 
 
+class BenchmarkAborted(BenchmarkError):
+  """Error raised when a benchmark is stopped because its results are unusable.
+
+  The runner records the failure and proceeds with the next benchmark.
+  """
+
+  def __init__(self, reason: watchdog.FailureReason) -> None:
+    """Initialize the error with the reason the benchmark was stopped."""
+    super(BenchmarkAborted, self).__init__(reason.message)
+    self.reason = reason
+
+
 class BaseBenchmark(abc.ABC):
   """Base Benchmark class with common functions for all invocations."""
 
-  def __init__(self, job_control: proto_control.JobControl, benchmark_name: str) -> None:
+  def __init__(self,
+               job_control: proto_control.JobControl,
+               benchmark_name: str,
+               source_cache: Optional[source_manager.SourceCache] = None) -> None:
     """Initialize the Base Benchmark class.
 
     Args:
         job_control: The protobuf object containing the parameters and locations
           of benchmark artifacts
         benchmark_name: The name of the benchmark to execute
+        source_cache: The source trees and build cache kept between jobs, if
+          any
 
     Raises:
         BaseBenchmarkError: if no job control object is specified
@@ -58,6 +78,7 @@ class BaseBenchmark(abc.ABC):
     self._docker_image = docker_image.DockerImage()
     self._control = job_control
     self._benchmark_name = benchmark_name
+    self._source_cache = source_cache
 
     self._mode_remote = self._control.remote
     self._build_envoy = False
@@ -74,6 +95,149 @@ class BaseBenchmark(abc.ABC):
     """Return the name of the envoy image being tested."""
     return self._control.images.envoy_image
 
+  def get_output_dir(self) -> str:
+    """Return the directory where the artifacts of this benchmark are placed."""
+    return self._control.environment.output_dir
+
+  def _create_container_pool(self) -> container_pool.ContainerPool:
+    """Create the pool of warm containers configured in the job control document.
+
+    The pool also applies the resource limits of the Envoy under test to the
+    containers of the Envoy image.
+
+    Returns:
+      a ContainerPool object serving the containers started by the harness
+
+    Raises:
+      BenchmarkError: if the resource limits are invalid
+    """
+    try:
+      limits = resource_limits.get_docker_arguments(self._control.environment.envoy_limits)
+    except resource_limits.ResourceLimitsError as limits_error:
+      raise BenchmarkError(str(limits_error))
+
+    return container_pool.ContainerPool(self._control.images.pool_containers, self._docker_image,
+                                        self.get_output_dir(), self.get_image(), limits)
+
+  def _create_throttling_monitor(self) -> resource_limits.ThrottlingMonitor:
+    """Create the monitor sampling the cgroups of the Envoy containers.
+
+    Returns:
+      a ThrottlingMonitor object, which is inactive unless Envoy has
+        resource limits
+    """
+
+    def get_cgroups():
+      return resource_limits.get_process_cgroups(
+          self._docker_image.get_container_pids(self.get_image()))
+
+    return resource_limits.ThrottlingMonitor(self._control.environment.envoy_limits, get_cgroups,
+                                             self.get_output_dir())
+
+  def _create_cpu_profiler(self, allow_gperftools: bool) -> cpu_profiler.CpuProfiler:
+    """Create the CPU profiler configured in the job control document.
+
+    Args:
+      allow_gperftools: Whether the benchmark can pass the gperftools
+        environment to the Envoy process under test. Heap profiling relies
+        on gperftools as well
+
+    Returns:
+      a CpuProfiler object capturing profiles into the output directory
+
+    Raises:
+      BenchmarkError: if gperftools is requested for a benchmark that does
+        not support it
+    """
+    profiler = cpu_profiler.CpuProfiler(self._control.profiling, self.get_output_dir())
+    if profiler.uses_gperftools() and not allow_gperftools:
+      raise BenchmarkError(f"gperftools CPU profiling is not supported by the "
+                           f"{self._benchmark_name}. Use perf instead")
+    if self._control.profiling.heap_profile and not allow_gperftools:
+      raise BenchmarkError(f"Heap profiling is not supported by the {self._benchmark_name}")
+    return profiler
+
+  def _collect_cpu_profile(self,
+                           profiler: cpu_profiler.CpuProfiler,
+                           envoy_binary: str = '') -> None:
+    """Write the folded stacks captured for this benchmark.
+
+    A failure to process the profile is logged, but does not fail the
+    benchmark whose results are already available.
+
+    Args:
+      profiler: The profiler that was active while the benchmark executed
+      envoy_binary: The path to the Envoy binary under test, if known
+    """
+    try:
+      profiler.collect(envoy_binary)
+    except (cpu_profiler.CpuProfilerError, subprocess.CalledProcessError) as profile_error:
+      log.error(f"Unable to collect the CPU profile: {profile_error}")
+
+  def _create_heap_profiler(self) -> heap_profiler.HeapProfiler:
+    """Create the heap profiler configured in the job control document.
+
+    Returns:
+      a HeapProfiler object capturing profiles into the output directory
+    """
+    return heap_profiler.HeapProfiler(self._control.profiling, self.get_output_dir())
+
+  def _collect_heap_profile(self, profiler: heap_profiler.HeapProfiler, envoy_binary: str) -> None:
+    """Summarize the heap profiles captured for this benchmark.
+
+    As with CPU profiles, a failure to process the heap profiles is logged
+    and does not fail the benchmark.
+
+    Args:
+      profiler: The profiler whose wrapper started Envoy
+      envoy_binary: The path to the Envoy binary under test
+    """
+    try:
+      profiler.collect(envoy_binary)
+    except (heap_profiler.HeapProfilerError, subprocess.CalledProcessError) as profile_error:
+      log.error(f"Unable to collect the heap profile: {profile_error}")
+
+  def _create_watchdog(self) -> watchdog.Watchdog:
+    """Create the watchdog configured in the job control document.
+
+    Returns:
+      a Watchdog object, which never aborts the benchmark if disabled
+    """
+    return watchdog.Watchdog(self._control.watchdog)
+
+  def _abort(self, reason: watchdog.FailureReason) -> BenchmarkAborted:
+    """Record why the benchmark failed in its output directory.
+
+    Args:
+      reason: The reason of the failure
+
+    Returns:
+      the error to be raised by the benchmark
+    """
+    report_path = watchdog.write_failure_report(self.get_output_dir(), reason)
+    log.error(f"{self._benchmark_name} failed: {reason.message}. See {report_path}")
+    return BenchmarkAborted(reason)
+
+  def _run_command(self, run_watchdog: watchdog.Watchdog, cmd: str,
+                   cmd_params: cmd_exec.CommandParameters) -> str:
+    """Run a benchmark command, following its output with the watchdog if enabled.
+
+    Args:
+      run_watchdog: The watchdog of the benchmark
+      cmd: The command to be executed
+      cmd_params: The parameters of the command
+
+    Returns:
+      the output produced by the command
+
+    Raises:
+      WatchdogAbort: if the watchdog aborts the command
+      subprocess.CalledProcessError: if the command fails
+    """
+    if run_watchdog.is_enabled():
+      return run_watchdog.run_command(cmd, cmd_params)
+    return cmd_exec.run_command(cmd, cmd_params)
+
   def _verify_sources(self, images: proto_image.DockerImages) -> None:
     """Validate that sources are available to build a missing image.
 
@@ -145,20 +309,34 @@ class BaseBenchmark(abc.ABC):
     """
     return self._control.source
 
-  def run_image(self, image_name: str,
-                run_parameters: docker_image.DockerRunParameters) -> Union[bytearray, None]:
+  def run_image(self,
+                image_name: str,
+                run_parameters: docker_image.DockerRunParameters,
+                run_watchdog: Optional[watchdog.Watchdog] = None) -> Union[bytearray, None]:
     """Run the specified docker image with the supplied keyword arguments.
 
     Args:
         image_name: The docker image to be executed
         run_paramters: a namedtuple of parameters supplied to an image for
           execution
+        run_watchdog: An optional watchdog following the output of the
+          container
 
     Returns:
         A bytearray containing the output produced from executing the specified
         container
+
+    Raises:
+        BenchmarkAborted: if the container fails or the watchdog aborts it
     """
-    return self._docker_image.run_image(image_name, run_parameters)
+    try:
+      return self._docker_image.run_image(image_name, run_parameters, run_watchdog)
+    except watchdog.WatchdogAbort as abort:
+      raise self._abort(abort.reason)
+    except docker_image.DockerRunError as run_error:
+      raise self._abort(
+          watchdog.FailureReason(watchdog.SIGNAL_EXIT_STATUS, run_error.exit_status, 0,
+                                 watchdog.SOURCE_CONTAINER, str(run_error)))
 
   @abc.abstractmethod
   def execute_benchmark(self) -> None:
@@ -194,77 +372,76 @@ class BenchmarkEnvironmentError(Exception):
 
 
 class BenchmarkEnvController():
-  """Benchmark Environment Controller context class."""
+  """Benchmark Environment Controller context class.
+
+  The controller derives the execution context of a benchmark from the
+  environment variables of the control document, without changing the
+  environment of Salvo, so that benchmarks can run concurrently.
+  """
 
-  def __init__(self, environment: proto_env.EnvironmentVars) -> None:
-    """Initialize the environment controller with the environment object."""
+  def __init__(self,
+               environment: proto_env.EnvironmentVars,
+               context: Optional[execution_context.ExecutionContext] = None) -> None:
+    """Initialize the environment controller with the environment object.
+
+    Args:
+      environment: The environment variables of the control document
+      context: The context from which the context of the benchmark is
+        derived. The default is the environment of Salvo
+    """
     self._environment = environment
-    self._preserved_vars = {}
+    self._context = context
 
-  def _set_environment_vars(self) -> None:
+  def get_variables(self) -> Dict[str, str]:
     """Build the environment variable map used to launch an image.
 
     Set the Envoy IP test versions and any other environment variables needed
-    by the test. This method is called before we execute the docker image so
-    that the image has all variables it needs for a given benchmark.
+    by the test, so that the image has all variables it needs for a given
+    benchmark.
+
+    Returns:
+      the variables of the benchmark
 
     Raises:
       BenchmarkEnvironmentError: if a required environment variable is
         unspecified
     """
-    self._clear_environment_vars()
-
     environment = self._environment
+    variables = {}
 
     if environment.test_version == environment.IPV_UNSPECIFIED:
       raise BenchmarkEnvironmentError("No IP version is specified for the benchmark")
     elif environment.test_version == environment.IPV_V4ONLY:
-      os.environ['ENVOY_IP_TEST_VERSIONS'] = 'v4only'
+      variables['ENVOY_IP_TEST_VERSIONS'] = 'v4only'
     elif environment.test_version == environment.IPV_V6ONLY:
-      os.environ['ENVOY_IP_TEST_VERSIONS'] = 'v6only'
+      variables['ENVOY_IP_TEST_VERSIONS'] = 'v6only'
 
     if environment.envoy_path:
       log.debug(f"Setting ENVOY_PATH={environment.envoy_path}")
-      os.environ['ENVOY_PATH'] = environment.envoy_path
+      variables['ENVOY_PATH'] = environment.envoy_path
 
     for key, value in environment.variables.items():
       log.debug(f"Setting environment {key}={value}")
-      os.environ[key] = value
-
-  def _preserve_and_clear_special_vars(self) -> None:
-    """Store the name and value for any special variables."""
-    for variable in _VARIABLES_TO_CLEAR_AND_RESTORE:
-      if variable in os.environ:
-        self._preserved_vars[variable] = os.environ[variable]
-        del os.environ[variable]
-
-  def _restore_special_vars(self):
-    """Restore any saved environment variables."""
-    for key, value in self._preserved_vars.items():
-      os.environ[key] = value
-
-  def _clear_environment_vars(self) -> None:
-    """Clear any environment variables in the job control document so that we do not influence \
-      additionally executing tests."""
-    environment = self._environment
+      variables[key] = value
+
+    return variables
 
-    # Check that the key exists before deleting it to prevent KeyErrors
-    if 'ENVOY_IP_TEST_VERSIONS' in os.environ:
-      del os.environ['ENVOY_IP_TEST_VERSIONS']
+  def get_context(self) -> execution_context.ExecutionContext:
+    """Return the execution context of the benchmark.
 
-    if 'ENVOY_PATH' in os.environ:
-      del os.environ['ENVOY_PATH']
+    Special variables set by an outer bazel invocation are removed from the
+    environment, and the variables of the benchmark added to it.
 
-    for key, _ in environment.variables.items():
-      if key in os.environ:
-        del os.environ[key]
+    Raises:
+      BenchmarkEnvironmentError: if a required environment variable is
+        unspecified
+    """
+    context = self._context or execution_context.from_process()
+    return context.without_variables(_VARIABLES_TO_CLEAR).with_variables(self.get_variables())
 
-  def __enter__(self):
-    """Set the environment variables specified in the control document."""
-    self._preserve_and_clear_special_vars()
-    self._set_environment_vars()
+  def __enter__(self) -> execution_context.ExecutionContext:
+    """Return the execution context with the environment variables of the control document."""
+    return self.get_context()
 
   def __exit__(self, type_param, value, traceback):
-    """Clear any environment variables specified in the control document."""
-    self._clear_environment_vars()
-    self._restore_special_vars()
+    """Leave the environment of Salvo unchanged."""
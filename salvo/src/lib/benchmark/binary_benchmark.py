@@ -3,19 +3,41 @@
 
 https://github.com/envoyproxy/nighthawk/blob/master/benchmarks/README.md
 """
+import functools
 import subprocess
 import logging
 import os
+import shlex
+from typing import (Dict, List, Optional)
 
 import api.control_pb2 as proto_control
+import api.env_pb2 as proto_env
 import api.source_pb2 as proto_source
 
-from src.lib.benchmark import base_benchmark
+from src.lib.benchmark import (base_benchmark, sharding)
 from src.lib.builder import (envoy_builder, nighthawk_builder)
-from src.lib import (cmd_exec, source_manager)
+from src.lib.common import (cgroup, resource_limits, trace, watchdog)
+from src.lib import (cmd_exec, execution_context, source_manager)
 
 log = logging.getLogger(__name__)
 
+# The options with which the benchmarks are compiled
+_BENCHMARK_BUILD_OPTIONS = ("--compilation_mode=opt "
+                            "--cxxopt=-g "
+                            "--cxxopt=-ggdb3 "
+                            "--define tcmalloc=gperftools ")
+
+# The environment of the benchmark tests
+_BENCHMARK_TEST_ENVIRONMENT = {
+    'ENVOY_IP_TEST_VERSIONS': 'v4only',
+    'HEAPPROFILE': '',
+    'HEAPCHECK': '',
+}
+
+# The directory below the output directory receiving the script starting
+# Envoy in its cgroup
+_ENVOY_LIMITS_DIRECTORY = 'envoy_limits'
+
 
 class BinaryBenchmarkError(Exception):
   """Error raised when running a binary benchmark in cases where we cannot make progress due to \
@@ -26,20 +48,26 @@ class Benchmark(base_benchmark.BaseBenchmark):
   """This benchmark class is the binary benchmark. We use a path to an Envoy binary to execute the \
     Nighthawk benchmarks using that specific build."""
 
-  def __init__(self, job_control: proto_control.JobControl, benchmark_name: str) -> None:
+  def __init__(self,
+               job_control: proto_control.JobControl,
+               benchmark_name: str,
+               source_cache: Optional[source_manager.SourceCache] = None) -> None:
     """Initialize the benchmark class.
 
     Args:
         job_control: The protobuf object containing the parameters and locations
           of benchmark artifacts
         benchmark_name: The name of the benchmark to execute
+        source_cache: The source trees and build cache kept between jobs, if
+          any
     """
-    super(Benchmark, self).__init__(job_control, benchmark_name)
+    super(Benchmark, self).__init__(job_control, benchmark_name, source_cache)
     self._benchmark_dir = None
     self._envoy_binary_path = job_control.environment.variables['ENVOY_PATH']
     self._envoy_builder = None
     self._nighthawk_builder = None
-    self._source_manager = source_manager.SourceManager(job_control)
+    self._prepared = False
+    self._source_manager = source_manager.SourceManager(job_control, source_cache)
 
   def get_image(self) -> str:
     """Return the commit hash string for the Envoy version being tested.
@@ -124,32 +152,54 @@ class Benchmark(base_benchmark.BaseBenchmark):
     self._envoy_builder = envoy_builder.EnvoyBuilder(self._source_manager)
     self._envoy_binary_path = self._envoy_builder.build_envoy_binary_from_source()
 
+  def prepare_benchmark(self) -> None:
+    """Build Nighthawk and Envoy for the benchmark.
+
+    The pipeline invokes this while an earlier benchmark executes. Otherwise
+    the artifacts are built when the benchmark is executed.
+    """
+    self._validate()
+    self._prepare_nighthawk()
+    self._prepare_envoy()
+    self._prepared = True
+
+  @trace.traced('BinaryBenchmark.execute_benchmark')
   def execute_benchmark(self) -> None:
     """Execute the binary benchmark.
 
     Uses either the Envoy specified in ENVOY_PATH, or one built from a
     specified source.
+
+    Raises:
+      BenchmarkAborted: if the watchdog aborts the benchmark
     """
     self._validate()
-    self._prepare_nighthawk()
-    self._prepare_envoy()
+    profiler = self._create_cpu_profiler(allow_gperftools=True)
+    heap_profiler = self._create_heap_profiler()
+    run_watchdog = self._create_watchdog()
+    if not self._prepared:
+      self.prepare_benchmark()
+
+    test_environment = dict(_BENCHMARK_TEST_ENVIRONMENT)
+    selection = self._control.test_selection
+    selection_args = sharding.get_selection_arguments(selection)
 
     # todo: refactor args, have frontend specify them via protobuf
     cmd = ("bazel test "
            "--test_summary=detailed "
            "--test_output=all "
-           "--test_arg=--log-cli-level=info "
-           "--test_env=ENVOY_IP_TEST_VERSIONS=v4only "
-           "--test_env=HEAPPROFILE= "
-           "--test_env=HEAPCHECK= "
-           "--cache_test_results=no "
-           "--compilation_mode=opt "
-           "--cxxopt=-g "
-           "--cxxopt=-ggdb3 "
-           "--define tcmalloc=gperftools "
-           "//benchmarks:* ")
-
-    cmd_params = cmd_exec.CommandParameters(cwd=self._benchmark_dir)
+           "--test_arg=--log-cli-level=info ")
+
+    for (key, value) in test_environment.items():
+      cmd += f"--test_env={key}={value} "
+
+    cmd += "--cache_test_results=no "
+    cmd += _BENCHMARK_BUILD_OPTIONS
+
+    for arg in selection_args:
+      cmd += f"--test_arg={shlex.quote(arg)} "
+
+    cmd += "//benchmarks:* "
 
     # pull in environment and set values
     env = self._control.environment
@@ -167,10 +217,136 @@ class Benchmark(base_benchmark.BaseBenchmark):
         log.debug(f"Building control environment variables: {key}={value}")
         env.variables[key] = value
 
-    environment_controller = base_benchmark.BenchmarkEnvController(env)
+    # CPUPROFILE and HEAPPROFILE remain empty for the benchmark so that only
+    # Envoy, started through the wrappers, writes profiles. The wrappers exec
+    # one another, so the profiles of a process share its id
+    envoy_path = self._envoy_binary_path
+    if profiler.uses_gperftools():
+      envoy_path = profiler.create_envoy_wrapper(envoy_path)
+    if heap_profiler.is_enabled():
+      envoy_path = heap_profiler.create_envoy_wrapper(envoy_path)
+    if envoy_path != self._envoy_binary_path:
+      env.variables['ENVOY_PATH'] = envoy_path
+
+    envoy_cgroup = self._create_envoy_cgroup(env)
+    throttling_monitor = resource_limits.ThrottlingMonitor(
+        env.envoy_limits, lambda: {'envoy': envoy_cgroup.get_path()}, env.output_dir)
+
+    # The benchmark is run by bazel in the NightHawk tree, with the HOME and
+    # compiler of the NightHawk build so that its output base is reused
+    environment_controller = base_benchmark.BenchmarkEnvController(
+        env, self._nighthawk_builder.get_context())
+
+    try:
+      with environment_controller as context, profiler, run_watchdog, throttling_monitor:
+        try:
+          if sharding.is_sharded(selection):
+            self._execute_shards(selection_args, test_environment, run_watchdog, context)
+          else:
+            self._run_command(run_watchdog, cmd,
+                              context.get_command_parameters(self._benchmark_dir))
+        except watchdog.WatchdogAbort as abort:
+          raise self._abort(abort.reason)
+        except subprocess.CalledProcessError as cpe:
+          log.error(f"Unable to execute the benchmark: {cpe}")
+        except sharding.ShardingError as sharding_error:
+          if run_watchdog.get_failure():
+            raise self._abort(run_watchdog.get_failure())
+          log.error(f"Unable to execute the benchmark: {sharding_error}")
+    finally:
+      if envoy_cgroup:
+        self._remove_envoy_cgroup(envoy_cgroup)
+
+    self._collect_cpu_profile(profiler, self._envoy_binary_path)
+    self._collect_heap_profile(heap_profiler, self._envoy_binary_path)
+
+  def _create_envoy_cgroup(self, env: proto_env.EnvironmentVars) -> Optional[cgroup.Cgroup]:
+    """Start Envoy in a cgroup enforcing its resource limits, if any are configured.
+
+    ENVOY_PATH is replaced with a script moving Envoy into the cgroup.
+
+    Args:
+      env: The environment of the benchmark
+
+    Returns:
+      the cgroup limiting Envoy, or None if Envoy has no resource limits
+
+    Raises:
+      BenchmarkError: if the cgroup cannot be created
+    """
+    if not resource_limits.is_limited(env.envoy_limits):
+      return None
+
+    try:
+      envoy_cgroup = resource_limits.create_limited_cgroup(env.envoy_limits,
+                                                           f"salvo_envoy_{os.getpid()}")
+    except resource_limits.ResourceLimitsError as limits_error:
+      raise base_benchmark.BenchmarkError(str(limits_error))
+
+    env.variables['ENVOY_PATH'] = resource_limits.create_cgroup_wrapper(
+        envoy_cgroup, env.variables.get('ENVOY_PATH', self._envoy_binary_path),
+        os.path.join(env.output_dir, _ENVOY_LIMITS_DIRECTORY))
+    return envoy_cgroup
+
+  def _remove_envoy_cgroup(self, envoy_cgroup: cgroup.Cgroup) -> None:
+    """Remove the cgroup limiting Envoy, killing any Envoy left running."""
+    try:
+      envoy_cgroup.kill()
+      envoy_cgroup.remove()
+    except cgroup.CgroupError as cgroup_error:
+      log.warning(f"Unable to remove the Envoy cgroup: {cgroup_error}")
+
+  def _execute_shards(self, selection_args: List[str], test_environment: Dict[str, str],
+                      run_watchdog: watchdog.Watchdog,
+                      context: execution_context.ExecutionContext) -> None:
+    """Execute the selected tests in shards running in parallel on the host.
+
+    "bazel test" executes one command at a time in a workspace, so the
+    benchmarks are compiled with the options of the test command and
+    executed directly by each shard.
+
+    Args:
+      selection_args: The arguments selecting the tests
+      test_environment: The variables set for the tests
+      run_watchdog: The watchdog following the output of all shards
+      context: The execution context of the benchmark
+
+    Raises:
+      subprocess.CalledProcessError: if the benchmarks cannot be compiled
+        or the tests cannot be collected
+      ShardingError: if the tests cannot be sharded or a shard fails
+    """
+    cmd_params = context.get_command_parameters(self._benchmark_dir)
+    cmd_exec.run_command(f"bazel build {_BENCHMARK_BUILD_OPTIONS}//benchmarks:benchmarks",
+                         cmd_params)
+
+    command = ['bazel-bin/benchmarks/benchmarks']
+    collect_cmd = ' '.join(
+        map(shlex.quote, command + sharding.COLLECT_ARGUMENTS + selection_args + ['benchmarks/']))
+    tests = sharding.parse_collected_tests(cmd_exec.run_command(collect_cmd, cmd_params))
+
+    output_dir = self.get_output_dir()
+    shards = sharding.plan_shards(tests, self._control.test_selection, output_dir)
+    sharding.run_shards(
+        shards,
+        functools.partial(self._execute_shard, command + ['--log-cli-level=info'], test_environment,
+                          run_watchdog, context), output_dir)
+
+  def _execute_shard(self, command: List[str], test_environment: Dict[str, str],
+                     run_watchdog: watchdog.Watchdog, context: execution_context.ExecutionContext,
+                     shard: sharding.Shard) -> None:
+    """Execute the tests of one shard on its CPUs.
 
-    with environment_controller:
-      try:
-        cmd_exec.run_command(cmd, cmd_params)
-      except subprocess.CalledProcessError as cpe:
-        log.error(f"Unable to execute the benchmark: {cpe}")
+    Args:
+      command: The benchmark command without test selection arguments
+      test_environment: The variables set for the tests
+      run_watchdog: The watchdog following the output of all shards
+      context: The execution context of the benchmark
+      shard: The shard to execute
+    """
+    environment = dict(test_environment, TMPDIR=shard.output_dir)
+    cmd = sharding.get_host_command(command, shard, environment)
+    shard_context = context.with_cpus(shard.cpus)
+    with shard_context.placement():
+      self._run_command(run_watchdog, cmd,
+                        shard_context.get_command_parameters(self._benchmark_dir))
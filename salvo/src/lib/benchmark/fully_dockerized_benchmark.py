@@ -3,11 +3,15 @@
 
 https://github.com/envoyproxy/nighthawk/blob/master/benchmarks/README.md
 """
+import functools
 import logging
+from typing import (List, Optional, Union)
 
 import api.control_pb2 as proto_control
-from src.lib.benchmark import base_benchmark
-from src.lib.docker_management import docker_image
+from src.lib.benchmark import (base_benchmark, sharding)
+from src.lib.common import (cgroup, trace, watchdog)
+from src.lib.docker_management import (container_pool, docker_image)
+from src.lib import source_manager
 
 log = logging.getLogger(__name__)
 
@@ -21,9 +25,12 @@ class Benchmark(base_benchmark.BaseBenchmark):
   """This benchmark class is the fully dockerized benchmark. Docker images containing the benchmark\
     scripts, binaries, and envoy are used to execute the tests."""
 
-  def __init__(self, job_control: proto_control.JobControl, benchmark_name: str) -> None:
+  def __init__(self,
+               job_control: proto_control.JobControl,
+               benchmark_name: str,
+               source_cache: Optional[source_manager.SourceCache] = None) -> None:
     """Initialize the benchmark class."""
-    super(Benchmark, self).__init__(job_control, benchmark_name)
+    super(Benchmark, self).__init__(job_control, benchmark_name, source_cache)
 
   def _validate(self) -> None:
     """Validate that all data required for running a benchmark exists.
@@ -49,6 +56,7 @@ class Benchmark(base_benchmark.BaseBenchmark):
     if verify_source:
       self._verify_sources(images)
 
+  @trace.traced('FullyDockerizedBenchmark.execute_benchmark')
   def execute_benchmark(self) -> None:
     """Prepare input artifacts and run the benchmark.
 
@@ -68,6 +76,11 @@ class Benchmark(base_benchmark.BaseBenchmark):
     if self.is_remote():
       raise NotImplementedError("Local benchmarks only for the moment")
 
+    profiler = self._create_cpu_profiler(allow_gperftools=False)
+    pool = self._create_container_pool()
+    run_watchdog = self._create_watchdog()
+    throttling_monitor = self._create_throttling_monitor()
+
     # pull in environment and set values
     output_dir = self._control.environment.output_dir
     test_dir = self._control.environment.test_dir
@@ -80,15 +93,22 @@ class Benchmark(base_benchmark.BaseBenchmark):
         'ENVOY_DOCKER_IMAGE_TO_TEST': images.envoy_image,
         'TMPDIR': output_dir
     }
+    image_vars.update(pool.get_environment())
+
+    # The container receives the variables of the control document instead
+    # of the environment of Salvo
+    environment_controller = base_benchmark.BenchmarkEnvController(self._control.environment)
+    image_vars = dict(environment_controller.get_variables(), **image_vars)
     log.debug(f"Using environment: {image_vars}")
 
     volumes = base_benchmark.get_docker_volumes(output_dir, test_dir)
     log.debug(f"Using Volumes: {volumes}")
 
-    environment_controller = base_benchmark.BenchmarkEnvController(self._control.environment)
+    selection = self._control.test_selection
+    command = ['./benchmarks', '--log-cli-level=info', '-vvvv']
 
     run_parameters = docker_image.DockerRunParameters(
-        command=['./benchmarks', '--log-cli-level=info', '-vvvv'],
+        command=pool.wrap_command(command + sharding.get_selection_arguments(selection)),
         environment=image_vars,
         volumes=volumes,
         network_mode='host',
@@ -98,19 +118,111 @@ class Benchmark(base_benchmark.BaseBenchmark):
     # invocation issues. This may help with the escaping that we see happening
     # on an successful invocation
 
-    with environment_controller:
-      result = self.run_image(images.nighthawk_benchmark_image, run_parameters)
-
-    # FIXME: result needs to be unescaped. We don't use this data and the same
-    # content is available in the nighthawk-human.txt file.
-    if result is not None:
-      log.debug(f"Output: {len(result)} bytes")
+    with profiler, pool, run_watchdog, throttling_monitor:
+      if sharding.is_sharded(selection):
+        self._execute_shards(command, run_parameters, pool, run_watchdog)
+      else:
+        result = self.run_image(images.nighthawk_benchmark_image, run_parameters, run_watchdog)
+        _check_result(result)
 
     log.info(f"Benchmark output: {output_dir}")
 
-    # Establishing success here requires that we examine the output produced by
-    # NightHawk. If the latency output exists we can be relatively certain that
-    # all containers were able to run and execute the specified tests
-    if result is None or ("benchmark_http_client" not in result.decode('utf-8')):
-      raise base_benchmark.BenchmarkError(
-          "Unable to assert that the benchmark executed successfully")
+    self._collect_cpu_profile(profiler)
+
+  def _execute_shards(self, command: List[str], run_parameters: docker_image.DockerRunParameters,
+                      pool: container_pool.ContainerPool, run_watchdog: watchdog.Watchdog) -> None:
+    """Execute the selected tests in shards, each in its own benchmark container.
+
+    Args:
+      command: The benchmark command without test selection arguments
+      run_parameters: The parameters of an unsharded run
+      pool: The container pool serving the containers started by the harness
+      run_watchdog: The watchdog following the output of all shards
+
+    Raises:
+      BenchmarkAborted: if the watchdog aborts the shards or a shard container
+        fails
+      BenchmarkError: if the tests cannot be collected or a shard fails
+    """
+    selection = self._control.test_selection
+    image = self.get_images().nighthawk_benchmark_image
+    output_dir = self.get_output_dir()
+
+    collect_parameters = run_parameters._replace(command=command + sharding.COLLECT_ARGUMENTS +
+                                                 sharding.get_selection_arguments(selection))
+    collected = self.run_image(image, collect_parameters)
+    tests = sharding.parse_collected_tests(collected.decode('utf-8') if collected else '')
+
+    # Containers started by one shard must not be stopped when another
+    # shard completes, so the containers are tracked across all shards
+    with docker_image.DockerImageController(self._docker_image) as controller:
+      try:
+        shards = sharding.plan_shards(tests, selection, output_dir)
+        sharding.run_shards(
+            shards,
+            functools.partial(self._execute_shard, controller, image, command, run_parameters, pool,
+                              run_watchdog), output_dir)
+      except sharding.ShardingError as sharding_error:
+        if run_watchdog.get_failure():
+          raise self._abort(run_watchdog.get_failure())
+        raise base_benchmark.BenchmarkError(str(sharding_error))
+
+  def _execute_shard(self, controller: docker_image.DockerImageController, image: str,
+                     command: List[str], run_parameters: docker_image.DockerRunParameters,
+                     pool: container_pool.ContainerPool, run_watchdog: watchdog.Watchdog,
+                     shard: sharding.Shard) -> None:
+    """Execute the tests of one shard in a benchmark container pinned to its CPUs.
+
+    A shard whose container fails aborts the other shards through the
+    watchdog, since the results of the benchmark are incomplete.
+
+    Args:
+      controller: The controller tracking the containers of all shards
+      image: The benchmark image
+      command: The benchmark command without test selection arguments
+      run_parameters: The parameters of an unsharded run
+      pool: The container pool serving the containers started by the harness
+      run_watchdog: The watchdog following the output of all shards
+      shard: The shard to execute
+
+    Raises:
+      BenchmarkError: if the shard does not execute successfully
+      DockerRunError: if the container of the shard fails
+      WatchdogAbort: if the watchdog aborts the shards
+    """
+    cpus = cgroup.format_cpu_list(shard.cpus)
+    environment = dict(run_parameters.environment, TMPDIR=shard.output_dir)
+    environment.update(pool.get_environment(cpus))
+
+    shard_parameters = run_parameters._replace(command=pool.wrap_command(command + shard.tests),
+                                               environment=environment,
+                                               cpuset_cpus=cpus)
+    try:
+      _check_result(controller.run(image, shard_parameters, run_watchdog))
+    except docker_image.DockerRunError as run_error:
+      run_watchdog.abort(
+          watchdog.FailureReason(watchdog.SIGNAL_EXIT_STATUS, run_error.exit_status, 0,
+                                 watchdog.SOURCE_CONTAINER, f"Shard {shard.index}: {run_error}"))
+      raise
+
+
+def _check_result(result: Union[bytearray, None]) -> None:
+  """Verify that a benchmark container executed its tests.
+
+  Establishing success here requires that we examine the output produced by
+  NightHawk. If the latency output exists we can be relatively certain that
+  all containers were able to run and execute the specified tests.
+
+  Args:
+    result: The output of the benchmark container
+
+  Raises:
+    BenchmarkError: if the output contains no latency results
+  """
+  # FIXME: result needs to be unescaped. We don't use this data and the same
+  # content is available in the nighthawk-human.txt file.
+  if result is not None:
+    log.debug(f"Output: {len(result)} bytes")
+
+  if result is None or ("benchmark_http_client" not in result.decode('utf-8')):
+    raise base_benchmark.BenchmarkError("Unable to assert that the benchmark executed successfully")
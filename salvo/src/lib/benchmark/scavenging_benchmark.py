@@ -3,18 +3,26 @@
 
 https://github.com/envoyproxy/nighthawk/blob/master/benchmarks/README.md
 """
+import functools
 import subprocess
 import logging
+import shlex
+from typing import (List, Optional)
 
 import api.control_pb2 as proto_control
 import api.source_pb2 as proto_source
 
-from src.lib.benchmark import base_benchmark
+from src.lib.benchmark import (base_benchmark, sharding)
 from src.lib.builder import nighthawk_builder
-from src.lib import (cmd_exec, source_manager)
+from src.lib.common import (cgroup, trace, watchdog)
+from src.lib.docker_management import container_pool
+from src.lib import (cmd_exec, execution_context, source_manager)
 
 log = logging.getLogger(__name__)
 
+# The tests executed when the job control document selects none
+DEFAULT_TEST_EXPRESSION = 'test_http_h1_small'
+
 
 class ScavengingBenchmarkError(Exception):
   """Error rasied when running a scavenging benchmark in cases where we cannot make progress due \
@@ -25,10 +33,13 @@ class Benchmark(base_benchmark.BaseBenchmark):
   """This benchmark class is the scavenging benchmark. We build the nighthawk binaries and \
     scripts, then execute "bazel test" to run all tests in the benchmarks directory."""
 
-  def __init__(self, job_control: proto_control.JobControl, benchmark_name: str) -> None:
+  def __init__(self,
+               job_control: proto_control.JobControl,
+               benchmark_name: str,
+               source_cache: Optional[source_manager.SourceCache] = None) -> None:
     """Initialize the benchmark class."""
     self._benchmark_dir = None
-    super(Benchmark, self).__init__(job_control, benchmark_name)
+    super(Benchmark, self).__init__(job_control, benchmark_name, source_cache)
 
   def _validate(self) -> None:
     """Validate that all data required for running a benchmark exists.
@@ -61,7 +72,7 @@ class Benchmark(base_benchmark.BaseBenchmark):
     and server binaries
 
     """
-    manager = source_manager.SourceManager(self._control)
+    manager = source_manager.SourceManager(self._control, self._source_cache)
 
     # This builder needs to be a self object so that the temporary cache
     # directory is not prematurely cleaned up
@@ -75,13 +86,19 @@ class Benchmark(base_benchmark.BaseBenchmark):
     self._benchmark_dir = nighthawk_source.get_source_directory()
     log.debug(f"NightHawk benchmark dir {self._benchmark_dir}")
 
+  @trace.traced('ScavengingBenchmark.execute_benchmark')
   def execute_benchmark(self) -> None:
     """Execute the scavenging benchmark.
 
     Raises:
+      BenchmarkAborted: if the watchdog aborts the benchmark
       BenchmarkError: if the benchmark fails to execute successfully
     """
     self._validate()
+    profiler = self._create_cpu_profiler(allow_gperftools=False)
+    pool = self._create_container_pool()
+    run_watchdog = self._create_watchdog()
+    throttling_monitor = self._create_throttling_monitor()
     self._prepare_nighthawk()
 
     # pull in environment and set values
@@ -97,6 +114,7 @@ class Benchmark(base_benchmark.BaseBenchmark):
         'ENVOY_DOCKER_IMAGE_TO_TEST': images.envoy_image,
         'TMPDIR': output_dir
     }
+    image_vars.update(pool.get_environment())
     log.debug(f"Using environment: {image_vars}")
 
     for (key, value) in image_vars.items():
@@ -106,13 +124,73 @@ class Benchmark(base_benchmark.BaseBenchmark):
 
     environment_controller = base_benchmark.BenchmarkEnvController(env)
 
-    cmd = ("bazel-bin/benchmarks/benchmarks "
-           "--log-cli-level=info -vvvv -k test_http_h1_small "
-           "benchmarks/")
-    cmd_params = cmd_exec.CommandParameters(cwd=self._benchmark_dir)
+    selection = self._control.test_selection
+    command = ['bazel-bin/benchmarks/benchmarks', '--log-cli-level=info', '-vvvv']
+    selection_args = sharding.get_selection_arguments(selection, DEFAULT_TEST_EXPRESSION)
+
+    cmd = ' '.join(map(shlex.quote, pool.wrap_command(command + selection_args + ['benchmarks/'])))
 
-    with environment_controller:
+    with environment_controller as context, profiler, pool, run_watchdog, throttling_monitor:
       try:
-        cmd_exec.run_command(cmd, cmd_params)
+        if sharding.is_sharded(selection):
+          self._execute_shards(command, selection_args, pool, run_watchdog, context)
+        else:
+          self._run_command(run_watchdog, cmd, context.get_command_parameters(self._benchmark_dir))
+      except watchdog.WatchdogAbort as abort:
+        raise self._abort(abort.reason)
       except subprocess.CalledProcessError as cpe:
         raise base_benchmark.BenchmarkError(f"Unable to execute the benchmark: {cpe}")
+      except sharding.ShardingError as sharding_error:
+        if run_watchdog.get_failure():
+          raise self._abort(run_watchdog.get_failure())
+        raise base_benchmark.BenchmarkError(str(sharding_error))
+
+    self._collect_cpu_profile(profiler)
+
+  def _execute_shards(self, command: List[str], selection_args: List[str],
+                      pool: container_pool.ContainerPool, run_watchdog: watchdog.Watchdog,
+                      context: execution_context.ExecutionContext) -> None:
+    """Execute the selected tests in shards running in parallel on the host.
+
+    Args:
+      command: The benchmark command without test selection arguments
+      selection_args: The arguments selecting the tests
+      pool: The container pool serving the containers started by the harness
+      run_watchdog: The watchdog following the output of all shards
+      context: The execution context of the benchmark
+
+    Raises:
+      subprocess.CalledProcessError: if the tests cannot be collected
+      ShardingError: if the tests cannot be sharded or a shard fails
+    """
+    cmd_params = context.get_command_parameters(self._benchmark_dir)
+    collect_cmd = ' '.join(
+        map(shlex.quote, command + sharding.COLLECT_ARGUMENTS + selection_args + ['benchmarks/']))
+    tests = sharding.parse_collected_tests(cmd_exec.run_command(collect_cmd, cmd_params))
+
+    output_dir = self.get_output_dir()
+    shards = sharding.plan_shards(tests, self._control.test_selection, output_dir)
+    sharding.run_shards(
+        shards, functools.partial(self._execute_shard, command, pool, run_watchdog, context),
+        output_dir)
+
+  def _execute_shard(self, command: List[str], pool: container_pool.ContainerPool,
+                     run_watchdog: watchdog.Watchdog, context: execution_context.ExecutionContext,
+                     shard: sharding.Shard) -> None:
+    """Execute the tests of one shard on its CPUs.
+
+    Args:
+      command: The benchmark command without test selection arguments
+      pool: The container pool serving the containers started by the harness
+      run_watchdog: The watchdog following the output of all shards
+      context: The execution context of the benchmark
+      shard: The shard to execute
+    """
+    environment = {'TMPDIR': shard.output_dir}
+    environment.update(pool.get_environment(cgroup.format_cpu_list(shard.cpus)))
+
+    cmd = sharding.get_host_command(pool.wrap_command(command), shard, environment)
+    shard_context = context.with_cpus(shard.cpus)
+    with shard_context.placement():
+      self._run_command(run_watchdog, cmd,
+                        shard_context.get_command_parameters(self._benchmark_dir))
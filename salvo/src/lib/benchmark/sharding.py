@@ -0,0 +1,244 @@
+"""Select the benchmark tests to execute and split them into shards executing in parallel.
+
+The tests matching the selection expression are discovered with pytest's
+collection, distributed among the shards and executed by each shard on a
+disjoint set of CPUs. Every shard writes its artifacts to its own
+directory. Once all shards complete, their artifacts are moved into the
+output directory so that it has the layout of an unsharded run.
+"""
+import concurrent.futures
+import logging
+import os
+import shlex
+import shutil
+from typing import (Callable, Dict, List, NamedTuple, Set)
+
+import api.selection_pb2 as proto_selection
+
+from src.lib.common import (cgroup, trace)
+
+log = logging.getLogger(__name__)
+
+SHARD_DIRECTORY = 'shards'
+
+# The pytest arguments listing the selected tests without executing them
+COLLECT_ARGUMENTS = ['--collect-only', '-q']
+
+
+class ShardingError(Exception):
+  """Error raised when the tests cannot be sharded or a shard fails."""
+
+
+# Encapsulates the tests executed by one shard and where they execute
+Shard = NamedTuple(
+    'Shard',
+    [
+        ('index', int),
+        ('tests', List[str]),  # The pytest node ids of the tests
+        ('cpus', Set[int]),  # The CPUs to which the shard is pinned
+        ('output_dir', str),  # The directory receiving the artifacts of the shard
+    ])
+
+
+def is_sharded(selection: proto_selection.TestSelection) -> bool:
+  """Return whether the selected tests are split into more than one shard."""
+  return selection.shards > 1
+
+
+def get_selection_arguments(selection: proto_selection.TestSelection,
+                            default_expression: str = '') -> List[str]:
+  """Return the pytest arguments selecting the tests to execute.
+
+  Args:
+    selection: The test selection from the job control document
+    default_expression: The expression used if the selection has none
+
+  Returns:
+    the "-k" argument and its expression, or an empty list if every test
+      executes
+  """
+  expression = selection.expression or default_expression
+  return ['-k', expression] if expression else []
+
+
+def parse_collected_tests(output: str) -> List[str]:
+  """Extract the test node ids from the output of pytest's quiet collection.
+
+  Args:
+    output: The output of pytest invoked with COLLECT_ARGUMENTS
+
+  Returns:
+    the node ids of the collected tests, in collection order
+  """
+  tests = []
+  for line in output.splitlines():
+    line = line.strip()
+    if '::' in line and ' ' not in line.split('::')[0]:
+      tests.append(line)
+  return tests
+
+
+def partition_cpus(cpus: Set[int], count: int) -> List[Set[int]]:
+  """Divide CPUs into contiguous, disjoint sets of similar size.
+
+  Args:
+    cpus: The CPUs to divide
+    count: The number of sets
+
+  Returns:
+    the CPU sets, the first of which receive any remaining CPUs
+
+  Raises:
+    ShardingError: if there are fewer CPUs than sets
+  """
+  if len(cpus) < count:
+    raise ShardingError(f"{count} shards need at least {count} CPUs, "
+                        f"but only [{cgroup.format_cpu_list(cpus)}] are available")
+
+  ordered = sorted(cpus)
+  size, remainder = divmod(len(ordered), count)
+  partitions = []
+  start = 0
+  for index in range(count):
+    end = start + size + (1 if index < remainder else 0)
+    partitions.append(set(ordered[start:end]))
+    start = end
+  return partitions
+
+
+def plan_shards(tests: List[str], selection: proto_selection.TestSelection,
+                output_dir: str) -> List[Shard]:
+  """Distribute the selected tests among the shards.
+
+  Tests are assigned in turn so that tests of the same module, which tend to
+  have similar durations, are spread across the shards.
+
+  Args:
+    tests: The node ids of the selected tests
+    selection: The test selection from the job control document
+    output_dir: The output directory of the benchmark
+
+  Returns:
+    the shards, each with at least one test. There are fewer shards than
+      requested when fewer tests are selected
+
+  Raises:
+    ShardingError: if no test is selected or the shard CPUs are invalid
+  """
+  if not tests:
+    raise ShardingError(f"No tests match the selection [{selection.expression}]")
+
+  try:
+    cpus = cgroup.parse_cpu_list(selection.shard_cpus) if selection.shard_cpus \
+        else os.sched_getaffinity(0)
+  except cgroup.CgroupError as cpu_list_error:
+    raise ShardingError(str(cpu_list_error))
+
+  count = min(selection.shards, len(tests))
+  cpu_sets = partition_cpus(cpus, count)
+
+  return [
+      Shard(index=index,
+            tests=tests[index::count],
+            cpus=cpu_sets[index],
+            output_dir=os.path.join(output_dir, SHARD_DIRECTORY, f"shard_{index}"))
+      for index in range(count)
+  ]
+
+
+def get_host_command(command: List[str], shard: Shard, environment: Dict[str, str]) -> str:
+  """Build the command line executing the tests of a shard on the host.
+
+  The variables of the shard are set with env(1), since the environment of
+  Salvo is shared by the shards executing concurrently.
+
+  Args:
+    command: The benchmark command without test selection arguments
+    shard: The shard whose tests execute
+    environment: The variables set for the shard, such as its TMPDIR
+
+  Returns:
+    the quoted command line
+  """
+  variables = [f"{key}={value}" for key, value in environment.items()]
+  arguments = (['env'] + variables if variables else []) + command + shard.tests
+  return ' '.join(map(shlex.quote, arguments))
+
+
+def _merge_directory(source: str, destination: str, suffix: str) -> None:
+  """Move the contents of a directory into another one.
+
+  Directories present in both are merged. A file that already exists in
+  the destination is kept and the moved file is renamed with a suffix.
+
+  Args:
+    source: The directory whose contents are moved
+    destination: The directory receiving the contents
+    suffix: The suffix appended to the name of conflicting files
+  """
+  os.makedirs(destination, exist_ok=True)
+  for entry in os.listdir(source):
+    source_path = os.path.join(source, entry)
+    destination_path = os.path.join(destination, entry)
+    if os.path.isdir(source_path) and os.path.isdir(destination_path):
+      _merge_directory(source_path, destination_path, suffix)
+      continue
+
+    if os.path.exists(destination_path):
+      destination_path += f".{suffix}"
+    shutil.move(source_path, destination_path)
+
+
+def merge_shard_outputs(output_dir: str, shards: List[Shard]) -> None:
+  """Move the artifacts of each shard into the output directory of the benchmark.
+
+  Args:
+    output_dir: The output directory of the benchmark
+    shards: The shards whose artifacts are moved
+  """
+  for shard in shards:
+    if os.path.isdir(shard.output_dir):
+      _merge_directory(shard.output_dir, output_dir, f"shard_{shard.index}")
+
+  shutil.rmtree(os.path.join(output_dir, SHARD_DIRECTORY), ignore_errors=True)
+
+
+def run_shards(shards: List[Shard], execute: Callable[[Shard], None], output_dir: str) -> None:
+  """Execute the shards in parallel and merge their artifacts.
+
+  The artifacts of all shards are merged even if some shards fail.
+
+  Args:
+    shards: The shards to execute
+    execute: The function executing the tests of a shard. It is invoked
+      from a separate thread for each shard
+    output_dir: The output directory of the benchmark
+
+  Raises:
+    ShardingError: if any shard fails
+  """
+
+  def execute_shard(shard: Shard) -> None:
+    os.makedirs(shard.output_dir, exist_ok=True)
+    log.info(f"Shard {shard.index}: {len(shard.tests)} tests on CPUs "
+             f"[{cgroup.format_cpu_list(shard.cpus)}]")
+    with trace.span('execute_shard', shard=shard.index, tests=len(shard.tests)):
+      execute(shard)
+
+  failures = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards),
+                                             thread_name_prefix='salvo_shard') as executor:
+    futures = {executor.submit(execute_shard, shard): shard for shard in shards}
+    for future in concurrent.futures.as_completed(futures):
+      shard = futures[future]
+      try:
+        future.result()
+      except Exception as shard_error:
+        log.error(f"Shard {shard.index} failed: {shard_error}")
+        failures.append(f"shard {shard.index}: {shard_error}")
+
+  merge_shard_outputs(output_dir, shards)
+
+  if failures:
+    raise ShardingError(f"{len(failures)} of {len(shards)} shards failed: "
+                        f"{'; '.join(sorted(failures))}")
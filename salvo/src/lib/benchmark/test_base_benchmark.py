@@ -1,19 +1,15 @@
 """Test the base benchmark class."""
 import os
-import copy
 import pytest
 
 import api.env_pb2 as proto_env
 import api.control_pb2 as proto_control
+from src.lib import execution_context
 from src.lib.benchmark import base_benchmark
 
 
 def test_environment_variables():
-  """Test that the specified environment variables are set for a benchmark.
-
-  We copy the environment variables for verification and clear the variables that we set so that we
-  do not pollute other tests.
-  """
+  """Test that the specified environment variables are set for a benchmark, and not for Salvo."""
   environ = proto_env.EnvironmentVars()
   environ.variables["TMP_DIR"] = "/home/user/nighthawk_output"
   environ.variables["TEST_VAR1"] = "TEST_VALUE1"
@@ -24,20 +20,20 @@ def test_environment_variables():
 
   benchmark_env_controller = base_benchmark.BenchmarkEnvController(environ)
 
-  environment_variables = {}
-  with benchmark_env_controller:
-    expected_vars = {
-        'TMP_DIR': '/home/user/nighthawk_output',
-        'TEST_VAR1': 'TEST_VALUE1',
-        'TEST_VAR2': 'TEST_VALUE2',
-        'TEST_VAR3': 'TEST_VALUE3',
-        'ENVOY_IP_TEST_VERSIONS': 'v4only',
-        'ENVOY_PATH': 'a_proxy_called_envoy'
-    }
-    environment_variables = copy.deepcopy(os.environ)
+  expected_vars = {
+      'TMP_DIR': '/home/user/nighthawk_output',
+      'TEST_VAR1': 'TEST_VALUE1',
+      'TEST_VAR2': 'TEST_VALUE2',
+      'TEST_VAR3': 'TEST_VALUE3',
+      'ENVOY_IP_TEST_VERSIONS': 'v4only',
+      'ENVOY_PATH': 'a_proxy_called_envoy'
+  }
+  with benchmark_env_controller as context:
+    for (key, value) in expected_vars.items():
+      assert context.env[key] == value
+      assert key not in os.environ
 
-  for (key, value) in expected_vars.items():
-    assert environment_variables[key] == value
+  assert benchmark_env_controller.get_variables() == expected_vars
 
 
 def test_no_environment_variables_exception():
@@ -73,12 +69,27 @@ def test_minimal_environment_variables():
   expected_vars = {
       'ENVOY_IP_TEST_VERSIONS': 'v6only',
   }
-  with benchmark_env_controller:
+  with benchmark_env_controller as context:
     for (key, value) in expected_vars.items():
-      assert os.environ[key] == value
+      assert context.env[key] == value
 
     for (key, _) in not_expected_vars.items():
-      assert key not in os.environ
+      assert key not in context.env
+
+
+def test_special_variables_cleared():
+  """Test that variables set by an outer bazel invocation are removed from the benchmark context."""
+  environ = proto_env.EnvironmentVars()
+  environ.test_version = environ.IPV_V4ONLY
+  outer_context = execution_context.ExecutionContext(env={
+      'RUNFILES_MANIFEST_FILE': '/outer/MANIFEST',
+      'PATH': '/usr/bin'
+  })
+
+  context = base_benchmark.BenchmarkEnvController(environ, outer_context).get_context()
+
+  assert context.env == {'PATH': '/usr/bin', 'ENVOY_IP_TEST_VERSIONS': 'v4only'}
+  assert outer_context.env['RUNFILES_MANIFEST_FILE'] == '/outer/MANIFEST'
 
 
 if __name__ == '__main__':
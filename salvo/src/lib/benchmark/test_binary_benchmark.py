@@ -72,6 +72,30 @@ def test_source_to_build_binaries(mock_cmd, mock_envoy_build, mock_nh_bin_build,
   mock_nh_bin_build.assert_called_once()
 
 
+@patch(_BUILD_NIGHTHAWK_BENCHMARKS)
+@patch(_BUILD_NIGHTHAWK_BINARIES)
+@patch(_BUILD_ENVOY_BINARY)
+@patch('src.lib.cmd_exec.run_command')
+def test_benchmark_uses_nighthawk_build_context(mock_cmd, mock_envoy_build, mock_nh_bin_build,
+                                                mock_nh_bench_build):
+  """Validate that the benchmark runs with the HOME and compiler of the NightHawk build."""
+  job_control = generate_test_objects.generate_default_job_control()
+
+  generate_test_objects.generate_envoy_source(job_control)
+  generate_test_objects.generate_nighthawk_source(job_control)
+  generate_test_objects.generate_environment(job_control)
+  mock_envoy_build.return_value = "/home/ubuntu/envoy/bazel-bin/source/exe/envoy-static"
+
+  benchmark = binary_benchmark.Benchmark(job_control, "test_benchmark")
+  benchmark.execute_benchmark()
+
+  build_context = benchmark._nighthawk_builder.get_context()
+  (cmd, cmd_params), _ = mock_cmd.call_args
+  assert cmd.startswith("bazel test ")
+  assert cmd_params.env['HOME'] == build_context.get_home()
+  assert cmd_params.env['CC'] == build_context.env['CC']
+
+
 def test_no_source_to_build_nh():
   """Validate that we fail the entire process in the absence of NH sources.
 
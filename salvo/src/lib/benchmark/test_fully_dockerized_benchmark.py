@@ -1,11 +1,14 @@
 """Test the fully dockerized benchmark class."""
+import json
+import os
+import tempfile
 import pytest
 from unittest import mock
 
 import api.control_pb2 as proto_control
 
 from src.lib.benchmark import (fully_dockerized_benchmark as full_docker, base_benchmark)
-from src.lib.docker_management import docker_image
+from src.lib.docker_management import (container_pool, docker_image)
 from src.lib import generate_test_objects
 
 
@@ -32,7 +35,101 @@ def test_execute_benchmark_using_images_only(mock_run_image):
   # Calling execute_benchmark shoud not throw an exception
   benchmark.execute_benchmark()
   mock_run_image.assert_called_once_with(
-      'envoyproxy/nighthawk-benchmark-dev:random_benchmark_image_tag', run_parameters)
+      'envoyproxy/nighthawk-benchmark-dev:random_benchmark_image_tag', run_parameters, mock.ANY)
+
+
+@mock.patch.object(container_pool.ContainerPool, 'remove_containers')
+@mock.patch.object(base_benchmark.BaseBenchmark, 'run_image')
+def test_execute_benchmark_with_pooled_containers(mock_run_image, mock_remove_containers):
+  """Validate that the benchmark selects the pooled docker client when pooling is enabled."""
+  mock_run_image.return_value = b'benchmark_http_client output'
+
+  job_control = generate_test_objects.generate_default_job_control()
+  images = generate_test_objects.generate_images(job_control)
+  images.pool_containers = True
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    generate_test_objects.generate_environment(job_control)
+    job_control.environment.output_dir = output_dir
+
+    benchmark = full_docker.Benchmark(job_control, "test_benchmark")
+    benchmark.execute_benchmark()
+
+  run_parameters = mock_run_image.call_args[0][1]
+  assert run_parameters.command[:2] == ['sh', '-c']
+  assert run_parameters.command[-3:] == ['./benchmarks', '--log-cli-level=info', '-vvvv']
+  assert run_parameters.environment['SALVO_POOL_SHARED_DIR'] == output_dir
+  mock_remove_containers.assert_called_once()
+
+
+@mock.patch.object(docker_image.DockerImageController, 'run')
+@mock.patch.object(docker_image.DockerImage, 'list_processes')
+@mock.patch.object(base_benchmark.BaseBenchmark, 'run_image')
+def test_execute_sharded_benchmark(mock_run_image, mock_list_processes, mock_controller_run):
+  """Validate that the selected tests execute in shards pinned to disjoint CPUs."""
+  mock_run_image.return_value = (b'benchmarks/test_benchmarks.py::test_http_h1_small\n'
+                                 b'benchmarks/test_benchmarks.py::test_http_h2_small\n\n'
+                                 b'2 tests collected in 0.05s\n')
+  mock_list_processes.return_value = []
+  mock_controller_run.return_value = b'benchmark_http_client output'
+
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.test_selection.expression = 'small'
+  job_control.test_selection.shards = 2
+  job_control.test_selection.shard_cpus = '0-3'
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    generate_test_objects.generate_environment(job_control)
+    job_control.environment.output_dir = output_dir
+
+    benchmark = full_docker.Benchmark(job_control, "test_benchmark")
+    benchmark.execute_benchmark()
+
+  collect_parameters = mock_run_image.call_args[0][1]
+  assert collect_parameters.command == [
+      './benchmarks', '--log-cli-level=info', '-vvvv', '--collect-only', '-q', '-k', 'small'
+  ]
+
+  shard_parameters = sorted([call[0][1] for call in mock_controller_run.call_args_list],
+                            key=lambda parameters: parameters.cpuset_cpus)
+  assert [parameters.cpuset_cpus for parameters in shard_parameters] == ['0-1', '2-3']
+  assert shard_parameters[0].command == [
+      './benchmarks', '--log-cli-level=info', '-vvvv',
+      'benchmarks/test_benchmarks.py::test_http_h1_small'
+  ]
+  assert shard_parameters[1].environment['TMPDIR'] == f"{output_dir}/shards/shard_1"
+
+
+@mock.patch.object(docker_image.DockerImageController, 'run')
+@mock.patch.object(docker_image.DockerImage, 'list_processes')
+@mock.patch.object(base_benchmark.BaseBenchmark, 'run_image')
+def test_execute_sharded_benchmark_container_failure(mock_run_image, mock_list_processes,
+                                                     mock_controller_run):
+  """Validate that a failed shard container aborts the benchmark and records the reason."""
+  mock_run_image.return_value = b'benchmarks/test_benchmarks.py::test_http_h1_small\n'
+  mock_list_processes.return_value = []
+  mock_controller_run.side_effect = docker_image.DockerRunError("container failed", 3)
+
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.test_selection.shards = 2
+  job_control.test_selection.shard_cpus = '0-3'
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    generate_test_objects.generate_environment(job_control)
+    job_control.environment.output_dir = output_dir
+
+    benchmark = full_docker.Benchmark(job_control, "test_benchmark")
+    with pytest.raises(base_benchmark.BenchmarkAborted) as aborted:
+      benchmark.execute_benchmark()
+
+    with open(os.path.join(output_dir, 'failure.json')) as report_file:
+      report = json.load(report_file)
+
+  assert aborted.value.reason.signal == 'exit_status'
+  assert report['value'] == 3
+  assert report['message'].endswith(": container failed")
 
 
 def test_execute_benchmark_no_image_or_sources():
@@ -82,7 +179,7 @@ def test_execute_benchmark_with_envoy_source(mock_run_image):
 
   benchmark.execute_benchmark()
   mock_run_image.assert_called_once_with(
-      'envoyproxy/nighthawk-benchmark-dev:random_benchmark_image_tag', run_parameters)
+      'envoyproxy/nighthawk-benchmark-dev:random_benchmark_image_tag', run_parameters, mock.ANY)
 
 
 @mock.patch.object(base_benchmark.BaseBenchmark, 'run_image')
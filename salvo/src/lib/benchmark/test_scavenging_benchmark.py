@@ -1,4 +1,5 @@
 """Test the scavenging benchmark class."""
+import tempfile
 import pytest
 from unittest import mock
 
@@ -94,5 +95,39 @@ def test_execute_benchmark(mock_benchmarks, mock_get_source_tree, mock_run_comma
   mock_run_command.assert_has_calls(calls)
 
 
+@mock.patch('src.lib.cmd_exec.run_command')
+@mock.patch.object(source_manager.SourceManager, 'get_source_tree')
+@mock.patch.object(nighthawk_builder.NightHawkBuilder, 'build_nighthawk_benchmarks')
+def test_execute_sharded_benchmark(mock_benchmarks, mock_get_source_tree, mock_run_command):
+  """Verify that the selected tests execute in shards with their own output directories."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_envoy_source(job_control)
+  generate_test_objects.generate_nighthawk_source(job_control)
+  generate_test_objects.generate_environment(job_control)
+  job_control.test_selection.expression = 'h1'
+  job_control.test_selection.shards = 2
+  job_control.test_selection.shard_cpus = '0-1'
+
+  mock_run_command.side_effect = [
+      "benchmarks/test_benchmarks.py::test_http_h1_small\n"
+      "benchmarks/test_benchmarks.py::test_http_h1_large\n", '', ''
+  ]
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    job_control.environment.output_dir = output_dir
+    benchmark = scavenging_benchmark.Benchmark(job_control, 'scavenging')
+    benchmark.execute_benchmark()
+
+  commands = [call[0][0] for call in mock_run_command.call_args_list]
+  assert commands[0] == ("bazel-bin/benchmarks/benchmarks --log-cli-level=info -vvvv "
+                         "--collect-only -q -k h1 benchmarks/")
+  assert sorted(commands[1:]) == [
+      f"env TMPDIR={output_dir}/shards/shard_0 bazel-bin/benchmarks/benchmarks "
+      "--log-cli-level=info -vvvv benchmarks/test_benchmarks.py::test_http_h1_small",
+      f"env TMPDIR={output_dir}/shards/shard_1 bazel-bin/benchmarks/benchmarks "
+      "--log-cli-level=info -vvvv benchmarks/test_benchmarks.py::test_http_h1_large",
+  ]
+
+
 if __name__ == '__main__':
   raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,129 @@
+"""Test the selection and sharding of benchmark tests."""
+import os
+import shlex
+import threading
+import pytest
+from unittest import mock
+
+import api.selection_pb2 as proto_selection
+
+from src.lib.benchmark import sharding
+
+_COLLECTED_OUTPUT = """benchmarks/test_benchmarks.py::test_http_h1_small[IpVersion.IPv4]
+benchmarks/test_benchmarks.py::test_http_h1_large[IpVersion.IPv4]
+benchmarks/test_benchmarks.py::test_http_h2_small[IpVersion.IPv4]
+
+3 tests collected in 0.05s
+"""
+
+
+def test_get_selection_arguments():
+  """Verify that the selection expression, or the default one, is passed to pytest."""
+  selection = proto_selection.TestSelection()
+  assert sharding.get_selection_arguments(selection) == []
+  assert sharding.get_selection_arguments(selection, 'small') == ['-k', 'small']
+
+  selection.expression = 'h1 and not large'
+  assert sharding.get_selection_arguments(selection, 'small') == ['-k', 'h1 and not large']
+
+
+def test_parse_collected_tests():
+  """Verify that only the test node ids are extracted from the collection output."""
+  assert sharding.parse_collected_tests(_COLLECTED_OUTPUT) == [
+      'benchmarks/test_benchmarks.py::test_http_h1_small[IpVersion.IPv4]',
+      'benchmarks/test_benchmarks.py::test_http_h1_large[IpVersion.IPv4]',
+      'benchmarks/test_benchmarks.py::test_http_h2_small[IpVersion.IPv4]',
+  ]
+
+
+def test_partition_cpus():
+  """Verify that CPUs are divided into contiguous, disjoint sets."""
+  assert sharding.partition_cpus({0, 1, 2, 3, 4}, 2) == [{0, 1, 2}, {3, 4}]
+  assert sharding.partition_cpus({8, 2, 4}, 3) == [{2}, {4}, {8}]
+
+  with pytest.raises(sharding.ShardingError):
+    sharding.partition_cpus({0, 1}, 3)
+
+
+def test_plan_shards():
+  """Verify that tests are distributed in turn among the shards."""
+  selection = proto_selection.TestSelection(shards=2, shard_cpus='0-3')
+  tests = sharding.parse_collected_tests(_COLLECTED_OUTPUT)
+
+  shards = sharding.plan_shards(tests, selection, '/output')
+
+  assert shards == [
+      sharding.Shard(index=0,
+                     tests=[tests[0], tests[2]],
+                     cpus={0, 1},
+                     output_dir='/output/shards/shard_0'),
+      sharding.Shard(index=1, tests=[tests[1]], cpus={2, 3}, output_dir='/output/shards/shard_1'),
+  ]
+
+
+def test_plan_shards_fewer_tests():
+  """Verify that no shard is planned without tests."""
+  selection = proto_selection.TestSelection(shards=4, shard_cpus='0-3')
+  shards = sharding.plan_shards(['test_a.py::test_a'], selection, '/output')
+  assert len(shards) == 1
+  assert shards[0].cpus == {0, 1, 2, 3}
+
+  with pytest.raises(sharding.ShardingError) as sharding_error:
+    sharding.plan_shards([], proto_selection.TestSelection(shards=2, expression='h3'), '/output')
+  assert str(sharding_error.value) == "No tests match the selection [h3]"
+
+
+def test_get_host_command():
+  """Verify that the shard environment and tests are passed on the command line."""
+  shard = sharding.Shard(index=0, tests=['test_a.py::test_a[x y]'], cpus={0}, output_dir='/out')
+  command = sharding.get_host_command(['benchmarks', '-vvvv'], shard, {'TMPDIR': '/out'})
+
+  assert shlex.split(command) == [
+      'env', 'TMPDIR=/out', 'benchmarks', '-vvvv', 'test_a.py::test_a[x y]'
+  ]
+
+
+def test_run_shards(tmp_path):
+  """Verify that shards execute in parallel and their outputs are merged."""
+  output_dir = str(tmp_path)
+  selection = proto_selection.TestSelection(shards=2, shard_cpus='0-1')
+  shards = sharding.plan_shards(['a.py::test_a', 'b.py::test_b'], selection, output_dir)
+  started = threading.Barrier(2, timeout=5)
+
+  def execute(shard):
+    started.wait()
+    test_dir = os.path.join(shard.output_dir, f"test_{shard.index}")
+    os.makedirs(test_dir)
+    with open(os.path.join(test_dir, 'nighthawk-human.txt'), 'w') as result_file:
+      result_file.write(shard.tests[0])
+    with open(os.path.join(shard.output_dir, 'summary.txt'), 'w') as summary_file:
+      summary_file.write(str(shard.index))
+
+  sharding.run_shards(shards, execute, output_dir)
+
+  assert sorted(
+      os.listdir(output_dir)) == ['summary.txt', 'summary.txt.shard_1', 'test_0', 'test_1']
+  with open(os.path.join(output_dir, 'test_1', 'nighthawk-human.txt')) as result_file:
+    assert result_file.read() == 'b.py::test_b'
+
+
+def test_run_shards_failure(tmp_path):
+  """Verify that the outputs are merged and the failure raised when a shard fails."""
+  output_dir = str(tmp_path)
+  selection = proto_selection.TestSelection(shards=2, shard_cpus='0-1')
+  shards = sharding.plan_shards(['a.py::test_a', 'b.py::test_b'], selection, output_dir)
+
+  def execute(shard):
+    open(os.path.join(shard.output_dir, f"result_{shard.index}"), 'w').close()
+    if shard.index == 1:
+      raise RuntimeError("container exited")
+
+  with pytest.raises(sharding.ShardingError) as sharding_error:
+    sharding.run_shards(shards, execute, output_dir)
+
+  assert str(sharding_error.value) == "1 of 2 shards failed: shard 1: container exited"
+  assert sorted(os.listdir(output_dir)) == ['result_0', 'result_1']
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,124 @@
+"""Keep the artifacts compiled from a source commit so that later builds can reuse them.
+
+Artifacts are stored below the Salvo home directory in an entry identified
+by the commit and the command that built them. A binary compiled for a
+binary benchmark is then reused when an image is built for the same commit
+and options, and the reverse.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+from src.lib import constants
+
+log = logging.getLogger(__name__)
+
+ARTIFACT_DIRECTORY = 'artifacts'
+MANIFEST_FILE = 'manifest.json'
+
+
+class ArtifactCacheError(Exception):
+  """Error raised when an artifact cannot be stored."""
+
+
+def get_default_cache_dir() -> str:
+  """Return the directory holding the cached artifacts."""
+  return os.path.join(os.getenv('SALVO_HOMEDIR', constants.SALVO_TMP), ARTIFACT_DIRECTORY)
+
+
+def get_artifact_key(commit_hash: str, build_command: str) -> str:
+  """Return the key identifying the artifacts built from a commit.
+
+  Args:
+    commit_hash: The commit from which the artifacts are built
+    build_command: The command, including its options, compiling the
+      artifacts
+
+  Returns:
+    a hexadecimal digest of the commit and the command
+  """
+  identity = json.dumps([commit_hash, build_command])
+  return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:24]
+
+
+class ArtifactCache(object):
+  """Store and retrieve the artifacts compiled from a commit."""
+
+  def __init__(self, cache_dir: str = '') -> None:
+    """Initialize the cache.
+
+    Args:
+      cache_dir: The directory holding the artifacts. The artifacts
+        directory below the Salvo home directory is used if empty
+    """
+    self._cache_dir = cache_dir or get_default_cache_dir()
+
+  def get_entry_directory(self, key: str) -> str:
+    """Return the directory holding the artifacts of a key."""
+    return os.path.join(self._cache_dir, key)
+
+  def get_artifact(self, key: str, name: str) -> Optional[str]:
+    """Return the path of a cached artifact.
+
+    Args:
+      key: The key of the commit and build command
+      name: The name of the artifact
+
+    Returns:
+      the path of the artifact, or None if it is not cached
+    """
+    artifact_path = os.path.join(self.get_entry_directory(key), name)
+    if os.path.isfile(artifact_path):
+      log.debug(f"Found cached artifact {artifact_path}")
+      return artifact_path
+    return None
+
+  def store_artifact(self, key: str, name: str, source_path: str, description: str) -> str:
+    """Copy an artifact into the cache.
+
+    The artifact is copied under a temporary name and renamed, so that
+    concurrent readers never observe a partial file.
+
+    Args:
+      key: The key of the commit and build command
+      name: The name of the artifact
+      source_path: The path of the artifact to cache
+      description: Text recorded in the manifest of the entry identifying
+        how the artifact was built
+
+    Returns:
+      the path of the cached artifact
+
+    Raises:
+      ArtifactCacheError: if the artifact cannot be copied
+    """
+    entry_dir = self.get_entry_directory(key)
+    artifact_path = os.path.join(entry_dir, name)
+    staged_path = ''
+
+    try:
+      os.makedirs(entry_dir, exist_ok=True)
+      with tempfile.NamedTemporaryFile(dir=entry_dir, prefix=f".{name}.", delete=False) as staged:
+        staged_path = staged.name
+      shutil.copy2(source_path, staged_path)
+      os.replace(staged_path, artifact_path)
+
+      manifest_path = os.path.join(entry_dir, MANIFEST_FILE)
+      manifest = {}
+      if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+          manifest = json.load(manifest_file)
+      manifest[name] = description
+      with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    except OSError as copy_error:
+      if staged_path and os.path.exists(staged_path):
+        os.remove(staged_path)
+      raise ArtifactCacheError(f"Unable to cache {source_path} as {artifact_path}: {copy_error}")
+
+    log.debug(f"Cached {source_path} as {artifact_path}")
+    return artifact_path
@@ -2,8 +2,9 @@
 execute bazel."""
 import os
 import logging
+from typing import Optional
 
-from src.lib import (cmd_exec, constants, source_manager)
+from src.lib import (cmd_exec, constants, execution_context, source_manager)
 from src.lib.common import file_ops
 from src.lib.builder import bazel_setup
 import api.source_pb2 as proto_source
@@ -19,22 +20,29 @@ class BaseBuilderError(Exception):
 class BaseBuilder():
   """BaseBuilder class encapsulating common build methods and objects managing sources."""
 
-  def __init__(self, manager: source_manager.SourceManager) -> None:
+  def __init__(self,
+               manager: source_manager.SourceManager,
+               context: Optional[execution_context.ExecutionContext] = None) -> None:
     """Initialize the builder with the location of the source and setup temporary directories \
     needed for operation.
 
     Args:
       manager: The SourceManager object handling the source code used by this builder object
+      context: The execution context from which the context of the builder
+        is derived. The default is the environment of Salvo
     """
     self._source_manager = manager
 
-    # TODO(abaptiste): Preserve the location of the source so that
-    # if nothing changes we can reuse the same disk data.  This could
-    # be considered a sandbox of sorts.
     temp_dir = os.getenv('SALVO_HOMEDIR', constants.SALVO_TMP)
 
-    # self._cache_dir is where the bazel cache is created
-    self._cache_dir = file_ops.get_random_dir(temp_dir)
+    # self._cache_dir is where the bazel cache is created. A Salvo server
+    # keeps it between jobs, so that the Bazel server and output base of the
+    # previous build are reused
+    self._cache_dir = None
+    home_dir = manager.get_build_cache_dir()
+    if not home_dir:
+      self._cache_dir = file_ops.get_random_dir(temp_dir)
+      home_dir = self._cache_dir.name
 
     # self._build_dir is where the source is copied or checked out. This is
     # the working directory where bazel operations are performed.  The
@@ -42,10 +50,11 @@ class BaseBuilder():
     # source_tree object
     self._build_dir = None
 
-    os.environ['HOME'] = self._cache_dir.name
-    log.debug(f"Using HOME={os.environ['HOME']}")
-
-    bazel_setup.setup_clang_env()
+    # The commands of the builder use the cache directory as HOME, without
+    # changing the environment of Salvo
+    context = (context or execution_context.from_process()).with_home(home_dir)
+    self._context = context.with_variables(bazel_setup.get_clang_environment(context.env))
+    log.debug(f"Using HOME={self._context.get_home()}")
 
   def set_build_dir(self, source_directory: str) -> None:
     """Set the source directory where build operations take place.
@@ -55,6 +64,14 @@ class BaseBuilder():
     """
     self._build_dir = source_directory
 
+  def get_context(self) -> execution_context.ExecutionContext:
+    """Return the execution context of the commands of the builder."""
+    return self._context
+
+  def _get_command_parameters(self) -> cmd_exec.CommandParameters:
+    """Return the parameters of a command run in the build directory."""
+    return self._context.get_command_parameters(self._build_dir)
+
   def _validate(self) -> None:
     """Verify the source and other dependencies required to build an artifact.
 
@@ -69,7 +86,7 @@ class BaseBuilder():
     """Run bazel clean in the source tree directory."""
     assert self._build_dir
 
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
+    cmd_params = self._get_command_parameters()
     cmd = "bazel clean"
     output = cmd_exec.run_command(cmd, cmd_params)
     log.debug(f"Clean output: {output}")
@@ -1,5 +1,6 @@
 """This module sets up environment variables required to execute bazel salvo."""
 import os
+from typing import (Dict, Mapping)
 
 from src.lib import constants
 
@@ -21,12 +22,21 @@ def get_clang_dir() -> str:
   return ''
 
 
-def setup_clang_env() -> None:
-  """Set the environment variables to use clang as a compiler."""
+def get_clang_environment(environment: Mapping[str, str]) -> Dict[str, str]:
+  """Return the environment variables to use clang as a compiler.
+
+  Args:
+    environment: The environment of the build commands
+
+  Returns:
+    the compiler variables to add to the environment, or none if it already
+      specifies a compiler
+  """
   # Use CC from the environment if specified. If not, use clang
   # TODO: We need additional sanity checks to ensure that the binaries
   #       we are trying to use exist and fail fast if they are absent.
-  if any(['CC' not in os.environ, 'CXX' not in os.environ]):
-    clang_dir = get_clang_dir()
-    os.environ['CC'] = os.path.join(clang_dir, 'clang')
-    os.environ['CXX'] = os.path.join(clang_dir, 'clang++')
+  if all(['CC' in environment, 'CXX' in environment]):
+    return {}
+
+  clang_dir = get_clang_dir()
+  return {'CC': os.path.join(clang_dir, 'clang'), 'CXX': os.path.join(clang_dir, 'clang++')}
@@ -1,14 +1,24 @@
 """Module to build an Envoy docker image from a source directory."""
-import glob
 import os
 import logging
+from typing import Optional
 
-from src.lib import (cmd_exec, constants, source_manager)
-from src.lib.builder import base_builder
+from src.lib import (cmd_exec, constants, execution_context, source_manager)
+from src.lib.builder import (artifact_cache, base_builder)
+from src.lib.common import trace
+from src.lib.docker_management import (docker_image, image_assembler)
 import api.source_pb2 as proto_source
 
 log = logging.getLogger(__name__)
 
+# The names of the Envoy artifacts kept in the artifact cache
+ENVOY_BINARY_ARTIFACT = 'envoy-static'
+ENVOY_DEBUGINFO_ARTIFACT = 'envoy.debug'
+SU_EXEC_ARTIFACT = 'su-exec'
+
+# The location of the su-exec binary compiled by bazel
+SU_EXEC_OUTPUT_PATH = 'bazel-bin/external/com_github_ncopa_suexec/su-exec'
+
 
 class EnvoyBuilderError(Exception):
   """An error raised when an unrecoverable situation occurs while building Envoy components."""
@@ -17,13 +27,17 @@ class EnvoyBuilderError(Exception):
 class EnvoyBuilder(base_builder.BaseBuilder):
   """This class encapsulates the logic to build the envoy binary and container image from source."""
 
-  def __init__(self, manager: source_manager.SourceManager) -> None:
+  def __init__(self,
+               manager: source_manager.SourceManager,
+               context: Optional[execution_context.ExecutionContext] = None) -> None:
     """Initialize the builder with the location of the source and the commit hash at which we are operating.
 
     Args:
       manager: The source manager object handling the source needed to build Envoy.
+      context: The execution context from which the context of the builder
+        is derived. The default is the environment of Salvo
     """
-    super(EnvoyBuilder, self).__init__(manager)
+    super(EnvoyBuilder, self).__init__(manager, context)
     self._source_tree = self._source_manager.get_source_tree(
         proto_source.SourceRepository.SRCID_ENVOY)
 
@@ -31,6 +45,17 @@ class EnvoyBuilder(base_builder.BaseBuilder):
         proto_source.SourceRepository.SRCID_ENVOY)
     self.set_build_dir(self._source_tree.get_source_directory())
 
+    self._artifact_cache = artifact_cache.ArtifactCache()
+
+    # The envoy-static binary staged into images. It is either compiled in
+    # the build directory or reused from the artifact cache
+    self._binary_path = constants.ENVOY_BINARY_TARGET_OUTPUT_PATH
+    self._su_exec_path = SU_EXEC_OUTPUT_PATH
+
+    # Whether the build directory holds the source checked out at the
+    # commit. Binaries reused from the artifact cache do not need it
+    self._source_prepared = False
+
   def _validate(self) -> None:
     """Validate the identity of the source defined from which Envoy is built."""
     if self._source_repo.identity != proto_source.SourceRepository.SRCID_ENVOY:
@@ -41,9 +66,8 @@ class EnvoyBuilder(base_builder.BaseBuilder):
     self._validate()
     self._run_bazel_clean()
 
-  def build_envoy(self) -> None:
-    """Run bazel build to generate the envoy-static."""
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
+  def _get_build_command(self) -> str:
+    """Return the bazel command compiling the envoy-static binary."""
     cmd = "bazel build {bazel_options}".format(
         bazel_options=self._generate_bazel_options(proto_source.SourceRepository.SRCID_ENVOY))
     if not cmd.endswith(" "):
@@ -57,29 +81,103 @@ class EnvoyBuilder(base_builder.BaseBuilder):
       cmd += "--incompatible_require_linker_input_cc_api=false "
 
     cmd += constants.ENVOY_BINARY_BUILD_TARGET
-    cmd_exec.run_check_command(cmd, cmd_params)
+    return cmd
+
+  def _get_artifact_key(self) -> Optional[str]:
+    """Return the key of the Envoy artifacts in the artifact cache.
+
+    Returns:
+      the key derived from the commit hash and the build command, or None
+        if no commit hash is specified. The source may then contain local
+        changes and its artifacts are not cached
+    """
+    if not self._source_repo.commit_hash:
+      return None
+    return artifact_cache.get_artifact_key(self._source_repo.commit_hash, self._get_build_command())
+
+  @trace.traced()
+  def build_envoy(self) -> None:
+    """Run bazel build to generate the envoy-static."""
+    cmd_params = self._get_command_parameters()
+    cmd_exec.run_check_command(self._get_build_command(), cmd_params)
 
   def build_envoy_binary_from_source(self) -> str:
     """Build an Envoy binary from source.
 
     This method cleans the working directory, compiles the binary,
-    and returns the name of the final envoy binary.
+    and returns the name of the final envoy binary. A binary previously
+    compiled from the same commit with the same options is reused from the
+    artifact cache instead, without copying or checking out the source,
+    and a newly compiled binary is added to it. The binary is then used from
+    the artifact cache, where a later build in the directory does not
+    replace it.
 
     Returns:
       A string representation of the path to the created binary
     """
     self._validate()
-    self._source_tree.copy_source_directory()
-    self._source_tree.checkout_commit_hash()
 
+    artifact_key = self._get_artifact_key()
+    if artifact_key:
+      cached_binary = self._artifact_cache.get_artifact(artifact_key, ENVOY_BINARY_ARTIFACT)
+      if cached_binary:
+        log.info(f"Reusing the Envoy binary built for {self._source_repo.commit_hash}")
+        self._binary_path = cached_binary
+        return cached_binary
+
+    self._prepare_source()
     self.clean_envoy()
     self.build_envoy()
 
-    return os.path.join(self._build_dir, constants.ENVOY_BINARY_TARGET_OUTPUT_PATH)
+    binary_path = os.path.join(self._build_dir, constants.ENVOY_BINARY_TARGET_OUTPUT_PATH)
+    # The cached binary is not replaced by a later build in the directory
+    if artifact_key:
+      binary_path = self._cache_artifact(artifact_key, ENVOY_BINARY_ARTIFACT,
+                                         binary_path) or binary_path
+    self._binary_path = binary_path
+
+    return binary_path
+
+  def _prepare_source(self) -> None:
+    """Copy the source to the build directory and check out the commit to build."""
+    self._source_tree.copy_source_directory()
+    self._source_tree.checkout_commit_hash()
+    self._source_prepared = True
+
+  def _cache_artifact(self, artifact_key: str, name: str, path: str) -> Optional[str]:
+    """Add an artifact to the artifact cache.
+
+    A failure to cache the artifact does not fail the build.
+
+    Args:
+      artifact_key: The key of the Envoy artifacts
+      name: The name of the artifact
+      path: The path of the artifact
+
+    Returns:
+      the path of the cached artifact, or None if it could not be cached
+    """
+    try:
+      return self._artifact_cache.store_artifact(
+          artifact_key, name, path, f"{self._source_repo.commit_hash}: "
+          f"{self._get_build_command()}")
+    except artifact_cache.ArtifactCacheError as cache_error:
+      log.warning(str(cache_error))
+    return None
 
   def build_su_exec(self) -> None:
-    """Run bazel build to generate the su-exec binary needed in Envoy docker images."""
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
+    """Run bazel build to generate the su-exec binary needed in Envoy docker images.
+
+    A su-exec binary cached alongside the Envoy binary is reused instead.
+    """
+    artifact_key = self._get_artifact_key()
+    if artifact_key:
+      cached_su_exec = self._artifact_cache.get_artifact(artifact_key, SU_EXEC_ARTIFACT)
+      if cached_su_exec:
+        self._su_exec_path = cached_su_exec
+        return
+
+    cmd_params = self._get_command_parameters()
     cmd = "bazel build {bazel_options}".format(
         bazel_options=self._generate_bazel_options(proto_source.SourceRepository.SRCID_ENVOY))
     if not cmd.endswith(" "):
@@ -88,6 +186,11 @@ class EnvoyBuilder(base_builder.BaseBuilder):
     cmd += "external:su-exec"
     cmd_exec.run_check_command(cmd, cmd_params)
 
+    self._su_exec_path = SU_EXEC_OUTPUT_PATH
+    if artifact_key:
+      self._cache_artifact(artifact_key, SU_EXEC_ARTIFACT,
+                           os.path.join(self._build_dir, SU_EXEC_OUTPUT_PATH))
+
   def stage_su_exec(self) -> None:
     """Copy the su-exec binary used in the Envoy docker image.
 
@@ -103,10 +206,10 @@ class EnvoyBuilder(base_builder.BaseBuilder):
       os.mkdir(dest_path, dir_mode)
 
     cmd = "cp -fv "
-    cmd += "bazel-bin/external/com_github_ncopa_suexec/su-exec "
+    cmd += f"{self._su_exec_path} "
     cmd += "build_release/su-exec"
 
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
+    cmd_params = self._get_command_parameters()
     cmd_exec.run_command(cmd, cmd_params)
 
   def build_envoy_image_from_source(self) -> None:
@@ -114,7 +217,9 @@ class EnvoyBuilder(base_builder.BaseBuilder):
 
     This method performs a few steps. It compiles the envoy binary,
     stages it for inclusion in a docker image, and builds the docker
-    image.
+    image. The binary is stripped, and its debug information kept in the
+    artifact cache for symbolizing profiles. Binaries already compiled
+    for the commit and options are reused from the artifact cache.
 
     su-exec was added as an additional binary.  That dependency is
     built and staged for packaging into the Envoy docker image also.
@@ -123,12 +228,18 @@ class EnvoyBuilder(base_builder.BaseBuilder):
       None
     """
     self.build_envoy_binary_from_source()
-    self.stage_envoy(False)
+    # The Dockerfile comes from the source, which is not copied when the
+    # binary is reused. Preparing it clears the build directory, so this
+    # precedes staging
+    if not self._source_prepared:
+      self._prepare_source()
+    debuginfo_path = self.stage_envoy(True)
+    log.info(f"Debug information for the Envoy image is kept in {debuginfo_path}")
     self.build_su_exec()
     self.stage_su_exec()
     self.create_docker_image()
 
-  def stage_envoy(self, strip_binary: bool) -> None:
+  def stage_envoy(self, strip_binary: bool) -> Optional[str]:
     """Copy and optionally strip the Envoy binary.
 
     After we compile Envoy, copy the binary into a platform directory
@@ -139,14 +250,15 @@ class EnvoyBuilder(base_builder.BaseBuilder):
 
     Args:
       strip_binary: determines whether we use objcopy to strip debug
-        symbols from the envoy binary. If strip_binary is False, we
-        simply copy the binary to its destination
-
-        Callers use False for now, until we expose a control for
-        manipulating this parameter.
+        symbols from the envoy binary. The debug symbols are then kept in
+        a separate file outside the image, linked from the stripped binary,
+        for symbolizing profiles. Debug information already in the
+        artifact cache is reused. If strip_binary is False, we simply copy
+        the binary to its destination
 
     Returns:
-      None
+      the path of the debug information file, preferably in the artifact
+        cache, if the binary is stripped, otherwise None
     """
     # Stage the envoy binary for the docker image
     dir_mode = 0o755
@@ -155,38 +267,46 @@ class EnvoyBuilder(base_builder.BaseBuilder):
     if not os.path.exists(dest_path):
       os.mkdir(dest_path, dir_mode)
 
-    cmd = "objcopy --strip-debug " if strip_binary else "cp -fv "
-    cmd += constants.ENVOY_BINARY_TARGET_OUTPUT_PATH
-    cmd += " build_release_stripped/envoy"
-
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
-    cmd_exec.run_command(cmd, cmd_params)
-
-  def _generate_docker_ignore(self) -> None:
-    """Generate a dockerignore file to reduce the context size."""
-    omit_from_dockerignore = ['configs', 'build_release', 'build_release_stripped', 'ci']
-
-    pwd = os.getcwd()
-    os.chdir(self._build_dir)
-
-    discovered_files = glob.glob('*')
-    files_to_write = filter(lambda f: f not in omit_from_dockerignore, discovered_files)
-
-    with open('.dockerignore', 'w') as dockerignore:
-      for entry in files_to_write:
-        dockerignore.write("{entry}\n".format(entry=entry))
-
-    os.chdir(pwd)
-
+    cmd_params = self._get_command_parameters()
+    if not strip_binary:
+      cmd = f"cp -fv {self._binary_path} build_release_stripped/envoy"
+      cmd_exec.run_command(cmd, cmd_params)
+      return None
+
+    artifact_key = self._get_artifact_key()
+    debuginfo_path = None
+    if artifact_key:
+      debuginfo_path = self._artifact_cache.get_artifact(artifact_key, ENVOY_DEBUGINFO_ARTIFACT)
+
+    if not debuginfo_path:
+      # The debug information is extracted outside the staged directory,
+      # whose contents the Dockerfile copies into the image
+      debuginfo_dir = os.path.join(self._build_dir, 'build_debuginfo')
+      if not os.path.exists(debuginfo_dir):
+        os.mkdir(debuginfo_dir, dir_mode)
+
+      debuginfo = f"build_debuginfo/{ENVOY_DEBUGINFO_ARTIFACT}"
+      cmd_exec.run_command(f"objcopy --only-keep-debug {self._binary_path} {debuginfo}", cmd_params)
+      debuginfo_path = os.path.join(self._build_dir, debuginfo)
+      if artifact_key:
+        debuginfo_path = self._cache_artifact(artifact_key, ENVOY_DEBUGINFO_ARTIFACT,
+                                              debuginfo_path) or debuginfo_path
+
+    cmd_exec.run_command(
+        f"objcopy --strip-debug --add-gnu-debuglink={debuginfo_path} "
+        f"{self._binary_path} build_release_stripped/envoy", cmd_params)
+
+    return debuginfo_path
+
+  @trace.traced()
   def create_docker_image(self) -> None:
-    """Build a docker image with the newly compiled Envoy binary."""
-    self._generate_docker_ignore()
-    commit_hash = self._source_repo.commit_hash
+    """Build a docker image with the newly compiled Envoy binary.
 
-    cmd = "docker build "
-    cmd += "-f ci/Dockerfile-envoy "
-    cmd += "-t envoyproxy/envoy-dev:{hash} ".format(hash=commit_hash)
-    cmd += "--build-arg TARGETPLATFORM=\'.\' ."
+    Only the Dockerfile and the staged binaries it copies are sent to the
+    docker daemon, rather than the whole source tree.
+    """
+    commit_hash = self._source_repo.commit_hash
 
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
-    cmd_exec.run_command(cmd, cmd_params)
+    assembler = image_assembler.ImageAssembler(docker_image.DockerImage())
+    assembler.assemble(self._build_dir, constants.ENVOY_DOCKERFILE,
+                       f"envoyproxy/envoy-dev:{commit_hash}", {'TARGETPLATFORM': '.'})
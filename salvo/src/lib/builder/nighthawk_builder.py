@@ -1,8 +1,10 @@
 """Module to build NightHawk artifacts."""
 import logging
+from typing import Optional
 
 from src.lib.builder import base_builder
-from src.lib import (constants, cmd_exec, source_manager)
+from src.lib.common import trace
+from src.lib import (constants, cmd_exec, execution_context, source_manager)
 import api.source_pb2 as proto_source
 
 log = logging.getLogger(__name__)
@@ -12,7 +14,8 @@ class NightHawkBuilderError(Exception):
   """An error raised when an unrecoverable situation occurs when building NightHawk components."""
 
 
-def _execute_docker_image_script(script: str, build_dir: str) -> None:
+@trace.traced('NightHawkBuilder.create_docker_image', 'script')
+def _execute_docker_image_script(script: str, cmd_params: cmd_exec.CommandParameters) -> None:
   """Run the specified script to build a docker image.
 
   The docker image tags are "fixed" at "latest" for the binary container.
@@ -27,9 +30,9 @@ def _execute_docker_image_script(script: str, build_dir: str) -> None:
   Args:
     script: The shell script in the nighthawk repository that builds
       the benchmark and binary docker images.
-    build_dir: The nighthawk source location
+    cmd_params: The parameters of the script, run in the nighthawk source
+      location
   """
-  cmd_params = cmd_exec.CommandParameters(cwd=build_dir)
   output = cmd_exec.run_command(script, cmd_params)
   log.debug(f"NightHawk Docker image output for {script}: {output}")
 
@@ -37,14 +40,18 @@ def _execute_docker_image_script(script: str, build_dir: str) -> None:
 class NightHawkBuilder(base_builder.BaseBuilder):
   """This class encapsulates the logic to build the nighthawk binaries benchmark scripts, and container images from source."""
 
-  def __init__(self, manager: source_manager.SourceManager) -> None:
+  def __init__(self,
+               manager: source_manager.SourceManager,
+               context: Optional[execution_context.ExecutionContext] = None) -> None:
     """Initialize the builder with the location of the source and the commit hash at which we are \
     operating.
 
     Args:
       manager: The SourceManager object handling the source code used by this builder object
+      context: The execution context from which the context of the builder
+        is derived. The default is the environment of Salvo
     """
-    super(NightHawkBuilder, self).__init__(manager)
+    super(NightHawkBuilder, self).__init__(manager, context)
     self._source_repo = self._source_manager.get_source_repository(
         proto_source.SourceRepository.SourceIdentity.SRCID_NIGHTHAWK)
 
@@ -75,8 +82,12 @@ class NightHawkBuilder(base_builder.BaseBuilder):
 
     log.debug(f"NightHawk source path: [{self._build_dir}]")
 
-    self._run_bazel_clean()
+    # The outputs of the previous build are reused if the build cache is kept
+    # between jobs
+    if not self._source_manager.get_build_cache_dir():
+      self._run_bazel_clean()
 
+  @trace.traced()
   def build_nighthawk_benchmarks(self) -> None:
     """Build the NightHawk benchmarks target.
 
@@ -84,7 +95,7 @@ class NightHawkBuilder(base_builder.BaseBuilder):
     requisite to building the benchmark container image
     """
     self.prepare_nighthawk_source()
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
+    cmd_params = self._get_command_parameters()
 
     bazel_options = self._generate_bazel_options(
         proto_source.SourceRepository.SourceIdentity.SRCID_NIGHTHAWK)
@@ -93,13 +104,14 @@ class NightHawkBuilder(base_builder.BaseBuilder):
 
     log.debug(f"Nighthawk build output: {output}")
 
+  @trace.traced()
   def build_nighthawk_binaries(self) -> None:
     """Build the NightHawk client and server binaries.
 
     This is a pre-requisite to building the nighthawk binary docker image
     """
     self.prepare_nighthawk_source()
-    cmd_params = cmd_exec.CommandParameters(cwd=self._build_dir)
+    cmd_params = self._get_command_parameters()
 
     bazel_options = self._generate_bazel_options(
         proto_source.SourceRepository.SourceIdentity.SRCID_NIGHTHAWK)
@@ -111,9 +123,10 @@ class NightHawkBuilder(base_builder.BaseBuilder):
   def build_nighthawk_benchmark_image(self) -> None:
     """Build the NightHawk benchmark docker image."""
     self.build_nighthawk_benchmarks()
-    _execute_docker_image_script(constants.NH_BENCHMARK_IMAGE_SCRIPT, self._build_dir)
+    _execute_docker_image_script(constants.NH_BENCHMARK_IMAGE_SCRIPT,
+                                 self._get_command_parameters())
 
   def build_nighthawk_binary_image(self) -> None:
     """Build the NightHawk binary docker image."""
     self.build_nighthawk_binaries()
-    _execute_docker_image_script(constants.NH_BINARY_IMAGE_SCRIPT, self._build_dir)
+    _execute_docker_image_script(constants.NH_BINARY_IMAGE_SCRIPT, self._get_command_parameters())
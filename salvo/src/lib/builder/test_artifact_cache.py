@@ -0,0 +1,53 @@
+"""Test the cache of artifacts compiled from a source commit."""
+import json
+import os
+import pytest
+
+from src.lib.builder import artifact_cache
+
+
+def test_get_artifact_key():
+  """Verify that the key depends on both the commit and the build command."""
+  key = artifact_cache.get_artifact_key('v1.16.0', 'bazel build -c opt //source/exe:envoy-static')
+
+  assert key == artifact_cache.get_artifact_key('v1.16.0',
+                                                'bazel build -c opt //source/exe:envoy-static')
+  assert key != artifact_cache.get_artifact_key('v1.17.0',
+                                                'bazel build -c opt //source/exe:envoy-static')
+  assert key != artifact_cache.get_artifact_key('v1.16.0',
+                                                'bazel build -c dbg //source/exe:envoy-static')
+
+
+def test_store_and_get_artifact(tmp_path):
+  """Verify that a stored artifact is returned with a manifest describing it."""
+  binary = tmp_path / 'envoy-static'
+  binary.write_text('envoy')
+  cache = artifact_cache.ArtifactCache(str(tmp_path / 'artifacts'))
+
+  assert cache.get_artifact('key', 'envoy-static') is None
+
+  cached_path = cache.store_artifact('key', 'envoy-static', str(binary), 'v1.16.0: bazel build')
+
+  assert cache.get_artifact('key', 'envoy-static') == cached_path
+  with open(cached_path) as cached_file:
+    assert cached_file.read() == 'envoy'
+  assert sorted(os.listdir(
+      cache.get_entry_directory('key'))) == ['envoy-static', artifact_cache.MANIFEST_FILE]
+
+  with open(os.path.join(cache.get_entry_directory('key'),
+                         artifact_cache.MANIFEST_FILE)) as manifest_file:
+    assert json.load(manifest_file) == {'envoy-static': 'v1.16.0: bazel build'}
+
+
+def test_store_missing_artifact(tmp_path):
+  """Verify that an error is raised and no partial file remains when the artifact is missing."""
+  cache = artifact_cache.ArtifactCache(str(tmp_path))
+
+  with pytest.raises(artifact_cache.ArtifactCacheError):
+    cache.store_artifact('key', 'envoy-static', str(tmp_path / 'missing'), 'v1.16.0')
+
+  assert os.listdir(cache.get_entry_directory('key')) == []
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -1,13 +1,22 @@
 """Test envoy building operations."""
+import os
 import pytest
 from unittest import mock
 
 import api.source_pb2 as proto_source
 import api.control_pb2 as proto_control
-from src.lib.builder import envoy_builder
+from src.lib.builder import (artifact_cache, envoy_builder)
 from src.lib import (constants, source_tree, source_manager)
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+  """Keep the artifacts cached by each test in a temporary directory."""
+  with mock.patch('src.lib.builder.artifact_cache.get_default_cache_dir',
+                  return_value=str(tmp_path)):
+    yield str(tmp_path)
+
+
 def _check_call_side_effect(args, parameters):
   """Examine the incoming arguments for command execution and return the expected or unexpected output.
 
@@ -26,19 +35,16 @@ def _check_call_side_effect(args, parameters):
     return "building..."
   elif args == "bazel build -c opt external:su-exec":
     return "building su-exec ..."
-  elif args == ("cp -fv bazel-bin/source/exe/envoy-static "
-                "build_release_stripped/envoy"):
+  elif args.startswith("cp -fv ") and args.endswith("envoy-static build_release_stripped/envoy"):
     return "copied..."
-  elif args == ("cp -fv bazel-bin/external/com_github_ncopa_suexec/su-exec "
-                "build_release/su-exec"):
+  elif args.startswith("cp -fv ") and args.endswith("su-exec build_release/su-exec"):
     return "copying su-exec for Dockerfile..."
-  elif args == ("objcopy --strip-debug bazel-bin/source/exe/envoy-static "
-                "build_release_stripped/envoy"):
+  elif args.startswith("objcopy --only-keep-debug ") and \
+      args.endswith("envoy-static build_debuginfo/envoy.debug"):
+    return "extracted debug information..."
+  elif args.startswith("objcopy --strip-debug --add-gnu-debuglink=") and \
+      args.endswith("envoy-static build_release_stripped/envoy") and "envoy.debug " in args:
     return "stripped..."
-  elif args == ("docker build -f ci/Dockerfile-envoy -t "
-                "envoyproxy/envoy-dev:v1.16.0 --build-arg "
-                "TARGETPLATFORM='.' ."):
-    return "docker build output..."
 
   raise NotImplementedError(f"Unhandled arguments in call: {args}")
 
@@ -62,12 +68,89 @@ def test_build_envoy_binary_from_source(mock_copy_source, mock_checkout_hash, mo
   assert constants.ENVOY_BINARY_TARGET_OUTPUT_PATH in binary_path
 
 
+@mock.patch('src.lib.cmd_exec.run_check_command')
+@mock.patch('src.lib.cmd_exec.run_command')
+@mock.patch.object(source_tree.SourceTree, 'checkout_commit_hash')
+@mock.patch.object(source_tree.SourceTree, 'copy_source_directory')
+def test_build_envoy_binary_from_cache(mock_copy_source, mock_checkout_hash, mock_run_command,
+                                       mock_run_check_command, cache_dir):
+  """Verify that a binary compiled for the same commit and options is reused."""
+  mock_run_command.side_effect = _check_call_side_effect
+  mock_run_check_command.side_effect = _check_call_side_effect
+
+  manager = _generate_default_source_manager()
+  builder = envoy_builder.EnvoyBuilder(manager)
+
+  compiled_binary = os.path.join(cache_dir, 'envoy-static')
+  with open(compiled_binary, 'w') as binary_file:
+    binary_file.write('envoy')
+  key = artifact_cache.get_artifact_key('v1.16.0',
+                                        "bazel build -c opt " + constants.ENVOY_BINARY_BUILD_TARGET)
+  cached_binary = artifact_cache.ArtifactCache().store_artifact(key, 'envoy-static',
+                                                                compiled_binary, 'test')
+
+  binary_path = builder.build_envoy_binary_from_source()
+
+  assert binary_path == cached_binary
+  mock_run_check_command.assert_not_called()
+  mock_copy_source.assert_not_called()
+  mock_checkout_hash.assert_not_called()
+
+  builder.stage_envoy(False)
+  mock_run_command.assert_called_once_with(f"cp -fv {cached_binary} build_release_stripped/envoy",
+                                           mock.ANY)
+
+
+@mock.patch('src.lib.cmd_exec.run_check_command')
+@mock.patch('src.lib.cmd_exec.run_command')
+@mock.patch.object(source_tree.SourceTree, 'copy_source_directory')
+def test_build_two_hashes_in_one_job(mock_copy_source, mock_run_command, mock_run_check_command,
+                                     cache_dir, tmp_path):
+  """Verify that the baseline and candidate of a job build their own commit in their own tree."""
+  checkouts = {}
+
+  def run_command(cmd, cmd_params):
+    if cmd.startswith("git checkout "):
+      commit_hash = cmd.split()[-1]
+      checkouts[commit_hash] = cmd_params.cwd
+      return f"HEAD is now at {commit_hash[:8]}"
+    return _check_call_side_effect(cmd, cmd_params)
+
+  def build(cmd, cmd_params):
+    binary_path = os.path.join(cmd_params.cwd, constants.ENVOY_BINARY_TARGET_OUTPUT_PATH)
+    os.makedirs(os.path.dirname(binary_path), exist_ok=True)
+    with open(binary_path, 'w') as binary_file:
+      binary_file.write(cmd_params.cwd)
+    return "building..."
+
+  mock_run_command.side_effect = run_command
+  mock_run_check_command.side_effect = build
+  cache = source_manager.SourceCache(str(tmp_path))
+  binaries = {}
+  for commit_hash in ['a' * 40, 'b' * 40]:
+    control = proto_control.JobControl(remote=False, binary_benchmark=True)
+    control.source.add(identity=proto_source.SourceRepository.SourceIdentity.SRCID_ENVOY,
+                       source_path='/some_random_envoy_directory',
+                       commit_hash=commit_hash)
+    builder = envoy_builder.EnvoyBuilder(source_manager.SourceManager(control, cache))
+    binaries[commit_hash] = builder.build_envoy_binary_from_source()
+
+  assert checkouts['a' * 40] != checkouts['b' * 40]
+  for commit_hash, binary_path in binaries.items():
+    key = artifact_cache.get_artifact_key(
+        commit_hash, "bazel build -c opt " + constants.ENVOY_BINARY_BUILD_TARGET)
+    assert binary_path == artifact_cache.ArtifactCache().get_artifact(key, 'envoy-static')
+    with open(binary_path) as binary_file:
+      assert binary_file.read() == checkouts[commit_hash]
+
+
+@mock.patch('src.lib.docker_management.image_assembler.ImageAssembler.assemble')
 @mock.patch('src.lib.cmd_exec.run_check_command')
 @mock.patch('src.lib.cmd_exec.run_command')
 @mock.patch.object(source_tree.SourceTree, 'checkout_commit_hash')
 @mock.patch.object(source_tree.SourceTree, 'copy_source_directory')
 def test_build_envoy_image_from_source(mock_copy_source, mock_checkout_hash, mock_run_command,
-                                       mock_run_check_command):
+                                       mock_run_check_command, mock_assemble):
   """Verify the calls made to build an envoy image from a source tree."""
   mock_copy_source.return_value = None
   mock_checkout_hash.return_value = None
@@ -80,6 +163,37 @@ def test_build_envoy_image_from_source(mock_copy_source, mock_checkout_hash, moc
 
   mock_copy_source.assert_called_once()
   mock_checkout_hash.assert_called_once()
+  mock_assemble.assert_called_once()
+
+
+@mock.patch('src.lib.docker_management.image_assembler.ImageAssembler.assemble')
+@mock.patch('src.lib.cmd_exec.run_check_command')
+@mock.patch('src.lib.cmd_exec.run_command')
+@mock.patch.object(source_tree.SourceTree, 'checkout_commit_hash')
+@mock.patch.object(source_tree.SourceTree, 'copy_source_directory')
+def test_build_envoy_image_from_cache(mock_copy_source, mock_checkout_hash, mock_run_command,
+                                      mock_run_check_command, mock_assemble, cache_dir):
+  """Verify that an image of a cached binary checks out the source only for its Dockerfile."""
+  mock_run_command.side_effect = _check_call_side_effect
+  mock_run_check_command.side_effect = _check_call_side_effect
+
+  manager = _generate_default_source_manager()
+  builder = envoy_builder.EnvoyBuilder(manager)
+  key = artifact_cache.get_artifact_key('v1.16.0',
+                                        "bazel build -c opt " + constants.ENVOY_BINARY_BUILD_TARGET)
+  for name in ['envoy-static', 'envoy.debug', 'su-exec']:
+    artifact_path = os.path.join(cache_dir, name)
+    with open(artifact_path, 'w') as artifact_file:
+      artifact_file.write(name)
+    artifact_cache.ArtifactCache().store_artifact(key, name, artifact_path, 'test')
+
+  builder.build_envoy_image_from_source()
+
+  mock_copy_source.assert_called_once()
+  mock_checkout_hash.assert_called_once()
+  mock_run_check_command.assert_not_called()
+  assert [call[0][0].split()[0] for call in mock_run_command.call_args_list] == ['objcopy', 'cp']
+  mock_assemble.assert_called_once()
 
 
 @mock.patch.object(source_manager.SourceManager, 'get_source_repository')
@@ -104,37 +218,56 @@ def test_stage_envoy(mock_run_command):
   """Verify the commands used to stage the envoy binary for docker image construction."""
   mock_run_command.side_effect = _check_call_side_effect
 
+  manager = _generate_default_source_manager()
+  builder = envoy_builder.EnvoyBuilder(manager)
+  build_dir = manager.get_source_tree(
+      proto_source.SourceRepository.SRCID_ENVOY).get_source_directory()
   calls = [
       mock.call(("cp -fv bazel-bin/source/exe/envoy-static "
                  "build_release_stripped/envoy"), mock.ANY),
-      mock.call(("objcopy --strip-debug bazel-bin/source/exe/envoy-static "
-                 "build_release_stripped/envoy"), mock.ANY)
+      mock.call(("objcopy --only-keep-debug bazel-bin/source/exe/envoy-static "
+                 "build_debuginfo/envoy.debug"), mock.ANY),
+      mock.call(
+          (f"objcopy --strip-debug --add-gnu-debuglink={build_dir}/build_debuginfo/envoy.debug "
+           "bazel-bin/source/exe/envoy-static build_release_stripped/envoy"), mock.ANY)
   ]
-  manager = _generate_default_source_manager()
-  builder = envoy_builder.EnvoyBuilder(manager)
-  builder.stage_envoy(False)
-  builder.stage_envoy(True)
+  assert builder.stage_envoy(False) is None
+  debuginfo_path = builder.stage_envoy(True)
 
   mock_run_command.assert_has_calls(calls)
+  assert debuginfo_path == os.path.join(build_dir, "build_debuginfo/envoy.debug")
 
 
-@mock.patch('glob.glob')
 @mock.patch('src.lib.cmd_exec.run_command')
-def test_create_docker_image(mock_run_command, mock_glob):
-  """Verify that we issue the correct commands to build an envoy docker image."""
+def test_stage_envoy_cached_debuginfo(mock_run_command, cache_dir):
+  """Verify that debug information in the artifact cache is linked rather than extracted again."""
   mock_run_command.side_effect = _check_call_side_effect
-  mock_glob.return_value = ['docker_ignore_file1', 'docker_ignore_file2']
 
+  manager = _generate_default_source_manager()
+  builder = envoy_builder.EnvoyBuilder(manager)
+  debuginfo_file = os.path.join(cache_dir, 'envoy.debug')
+  with open(debuginfo_file, 'w') as debuginfo:
+    debuginfo.write('debug information')
+  key = artifact_cache.get_artifact_key('v1.16.0',
+                                        "bazel build -c opt " + constants.ENVOY_BINARY_BUILD_TARGET)
+  cached_debuginfo = artifact_cache.ArtifactCache().store_artifact(key, 'envoy.debug',
+                                                                   debuginfo_file, 'test')
+
+  assert builder.stage_envoy(True) == cached_debuginfo
+  mock_run_command.assert_called_once_with(
+      f"objcopy --strip-debug --add-gnu-debuglink={cached_debuginfo} "
+      "bazel-bin/source/exe/envoy-static build_release_stripped/envoy", mock.ANY)
+
+
+@mock.patch('src.lib.docker_management.image_assembler.ImageAssembler.assemble')
+def test_create_docker_image(mock_assemble):
+  """Verify that we assemble the envoy docker image from the staged binaries."""
   manager = _generate_default_source_manager()
   builder = envoy_builder.EnvoyBuilder(manager)
   builder.create_docker_image()
 
-  calls = [
-      mock.call(("docker build -f ci/Dockerfile-envoy -t "
-                 "envoyproxy/envoy-dev:v1.16.0 --build-arg "
-                 "TARGETPLATFORM='.' ."), mock.ANY)
-  ]
-  mock_run_command.assert_has_calls(calls)
+  mock_assemble.assert_called_once_with(builder._build_dir, 'ci/Dockerfile-envoy',
+                                        'envoyproxy/envoy-dev:v1.16.0', {'TARGETPLATFORM': '.'})
 
 
 def _generate_default_source_manager():
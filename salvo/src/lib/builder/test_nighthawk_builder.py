@@ -1,4 +1,5 @@
 """Test envoy building operations."""
+import os
 import pytest
 from unittest import mock
 
@@ -45,8 +46,12 @@ def test_prepare_nighthawk_source(mock_pull, mock_copy_source, mock_get_source_d
                   mock.MagicMock(return_value="Cleaned...")) as mock_cmd:
     builder.prepare_nighthawk_source()
 
-  params = cmd_exec.CommandParameters(cwd='/tmp/nighthawk_source_dir')
-  mock_cmd.assert_called_once_with(_BAZEL_CLEAN_CMD, params)
+  mock_cmd.assert_called_once_with(_BAZEL_CLEAN_CMD, mock.ANY)
+  params = mock_cmd.call_args[0][1]
+  assert params.cwd == '/tmp/nighthawk_source_dir'
+  # Bazel runs with the cache directory of the builder as HOME
+  assert params.env['HOME'] == builder.get_context().get_home()
+  assert params.env['HOME'] != os.environ.get('HOME')
   mock_pull.assert_called_once()
   mock_copy_source.assert_called_once()
 
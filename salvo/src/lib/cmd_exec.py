@@ -1,20 +1,126 @@
 """Module to execute a command and return the output generated. Returns both stdout and stderr in \
   the buffer. We also convert bytes objects to a string so callers manipulate one type of object."""
+import contextlib
+import os
 import shlex
 import subprocess
+import threading
+import time
 import typing
 import logging
 import tempfile
 
+from src.lib.common import (cgroup, cost_accounting)
+
 log = logging.getLogger(__name__)
 
-# Encapsulates parameters and their values required to execute a command
-CommandParameters = typing.NamedTuple(
-    "CommandParameters",
-    [
-        ('cwd', str),  # A string specifying the working directory of the executing
-        # command
-    ])
+
+class CommandParameters(typing.NamedTuple):
+  """Encapsulates parameters and their values required to execute a command."""
+
+  # A string specifying the working directory of the executing command
+  cwd: str
+  # The complete environment of the command, or None to inherit the
+  # environment of Salvo
+  env: typing.Optional[typing.Dict[str, str]] = None
+
+
+# The CPUs and cgroup into which the commands started by a thread are placed
+_placement = threading.local()
+
+
+@contextlib.contextmanager
+def process_placement(cpus: typing.Set[int], cgroup_procs: str = '') -> typing.Iterator[None]:
+  """Place the commands started by the current thread on a set of CPUs and into a cgroup.
+
+  Commands inherit the placement when they fork, so daemons such as the
+  Bazel server started by a placed command remain placed. The containers
+  run and the images built through the docker API by the thread are pinned
+  to the CPUs as well, see get_placement_cpus.
+
+  Args:
+    cpus: The CPUs on which the commands may run. If empty, the affinity
+      is inherited from Salvo
+    cgroup_procs: The cgroup.procs file of the cgroup receiving the
+      commands. If empty, the commands remain in the cgroup of Salvo
+  """
+  previous = (getattr(_placement, 'cpus', None), getattr(_placement, 'cgroup_procs', ''))
+  _placement.cpus = cpus
+  _placement.cgroup_procs = cgroup_procs
+  try:
+    yield
+  finally:
+    _placement.cpus, _placement.cgroup_procs = previous
+
+
+def get_placement_cpus() -> str:
+  """Return the cpuset list of the placement of the current thread, or an empty string if none.
+
+  The docker daemon, not Salvo, starts the containers of the thread, so they
+  are pinned by passing this list to docker.
+  """
+  cpus = getattr(_placement, 'cpus', None)
+  return cgroup.format_cpu_list(cpus) if cpus else ''
+
+
+def _place_command(cmd_array: typing.List[str]) -> typing.List[str]:
+  """Wrap a command so that it is placed before it executes, if the current thread has a placement.
+
+  Python code run in the forked child, such as a preexec_fn, is unsafe while
+  other threads of Salvo run. Instead, a shell moves itself into the cgroup
+  and taskset sets the affinity, each replacing itself with the next
+  program, so the command starts placed under the same process id.
+
+  Args:
+    cmd_array: The command and its arguments
+
+  Returns:
+    the command to execute
+  """
+  cpus = getattr(_placement, 'cpus', None)
+  cgroup_procs = getattr(_placement, 'cgroup_procs', '')
+
+  placed = list(cmd_array)
+  if cpus:
+    placed = ['taskset', '--cpu-list', cgroup.format_cpu_list(cpus)] + placed
+  if cgroup_procs:
+    placed = ['sh', '-c', 'echo $$ > "$1" && shift && exec "$@"', 'sh', cgroup_procs] + placed
+  return placed
+
+
+def _call(cmd_array: typing.List[str], name: str = '', **kwargs) -> int:
+  """Run a command to completion and record the resources it consumed.
+
+  Args:
+    cmd_array: The command and its arguments
+    name: The name under which the usage of the command is recorded. The
+      default is the program of the command
+    kwargs: Additional arguments provided to Popen
+
+  Returns:
+    the exit code of the command
+
+  Raises:
+    subprocess.CalledProcessError: if the command exits with a non-zero exit
+      code
+  """
+  start = time.perf_counter()
+  process = subprocess.Popen(cmd_array, **kwargs)
+  try:
+    # Unlike Popen.wait, wait4 returns the resources used by the process and
+    # the descendants it waited for
+    _, status, rusage = os.wait4(process.pid, 0)
+  except BaseException:
+    process.wait()
+    raise
+
+  process.returncode = os.waitstatus_to_exitcode(status)
+  cost_accounting.record_process(
+      cost_accounting.usage_from_rusage(name or cmd_array[0], rusage,
+                                        time.perf_counter() - start))
+  if process.returncode:
+    raise subprocess.CalledProcessError(process.returncode, cmd_array)
+  return process.returncode
 
 
 def run_command(cmd: str, parameters: CommandParameters) -> str:
@@ -44,10 +150,14 @@ def run_command(cmd: str, parameters: CommandParameters) -> str:
   tmpfile = tempfile.TemporaryFile(mode='w+', dir=params['cwd'], prefix='cmd_output')
 
   try:
-    log.debug(f"Executing command: [{cmd}] with args [{parameters._asdict()}]")
+    log.debug(f"Executing command: [{cmd}] in [{parameters.cwd}]")
     cmd_array = shlex.split(cmd)
 
-    subprocess.check_call(cmd_array, stdout=tmpfile, stderr=tmpfile, **parameters._asdict())
+    _call(_place_command(cmd_array),
+          name=cmd_array[0],
+          stdout=tmpfile,
+          stderr=tmpfile,
+          **parameters._asdict())
 
   except subprocess.CalledProcessError as process_error:
     log.error(f"Unable to execute [{cmd}]: {process_error}")
@@ -83,10 +193,36 @@ def run_check_command(cmd: str, parameters: CommandParameters) -> None:
       code
   """
   try:
-    log.debug(f"Executing command: [{cmd}] with args [{parameters._asdict()}]")
+    log.debug(f"Executing command: [{cmd}] in [{parameters.cwd}]")
     cmd_array = shlex.split(cmd)
-    subprocess.check_call(cmd_array, stderr=subprocess.STDOUT, **parameters._asdict())
+    _call(_place_command(cmd_array),
+          name=cmd_array[0],
+          stderr=subprocess.STDOUT,
+          **parameters._asdict())
 
   except subprocess.CalledProcessError as process_error:
     log.error(f"Unable to execute [{cmd}]: {process_error}")
     raise
+
+
+def start_command(cmd: str, parameters: CommandParameters, output: typing.IO) -> subprocess.Popen:
+  """Start the specified command without waiting for it to complete.
+
+  This is used for helper processes, such as profilers, that run alongside
+  a benchmark and are stopped by the caller once the benchmark finishes.
+
+  Args:
+      cmd: The command to be executed
+      parameters: Additional arguments provided to Popen. See run_command
+        for the supported parameters.
+      output: A file object receiving the stdout and stderr of the command
+
+  Returns:
+      The Popen object for the started process
+  """
+  log.debug(f"Starting command: [{cmd}] in [{parameters.cwd}]")
+  cmd_array = shlex.split(cmd)
+  return subprocess.Popen(_place_command(cmd_array),
+                          stdout=output,
+                          stderr=output,
+                          **parameters._asdict())
@@ -0,0 +1,126 @@
+"""Index the commits and tags of a source tree for repeated lookups.
+
+Resolving the predecessor of a commit or tag with git forks a process for
+every lookup. The indexes here are built from a single listing of the
+commits of the branch and of the tags of the repository, and answer each
+lookup in memory: a commit by its full hash in constant time or by an
+abbreviated hash with a binary search, and a tag by its position among the
+tags sorted by version. The source tree rebuilds them when it fetches the
+repository.
+
+The commits are indexed in the order listed by "git rev-list", so the
+ancestors of a commit follow it in the index as long as the history of the
+branch is linear, which holds for branches merged by squashing.
+"""
+import bisect
+from typing import (List, Optional)
+
+# Abbreviated hashes shorter than this are not resolved, matching git
+MIN_ABBREVIATED_LENGTH = 4
+
+
+class CommitIndex(object):
+  """The commits of a branch, newest first."""
+
+  def __init__(self, commits: List[str]) -> None:
+    """Index the commits of a branch.
+
+    Args:
+      commits: The hashes of the commits listed by "git rev-list", newest
+        first
+    """
+    self._commits = commits
+    self._positions = {commit_hash: position for position, commit_hash in enumerate(commits)}
+    self._sorted_hashes = sorted(self._positions)
+
+  def __len__(self) -> int:
+    """Return the number of indexed commits."""
+    return len(self._commits)
+
+  def get_head(self) -> str:
+    """Return the newest commit, or an empty string if no commit is indexed."""
+    return self._commits[0] if self._commits else ''
+
+  def resolve(self, commit: str) -> Optional[str]:
+    """Return the full hash of a commit from a full or abbreviated hash.
+
+    Args:
+      commit: The full hash or a unique prefix of the hash of a commit
+
+    Returns:
+      the full hash, or None if the commit is not indexed or the prefix is
+        ambiguous
+    """
+    if commit in self._positions:
+      return commit
+    if len(commit) < MIN_ABBREVIATED_LENGTH:
+      return None
+
+    index = bisect.bisect_left(self._sorted_hashes, commit)
+    matches = self._sorted_hashes[index:index + 2]
+    if not matches or not matches[0].startswith(commit):
+      return None
+    if len(matches) > 1 and matches[1].startswith(commit):
+      return None
+    return matches[0]
+
+  def has_history(self, commit: str, revisions: int) -> bool:
+    """Return whether the index holds a number of revisions from a commit, the commit included."""
+    full_hash = self.resolve(commit)
+    return full_hash is not None and \
+        self._positions[full_hash] + max(revisions, 1) <= len(self._commits)
+
+  def get_ancestor(self, commit: str, revisions: int) -> Optional[str]:
+    """Return the commit a number of revisions behind a commit.
+
+    The count includes the commit itself, so one revision is the commit, as
+    with "git rev-list --max-count". The oldest indexed commit is returned
+    if the history is shorter than the requested revisions.
+
+    Args:
+      commit: The full or abbreviated hash of the commit
+      revisions: The number of commits listed from the commit
+
+    Returns:
+      the hash of the ancestor, or None if the commit is not indexed
+    """
+    full_hash = self.resolve(commit)
+    if full_hash is None:
+      return None
+
+    position = self._positions[full_hash] + max(revisions, 1) - 1
+    return self._commits[min(position, len(self._commits) - 1)]
+
+
+class TagIndex(object):
+  """The tags of a repository, sorted by version."""
+
+  def __init__(self, tags: List[str]) -> None:
+    """Index the tags of a repository.
+
+    Args:
+      tags: The tags listed by "git tag --sort v:refname", oldest version
+        first
+    """
+    self._tags = tags
+    self._positions = {tag: position for position, tag in enumerate(tags)}
+
+  def get_tags(self) -> List[str]:
+    """Return the tags, oldest version first."""
+    return list(self._tags)
+
+  def get_previous_tag(self, tag: str, revisions: int = 1) -> str:
+    """Return the tag a number of versions before a tag.
+
+    Args:
+      tag: The current tag
+      revisions: The number of versions to step back
+
+    Returns:
+      the previous tag, or an empty string if the tag is unknown or has
+        fewer previous versions
+    """
+    position = self._positions.get(tag)
+    if position is None or position < revisions:
+      return ''
+    return self._tags[position - revisions]
@@ -0,0 +1,372 @@
+"""Pack the output directories of benchmarks into a compressed, deduplicated store.
+
+Files whose content appears more than once, such as the configurations
+repeated across runs, are stored once in the object directory of the store,
+named after the sha256 of their content. The remaining files of each run
+are compressed into a single archive. Each file is compressed into an
+independent zstd frame, and the index of the run records where the frame
+starts, so that a file is read without decompressing the rest of the
+archive:
+
+  <store>/objects/<sha[:2]>/<sha>.zst
+  <store>/runs/<run>.pack
+  <store>/runs/<run>.index.json
+
+A marker file left in each packed directory names its run, so that
+open_artifact() reads the files of a directory whether or not they were
+packed.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import (Dict, IO, List, NamedTuple)
+
+import zstandard
+
+log = logging.getLogger(__name__)
+
+MARKER_FILE = 'PACKED.json'
+OBJECT_DIRECTORY = 'objects'
+RUN_DIRECTORY = 'runs'
+
+DEFAULT_COMPRESSION_LEVEL = 9
+
+_INDEX_SUFFIX = '.index.json'
+_PACK_SUFFIX = '.pack'
+_READ_SIZE = 1 << 20
+
+
+class ArtifactStoreError(Exception):
+  """Error raised when artifacts cannot be packed or read from the store."""
+
+
+class _PackedFile(NamedTuple):
+  """A file of a run directory selected for packing."""
+
+  path: str
+  relative_path: str
+  size: int
+  sha256: str
+
+
+def _hash_file(path: str) -> str:
+  """Return the sha256 of the content of a file."""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as input_file:
+    for chunk in iter(lambda: input_file.read(_READ_SIZE), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _list_files(run_dir: str, excluded_dir: str) -> List[str]:
+  """Return the paths of the regular files below a run directory.
+
+  Symbolic links, the marker file and the files below the excluded
+  directory are left in place.
+  """
+  paths = []
+  for root, dirs, files in os.walk(run_dir):
+    dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != excluded_dir)
+    for name in sorted(files):
+      path = os.path.join(root, name)
+      if os.path.islink(path) or not os.path.isfile(path):
+        continue
+      if root == run_dir and name == MARKER_FILE:
+        continue
+      paths.append(path)
+  return paths
+
+
+def _remove_empty_directories(run_dir: str) -> None:
+  """Remove the directories below a run directory that no longer contain files."""
+  for root, dirs, _ in os.walk(run_dir, topdown=False):
+    for name in dirs:
+      path = os.path.join(root, name)
+      if not os.path.islink(path) and not os.listdir(path):
+        os.rmdir(path)
+
+
+def _replace_file(path: str, content: bytes) -> None:
+  """Write a file atomically so that readers never see a partial file."""
+  file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+  with os.fdopen(file_descriptor, 'wb') as output_file:
+    output_file.write(content)
+  os.replace(temporary_path, path)
+
+
+class ArtifactPacker(object):
+  """Move the files of run directories into the artifact store."""
+
+  def __init__(self, store_dir: str, compression_level: int = 0) -> None:
+    """Initialize the packer.
+
+    Args:
+      store_dir: The directory holding the packed artifacts. It is created
+        if it does not exist
+      compression_level: The zstd compression level. If zero, the default
+        level is used
+    """
+    self._store_dir = os.path.abspath(store_dir)
+    self._compressor = zstandard.ZstdCompressor(
+        level=compression_level or DEFAULT_COMPRESSION_LEVEL)
+
+  def pack(self, run_dirs: List[str], keep_originals: bool = False) -> Dict[str, str]:
+    """Pack the files of run directories into the store.
+
+    Content found more than once across the run directories, or already
+    packed into the store, is written to the object directory. The other
+    files of each run are compressed into its archive.
+
+    Args:
+      run_dirs: The output directories of the runs. The name of a directory
+        is used as the name of its run, with a suffix if the store already
+        has a run of the same name
+      keep_originals: Leave the files in the run directories once packed
+
+    Returns:
+      the name of the run of each directory, by directory
+
+    Raises:
+      ArtifactStoreError: if a directory cannot be packed
+    """
+    for directory in [OBJECT_DIRECTORY, RUN_DIRECTORY]:
+      os.makedirs(os.path.join(self._store_dir, directory), exist_ok=True)
+
+    try:
+      run_files = {run_dir: self._scan(run_dir) for run_dir in run_dirs}
+    except OSError as scan_error:
+      raise ArtifactStoreError(f"Unable to read the artifacts to pack: {scan_error}")
+
+    # Content already archived by a run in the store counts as repeated, so
+    # that it is moved to an object rather than archived again
+    occurrences = dict.fromkeys(self._get_stored_content(), 1)
+    for packed_file in [f for files in run_files.values() for f in files]:
+      occurrences[packed_file.sha256] = occurrences.get(packed_file.sha256, 0) + 1
+
+    runs = {}
+    for run_dir, files in run_files.items():
+      run = self._get_run_name(run_dir)
+      try:
+        self._pack_run(run, run_dir, files, occurrences)
+      except OSError as pack_error:
+        raise ArtifactStoreError(f"Unable to pack [{run_dir}]: {pack_error}")
+
+      if not keep_originals:
+        for packed_file in files:
+          os.remove(packed_file.path)
+        _remove_empty_directories(run_dir)
+      runs[run_dir] = run
+    return runs
+
+  def _scan(self, run_dir: str) -> List[_PackedFile]:
+    """Hash the files of a run directory."""
+    if not os.path.isdir(run_dir):
+      raise ArtifactStoreError(f"No output directory to pack at [{run_dir}]")
+
+    files = []
+    for path in _list_files(run_dir, self._store_dir):
+      files.append(
+          _PackedFile(path=path,
+                      relative_path=os.path.relpath(path, run_dir),
+                      size=os.path.getsize(path),
+                      sha256=_hash_file(path)))
+    return files
+
+  def _get_stored_content(self) -> List[str]:
+    """Return the sha256 of the content archived by the runs in the store."""
+    run_dir = os.path.join(self._store_dir, RUN_DIRECTORY)
+    stored = []
+    for name in os.listdir(run_dir):
+      if not name.endswith(_INDEX_SUFFIX):
+        continue
+      try:
+        with open(os.path.join(run_dir, name)) as index_file:
+          stored += [entry['sha256'] for entry in json.load(index_file)['files'].values()]
+      except (OSError, ValueError, KeyError) as index_error:
+        log.warning(f"Ignoring the unreadable index [{name}]: {index_error}")
+    return stored
+
+  def _get_run_name(self, run_dir: str) -> str:
+    """Return a name for the run of a directory that is not used in the store."""
+    base_name = os.path.basename(os.path.normpath(run_dir))
+    run, suffix = base_name, 0
+    while os.path.exists(os.path.join(self._store_dir, RUN_DIRECTORY, run + _INDEX_SUFFIX)):
+      suffix += 1
+      run = f"{base_name}.{suffix}"
+    return run
+
+  def _get_object_path(self, sha256: str) -> str:
+    """Return the path of the object holding a content."""
+    return os.path.join(self._store_dir, OBJECT_DIRECTORY, sha256[:2], sha256 + '.zst')
+
+  def _write_object(self, packed_file: _PackedFile) -> None:
+    """Compress a file into the object directory unless its content is already stored."""
+    object_path = self._get_object_path(packed_file.sha256)
+    if os.path.exists(object_path):
+      return
+
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(object_path))
+    with open(packed_file.path, 'rb') as input_file, os.fdopen(file_descriptor,
+                                                               'wb') as output_file:
+      self._compressor.copy_stream(input_file, output_file, size=packed_file.size)
+    os.replace(temporary_path, object_path)
+
+  def _pack_run(self, run: str, run_dir: str, files: List[_PackedFile],
+                occurrences: Dict[str, int]) -> None:
+    """Write the archive and the index of a run."""
+    run_path = os.path.join(self._store_dir, RUN_DIRECTORY, run)
+    index = {
+        'run': run,
+        'source': os.path.abspath(run_dir),
+        'packed': time.time(),
+        'files': {},
+    }
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(run_path))
+    with os.fdopen(file_descriptor, 'wb') as pack_file:
+      for packed_file in files:
+        entry = {'sha256': packed_file.sha256, 'size': packed_file.size}
+        if occurrences[packed_file.sha256] > 1:
+          self._write_object(packed_file)
+          entry['object'] = True
+        else:
+          entry['offset'] = pack_file.tell()
+          with open(packed_file.path, 'rb') as input_file:
+            self._compressor.copy_stream(input_file, pack_file, size=packed_file.size)
+          entry['length'] = pack_file.tell() - entry['offset']
+        index['files'][packed_file.relative_path] = entry
+    os.replace(temporary_path, run_path + _PACK_SUFFIX)
+
+    _replace_file(run_path + _INDEX_SUFFIX, json.dumps(index, indent=2).encode())
+    _replace_file(os.path.join(run_dir, MARKER_FILE),
+                  json.dumps({
+                      'store': self._store_dir,
+                      'run': run
+                  }).encode())
+
+    stored = sum(1 for entry in index['files'].values() if entry.get('object'))
+    log.info(f"Packed {len(files)} files of [{run_dir}] into run [{run}], "
+             f"{stored} of them in shared objects")
+
+
+class ArtifactReader(object):
+  """Read individual files of the runs in the artifact store."""
+
+  def __init__(self, store_dir: str) -> None:
+    """Initialize the reader.
+
+    Args:
+      store_dir: The directory holding the packed artifacts
+    """
+    self._store_dir = store_dir
+    self._indexes = {}
+    self._decompressor = zstandard.ZstdDecompressor()
+
+  def list_runs(self) -> List[str]:
+    """Return the names of the runs in the store."""
+    run_dir = os.path.join(self._store_dir, RUN_DIRECTORY)
+    if not os.path.isdir(run_dir):
+      return []
+    return sorted(
+        name[:-len(_INDEX_SUFFIX)] for name in os.listdir(run_dir) if name.endswith(_INDEX_SUFFIX))
+
+  def _get_index(self, run: str) -> Dict:
+    """Load the index of a run.
+
+    Raises:
+      ArtifactStoreError: if the run is not in the store
+    """
+    if run not in self._indexes:
+      index_path = os.path.join(self._store_dir, RUN_DIRECTORY, run + _INDEX_SUFFIX)
+      try:
+        with open(index_path) as index_file:
+          self._indexes[run] = json.load(index_file)
+      except (OSError, ValueError) as index_error:
+        raise ArtifactStoreError(f"Unable to load run [{run}]: {index_error}")
+    return self._indexes[run]
+
+  def list_files(self, run: str) -> List[str]:
+    """Return the paths of the files of a run, relative to its output directory."""
+    return sorted(self._get_index(run)['files'])
+
+  def read_bytes(self, run: str, relative_path: str) -> bytes:
+    """Decompress one file of a run.
+
+    Args:
+      run: The name of the run
+      relative_path: The path of the file, relative to the output directory
+        of the run
+
+    Returns:
+      the content of the file
+
+    Raises:
+      ArtifactStoreError: if the file is not in the run or is corrupted
+    """
+    entry = self._get_index(run)['files'].get(os.path.normpath(relative_path))
+    if entry is None:
+      raise ArtifactStoreError(f"No file [{relative_path}] in run [{run}]")
+
+    try:
+      if entry.get('object'):
+        object_path = os.path.join(self._store_dir, OBJECT_DIRECTORY, entry['sha256'][:2],
+                                   entry['sha256'] + '.zst')
+        with open(object_path, 'rb') as object_file:
+          frame = object_file.read()
+      else:
+        with open(os.path.join(self._store_dir, RUN_DIRECTORY, run + _PACK_SUFFIX),
+                  'rb') as pack_file:
+          pack_file.seek(entry['offset'])
+          frame = pack_file.read(entry['length'])
+      content = self._decompressor.decompress(frame, max_output_size=entry['size'])
+    except (OSError, zstandard.ZstdError) as read_error:
+      raise ArtifactStoreError(f"Unable to read [{relative_path}] of run [{run}]: {read_error}")
+
+    if hashlib.sha256(content).hexdigest() != entry['sha256']:
+      raise ArtifactStoreError(f"Corrupted content for [{relative_path}] in run [{run}]")
+    return content
+
+  def open(self, run: str, relative_path: str, mode: str = 'r') -> IO:
+    """Open one file of a run for reading.
+
+    Args:
+      run: The name of the run
+      relative_path: The path of the file, relative to the output directory
+        of the run
+      mode: 'r' to read text or 'rb' to read bytes
+
+    Returns:
+      a file object with the content of the file
+    """
+    content = io.BytesIO(self.read_bytes(run, relative_path))
+    return content if 'b' in mode else io.TextIOWrapper(content)
+
+
+def open_artifact(run_dir: str, relative_path: str, mode: str = 'r') -> IO:
+  """Open a file of a benchmark output directory, whether or not the directory was packed.
+
+  Args:
+    run_dir: The output directory of the benchmark
+    relative_path: The path of the file, relative to the output directory
+    mode: 'r' to read text or 'rb' to read bytes
+
+  Returns:
+    a file object with the content of the file
+
+  Raises:
+    FileNotFoundError: if the directory has no such file and was not packed
+    ArtifactStoreError: if the file cannot be read from the store
+  """
+  path = os.path.join(run_dir, relative_path)
+  marker_path = os.path.join(run_dir, MARKER_FILE)
+  if os.path.exists(path) or not os.path.exists(marker_path):
+    return open(path, mode)
+
+  with open(marker_path) as marker_file:
+    marker = json.load(marker_file)
+  return ArtifactReader(marker['store']).open(marker['run'], relative_path, mode)
@@ -0,0 +1,341 @@
+"""Helpers to fence processes onto CPUs and to control them through cgroup v2.
+
+Salvo creates cgroups beneath the cgroup in which it runs. This requires
+the unified (v2) hierarchy and write access to that cgroup, which is
+usually the case when Salvo runs as root or in a delegated systemd scope.
+"""
+import logging
+import os
+import signal
+from typing import (Dict, List, Set)
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+class CgroupError(Exception):
+  """Error raised when a cgroup cannot be created or controlled."""
+
+
+def parse_cpu_list(cpu_list: str) -> Set[int]:
+  """Convert a cpuset list such as "0-3,8" into the set of CPUs it contains.
+
+  Args:
+    cpu_list: A comma separated list of CPUs and inclusive CPU ranges
+
+  Returns:
+    the set of CPU numbers in the list
+
+  Raises:
+    CgroupError: if the list is malformed
+  """
+  cpus = set()
+  for item in filter(None, [i.strip() for i in cpu_list.split(',')]):
+    try:
+      bounds = [int(bound) for bound in item.split('-')]
+      first_cpu, last_cpu = bounds[0], bounds[-1]
+    except ValueError:
+      raise CgroupError(f"Invalid CPU list: [{cpu_list}]")
+
+    if len(bounds) > 2 or last_cpu < first_cpu:
+      raise CgroupError(f"Invalid CPU range [{item}] in [{cpu_list}]")
+    cpus.update(range(first_cpu, last_cpu + 1))
+
+  return cpus
+
+
+def format_cpu_list(cpus: Set[int]) -> str:
+  """Convert a set of CPUs into a cpuset list with consecutive CPUs collapsed into ranges.
+
+  Args:
+    cpus: The CPU numbers
+
+  Returns:
+    a cpuset list such as "0-3,8"
+  """
+  ranges = []
+  for cpu in sorted(cpus):
+    if ranges and ranges[-1][1] == cpu - 1:
+      ranges[-1][1] = cpu
+    else:
+      ranges.append([cpu, cpu])
+
+  return ','.join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+def get_unified_root() -> str:
+  """Return the mount point of the cgroup v2 hierarchy.
+
+  On hosts using the hybrid layout the v2 hierarchy is mounted beneath the
+  v1 controllers.
+
+  Returns:
+    the mount point, or an empty string if cgroup v2 is unavailable
+  """
+  for root in [CGROUP_ROOT, os.path.join(CGROUP_ROOT, 'unified')]:
+    if os.path.exists(os.path.join(root, 'cgroup.controllers')):
+      return root
+  return ''
+
+
+def get_process_cgroup(pid: str = 'self') -> str:
+  """Return the path of a process' cgroup relative to the v2 hierarchy.
+
+  Args:
+    pid: The process identifier, or 'self' for the running process
+
+  Returns:
+    the cgroup path, eg "/user.slice/session-1.scope"
+
+  Raises:
+    CgroupError: if the process is not attached to a v2 hierarchy
+  """
+  with open(f'/proc/{pid}/cgroup') as cgroup_file:
+    for line in cgroup_file:
+      hierarchy, _, path = line.strip().split(':', 2)
+      if hierarchy == '0':
+        return path
+
+  raise CgroupError(f"Process [{pid}] is not in a cgroup v2 hierarchy")
+
+
+def read_flat_keyed(path: str) -> Dict[str, int]:
+  """Read a cgroup interface file made of "key value" lines, such as cpu.stat.
+
+  Args:
+    path: The path of the interface file
+
+  Returns:
+    the value of each key
+
+  Raises:
+    CgroupError: if the file cannot be read
+  """
+  try:
+    with open(path) as interface_file:
+      return {
+          key: int(value) for key, value in (line.split() for line in interface_file if line.strip())
+      }
+  except (OSError, ValueError) as read_error:
+    raise CgroupError(f"Unable to read [{path}]: {read_error}")
+
+
+def _enable_controllers(path: str, controllers: List[str]) -> None:
+  """Enable controllers for the children of a cgroup.
+
+  Args:
+    path: The absolute path of the cgroup
+    controllers: The controllers to enable
+
+  Raises:
+    CgroupError: if a controller is unavailable or cannot be enabled
+  """
+  subtree_control = os.path.join(path, 'cgroup.subtree_control')
+  try:
+    with open(subtree_control) as control_file:
+      enabled = control_file.read().split()
+    missing = [controller for controller in controllers if controller not in enabled]
+    if missing:
+      with open(subtree_control, 'w') as control_file:
+        control_file.write(' '.join(f"+{controller}" for controller in missing))
+  except OSError as os_error:
+    raise CgroupError(f"Unable to enable the {', '.join(controllers)} controllers in "
+                      f"[{path}]: {os_error}")
+
+
+class Cgroup(object):
+  """A cgroup v2 node whose processes can be frozen, thawed and killed as a group."""
+
+  def __init__(self, path: str) -> None:
+    """Refer to an existing cgroup.
+
+    Args:
+      path: The absolute path of the cgroup directory
+    """
+    self._path = path
+
+  @classmethod
+  def create(cls, name: str, controllers: List[str] = None) -> 'Cgroup':
+    """Create a cgroup as a child of the cgroup in which Salvo runs.
+
+    A cgroup that limits resources is created beside the cgroup of Salvo
+    instead, since cgroup v2 does not enable controllers for the children
+    of a cgroup that contains processes.
+
+    Args:
+      name: The name of the new cgroup
+      controllers: The controllers, eg "cpu" and "memory", enabled in the
+        new cgroup
+
+    Returns:
+      the created Cgroup
+
+    Raises:
+      CgroupError: if cgroup v2 is unavailable, the controllers cannot be
+        enabled, or the cgroup cannot be created or written
+    """
+    root = get_unified_root()
+    if not root:
+      raise CgroupError("The cgroup v2 hierarchy is not mounted")
+
+    parent = root + get_process_cgroup()
+    if controllers:
+      parent = os.path.dirname(parent.rstrip('/'))
+      _enable_controllers(parent, controllers)
+
+    path = os.path.join(parent, name)
+    try:
+      os.makedirs(path, exist_ok=True)
+    except OSError as os_error:
+      raise CgroupError(f"Unable to create cgroup [{path}]: {os_error}")
+
+    cgroup = cls(path)
+    if not os.access(cgroup.get_procs_path(), os.W_OK):
+      os.rmdir(path)
+      raise CgroupError(f"Unable to move processes into cgroup [{path}]")
+
+    log.debug(f"Created cgroup {path}")
+    return cgroup
+
+  def get_path(self) -> str:
+    """Return the absolute path of the cgroup directory."""
+    return self._path
+
+  def get_procs_path(self) -> str:
+    """Return the path of the file to which a pid is written to move a process into the cgroup."""
+    return os.path.join(self._path, 'cgroup.procs')
+
+  def _write(self, name: str, value: str) -> None:
+    """Write a value to a cgroup interface file.
+
+    Args:
+      name: The interface file, eg "cgroup.freeze"
+      value: The value to write
+
+    Raises:
+      CgroupError: if the file cannot be written
+    """
+    try:
+      with open(os.path.join(self._path, name), 'w') as interface_file:
+        interface_file.write(value)
+    except OSError as os_error:
+      raise CgroupError(f"Unable to write [{value}] to {name} of [{self._path}]: {os_error}")
+
+  def add_process(self, pid: int) -> None:
+    """Move a process into the cgroup. Its future children are created in the cgroup.
+
+    Args:
+      pid: The process identifier
+    """
+    self._write('cgroup.procs', str(pid))
+
+  def set_value(self, name: str, value: str) -> None:
+    """Write a resource setting, such as cpu.max or memory.max.
+
+    Args:
+      name: The interface file
+      value: The value to write
+
+    Raises:
+      CgroupError: if the setting cannot be written
+    """
+    self._write(name, value)
+
+  def read_stat(self, name: str) -> Dict[str, int]:
+    """Read a flat keyed statistics file of the cgroup, such as cpu.stat or memory.events.
+
+    Args:
+      name: The interface file
+
+    Returns:
+      the value of each key
+
+    Raises:
+      CgroupError: if the file cannot be read
+    """
+    return read_flat_keyed(os.path.join(self._path, name))
+
+  def read_value(self, name: str) -> int:
+    """Read a single value interface file of the cgroup, such as memory.peak.
+
+    Args:
+      name: The interface file
+
+    Returns:
+      the value
+
+    Raises:
+      CgroupError: if the file cannot be read
+    """
+    path = os.path.join(self._path, name)
+    try:
+      with open(path) as interface_file:
+        return int(interface_file.read().strip())
+    except (OSError, ValueError) as read_error:
+      raise CgroupError(f"Unable to read [{path}]: {read_error}")
+
+  def read_io_stat(self) -> Dict[str, int]:
+    """Read the io.stat counters of the cgroup, summed across devices.
+
+    Returns:
+      the value of each counter, eg "rbytes" and "wbytes"
+
+    Raises:
+      CgroupError: if the file cannot be read
+    """
+    path = os.path.join(self._path, 'io.stat')
+    counters = {}
+    try:
+      with open(path) as stat_file:
+        for line in stat_file:
+          for field in line.split()[1:]:
+            key, value = field.split('=', 1)
+            counters[key] = counters.get(key, 0) + int(value)
+    except (OSError, ValueError) as read_error:
+      raise CgroupError(f"Unable to read [{path}]: {read_error}")
+    return counters
+
+  def get_processes(self) -> List[int]:
+    """Return the identifiers of the processes in the cgroup."""
+    try:
+      with open(self.get_procs_path()) as procs_file:
+        return [int(pid) for pid in procs_file.read().split()]
+    except FileNotFoundError:
+      return []
+
+  def freeze(self) -> None:
+    """Stop all processes in the cgroup until it is thawed."""
+    self._write('cgroup.freeze', '1')
+
+  def thaw(self) -> None:
+    """Resume the processes in a frozen cgroup."""
+    self._write('cgroup.freeze', '0')
+
+  def kill(self) -> None:
+    """Kill all processes in the cgroup.
+
+    Kernels without cgroup.kill have each process signalled in turn.
+    """
+    if os.path.exists(os.path.join(self._path, 'cgroup.kill')):
+      self._write('cgroup.kill', '1')
+      return
+
+    for pid in self.get_processes():
+      try:
+        os.kill(pid, signal.SIGKILL)
+      except ProcessLookupError:
+        pass
+
+  def remove(self) -> None:
+    """Remove the cgroup directory.
+
+    A cgroup can only be removed once all of its processes have exited.
+
+    Raises:
+      CgroupError: if the cgroup cannot be removed
+    """
+    try:
+      os.rmdir(self._path)
+    except OSError as os_error:
+      raise CgroupError(f"Unable to remove cgroup [{self._path}]: {os_error}")
@@ -0,0 +1,290 @@
+"""Detect the commits where a metric changed in the history of the results database.
+
+The value of a metric for a commit is the median of its repetitions, and
+the commits are ordered by the time they were first recorded. Change
+points in the resulting series are found with PELT (Killick et al. 2012),
+which minimizes the squared deviation of each segment from its mean plus a
+penalty per change point. Candidates that cannot start the last segment of
+an optimal segmentation are pruned, so the detection is close to linear in
+the number of commits. Each change point is then kept only if it splits
+its neighboring segments better than the best split of nearly all random
+permutations of their values, as in the E-divisive permutation test.
+"""
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import statistics
+from typing import (List, NamedTuple, Optional, Sequence, Tuple)
+
+import api.analysis_pb2 as proto_analysis
+
+from src.lib.common import results_db
+
+log = logging.getLogger(__name__)
+
+REPORT_FILE = 'change_points.json'
+
+# The metrics analyzed unless the job control document lists others
+DEFAULT_METRICS = [
+    'benchmark_http_client.latency_2xx.p50',
+    'benchmark_http_client.latency_2xx.p99*',
+    'counter.benchmark.http_2xx.per_second',
+]
+DEFAULT_PENALTY_FACTOR = 3.0
+DEFAULT_PERMUTATIONS = 199
+DEFAULT_SIGNIFICANCE = 0.05
+DEFAULT_MIN_SEGMENT = 3
+
+# Scale the MAD into a consistent estimator of the standard deviation of
+# normally distributed values
+_MAD_SCALE = 1.4826
+
+
+class ChangePoint(NamedTuple):
+  """A step change in the series of a metric."""
+
+  test: str
+  metric: str
+  # The first commit measured after the change and its position in the series
+  commit_hash: str
+  index: int
+  before: float
+  after: float
+  magnitude: float
+  # The change relative to the value before it, or None if that value is zero
+  relative: Optional[float]
+  p_value: float
+
+
+def _get_segment_cost(prefix: List[float], prefix_squares: List[float], start: int,
+                      end: int) -> float:
+  """Return the squared deviation of values[start:end] from their mean."""
+  total = prefix[end] - prefix[start]
+  return prefix_squares[end] - prefix_squares[start] - total * total / (end - start)
+
+
+def estimate_noise(values: Sequence[float]) -> float:
+  """Estimate the variance of the noise of a series that may contain steps.
+
+  The differences of consecutive values are not affected by the level of
+  the series, and their MAD is not affected by the few differences spanning
+  a step.
+  """
+  if len(values) < 3:
+    return statistics.pvariance(values) if len(values) > 1 else 0.0
+
+  differences = [b - a for a, b in zip(values, values[1:])]
+  center = statistics.median(differences)
+  sigma = _MAD_SCALE * statistics.median([abs(d - center) for d in differences]) / math.sqrt(2)
+  return sigma * sigma if sigma else statistics.pvariance(values)
+
+
+def pelt(values: Sequence[float], penalty: float, min_segment: int = 2) -> List[int]:
+  """Find the change points of the mean of a series with the PELT algorithm.
+
+  Args:
+    values: The series
+    penalty: The cost added for each change point
+    min_segment: The smallest number of values between change points
+
+  Returns:
+    the positions at which a new segment starts, in increasing order
+  """
+  count = len(values)
+  if count < 2 * min_segment:
+    return []
+
+  prefix, prefix_squares = [0.0], [0.0]
+  for value in values:
+    prefix.append(prefix[-1] + value)
+    prefix_squares.append(prefix_squares[-1] + value * value)
+
+  best_cost = [math.inf] * (count + 1)
+  best_cost[0] = -penalty
+  last_change = [0] * (count + 1)
+  candidates = [0]
+
+  for end in range(min_segment, count + 1):
+    # A segment may start here once the segment before it is long enough
+    newest = end - min_segment
+    if newest >= min_segment:
+      candidates.append(newest)
+
+    costs = [(best_cost[start] + _get_segment_cost(prefix, prefix_squares, start, end) + penalty,
+              start) for start in candidates]
+    best_cost[end], last_change[end] = min(costs)
+
+    # A start that is already worse than the optimum, even without the
+    # penalty of a new change point, cannot be part of a later optimum
+    candidates = [start for cost, start in costs if cost - penalty <= best_cost[end]]
+
+  change_points = []
+  end = count
+  while last_change[end] > 0:
+    end = last_change[end]
+    change_points.append(end)
+  return sorted(change_points)
+
+
+def _get_largest_split(values: Sequence[float], min_segment: int) -> float:
+  """Return the largest cost reduction of splitting the values into two segments in one place.
+
+  Splitting n values into segments of n1 and n2 values with means m1 and m2
+  reduces the squared deviation by n1 * n2 / n * (m1 - m2)^2.
+  """
+  count = len(values)
+  prefix = list(itertools.accumulate(values))
+  largest = 0.0
+  for left_count in range(min_segment, count - min_segment + 1):
+    left_total = prefix[left_count - 1]
+    right_count = count - left_count
+    difference = left_total / left_count - (prefix[-1] - left_total) / right_count
+    largest = max(largest, left_count * right_count / count * difference * difference)
+  return largest
+
+
+def permutation_p_value(values: Sequence[float],
+                        position: int,
+                        permutations: int,
+                        min_segment: int = 1,
+                        rng: Optional[random.Random] = None) -> float:
+  """Return the significance of a change point found by searching the values.
+
+  The change point was chosen as the split with the largest difference of
+  means, so it is compared with the best split of each random permutation
+  of the values rather than with a split at the same position.
+
+  Args:
+    values: The values of the segments before and after the change point
+    position: The position of the change point in the values
+    permutations: The number of random permutations of the values
+    min_segment: The smallest number of values on each side of a split
+    rng: The random generator, for reproducible results
+
+  Returns:
+    the share of permutations splitting at least as well as the change point
+  """
+  rng = rng or random.Random(0)
+  before, after = values[:position], values[position:]
+  difference = statistics.mean(after) - statistics.mean(before)
+  observed = len(before) * len(after) / len(values) * difference * difference
+
+  pooled = list(values)
+  extreme = 0
+  for _ in range(permutations):
+    rng.shuffle(pooled)
+    if _get_largest_split(pooled, min_segment) >= observed * (1 - 1e-9):
+      extreme += 1
+  return (extreme + 1) / (permutations + 1)
+
+
+def detect_change_points(test: str, metric: str, series: List[Tuple[str, float]],
+                         options: proto_analysis.ChangePointOptions) -> List[ChangePoint]:
+  """Find the significant step changes in the per-commit series of a metric.
+
+  Args:
+    test: The name of the test
+    metric: The name of the metric
+    series: The (commit hash, value) of each commit, in commit order
+    options: The change point options from the job control document
+
+  Returns:
+    the significant change points, in commit order
+  """
+  values = [value for _, value in series]
+  min_segment = options.min_segment or DEFAULT_MIN_SEGMENT
+  if len(values) < 2 * min_segment:
+    return []
+
+  noise = estimate_noise(values)
+  if not noise:
+    return []
+
+  penalty = (options.penalty_factor or DEFAULT_PENALTY_FACTOR) * noise * math.log(len(values))
+  positions = pelt(values, penalty, min_segment)
+
+  rng = random.Random(0)
+  change_points = []
+  boundaries = [0] + positions + [len(values)]
+  for segment, position in enumerate(positions, start=1):
+    start = boundaries[segment - 1]
+    window = values[start:boundaries[segment + 1]]
+    p_value = permutation_p_value(window, position - start, options.permutations or
+                                  DEFAULT_PERMUTATIONS, min_segment, rng)
+    if p_value > (options.significance or DEFAULT_SIGNIFICANCE):
+      continue
+
+    before_mean = statistics.mean(window[:position - start])
+    after_mean = statistics.mean(window[position - start:])
+    change_points.append(
+        ChangePoint(test=test,
+                    metric=metric,
+                    commit_hash=series[position][0],
+                    index=position,
+                    before=before_mean,
+                    after=after_mean,
+                    magnitude=after_mean - before_mean,
+                    relative=(after_mean - before_mean) / before_mean if before_mean else None,
+                    p_value=p_value))
+  return change_points
+
+
+def analyze_database(database: results_db.ResultsDatabase,
+                     options: proto_analysis.ChangePointOptions,
+                     host_profile: str = '',
+                     test: str = '') -> List[ChangePoint]:
+  """Find the change points of the metrics of every test in the results database.
+
+  Args:
+    database: The results database
+    options: The change point options from the job control document
+    host_profile: Only analyze the results of this host configuration, if set
+    test: Only analyze this test, or the tests matching this pattern, if set
+
+  Returns:
+    the significant change points of every test and metric
+
+  Raises:
+    ResultsDatabaseError: if the results cannot be read
+  """
+  change_points = []
+  for test_name in database.list_tests(host_profile, test):
+    for pattern in list(options.metrics) or DEFAULT_METRICS:
+      for metric, series in database.get_commit_series(test_name, pattern, host_profile).items():
+        change_points += detect_change_points(test_name, metric, series, options)
+  return change_points
+
+
+def format_change_points(change_points: List[ChangePoint]) -> str:
+  """Format change points as a table, one change point per line."""
+  columns = ['commit', 'test', 'metric', 'before', 'after', 'change', 'p-value']
+  rows = [columns] + [[
+      change_point.commit_hash, change_point.test, change_point.metric, f"{change_point.before:g}",
+      f"{change_point.after:g}", f"{change_point.relative:+.1%}" if change_point.relative
+      is not None else f"{change_point.magnitude:+g}", f"{change_point.p_value:.3f}"
+  ] for change_point in change_points]
+  widths = [max(len(row[column]) for row in rows) for column in range(len(columns))]
+  return '\n'.join(
+      '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def write_report(change_points: List[ChangePoint], output_dir: str) -> str:
+  """Write the change points to the output directory of the job and log them.
+
+  Returns:
+    the path of the report
+  """
+  log.info(f"Found {len(change_points)} change points in the recorded commits")
+  for change_point in change_points:
+    log.warning(f"{change_point.test}: {change_point.metric} changed from "
+                f"{change_point.before:g} to {change_point.after:g} at "
+                f"{change_point.commit_hash} (p={change_point.p_value:.3f})")
+
+  os.makedirs(output_dir, exist_ok=True)
+  report_path = os.path.join(output_dir, REPORT_FILE)
+  with open(report_path, 'w') as report_file:
+    json.dump([change_point._asdict() for change_point in change_points], report_file, indent=2)
+  return report_path
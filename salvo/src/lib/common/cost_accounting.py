@@ -0,0 +1,338 @@
+"""Account for the resources consumed by the commands and containers of a job.
+
+The resource usage of every command started through cmd_exec is read from
+the rusage of the process when it is reaped, and includes the descendants
+it waited for. The usage of every container started by DockerImage is read
+from its cgroup v2 node, sampled while the container runs since the node is
+removed with the container. Each usage is attributed to the innermost
+phase of the trace in progress on the thread that started it, and the
+usage of the job is written to the run manifest of its output directory:
+the CPU seconds, peak RSS, bytes written to disk and wall time of each
+phase and of the whole job.
+
+Daemons, such as the Bazel server, are not children of the commands that
+contact them, so their usage is not accounted.
+
+The manifest also lists every fetch of a source repository, with its
+strategy and the bytes it added to the repository.
+"""
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from typing import (Callable, Dict, List, NamedTuple)
+
+from src.lib.common import (cgroup, trace)
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'run_manifest.json'
+DEFAULT_SAMPLE_INTERVAL = 0.5
+
+# The phase of the usage recorded outside of any traced phase
+UNATTRIBUTED_PHASE = 'unattributed'
+
+KIND_PROCESS = 'process'
+KIND_CONTAINER = 'container'
+
+
+class Usage(NamedTuple):
+  """The resources consumed by a command or a container."""
+
+  phase: str
+  kind: str
+  # The command or the container
+  name: str
+  cpu_seconds: float
+  peak_rss_bytes: int
+  disk_write_bytes: int
+  wall_seconds: float
+
+
+class PhaseCost(NamedTuple):
+  """The resources consumed by the commands and containers of a phase, or of the job."""
+
+  cpu_seconds: float
+  # The largest peak RSS of a single command or container
+  peak_rss_bytes: int
+  disk_write_bytes: int
+  wall_seconds: float
+  processes: int
+  containers: int
+
+
+class Fetch(NamedTuple):
+  """A fetch of a source repository."""
+
+  source: str
+  # The fetch strategy of the repository
+  strategy: str
+  # The clone, or the fetch deepening the history
+  operation: str
+  fetched_bytes: int
+  wall_seconds: float
+
+
+_process_usages = []
+# The latest usage of each container, by cgroup path
+_container_usages = {}
+_fetches = []
+_usages_lock = threading.Lock()
+
+
+def _get_phase() -> str:
+  """Return the phase to which usage recorded by the current thread is attributed."""
+  return trace.get_current_phase() or UNATTRIBUTED_PHASE
+
+
+def usage_from_rusage(name: str, rusage: resource.struct_rusage, wall_seconds: float) -> Usage:
+  """Convert the rusage of a reaped process into its usage.
+
+  Args:
+    name: The command
+    rusage: The resource usage returned by os.wait4
+    wall_seconds: The time the command ran
+
+  Returns:
+    the usage, attributed to the current phase
+  """
+  # Linux reports the peak RSS in kilobytes and counts blocks of 512 bytes
+  return Usage(phase=_get_phase(),
+               kind=KIND_PROCESS,
+               name=name,
+               cpu_seconds=rusage.ru_utime + rusage.ru_stime,
+               peak_rss_bytes=rusage.ru_maxrss * 1024,
+               disk_write_bytes=rusage.ru_oublock * 512,
+               wall_seconds=wall_seconds)
+
+
+def record_process(usage: Usage) -> None:
+  """Record the usage of a command once it completed."""
+  with _usages_lock:
+    _process_usages.append(usage)
+
+
+def record_container(path: str, usage: Usage) -> None:
+  """Record the latest usage sampled from the cgroup of a container.
+
+  The counters of a cgroup only increase, so a container sampled by
+  several monitors keeps its largest values and its first phase.
+  """
+  with _usages_lock:
+    previous = _container_usages.get(path)
+    if previous:
+      usage = previous._replace(cpu_seconds=max(previous.cpu_seconds, usage.cpu_seconds),
+                                peak_rss_bytes=max(previous.peak_rss_bytes, usage.peak_rss_bytes),
+                                disk_write_bytes=max(previous.disk_write_bytes,
+                                                     usage.disk_write_bytes),
+                                wall_seconds=max(previous.wall_seconds, usage.wall_seconds))
+    _container_usages[path] = usage
+
+
+def record_fetch(fetch: Fetch) -> None:
+  """Record a fetch of a source repository once it completed."""
+  with _usages_lock:
+    _fetches.append(fetch)
+
+
+def get_fetches() -> List[Fetch]:
+  """Return every fetch recorded so far."""
+  with _usages_lock:
+    return list(_fetches)
+
+
+def get_usages() -> List[Usage]:
+  """Return the usage of every command and container recorded so far."""
+  with _usages_lock:
+    return _process_usages + list(_container_usages.values())
+
+
+def reset() -> None:
+  """Discard all recorded usage."""
+  with _usages_lock:
+    _process_usages.clear()
+    _container_usages.clear()
+    _fetches.clear()
+
+
+def read_cgroup_usage(path: str) -> Dict[str, int]:
+  """Read the CPU, memory and disk counters of a cgroup.
+
+  Args:
+    path: The absolute path of the cgroup
+
+  Returns:
+    the CPU time in microseconds, the peak memory and the bytes written to
+    disk. The peak memory is the current memory on kernels without
+    memory.peak, and the bytes written are zero without the io controller
+
+  Raises:
+    CgroupError: if the CPU or memory counters cannot be read
+  """
+  container_cgroup = cgroup.Cgroup(path)
+  usage = {'usage_usec': container_cgroup.read_stat('cpu.stat')['usage_usec']}
+  try:
+    usage['memory_peak'] = container_cgroup.read_value('memory.peak')
+  except cgroup.CgroupError:
+    usage['memory_peak'] = container_cgroup.read_value('memory.current')
+  try:
+    usage['wbytes'] = container_cgroup.read_io_stat().get('wbytes', 0)
+  except cgroup.CgroupError:
+    usage['wbytes'] = 0
+  return usage
+
+
+class ContainerMonitor(object):
+  """Sample the cgroups of the containers of a run and record their usage.
+
+  The monitor is a context manager sampling from a background thread, and
+  records the usage of each container in the phase entering the monitor.
+  The activity of a container after its last sample is not recorded. Nothing
+  is sampled without the cgroup v2 hierarchy.
+  """
+
+  def __init__(self,
+               get_cgroups: Callable[[], Dict[str, str]],
+               interval: float = DEFAULT_SAMPLE_INTERVAL) -> None:
+    """Initialize the monitor.
+
+    Args:
+      get_cgroups: A function returning the paths of the cgroups of the
+        running containers, by container name
+      interval: The time between samples in seconds
+    """
+    self._get_cgroups = get_cgroups
+    self._interval = interval
+    self._phase = ''
+    self._first_seen = {}
+    self._peaks = {}
+    self._stop = threading.Event()
+    self._thread = None
+
+  def __enter__(self) -> 'ContainerMonitor':
+    """Start sampling the cgroups."""
+    self._phase = _get_phase()
+    if cgroup.get_unified_root():
+      self._thread = threading.Thread(target=self._run, name='container_monitor', daemon=True)
+      self._thread.start()
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Stop sampling."""
+    if self._thread:
+      self._stop.set()
+      self._thread.join()
+
+  def _run(self) -> None:
+    """Sample the cgroups until the monitor is stopped."""
+    self.sample()
+    while not self._stop.wait(self._interval):
+      self.sample()
+
+  def sample(self) -> None:
+    """Record the usage of every running container."""
+    try:
+      cgroups = self._get_cgroups()
+    except Exception as list_error:
+      log.debug(f"Unable to list the container cgroups: {list_error}")
+      return
+
+    now = time.monotonic()
+    for name, path in cgroups.items():
+      try:
+        counters = read_cgroup_usage(path)
+      except cgroup.CgroupError as read_error:
+        # The container exited since it was listed
+        log.debug(f"Unable to sample {name}: {read_error}")
+        continue
+
+      first_seen = self._first_seen.setdefault(path, now)
+      # Without memory.peak, the peak is the largest sampled memory
+      self._peaks[path] = max(self._peaks.get(path, 0), counters['memory_peak'])
+      record_container(
+          path,
+          Usage(phase=self._phase,
+                kind=KIND_CONTAINER,
+                name=name,
+                cpu_seconds=counters['usage_usec'] / 1e6,
+                peak_rss_bytes=self._peaks[path],
+                disk_write_bytes=counters['wbytes'],
+                wall_seconds=now - first_seen))
+
+
+def _sum_usage(usages: List[Usage], wall_seconds: float) -> PhaseCost:
+  """Aggregate usages into the cost of a phase with the given wall time."""
+  return PhaseCost(cpu_seconds=sum(usage.cpu_seconds for usage in usages),
+                   peak_rss_bytes=max([usage.peak_rss_bytes for usage in usages], default=0),
+                   disk_write_bytes=sum(usage.disk_write_bytes for usage in usages),
+                   wall_seconds=wall_seconds,
+                   processes=sum(usage.kind == KIND_PROCESS for usage in usages),
+                   containers=sum(usage.kind == KIND_CONTAINER for usage in usages))
+
+
+def summarize(usages: List[Usage], spans: List[trace.Span]) -> Dict[str, PhaseCost]:
+  """Aggregate the usage of the commands and containers by phase.
+
+  Args:
+    usages: The usage of every command and container
+    spans: The spans of the trace, whose total duration is the wall time of
+      each phase
+
+  Returns:
+    the cost of each phase, in decreasing order of CPU seconds
+  """
+  durations = {phase.name: phase.total for phase in trace.summarize(spans)}
+  by_phase = {phase: [] for phase in durations}
+  for usage in usages:
+    by_phase.setdefault(usage.phase, []).append(usage)
+
+  costs = {
+      phase: _sum_usage(phase_usages, durations.get(phase, 0.0))
+      for phase, phase_usages in by_phase.items()
+  }
+  return dict(sorted(costs.items(), key=lambda item: (-item[1].cpu_seconds, item[0])))
+
+
+def get_job_cost(usages: List[Usage], wall_seconds: float) -> PhaseCost:
+  """Aggregate the usage of every command and container of the job."""
+  return _sum_usage(usages, wall_seconds)
+
+
+def write_manifest(output_dir: str, wall_seconds: float) -> str:
+  """Write the cost of the job and of each phase to the run manifest.
+
+  The CPU time of Salvo itself and the fetches of the source repositories
+  are listed beside the cost of the job.
+
+  Args:
+    output_dir: The output directory of the job
+    wall_seconds: The duration of the job
+
+  Returns:
+    the path of the manifest
+  """
+  usages = get_usages()
+  job = get_job_cost(usages, wall_seconds)
+  own_usage = resource.getrusage(resource.RUSAGE_SELF)
+  log.info(f"The job used {job.cpu_seconds:.1f} CPU seconds in {job.processes} commands and "
+           f"{job.containers} containers, wrote {job.disk_write_bytes} bytes to disk and "
+           f"peaked at {job.peak_rss_bytes} bytes of RSS")
+
+  os.makedirs(output_dir, exist_ok=True)
+  manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+  with open(manifest_path, 'w') as manifest_file:
+    json.dump(
+        {
+            'job': job._asdict(),
+            'salvo_cpu_seconds': own_usage.ru_utime + own_usage.ru_stime,
+            'phases': {
+                phase: cost._asdict()
+                for phase, cost in summarize(usages, trace.get_spans()).items()
+            },
+            'fetches': [fetch._asdict() for fetch in get_fetches()],
+        },
+        manifest_file,
+        indent=2)
+  return manifest_path
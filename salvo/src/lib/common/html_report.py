@@ -0,0 +1,471 @@
+"""Generate a self contained HTML report comparing the Envoy versions of a job.
+
+For every test, the report shows the latency CDF and the latency
+percentiles of each version, with 95% confidence intervals when a version
+was measured more than once. A summary table compares the latency and
+throughput of the versions, and the resource usage of Envoy is listed when
+it was recorded. The charts are rendered as inline SVG from the aggregated
+results and their series are down-sampled, so that the report has no
+external dependencies and stays small for jobs with many tests.
+"""
+import html
+import json
+import logging
+import math
+import os
+import statistics
+import time
+from typing import (Dict, List, NamedTuple, Optional, Sequence, Tuple)
+
+from src.lib.common import (resource_limits, results_db)
+
+log = logging.getLogger(__name__)
+
+REPORT_FILE = 'report.html'
+DEFAULT_MAX_POINTS = 64
+
+# The histogram of the NightHawk results plotted in the report
+LATENCY_HISTOGRAM = 'benchmark_http_client.latency_2xx'
+THROUGHPUT_METRIC = 'counter.benchmark.http_2xx.per_second'
+SUMMARY_PERCENTILES = [50, 90, 99]
+
+# The counters of the Envoy resource report listed in the report
+RESOURCE_COUNTERS = [
+    'throttled_ratio', 'throttled_usec', 'usage_usec', 'memory_max', 'memory_oom_kill'
+]
+
+_CHART_WIDTH = 560
+_CHART_HEIGHT = 260
+_MARGIN_LEFT = 64
+_MARGIN_RIGHT = 16
+_MARGIN_TOP = 12
+_MARGIN_BOTTOM = 40
+_COLORS = ['#1f77b4', '#d62728', '#2ca02c', '#ff7f0e', '#9467bd', '#8c564b', '#e377c2']
+
+# Student's t quantiles for a two sided 95% confidence interval, by degrees
+# of freedom. The normal quantile is used beyond the table
+_T_QUANTILES = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228]
+_NORMAL_QUANTILE = 1.96
+
+_STYLE = """
+body { font-family: Verdana, sans-serif; font-size: 13px; margin: 24px; color: #222; }
+table { border-collapse: collapse; margin-bottom: 16px; }
+th, td { border: 1px solid #ccc; padding: 3px 8px; text-align: right; }
+th:first-child, td:first-child { text-align: left; }
+.worse { color: #c00; } .better { color: #080; }
+.legend span { display: inline-block; margin-right: 16px; }
+.legend i { display: inline-block; width: 12px; height: 12px; margin-right: 4px; }
+details { margin-bottom: 8px; } summary { cursor: pointer; font-weight: bold; }
+svg text { font-size: 11px; } svg .g { stroke: #e5e5e5; } svg .a { stroke: #888; }
+svg .m { text-anchor: middle; } svg .e { text-anchor: end; }
+"""
+
+
+class VersionResults(NamedTuple):
+  """The results of one Envoy version."""
+
+  version: str
+  # The metrics of each repetition, by test
+  tests: Dict[str, List[Dict[str, float]]]
+  # The counters of the Envoy resource report, if recorded
+  resources: Dict[str, float]
+
+
+def load_version_results(version: str,
+                         output_dir: str,
+                         database: Optional[results_db.ResultsDatabase] = None) -> VersionResults:
+  """Load the results of a version from its output directory or the results database.
+
+  Args:
+    version: The commit hash or tag of the Envoy version
+    output_dir: The output directory of the benchmark of the version
+    database: The results database. If given, every recorded repetition
+      of the version is loaded rather than the output directory only
+
+  Returns:
+    the results of the version
+  """
+  tests = {}
+  if database:
+    repetitions = {}
+    for result in database.query(commits=[version]):
+      repetitions.setdefault(result.test, {}).setdefault(result.run_id, {})[result.metric] = \
+          result.value
+    tests = {test: list(runs.values()) for test, runs in repetitions.items()}
+  else:
+    for test, results_path in results_db.find_test_results(output_dir).items():
+      with open(results_path) as results_file:
+        tests[test] = [results_db.parse_nighthawk_results(results_file.read())]
+
+  resources = {}
+  resources_path = os.path.join(output_dir, resource_limits.REPORT_FILE)
+  if os.path.exists(resources_path):
+    with open(resources_path) as resources_file:
+      resources = json.load(resources_file).get('summary', {})
+
+  return VersionResults(version=version, tests=tests, resources=resources)
+
+
+def downsample(points: Sequence, max_points: int) -> List:
+  """Select evenly spaced points of a series, keeping its first and last points.
+
+  Args:
+    points: The points of the series, in order
+    max_points: The largest number of points kept
+
+  Returns:
+    the selected points
+  """
+  if len(points) <= max_points or max_points < 2:
+    return list(points)
+  step = (len(points) - 1) / (max_points - 1)
+  return [points[round(index * step)] for index in range(max_points)]
+
+
+def confidence_interval(values: Sequence[float]) -> Tuple[float, float, float]:
+  """Return the mean of the values and the bounds of its 95% confidence interval.
+
+  The interval is empty when there is a single value.
+  """
+  mean = statistics.mean(values)
+  if len(values) < 2:
+    return mean, mean, mean
+
+  degrees = len(values) - 1
+  quantile = _T_QUANTILES[degrees - 1] if degrees <= len(_T_QUANTILES) else _NORMAL_QUANTILE
+  margin = quantile * statistics.stdev(values) / math.sqrt(len(values))
+  return mean, mean - margin, mean + margin
+
+
+def get_percentiles(metrics: Dict[str, float], histogram: str = LATENCY_HISTOGRAM) -> List[float]:
+  """Return the percentiles of a histogram found in the metrics, in increasing order."""
+  prefix = f"{histogram}.p"
+  percentiles = []
+  for metric in metrics:
+    if metric.startswith(prefix):
+      try:
+        percentiles.append(float(metric[len(prefix):]))
+      except ValueError:
+        continue
+  return sorted(percentiles)
+
+
+def _percentile_metric(percentile: float) -> str:
+  """Return the name of the metric of a latency percentile."""
+  return f"{LATENCY_HISTOGRAM}.p{percentile:g}"
+
+
+def _mean_metric(repetitions: List[Dict[str, float]], metric: str) -> Optional[float]:
+  """Return the mean of a metric across repetitions, or None if it was not recorded."""
+  values = [metrics[metric] for metrics in repetitions if metric in metrics]
+  return statistics.mean(values) if values else None
+
+
+def _nice_ticks(low: float, high: float, count: int = 5) -> List[float]:
+  """Return round axis ticks covering a range."""
+  if high <= low:
+    high = low + 1.0
+  step = 10**math.floor(math.log10((high - low) / count))
+  for multiple in [1, 2, 5, 10]:
+    if (high - low) / (step * multiple) <= count:
+      step *= multiple
+      break
+  first = math.floor(low / step) * step
+  return [first + index * step for index in range(int(math.ceil((high - first) / step)) + 1)]
+
+
+class _Axes(object):
+  """Map values to the coordinates of a chart and render its axes."""
+
+  def __init__(self, x_ticks: List[float], y_ticks: List[float]) -> None:
+    self._x_ticks = x_ticks
+    self._y_ticks = y_ticks
+    self._plot_width = _CHART_WIDTH - _MARGIN_LEFT - _MARGIN_RIGHT
+    self._plot_height = _CHART_HEIGHT - _MARGIN_TOP - _MARGIN_BOTTOM
+
+  def x(self, value: float) -> float:
+    """Return the horizontal coordinate of a value."""
+    low, high = self._x_ticks[0], self._x_ticks[-1]
+    return _MARGIN_LEFT + (value - low) / (high - low) * self._plot_width
+
+  def y(self, value: float) -> float:
+    """Return the vertical coordinate of a value."""
+    low, high = self._y_ticks[0], self._y_ticks[-1]
+    return _MARGIN_TOP + (1 - (value - low) / (high - low)) * self._plot_height
+
+  def render(self, x_label: str, y_label: str, categorical: bool = False) -> List[str]:
+    """Render the grid, the tick labels and the axis labels.
+
+    The horizontal ticks are not labelled if the chart places its own
+    labels for categories.
+    """
+    elements = []
+    bottom = _MARGIN_TOP + self._plot_height
+    for tick in self._y_ticks:
+      elements.append(f'<line x1="{_MARGIN_LEFT}" x2="{_CHART_WIDTH - _MARGIN_RIGHT}" '
+                      f'y1="{self.y(tick):.1f}" y2="{self.y(tick):.1f}" class="g"/>'
+                      f'<text x="{_MARGIN_LEFT - 4}" y="{self.y(tick) + 4:.1f}" '
+                      f'class="e">{tick:g}</text>')
+    if not categorical:
+      for tick in self._x_ticks:
+        elements.append(f'<text x="{self.x(tick):.1f}" y="{bottom + 14}" '
+                        f'class="m">{tick:g}</text>')
+    elements.append(f'<line x1="{_MARGIN_LEFT}" x2="{_CHART_WIDTH - _MARGIN_RIGHT}" '
+                    f'y1="{bottom}" y2="{bottom}" class="a"/>')
+    elements.append(f'<text x="{_MARGIN_LEFT + self._plot_width / 2:.1f}" '
+                    f'y="{_CHART_HEIGHT - 6}" class="m">{html.escape(x_label)}</text>')
+    elements.append(f'<text transform="translate(14,{_MARGIN_TOP + self._plot_height / 2:.1f}) '
+                    f'rotate(-90)" class="m">{html.escape(y_label)}</text>')
+    return elements
+
+
+def _svg(elements: List[str]) -> str:
+  """Wrap chart elements into an inline SVG element."""
+  return (f'<svg width="{_CHART_WIDTH}" height="{_CHART_HEIGHT}" '
+          f'viewBox="0 0 {_CHART_WIDTH} {_CHART_HEIGHT}" xmlns="http://www.w3.org/2000/svg">' +
+          ''.join(elements) + '</svg>')
+
+
+def render_cdf_svg(series: List[List[Tuple[float, float]]], max_points: int) -> str:
+  """Render the latency CDF of each version as a line chart.
+
+  Args:
+    series: The (latency in ms, percentile) points of each version, in the
+      order of the versions
+    max_points: The largest number of points drawn for a version
+
+  Returns:
+    the inline SVG element
+  """
+  points = [p for line in series for p in line]
+  if not points:
+    return ''
+
+  axes = _Axes(_nice_ticks(0.0, max(p[0] for p in points)), [0.0, 25.0, 50.0, 75.0, 100.0])
+  elements = axes.render("latency (ms)", "percentile")
+  for index, line in enumerate(series):
+    coordinates = ' '.join(
+        f"{axes.x(x):.1f},{axes.y(y):.1f}" for x, y in downsample(line, max_points))
+    elements.append(f'<polyline points="{coordinates}" fill="none" '
+                    f'stroke="{_COLORS[index % len(_COLORS)]}" stroke-width="1.5"/>')
+  return _svg(elements)
+
+
+def render_bar_svg(groups: List[str], series: List[List[Optional[Tuple[float, float, float]]]],
+                   y_label: str) -> str:
+  """Render grouped bars with confidence interval whiskers.
+
+  Args:
+    groups: The label of each group of bars
+    series: For each version, the (mean, low, high) of each group, or None
+      if the version has no value for the group
+    y_label: The label of the vertical axis
+
+  Returns:
+    the inline SVG element
+  """
+  values = [bar[2] for bars in series for bar in bars if bar]
+  if not values:
+    return ''
+
+  axes = _Axes([0.0, float(len(groups))], _nice_ticks(0.0, max(values)))
+  elements = axes.render("", y_label, categorical=True)
+  group_width = axes.x(1.0) - axes.x(0.0)
+  bar_width = group_width * 0.8 / len(series)
+  for group_index, group in enumerate(groups):
+    left = axes.x(group_index) + group_width * 0.1
+    elements.append(f'<text x="{left + group_width * 0.4:.1f}" '
+                    f'y="{_CHART_HEIGHT - _MARGIN_BOTTOM + 14}" '
+                    f'class="m">{html.escape(group)}</text>')
+    for index, bars in enumerate(series):
+      if not bars[group_index]:
+        continue
+      mean, low, high = bars[group_index]
+      x = left + index * bar_width
+      elements.append(f'<rect x="{x:.1f}" y="{axes.y(mean):.1f}" width="{bar_width - 1:.1f}" '
+                      f'height="{axes.y(0.0) - axes.y(mean):.1f}" '
+                      f'fill="{_COLORS[index % len(_COLORS)]}"/>')
+      if high > low:
+        center = x + bar_width / 2
+        elements.append(f'<line x1="{center:.1f}" x2="{center:.1f}" y1="{axes.y(low):.1f}" '
+                        f'y2="{axes.y(high):.1f}" stroke="#000"/>')
+  return _svg(elements)
+
+
+def _get_cdf(repetitions: List[Dict[str, float]]) -> List[Tuple[float, float]]:
+  """Return the mean latency CDF of the repetitions of a test, in ms."""
+  if not repetitions:
+    return []
+
+  points = []
+  for bound, percentile in [('min', 0.0), ('max', 100.0)]:
+    value = _mean_metric(repetitions, f"{LATENCY_HISTOGRAM}.{bound}")
+    if value is not None:
+      points.append((value * 1e3, percentile))
+  for percentile in get_percentiles(repetitions[0]):
+    value = _mean_metric(repetitions, _percentile_metric(percentile))
+    if value is not None:
+      points.append((value * 1e3, percentile))
+  return sorted(points)
+
+
+def _format_change(baseline: Optional[float], value: Optional[float],
+                   higher_is_better: bool) -> str:
+  """Format the relative change of a value from the baseline as a table cell."""
+  if baseline is None or value is None or not baseline:
+    return '<td></td>'
+  change = (value - baseline) / baseline * 100
+  worse = change < 0 if higher_is_better else change > 0
+  css_class = 'worse' if worse else 'better'
+  return f'<td class="{css_class}">{change:+.1f}%</td>'
+
+
+def _render_summary(versions: List[VersionResults], tests: List[str]) -> List[str]:
+  """Render the table comparing the latency and throughput of every version with the first."""
+  columns = [(f"p{percentile}", False) for percentile in SUMMARY_PERCENTILES]
+  columns.append(("rps", True))
+  header = ''.join(f"<th>{html.escape(v.version)} {name}</th>" +
+                   (f"<th>{name} change</th>" if index else '')
+                   for name, _ in columns
+                   for index, v in enumerate(versions))
+  rows = [f"<table><tr><th>test</th>{header}</tr>"]
+
+  for test in tests:
+    cells = []
+    for name, higher_is_better in columns:
+      values = []
+      for version in versions:
+        repetitions = version.tests.get(test, [])
+        if name == 'rps':
+          values.append(_mean_metric(repetitions, THROUGHPUT_METRIC))
+          continue
+        percentiles = get_percentiles(repetitions[0]) if repetitions else []
+        if not percentiles:
+          values.append(None)
+          continue
+        target = float(name[1:])
+        nearest = min(percentiles, key=lambda p: abs(p - target))
+        value = _mean_metric(repetitions, _percentile_metric(nearest))
+        values.append(value * 1e3 if value is not None else None)
+
+      for index, value in enumerate(values):
+        cells.append(f"<td>{value:.3f}</td>" if value is not None else "<td></td>")
+        if index:
+          cells.append(_format_change(values[0], value, higher_is_better))
+    rows.append(f"<tr><td>{html.escape(test)}</td>{''.join(cells)}</tr>")
+
+  rows.append("</table>")
+  return rows
+
+
+def _render_resources(versions: List[VersionResults]) -> List[str]:
+  """Render the resource usage of Envoy for the versions that recorded it."""
+  if not any(version.resources for version in versions):
+    return []
+
+  header = ''.join(f"<th>{counter}</th>" for counter in RESOURCE_COUNTERS)
+  rows = ["<h2>Envoy resource usage</h2>", f"<table><tr><th>version</th>{header}</tr>"]
+  for version in versions:
+    cells = ''.join(
+        f"<td>{version.resources[counter]:g}</td>" if counter in version.resources else "<td></td>"
+        for counter in RESOURCE_COUNTERS)
+    rows.append(f"<tr><td>{html.escape(version.version)}</td>{cells}</tr>")
+  rows.append("</table>")
+  return rows
+
+
+def render_report(versions: List[VersionResults],
+                  title: str,
+                  max_points: int = DEFAULT_MAX_POINTS) -> str:
+  """Render the HTML report comparing the versions.
+
+  Args:
+    versions: The results of each version. The first version is the
+      baseline the others are compared with
+    title: The title of the report
+    max_points: The largest number of points drawn for a series
+
+  Returns:
+    the HTML document
+  """
+  tests = sorted({test for version in versions for test in version.tests})
+  legend = ''.join(f'<span><i style="background:{_COLORS[index % len(_COLORS)]}"></i>'
+                   f'{html.escape(version.version)}</span>'
+                   for index, version in enumerate(versions))
+
+  body = [
+      f"<h1>{html.escape(title)}</h1>",
+      f"<p>Generated {time.strftime('%Y-%m-%d %H:%M:%S')}. Latencies are in milliseconds and "
+      f"changes are relative to {html.escape(versions[0].version)}.</p>",
+      f'<p class="legend">{legend}</p>',
+      "<h2>Summary</h2>",
+  ]
+  body += _render_summary(versions, tests)
+  body += _render_resources(versions)
+  body.append("<h2>Tests</h2>")
+
+  for test in tests:
+    repetitions = [version.tests.get(test, []) for version in versions]
+    cdf = render_cdf_svg([_get_cdf(runs) for runs in repetitions], max_points)
+
+    percentiles = []
+    for runs in repetitions:
+      for percentile in (get_percentiles(runs[0]) if runs else []):
+        if percentile not in percentiles:
+          percentiles.append(percentile)
+    percentiles = downsample(sorted(percentiles), max_points)
+
+    bars = []
+    for runs in repetitions:
+      version_bars = []
+      for percentile in percentiles:
+        values = [
+            m[_percentile_metric(percentile)] * 1e3
+            for m in runs
+            if _percentile_metric(percentile) in m
+        ]
+        version_bars.append(confidence_interval(values) if values else None)
+      bars.append(version_bars)
+    percentile_chart = render_bar_svg([f"p{p:g}" for p in percentiles], bars, "latency (ms)")
+
+    throughput = [
+        [confidence_interval([m[THROUGHPUT_METRIC]
+                              for m in runs
+                              if THROUGHPUT_METRIC in m])] if any(THROUGHPUT_METRIC in m
+                                                                  for m in runs) else [None]
+        for runs in repetitions
+    ]
+    throughput_chart = render_bar_svg(["responses/s"], throughput, "responses/s")
+
+    counts = ', '.join(
+        f"{version.version}: {len(runs)}" for version, runs in zip(versions, repetitions))
+    body.append(f"<details><summary>{html.escape(test)}</summary>"
+                f"<p>Repetitions {html.escape(counts)}</p>"
+                f"{cdf}{percentile_chart}{throughput_chart}</details>")
+
+  return (f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}'
+          f'</title><style>{_STYLE}</style></head>\n<body>\n' + '\n'.join(body) +
+          '\n</body></html>\n')
+
+
+def write_report(versions: List[VersionResults],
+                 report_path: str,
+                 title: str,
+                 max_points: int = DEFAULT_MAX_POINTS) -> str:
+  """Write the HTML report comparing the versions.
+
+  Args:
+    versions: The results of each version. The first version is the
+      baseline the others are compared with
+    report_path: The path of the report
+    title: The title of the report
+    max_points: The largest number of points drawn for a series
+
+  Returns:
+    the path of the report
+  """
+  os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+  with open(report_path, 'w') as report_file:
+    report_file.write(render_report(versions, title, max_points or DEFAULT_MAX_POINTS))
+  log.info(f"Wrote the report comparing {len(versions)} versions to {report_path}")
+  return report_path
@@ -0,0 +1,346 @@
+"""Summarize latency distributions in mergeable sketches with a bounded relative error.
+
+A sketch is a DDSketch (Masson et al. 2019): values are counted in buckets
+whose bounds grow geometrically by gamma = (1 + a) / (1 - a), so any
+quantile is estimated within a relative error a of the true value. Sketches
+with the same relative accuracy merge by adding their bucket counts, so the
+percentiles of any set of runs are computed from their sketches alone. The
+number of buckets is bounded by collapsing the lowest buckets, which keeps
+the tail of the distribution accurate.
+
+NightHawk reports the cumulative count of samples at a fixed set of
+percentiles rather than the samples themselves. A sketch of a run is built
+from this table by interpolating the cumulative count between the reported
+percentiles, so only the quantiles between them are approximate.
+"""
+import bisect
+import json
+import math
+from typing import (Callable, Dict, Optional, Sequence, Tuple)
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+
+# Values below this bound, in seconds, are counted as zero
+MIN_INDEXABLE_VALUE = 1e-9
+
+
+class LatencySketchError(Exception):
+  """Raised when sketches cannot be merged or decoded."""
+
+
+class LatencySketch(object):
+  """A DDSketch of non-negative values."""
+
+  def __init__(self,
+               relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+               max_buckets: int = DEFAULT_MAX_BUCKETS) -> None:
+    """Initialize an empty sketch.
+
+    Args:
+      relative_accuracy: The largest relative error of the quantiles, between
+        0 and 1
+      max_buckets: The largest number of buckets kept
+    """
+    if not 0 < relative_accuracy < 1:
+      raise LatencySketchError(f"Invalid relative accuracy {relative_accuracy}")
+    self._relative_accuracy = relative_accuracy
+    self._max_buckets = max_buckets
+    self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self._log_gamma = math.log(self._gamma)
+    self._buckets: Dict[int, float] = {}
+    self._zero_count = 0.0
+    self._count = 0.0
+    self._sum = 0.0
+    self._min = math.inf
+    self._max = -math.inf
+
+  def _get_key(self, value: float) -> int:
+    """Return the bucket counting a positive value."""
+    return math.ceil(math.log(value) / self._log_gamma)
+
+  def _get_value(self, key: int) -> float:
+    """Return the value of a bucket, within the relative accuracy of all its values."""
+    return 2 * self._gamma**key / (self._gamma + 1)
+
+  def _collapse(self) -> None:
+    """Merge the lowest buckets until at most the largest number of buckets remain."""
+    if len(self._buckets) <= self._max_buckets:
+      return
+    keys = sorted(self._buckets)
+    excess = keys[:len(keys) - self._max_buckets + 1]
+    self._buckets[excess[-1]] += sum(self._buckets.pop(key) for key in excess[:-1])
+
+  def get_relative_accuracy(self) -> float:
+    """Return the largest relative error of the quantiles."""
+    return self._relative_accuracy
+
+  def get_count(self) -> float:
+    """Return the number of values."""
+    return self._count
+
+  def get_min(self) -> float:
+    """Return the smallest value, or infinity if the sketch is empty."""
+    return self._min
+
+  def get_max(self) -> float:
+    """Return the largest value, or minus infinity if the sketch is empty."""
+    return self._max
+
+  def get_mean(self) -> Optional[float]:
+    """Return the mean of the values, or None if the sketch is empty."""
+    return self._sum / self._count if self._count else None
+
+  def add(self, value: float, count: float = 1.0) -> None:
+    """Add a value to the sketch.
+
+    Args:
+      value: The value, which must not be negative
+      count: The number of times the value occurs
+    """
+    if value < 0:
+      raise LatencySketchError(f"Invalid negative value {value}")
+    if count <= 0:
+      return
+
+    if value < MIN_INDEXABLE_VALUE:
+      self._zero_count += count
+    else:
+      key = self._get_key(value)
+      self._buckets[key] = self._buckets.get(key, 0.0) + count
+    self._count += count
+    self._sum += value * count
+    self._min = min(self._min, value)
+    self._max = max(self._max, value)
+    self._collapse()
+
+  def add_distribution(self,
+                       cumulative: Callable[[float], float],
+                       minimum: float,
+                       maximum: float,
+                       mean: Optional[float] = None) -> None:
+    """Add the values of a distribution known by its cumulative count.
+
+    Args:
+      cumulative: The number of values lower than or equal to a value
+      minimum: The smallest value
+      maximum: The largest value, at which the cumulative count is the
+        number of values
+      mean: The mean of the values. If unspecified, the values of the
+        buckets are used
+    """
+    if minimum < 0 or maximum < minimum:
+      raise LatencySketchError(f"Invalid range of values [{minimum}, {maximum}]")
+
+    counts = {}
+    seen = cumulative(MIN_INDEXABLE_VALUE) if minimum < MIN_INDEXABLE_VALUE else 0.0
+    zero_count = seen
+    if maximum >= MIN_INDEXABLE_VALUE:
+      for key in range(self._get_key(max(minimum, MIN_INDEXABLE_VALUE)),
+                       self._get_key(maximum) + 1):
+        upper = min(self._gamma**key, maximum)
+        count = cumulative(upper) - seen
+        if count > 0:
+          counts[key] = count
+          seen += count
+
+    total = zero_count + sum(counts.values())
+    if total <= 0:
+      return
+    for key, count in counts.items():
+      self._buckets[key] = self._buckets.get(key, 0.0) + count
+    self._zero_count += zero_count
+    self._count += total
+    self._sum += mean * total if mean is not None else sum(
+        self._get_value(key) * count for key, count in counts.items())
+    self._min = min(self._min, minimum)
+    self._max = max(self._max, maximum)
+    self._collapse()
+
+  def merge(self, other: 'LatencySketch') -> None:
+    """Add the values of another sketch with the same relative accuracy.
+
+    Raises:
+      LatencySketchError: if the sketches have different relative accuracies
+    """
+    if other.get_relative_accuracy() != self._relative_accuracy:
+      raise LatencySketchError(f"Unable to merge a sketch of relative accuracy "
+                               f"{other.get_relative_accuracy()} into one of "
+                               f"{self._relative_accuracy}")
+    for key, count in other._buckets.items():
+      self._buckets[key] = self._buckets.get(key, 0.0) + count
+    self._zero_count += other._zero_count
+    self._count += other._count
+    self._sum += other._sum
+    self._min = min(self._min, other._min)
+    self._max = max(self._max, other._max)
+    self._collapse()
+
+  def get_quantile(self, quantile: float) -> Optional[float]:
+    """Return the estimated value of a quantile.
+
+    Args:
+      quantile: The quantile, between 0 and 1
+
+    Returns:
+      the value, within the relative accuracy of the true value, or None if
+      the sketch is empty
+    """
+    if not self._count:
+      return None
+    if quantile <= 0:
+      return self._min
+    if quantile >= 1:
+      return self._max
+
+    rank = quantile * (self._count - 1)
+    cumulative = self._zero_count
+    if cumulative > rank:
+      return max(self._min, 0.0)
+    for key in sorted(self._buckets):
+      cumulative += self._buckets[key]
+      if cumulative > rank:
+        return min(max(self._get_value(key), self._min), self._max)
+    return self._max
+
+  def to_json(self) -> str:
+    """Encode the sketch as compact JSON.
+
+    The bucket counts are stored as a list starting at the lowest bucket.
+    """
+    offset = min(self._buckets) if self._buckets else 0
+    counts = [0.0] * (max(self._buckets) - offset + 1 if self._buckets else 0)
+    for key, count in self._buckets.items():
+      counts[key - offset] = count
+    return json.dumps(
+        {
+            'relative_accuracy': self._relative_accuracy,
+            'count': self._count,
+            'zero_count': self._zero_count,
+            'sum': self._sum,
+            'min': self._min if self._count else None,
+            'max': self._max if self._count else None,
+            'offset': offset,
+            'counts': [round(count, 6) for count in counts],
+        },
+        separators=(',', ':'))
+
+  @classmethod
+  def from_json(cls, encoded: str, max_buckets: int = DEFAULT_MAX_BUCKETS) -> 'LatencySketch':
+    """Decode a sketch encoded with to_json.
+
+    Raises:
+      LatencySketchError: if the sketch cannot be decoded
+    """
+    try:
+      fields = json.loads(encoded)
+      sketch = cls(fields['relative_accuracy'], max_buckets)
+      sketch._buckets = {
+          fields['offset'] + index: count for index, count in enumerate(fields['counts']) if count
+      }
+      sketch._zero_count = fields['zero_count']
+      sketch._count = fields['count']
+      sketch._sum = fields['sum']
+      if fields['count']:
+        sketch._min, sketch._max = fields['min'], fields['max']
+    except (ValueError, KeyError, TypeError) as decode_error:
+      raise LatencySketchError(f"Unable to decode the sketch: {decode_error}")
+    return sketch
+
+
+def _interpolate_monotone(points: Sequence[Tuple[float, float]]) -> Callable[[float], float]:
+  """Return the monotone cubic interpolation of increasing points.
+
+  The slopes at the points follow Fritsch and Carlson, so the interpolation
+  does not overshoot between two points and remains non-decreasing.
+  """
+  xs = [x for x, _ in points]
+  ys = [y for _, y in points]
+  widths = [b - a for a, b in zip(xs, xs[1:])]
+  secants = [(ys[i + 1] - ys[i]) / widths[i] for i in range(len(widths))]
+
+  slopes = [secants[0]] + [0.0] * (len(widths) - 1) + [secants[-1]]
+  for i in range(1, len(widths)):
+    if secants[i - 1] > 0 and secants[i] > 0:
+      before, after = 2 * widths[i] + widths[i - 1], widths[i] + 2 * widths[i - 1]
+      slopes[i] = (before + after) / (before / secants[i - 1] + after / secants[i])
+
+  def interpolate(x: float) -> float:
+    if x <= xs[0]:
+      return ys[0]
+    if x >= xs[-1]:
+      return ys[-1]
+    i = bisect.bisect_right(xs, x) - 1
+    t = (x - xs[i]) / widths[i]
+    return ((2 * t**3 - 3 * t**2 + 1) * ys[i] + (t**3 - 2 * t**2 + t) * widths[i] * slopes[i] +
+            (3 * t**2 - 2 * t**3) * ys[i + 1] + (t**3 - t**2) * widths[i] * slopes[i + 1])
+
+  return interpolate
+
+
+def from_percentiles(percentiles: Sequence[Tuple[float, int, float]],
+                     samples: int,
+                     minimum: float,
+                     maximum: float,
+                     mean: Optional[float] = None,
+                     relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY) -> LatencySketch:
+  """Build the sketch of a histogram from its percentile table.
+
+  The cumulative count between the reported percentiles is interpolated on
+  a logarithmic scale of the values, which follows the shape of latency
+  distributions more closely than a linear scale.
+
+  Args:
+    percentiles: The (percentile, cumulative count, value) rows of the table
+    samples: The number of samples of the histogram
+    minimum: The smallest sample
+    maximum: The largest sample
+    mean: The mean of the samples, if known
+    relative_accuracy: The relative accuracy of the sketch
+
+  Returns:
+    the sketch, holding the samples of the histogram
+  """
+  sketch = LatencySketch(relative_accuracy)
+  if not samples:
+    return sketch
+  if maximum <= minimum:
+    sketch.add(minimum, samples)
+    return sketch
+
+  # The smallest sample, the rows of the table and the largest sample form
+  # the cumulative distribution
+  floor = max(minimum, MIN_INDEXABLE_VALUE)
+  points = [(math.log(floor), 1.0)]
+  for _, count, value in sorted(percentiles, key=lambda row: (row[2], row[1])):
+    x, y = math.log(max(value, floor)), float(min(max(count, 1), samples))
+    if x <= points[-1][0]:
+      points[-1] = (points[-1][0], max(points[-1][1], y))
+    elif y >= points[-1][1]:
+      points.append((x, y))
+  if math.log(maximum) > points[-1][0]:
+    points.append((math.log(maximum), float(samples)))
+  else:
+    points[-1] = (points[-1][0], float(samples))
+
+  if len(points) == 1:
+    sketch.add(maximum, samples)
+    return sketch
+
+  interpolate = _interpolate_monotone(points)
+  sketch.add_distribution(lambda value: interpolate(math.log(max(value, floor))), minimum, maximum,
+                          mean)
+  return sketch
+
+
+def merge_sketches(sketches: Sequence[LatencySketch]) -> LatencySketch:
+  """Return the sketch holding the values of all sketches.
+
+  Raises:
+    LatencySketchError: if the sketches have different relative accuracies
+  """
+  merged = LatencySketch(
+      sketches[0].get_relative_accuracy() if sketches else DEFAULT_RELATIVE_ACCURACY)
+  for sketch in sketches:
+    merged.merge(sketch)
+  return merged
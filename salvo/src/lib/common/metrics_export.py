@@ -0,0 +1,297 @@
+"""Export the results of benchmarks as OpenMetrics text and to Prometheus remote-write.
+
+Every aggregated metric of a test becomes a gauge sample labelled with the
+Envoy commit, the test and the host profile. The metric names are prefixed
+with "salvo_" and their dots replaced, and latency percentiles become a
+"quantile" label of their histogram. Samples are pushed to a remote-write
+endpoint in as few requests as the batch size allows, each holding the
+samples of whole series, so a sweep of many benchmarks is ingested in a
+single bulk push.
+"""
+import logging
+import os
+import re
+import time
+from typing import (Dict, Iterable, List, NamedTuple, Optional, Tuple)
+
+import requests
+
+import api.export_pb2 as proto_export
+import api.remote_write_pb2 as proto_remote_write
+
+from src.lib.common import (results_db, snappy_block)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_EXPORT_FILE = 'metrics.txt'
+DEFAULT_BATCH_SIZE = 100000
+DEFAULT_TIMEOUT = 30.0
+
+METRIC_PREFIX = 'salvo_'
+
+_PERCENTILE_PATTERN = re.compile(r'^(.*)\.p(\d+(?:\.\d+)?)$')
+_INVALID_NAME_CHARACTERS = re.compile(r'[^a-zA-Z0-9_:]')
+
+_REMOTE_WRITE_HEADERS = {
+    'Content-Encoding': 'snappy',
+    'Content-Type': 'application/x-protobuf',
+    'User-Agent': 'salvo',
+    'X-Prometheus-Remote-Write-Version': '0.1.0',
+}
+
+
+class MetricsExportError(Exception):
+  """Raised when the metrics cannot be written or pushed."""
+
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+class Sample(NamedTuple):
+  """A sample of a gauge."""
+
+  name: str
+  # The labels of the sample, sorted by name
+  labels: _Labels
+  value: float
+  # The time of the sample in seconds since the epoch
+  timestamp: float
+
+
+# The samples of each series, keyed by the metric name and the labels
+_Series = Dict[Tuple[str, _Labels], List[Sample]]
+
+
+def get_export_path(options: proto_export.MetricsExport, output_dir: str) -> str:
+  """Return the path of the OpenMetrics file of a job.
+
+  Args:
+    options: The export options from the job control document
+    output_dir: The output directory of the job
+
+  Returns:
+    the path specified in the options, or the default file in the output
+    directory
+  """
+  return options.path or os.path.join(output_dir, DEFAULT_EXPORT_FILE)
+
+
+def to_sample(metric: str, value: float, timestamp: float, **labels: str) -> Sample:
+  """Convert a metric of the results into a sample.
+
+  Args:
+    metric: The name of the metric in the results, eg
+      "benchmark_http_client.latency_2xx.p99"
+    value: The value of the metric
+    timestamp: The time the metric was measured, in seconds since the epoch
+    labels: The labels of the sample. Empty labels are left out
+
+  Returns:
+    the sample of the gauge named after the metric
+  """
+  percentile = _PERCENTILE_PATTERN.match(metric)
+  if percentile:
+    metric = percentile.group(1)
+    labels['quantile'] = f"{float(percentile.group(2)) / 100:g}"
+
+  name = METRIC_PREFIX + _INVALID_NAME_CHARACTERS.sub('_', metric)
+  return Sample(name=name,
+                labels=tuple(sorted((key, value) for key, value in labels.items() if value)),
+                value=value,
+                timestamp=timestamp)
+
+
+def collect_run_samples(output_dir: str,
+                        commit_hash: str,
+                        host_profile: str,
+                        role: str = '',
+                        timestamp: Optional[float] = None) -> List[Sample]:
+  """Return the samples of the metrics of every test of a benchmark.
+
+  Args:
+    output_dir: The output directory of the benchmark
+    commit_hash: The Envoy commit or tag benchmarked
+    host_profile: The host configuration running the benchmark
+    role: Whether the Envoy is the candidate or a baseline, if known
+    timestamp: The time of the samples. The default is the current time
+
+  Returns:
+    the samples of every test, whose name is the directory of its results
+    relative to the output directory
+
+  Raises:
+    MetricsExportError: if the results of a test cannot be read
+  """
+  timestamp = timestamp or time.time()
+  samples = []
+  for test, results_path in results_db.find_test_results(output_dir).items():
+    try:
+      with open(results_path) as results_file:
+        metrics = results_db.parse_nighthawk_results(results_file.read())
+    except OSError as read_error:
+      raise MetricsExportError(f"Unable to read the results of [{test}]: {read_error}")
+
+    samples += [
+        to_sample(metric,
+                  value,
+                  timestamp,
+                  commit=commit_hash,
+                  test=test,
+                  host_profile=host_profile,
+                  role=role) for metric, value in sorted(metrics.items())
+    ]
+  return samples
+
+
+def samples_from_results(results: Iterable[results_db.Result]) -> List[Sample]:
+  """Convert the results recorded in the results database into samples.
+
+  Each repetition of a commit is a sample at the time it was recorded.
+  """
+  return [
+      to_sample(result.metric,
+                result.value,
+                result.timestamp,
+                commit=result.commit_hash,
+                test=result.test,
+                host_profile=result.host_profile,
+                role=result.role) for result in results
+  ]
+
+
+def _group_series(samples: Iterable[Sample]) -> _Series:
+  """Group the samples by metric name and labels, in name order and then time order."""
+  series = {}
+  for sample in sorted(samples, key=lambda s: (s.name, s.labels, s.timestamp)):
+    series.setdefault((sample.name, sample.labels), []).append(sample)
+  return series
+
+
+def _escape_label_value(value: str) -> str:
+  """Escape a label value for the OpenMetrics text format."""
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_openmetrics(samples: Iterable[Sample]) -> str:
+  """Format samples as an OpenMetrics text exposition.
+
+  The samples of a metric are grouped under its type, and the samples of a
+  series are in time order, as the format requires.
+  """
+  lines = []
+  family = None
+  for (name, labels), series_samples in _group_series(samples).items():
+    if name != family:
+      family = name
+      lines.append(f"# TYPE {name} gauge")
+    label_text = ','.join(f'{key}="{_escape_label_value(value)}"' for key, value in labels)
+    for sample in series_samples:
+      lines.append(f"{name}{{{label_text}}} {sample.value!r} {sample.timestamp:.3f}")
+  lines.append('# EOF')
+  return '\n'.join(lines) + '\n'
+
+
+def write_openmetrics(samples: Iterable[Sample], path: str) -> str:
+  """Write samples to an OpenMetrics file.
+
+  The file is replaced atomically, so a scraper never reads a partial file.
+
+  Returns:
+    the path of the file
+
+  Raises:
+    MetricsExportError: if the file cannot be written
+  """
+  temporary_path = f"{path}.tmp"
+  try:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(temporary_path, 'w') as metrics_file:
+      metrics_file.write(format_openmetrics(samples))
+    os.replace(temporary_path, path)
+  except OSError as write_error:
+    raise MetricsExportError(f"Unable to write the metrics to [{path}]: {write_error}")
+  return path
+
+
+def encode_write_request(series: _Series) -> bytes:
+  """Encode grouped samples as a remote-write request.
+
+  Args:
+    series: The samples of each series, keyed by metric name and labels
+
+  Returns:
+    the serialized request, before compression
+  """
+  request = proto_remote_write.WriteRequest()
+  for (name, labels), series_samples in series.items():
+    timeseries = request.timeseries.add()
+    for label_name, label_value in sorted((('__name__', name),) + labels):
+      timeseries.labels.add(name=label_name, value=label_value)
+    for sample in series_samples:
+      timeseries.samples.add(value=sample.value, timestamp=int(sample.timestamp * 1000))
+  return request.SerializeToString()
+
+
+class RemoteWriter(object):
+  """Push samples to a Prometheus remote-write endpoint in batches."""
+
+  def __init__(self, url: str, batch_size: int = 0, timeout: float = 0.0) -> None:
+    """Initialize the writer.
+
+    Args:
+      url: The remote-write endpoint
+      batch_size: The largest number of samples of a request
+      timeout: The timeout of each request in seconds
+    """
+    self._url = url
+    self._batch_size = batch_size or DEFAULT_BATCH_SIZE
+    self._timeout = timeout or DEFAULT_TIMEOUT
+
+  def get_batches(self, samples: Iterable[Sample]) -> List[_Series]:
+    """Split samples into batches of whole series of at most the batch size.
+
+    A series larger than the batch size is split over consecutive batches.
+    """
+    batches = [{}]
+    batch_samples = 0
+    for key, series_samples in _group_series(samples).items():
+      for start in range(0, len(series_samples), self._batch_size):
+        chunk = series_samples[start:start + self._batch_size]
+        if batch_samples + len(chunk) > self._batch_size:
+          batches.append({})
+          batch_samples = 0
+        batches[-1].setdefault(key, []).extend(chunk)
+        batch_samples += len(chunk)
+    return [batch for batch in batches if batch]
+
+  def push(self, samples: Iterable[Sample]) -> int:
+    """Push samples to the endpoint.
+
+    Args:
+      samples: The samples to push
+
+    Returns:
+      the number of requests sent
+
+    Raises:
+      MetricsExportError: if the endpoint cannot be reached or rejects a
+        request. The batches before the failed one were accepted
+    """
+    batches = self.get_batches(samples)
+    for index, batch in enumerate(batches):
+      body = snappy_block.compress(encode_write_request(batch))
+      try:
+        response = requests.post(self._url,
+                                 data=body,
+                                 headers=_REMOTE_WRITE_HEADERS,
+                                 timeout=self._timeout)
+      except requests.exceptions.RequestException as request_error:
+        raise MetricsExportError(f"Unable to push batch {index + 1} of {len(batches)} to "
+                                 f"[{self._url}]: {request_error}")
+      if response.status_code >= 300:
+        raise MetricsExportError(f"[{self._url}] rejected batch {index + 1} of {len(batches)} "
+                                 f"with status {response.status_code}: {response.text[:200]}")
+
+    log.info(f"Pushed {sum(sum(map(len, batch.values())) for batch in batches)} samples to "
+             f"[{self._url}] in {len(batches)} requests")
+    return len(batches)
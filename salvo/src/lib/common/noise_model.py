@@ -0,0 +1,180 @@
+"""Score the results of a candidate Envoy against the rolling noise model of each test.
+
+The noise model of a test holds the median and the median absolute
+deviation (MAD) of each metric over the most recent baseline runs recorded
+in the results database for the same host profile. A candidate metric is
+scored with its robust z-score, the distance from the median in scaled
+MADs, and flagged when the score exceeds the threshold. Unlike a
+comparison with a single baseline run, a noisy baseline run only shifts
+the model slightly.
+"""
+import json
+import logging
+import os
+import statistics
+from typing import (Dict, List, NamedTuple, Optional)
+
+import api.analysis_pb2 as proto_analysis
+
+from src.lib.common import results_db
+
+log = logging.getLogger(__name__)
+
+SCORES_FILE = 'noise_scores.json'
+
+DEFAULT_WINDOW = 20
+DEFAULT_MIN_SAMPLES = 5
+DEFAULT_THRESHOLD = 3.5
+
+# Scale the MAD into a consistent estimator of the standard deviation of
+# normally distributed values
+MAD_SCALE = 1.4826
+
+
+class MetricModel(NamedTuple):
+  """The distribution of a metric over the baseline runs."""
+
+  median: float
+  mad: float
+  samples: int
+
+
+class MetricScore(NamedTuple):
+  """The score of a candidate metric against its model."""
+
+  metric: str
+  value: float
+  median: float
+  mad: float
+  samples: int
+  # The robust z-score, or None if the baseline runs did not vary and the
+  # candidate differs from them
+  score: Optional[float]
+  outlier: bool
+
+
+def build_model(values: List[float]) -> MetricModel:
+  """Return the median and the MAD of the values of a metric."""
+  median = statistics.median(values)
+  mad = statistics.median([abs(value - median) for value in values])
+  return MetricModel(median=median, mad=mad, samples=len(values))
+
+
+def score_value(metric: str, value: float, model: MetricModel, threshold: float) -> MetricScore:
+  """Score a candidate value against the model of its metric.
+
+  Args:
+    metric: The name of the metric
+    value: The value measured for the candidate
+    model: The model of the metric
+    threshold: The robust z-score beyond which the value is an outlier
+
+  Returns:
+    the score of the value
+  """
+  if model.mad:
+    score = (value - model.median) / (MAD_SCALE * model.mad)
+    outlier = abs(score) > threshold
+  else:
+    # The baseline runs agree exactly, which is the case of most counters
+    score = 0.0 if value == model.median else None
+    outlier = score is None
+
+  return MetricScore(metric=metric,
+                     value=value,
+                     median=model.median,
+                     mad=model.mad,
+                     samples=model.samples,
+                     score=score,
+                     outlier=outlier)
+
+
+class NoiseModel(object):
+  """Score candidate runs against the baseline history of the results database."""
+
+  def __init__(self, options: proto_analysis.NoiseModelOptions,
+               database: results_db.ResultsDatabase, host_profile: str) -> None:
+    """Initialize the model.
+
+    Args:
+      options: The noise model options from the job control document
+      database: The results database holding the baseline runs
+      host_profile: The host configuration whose baseline runs are used
+    """
+    self._database = database
+    self._host_profile = host_profile
+    self._window = options.window or DEFAULT_WINDOW
+    self._min_samples = options.min_samples or DEFAULT_MIN_SAMPLES
+    self._threshold = options.threshold or DEFAULT_THRESHOLD
+
+  def get_models(self, test: str) -> Dict[str, MetricModel]:
+    """Return the model of each metric of a test with enough baseline runs.
+
+    Raises:
+      ResultsDatabaseError: if the history cannot be read
+    """
+    history = self._database.get_baseline_history(test, self._host_profile, self._window)
+    return {
+        metric: build_model(values)
+        for metric, values in history.items()
+        if len(values) >= self._min_samples
+    }
+
+  def score_run(self, test_metrics: Dict[str, Dict[str, float]]) -> Dict[str, List[MetricScore]]:
+    """Score the metrics of a candidate run.
+
+    Args:
+      test_metrics: The metrics of the candidate, by test
+
+    Returns:
+      the scores of the metrics that have a model, by test
+
+    Raises:
+      ResultsDatabaseError: if the history cannot be read
+    """
+    scores = {}
+    for test, metrics in sorted(test_metrics.items()):
+      models = self.get_models(test)
+      scores[test] = [
+          score_value(metric, value, models[metric], self._threshold)
+          for metric, value in sorted(metrics.items())
+          if metric in models
+      ]
+    return scores
+
+  def write_scores(self, scores: Dict[str, List[MetricScore]], output_dir: str) -> str:
+    """Write the scores of a candidate run and log its outliers.
+
+    Args:
+      scores: The scores of the metrics, by test
+      output_dir: The output directory of the candidate
+
+    Returns:
+      the path of the scores
+    """
+    outliers = [(test, score)
+                for test, test_scores in scores.items()
+                for score in test_scores
+                if score.outlier]
+    scored = sum(map(len, scores.values()))
+    log.info(f"{len(outliers)} of {scored} metrics of the candidate are outside the noise of the "
+             f"last {self._window} baseline runs on [{self._host_profile}]")
+    for test, score in outliers:
+      z_score = f"{score.score:+.1f}" if score.score is not None else "n/a"
+      log.warning(f"{test}: {score.metric} = {score.value:g}, baseline median {score.median:g}, "
+                  f"MAD {score.mad:g}, score {z_score}")
+
+    report = {
+        'host_profile': self._host_profile,
+        'window': self._window,
+        'threshold': self._threshold,
+        'tests': {},
+    }
+    for test, test_scores in scores.items():
+      report['tests'][test] = [score._asdict() for score in test_scores]
+
+    os.makedirs(output_dir, exist_ok=True)
+    scores_path = os.path.join(output_dir, SCORES_FILE)
+    with open(scores_path, 'w') as scores_file:
+      json.dump(report, scores_file, indent=2)
+    return scores_path
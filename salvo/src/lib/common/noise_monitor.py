@@ -0,0 +1,201 @@
+"""Watch the pressure stall information of the host while a benchmark executes.
+
+When the share of time in which tasks stall on CPU, IO or memory exceeds a
+threshold, the monitor invokes a callback so that the work competing with
+the benchmark, such as a build, can be paused. The work is resumed once the
+pressure falls below half of the threshold.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import (Callable, Dict, Optional)
+
+log = logging.getLogger(__name__)
+
+PRESSURE_DIRECTORY = '/proc/pressure'
+PRESSURE_RESOURCES = ['cpu', 'io', 'memory']
+NOISE_REPORT_FILE = 'noise_monitor.json'
+
+DEFAULT_PRESSURE_THRESHOLD = 25.0
+DEFAULT_MONITOR_INTERVAL_MS = 1000
+
+
+class NoiseMonitorError(Exception):
+  """Error raised when the pressure of the host cannot be read."""
+
+
+def read_pressure(resource: str, pressure_dir: str = PRESSURE_DIRECTORY) -> float:
+  """Read the share of time in the last 10 seconds that some task stalled on a resource.
+
+  Args:
+    resource: One of "cpu", "io" or "memory"
+    pressure_dir: The directory containing the pressure files
+
+  Returns:
+    the "some avg10" value of the resource, in percent
+
+  Raises:
+    NoiseMonitorError: if the pressure file cannot be read or parsed
+  """
+  pressure_path = os.path.join(pressure_dir, resource)
+  try:
+    with open(pressure_path) as pressure_file:
+      for line in pressure_file:
+        kind, *fields = line.split()
+        if kind == 'some':
+          values = dict(field.split('=', 1) for field in fields)
+          return float(values['avg10'])
+  except (OSError, KeyError, ValueError) as read_error:
+    raise NoiseMonitorError(f"Unable to read pressure from {pressure_path}: {read_error}")
+
+  raise NoiseMonitorError(f"No pressure recorded in {pressure_path}")
+
+
+class NoiseMonitor(object):
+  """Sample the host pressure in a background thread for the duration of a benchmark.
+
+  The monitor is a context manager. The pause and resume callbacks are
+  invoked from the monitoring thread.
+  """
+
+  def __init__(self,
+               threshold: float,
+               interval_ms: int,
+               pause: Optional[Callable[[], None]] = None,
+               resume: Optional[Callable[[], None]] = None,
+               pressure_dir: str = PRESSURE_DIRECTORY) -> None:
+    """Initialize the monitor.
+
+    Args:
+      threshold: The pressure in percent above which pause is invoked.
+        Zero selects the default threshold
+      interval_ms: The sampling interval. Zero selects the default interval
+      pause: The callback invoked when the pressure exceeds the threshold
+      resume: The callback invoked when the pressure subsides
+      pressure_dir: The directory containing the pressure files
+    """
+    self._threshold = threshold or DEFAULT_PRESSURE_THRESHOLD
+    self._interval = (interval_ms or DEFAULT_MONITOR_INTERVAL_MS) / 1000.0
+    self._pause = pause
+    self._resume = resume
+    self._pressure_dir = pressure_dir
+
+    self._stop = threading.Event()
+    self._thread = None
+    self._samples = []
+    self._paused_since = None
+    self._paused_time = 0.0
+    self._interference_events = 0
+
+  def __enter__(self) -> 'NoiseMonitor':
+    """Start sampling the pressure."""
+    try:
+      read_pressure(PRESSURE_RESOURCES[0], self._pressure_dir)
+    except NoiseMonitorError as monitor_error:
+      log.warning(f"Noise monitoring is disabled: {monitor_error}")
+      return self
+
+    self._thread = threading.Thread(target=self._run, name='noise_monitor', daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Stop sampling and resume any paused work."""
+    if self._thread:
+      self._stop.set()
+      self._thread.join()
+    self._set_paused(False)
+
+  def _get_pressure(self) -> float:
+    """Return the highest pressure across the monitored resources."""
+    pressures = []
+    for resource in PRESSURE_RESOURCES:
+      try:
+        pressures.append(read_pressure(resource, self._pressure_dir))
+      except NoiseMonitorError:
+        continue
+    return max(pressures, default=0.0)
+
+  def _set_paused(self, paused: bool) -> None:
+    """Invoke the pause or resume callback when the state changes.
+
+    Args:
+      paused: Whether the competing work should be paused
+    """
+    if paused == (self._paused_since is not None):
+      return
+
+    callback = self._pause if paused else self._resume
+    if callback:
+      try:
+        callback()
+      except Exception as callback_error:
+        log.error(f"Unable to {'pause' if paused else 'resume'} the competing work: "
+                  f"{callback_error}")
+
+    if paused:
+      self._paused_since = time.monotonic()
+      self._interference_events += 1
+    else:
+      self._paused_time += time.monotonic() - self._paused_since
+      self._paused_since = None
+
+  def sample(self) -> float:
+    """Record one pressure sample and pause or resume the competing work.
+
+    Returns:
+      the sampled pressure
+    """
+    pressure = self._get_pressure()
+    self._samples.append(pressure)
+
+    if pressure > self._threshold and self._paused_since is None:
+      log.info(f"Pressure of {pressure:.1f}% exceeds {self._threshold:.1f}%. "
+               "Pausing competing work")
+      self._set_paused(True)
+    elif pressure < self._threshold / 2 and self._paused_since is not None:
+      log.info(f"Pressure fell to {pressure:.1f}%. Resuming competing work")
+      self._set_paused(False)
+
+    return pressure
+
+  def _run(self) -> None:
+    """Sample the pressure until the monitor is stopped."""
+    while not self._stop.is_set():
+      self.sample()
+      self._stop.wait(self._interval)
+
+  def get_report(self) -> Dict[str, float]:
+    """Summarize the pressure observed while the monitor ran.
+
+    Returns:
+      a dictionary with the sample count, the mean and maximum pressure, the
+        number of times the competing work was paused and the time it
+        remained paused
+    """
+    samples = self._samples or [0.0]
+    return {
+        'threshold': self._threshold,
+        'samples': len(self._samples),
+        'mean_pressure': sum(samples) / len(samples),
+        'max_pressure': max(samples),
+        'interference_events': self._interference_events,
+        'paused_seconds': self._paused_time,
+    }
+
+  def write_report(self, output_dir: str) -> str:
+    """Write the summary of the observed pressure to the output directory.
+
+    Args:
+      output_dir: The directory receiving the report
+
+    Returns:
+      the path of the written report
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    report_path = os.path.join(output_dir, NOISE_REPORT_FILE)
+    with open(report_path, 'w') as report_file:
+      json.dump(self.get_report(), report_file, indent=2)
+    return report_path
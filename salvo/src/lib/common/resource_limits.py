@@ -0,0 +1,287 @@
+"""Constrain the Envoy under test as it runs in production and record how it was throttled.
+
+Containers of the Envoy image receive the CPU quota, cpuset and memory
+limit as docker options. An Envoy binary is started in a cgroup v2 node
+with the same limits. While the benchmark executes, the cpu.stat and
+memory.events counters of these cgroups are sampled and summarized in the
+output directory.
+"""
+import json
+import logging
+import os
+import re
+import threading
+from typing import (Callable, Dict, List)
+
+import api.env_pb2 as proto_env
+
+from src.lib.common import cgroup
+
+log = logging.getLogger(__name__)
+
+REPORT_FILE = 'envoy_resources.json'
+
+DEFAULT_CPU_PERIOD = 100000
+DEFAULT_SAMPLE_INTERVAL_MS = 500
+
+# The counters of cpu.stat and memory.events that are summed across cgroups
+CPU_COUNTERS = ['usage_usec', 'nr_periods', 'nr_throttled', 'throttled_usec']
+MEMORY_COUNTERS = ['low', 'high', 'max', 'oom', 'oom_kill']
+
+_MEMORY_SIZE_PATTERN = re.compile(r'^(\d+)([bkmg]?)$')
+_MEMORY_UNITS = {'': 1, 'b': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+
+class ResourceLimitsError(Exception):
+  """Error raised when the resource limits are invalid or cannot be applied."""
+
+
+def is_limited(limits: proto_env.ResourceLimits) -> bool:
+  """Return whether any resource limit is configured for Envoy."""
+  return bool(limits.cpu_quota or limits.cpuset or limits.mem_limit)
+
+
+def parse_memory_size(size: str) -> int:
+  """Convert a memory size such as "512m" into bytes.
+
+  Args:
+    size: A number of bytes, optionally with a k, m or g suffix
+
+  Returns:
+    the size in bytes
+
+  Raises:
+    ResourceLimitsError: if the size is malformed
+  """
+  match = _MEMORY_SIZE_PATTERN.match(size.strip().lower())
+  if not match:
+    raise ResourceLimitsError(f"Invalid memory limit: [{size}]")
+  return int(match.group(1)) * _MEMORY_UNITS[match.group(2)]
+
+
+def get_docker_arguments(limits: proto_env.ResourceLimits) -> List[str]:
+  """Return the "docker run" options applying the limits to a container.
+
+  Args:
+    limits: The resource limits from the job control document
+
+  Returns:
+    the options, or an empty list if no limit is configured
+
+  Raises:
+    ResourceLimitsError: if a limit is malformed
+  """
+  arguments = []
+  if limits.cpu_quota:
+    arguments += [
+        '--cpu-quota',
+        str(limits.cpu_quota), '--cpu-period',
+        str(limits.cpu_period or DEFAULT_CPU_PERIOD)
+    ]
+  if limits.cpuset:
+    arguments += ['--cpuset-cpus', _get_cpuset(limits)]
+  if limits.mem_limit:
+    arguments += ['--memory', str(parse_memory_size(limits.mem_limit))]
+  return arguments
+
+
+def _get_cpuset(limits: proto_env.ResourceLimits) -> str:
+  """Return the validated cpuset list of the limits."""
+  try:
+    return cgroup.format_cpu_list(cgroup.parse_cpu_list(limits.cpuset))
+  except cgroup.CgroupError as cpu_list_error:
+    raise ResourceLimitsError(str(cpu_list_error))
+
+
+def create_limited_cgroup(limits: proto_env.ResourceLimits, name: str) -> cgroup.Cgroup:
+  """Create a cgroup enforcing the limits on the processes moved into it.
+
+  Args:
+    limits: The resource limits from the job control document
+    name: The name of the cgroup
+
+  Returns:
+    the created cgroup. The caller removes it once its processes exit
+
+  Raises:
+    ResourceLimitsError: if the cgroup cannot be created or a limit cannot
+      be applied
+  """
+  settings = {}
+  if limits.cpu_quota:
+    settings['cpu.max'] = f"{limits.cpu_quota} {limits.cpu_period or DEFAULT_CPU_PERIOD}"
+  if limits.cpuset:
+    settings['cpuset.cpus'] = _get_cpuset(limits)
+  if limits.mem_limit:
+    settings['memory.max'] = str(parse_memory_size(limits.mem_limit))
+
+  controllers = sorted({setting.split('.')[0] for setting in settings} | {'cpu', 'memory'})
+  try:
+    limited_cgroup = cgroup.Cgroup.create(name, controllers)
+  except cgroup.CgroupError as cgroup_error:
+    raise ResourceLimitsError(f"Unable to create a cgroup limiting Envoy: {cgroup_error}")
+
+  try:
+    for setting, value in settings.items():
+      limited_cgroup.set_value(setting, value)
+  except cgroup.CgroupError as cgroup_error:
+    limited_cgroup.remove()
+    raise ResourceLimitsError(str(cgroup_error))
+
+  log.debug(f"Limiting Envoy in {limited_cgroup.get_path()}: {settings}")
+  return limited_cgroup
+
+
+def create_cgroup_wrapper(limited_cgroup: cgroup.Cgroup, envoy_binary: str,
+                          wrapper_dir: str) -> str:
+  """Write a script that starts Envoy in a cgroup.
+
+  Args:
+    limited_cgroup: The cgroup enforcing the limits
+    envoy_binary: The path to the Envoy binary, or to a script starting it
+    wrapper_dir: The directory receiving the script
+
+  Returns:
+    the path to the script, to be used in place of the Envoy binary
+  """
+  os.makedirs(wrapper_dir, exist_ok=True)
+  wrapper_path = os.path.join(wrapper_dir, 'envoy_limited.sh')
+  with open(wrapper_path, 'w') as wrapper:
+    wrapper.write("#!/bin/sh\n"
+                  f"echo $$ > \"{limited_cgroup.get_procs_path()}\" && "
+                  f"exec \"{envoy_binary}\" \"$@\"\n")
+  os.chmod(wrapper_path, 0o755)
+  return wrapper_path
+
+
+def get_process_cgroups(pids: Dict[str, int]) -> Dict[str, str]:
+  """Return the cgroup directories of processes, such as the init processes of containers.
+
+  Processes that exited, or whose cgroup is not visible from Salvo's
+  cgroup v2 hierarchy, are skipped.
+
+  Args:
+    pids: The process identifiers, by name
+
+  Returns:
+    the absolute cgroup paths, by name
+  """
+  root = cgroup.get_unified_root()
+  if not root:
+    return {}
+
+  paths = {}
+  for name, pid in pids.items():
+    try:
+      path = root + cgroup.get_process_cgroup(str(pid))
+    except (OSError, cgroup.CgroupError):
+      continue
+    if os.path.isdir(path):
+      paths[name] = path
+  return paths
+
+
+class ThrottlingMonitor(object):
+  """Sample the CPU throttling and memory events of the cgroups running Envoy.
+
+  The monitor is a context manager sampling from a background thread. The
+  counters of a cgroup only increase, so the last sample of each cgroup is
+  kept. Cgroups of containers are removed with the container, so the
+  activity after their last sample is not recorded. Envoy is not monitored
+  unless it has resource limits.
+  """
+
+  def __init__(self, limits: proto_env.ResourceLimits, get_cgroups: Callable[[], Dict[str, str]],
+               output_dir: str) -> None:
+    """Initialize the monitor.
+
+    Args:
+      limits: The resource limits from the job control document
+      get_cgroups: A function returning the paths of the cgroups running
+        Envoy, by name
+      output_dir: The directory receiving the report
+    """
+    self._enabled = is_limited(limits)
+    self._get_cgroups = get_cgroups
+    self._output_dir = output_dir
+    self._interval = (limits.sample_interval_ms or DEFAULT_SAMPLE_INTERVAL_MS) / 1000.0
+    self._samples = {}
+    self._stop = threading.Event()
+    self._thread = None
+
+  def __enter__(self) -> 'ThrottlingMonitor':
+    """Start sampling the cgroups."""
+    if self._enabled:
+      self._thread = threading.Thread(target=self._run, name='throttling_monitor', daemon=True)
+      self._thread.start()
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Stop sampling and write the report."""
+    if not self._enabled:
+      return
+
+    self._stop.set()
+    self._thread.join()
+    self.sample()
+    self.write_report()
+
+  def _run(self) -> None:
+    """Sample the cgroups until the monitor is stopped."""
+    while not self._stop.wait(self._interval):
+      self.sample()
+
+  def sample(self) -> None:
+    """Read the counters of every cgroup running Envoy."""
+    try:
+      cgroups = self._get_cgroups()
+    except Exception as list_error:
+      log.debug(f"Unable to list the Envoy cgroups: {list_error}")
+      return
+
+    for name, path in cgroups.items():
+      envoy_cgroup = cgroup.Cgroup(path)
+      try:
+        self._samples[name] = {
+            'cgroup': path,
+            'cpu': envoy_cgroup.read_stat('cpu.stat'),
+            'memory': envoy_cgroup.read_stat('memory.events'),
+        }
+      except cgroup.CgroupError as read_error:
+        # The cgroup was removed since it was listed
+        log.debug(f"Unable to sample {name}: {read_error}")
+
+  def get_summary(self) -> Dict[str, float]:
+    """Sum the counters of all sampled cgroups.
+
+    Returns:
+      the CPU and memory counters, and the share of CPU periods in which
+        Envoy was throttled
+    """
+    summary = {'cgroups': len(self._samples)}
+    for counter in CPU_COUNTERS:
+      summary[counter] = sum(sample['cpu'].get(counter, 0) for sample in self._samples.values())
+    for counter in MEMORY_COUNTERS:
+      summary[f"memory_{counter}"] = sum(
+          sample['memory'].get(counter, 0) for sample in self._samples.values())
+
+    summary['throttled_ratio'] = \
+        summary['nr_throttled'] / summary['nr_periods'] if summary['nr_periods'] else 0.0
+    return summary
+
+  def write_report(self) -> str:
+    """Write the summary and the counters of each cgroup to the output directory.
+
+    Returns:
+      the path of the report
+    """
+    summary = self.get_summary()
+    log.info(f"Envoy was throttled in {summary['throttled_ratio']:.1%} of "
+             f"{summary['nr_periods']} CPU periods for {summary['throttled_usec']}us, "
+             f"and reached its memory limit {summary['memory_max']} times")
+
+    os.makedirs(self._output_dir, exist_ok=True)
+    report_path = os.path.join(self._output_dir, REPORT_FILE)
+    with open(report_path, 'w') as report_file:
+      json.dump({'summary': summary, 'cgroups': self._samples}, report_file, indent=2)
+    return report_path
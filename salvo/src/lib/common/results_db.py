@@ -0,0 +1,597 @@
+"""Record the results of benchmarks in an SQLite database and query them.
+
+Each benchmark output directory is parsed for the NightHawk results of its
+tests. Every statistic, percentile and counter becomes a row keyed by the
+run, the Envoy commit, the image digest, the test, the repetition and the
+metric. The results are indexed by commit, test and timestamp, so that the
+history of a metric is queried without reading the output directories.
+"""
+import logging
+import os
+import re
+import socket
+import sqlite3
+import statistics
+import time
+from typing import (Dict, List, NamedTuple, Optional, Tuple)
+
+import api.storage_pb2 as proto_storage
+
+from src.lib.common import latency_sketch
+
+log = logging.getLogger(__name__)
+
+RESULTS_FILE = 'nighthawk-human.txt'
+DEFAULT_DATABASE_FILE = 'results.db'
+SCHEMA_VERSION = 3
+
+# The roles of a run in its job
+ROLE_BASELINE = 'baseline'
+ROLE_CANDIDATE = 'candidate'
+
+_TABLES = [
+    """CREATE TABLE IF NOT EXISTS runs (
+         run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+         timestamp REAL NOT NULL,
+         commit_hash TEXT NOT NULL,
+         image TEXT NOT NULL,
+         image_digest TEXT NOT NULL,
+         benchmark TEXT NOT NULL,
+         output_dir TEXT NOT NULL,
+         host_profile TEXT NOT NULL DEFAULT '',
+         role TEXT NOT NULL DEFAULT '')""",
+    """CREATE TABLE IF NOT EXISTS results (
+         run_id INTEGER NOT NULL REFERENCES runs(run_id),
+         timestamp REAL NOT NULL,
+         commit_hash TEXT NOT NULL,
+         image_digest TEXT NOT NULL,
+         test TEXT NOT NULL,
+         repetition INTEGER NOT NULL,
+         metric TEXT NOT NULL,
+         value REAL NOT NULL,
+         host_profile TEXT NOT NULL DEFAULT '',
+         role TEXT NOT NULL DEFAULT '')""",
+    """CREATE TABLE IF NOT EXISTS sketches (
+         run_id INTEGER NOT NULL REFERENCES runs(run_id),
+         timestamp REAL NOT NULL,
+         commit_hash TEXT NOT NULL,
+         test TEXT NOT NULL,
+         repetition INTEGER NOT NULL,
+         histogram TEXT NOT NULL,
+         host_profile TEXT NOT NULL,
+         role TEXT NOT NULL,
+         sketch TEXT NOT NULL)""",
+]
+
+# The statements upgrading a database created by an earlier schema version
+_MIGRATIONS = {
+    2: [
+        "ALTER TABLE runs ADD COLUMN host_profile TEXT NOT NULL DEFAULT ''",
+        "ALTER TABLE runs ADD COLUMN role TEXT NOT NULL DEFAULT ''",
+        "ALTER TABLE results ADD COLUMN host_profile TEXT NOT NULL DEFAULT ''",
+        "ALTER TABLE results ADD COLUMN role TEXT NOT NULL DEFAULT ''",
+    ],
+}
+
+_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS results_by_commit ON results(commit_hash)",
+    "CREATE INDEX IF NOT EXISTS results_by_test ON results(test, metric)",
+    "CREATE INDEX IF NOT EXISTS results_by_timestamp ON results(timestamp)",
+    "CREATE INDEX IF NOT EXISTS results_by_history ON results(test, host_profile, role, run_id)",
+    "CREATE INDEX IF NOT EXISTS sketches_by_test ON sketches(test, histogram)",
+]
+
+# A histogram or statistic of the NightHawk output, eg
+# "benchmark_http_client.latency_2xx (29999 samples)"
+_SECTION_PATTERN = re.compile(r'^(\S.*?) \((\d+) samples\)$')
+_STATISTIC_PATTERN = re.compile(r'(min|mean|max|pstdev): ([^|]+)')
+_PERCENTILE_PATTERN = re.compile(r'^\s+([01](?:\.\d+)?)\s+(\d+)\s+(.+?)\s*$')
+_COUNTER_HEADER_PATTERN = re.compile(r'^Counter\s+Value\s+Per second')
+_COUNTER_PATTERN = re.compile(r'^([a-z][\w.]*)\s+(\d+)\s+(\d+(?:\.\d+)?)\s*$')
+_DURATION_PATTERN = re.compile(r'^(\d+)s (\d+)ms (\d+)us$')
+
+
+class ResultsDatabaseError(Exception):
+  """Error raised when the results database cannot be read or updated."""
+
+
+class Result(NamedTuple):
+  """A metric of one repetition of a test."""
+
+  run_id: int
+  timestamp: float
+  commit_hash: str
+  image_digest: str
+  test: str
+  repetition: int
+  metric: str
+  value: float
+  host_profile: str = ''
+  role: str = ''
+
+
+def get_database_path(options: proto_storage.ResultsDatabase, output_dir: str) -> str:
+  """Return the path of the results database of a job.
+
+  Args:
+    options: The results database options from the job control document
+    output_dir: The output directory of the job
+
+  Returns:
+    the configured path, or the default database in the output directory
+  """
+  return options.path or os.path.join(output_dir, DEFAULT_DATABASE_FILE)
+
+
+def get_host_profile(options: proto_storage.ResultsDatabase) -> str:
+  """Return the name of the host configuration recorded with the results.
+
+  Args:
+    options: The results database options from the job control document
+
+  Returns:
+    the configured host profile, or the host name
+  """
+  return options.host_profile or socket.gethostname()
+
+
+def format_results(results: List[Result]) -> str:
+  """Format results as a table, one result per line."""
+  columns = ['time', 'commit', 'test', 'repetition', 'metric', 'value']
+  rows = [columns] + [[
+      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(result.timestamp)), result.commit_hash,
+      result.test,
+      str(result.repetition), result.metric, f"{result.value:g}"
+  ] for result in results]
+  widths = [max(len(row[column]) for row in rows) for column in range(len(columns))]
+  return '\n'.join(
+      '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def _parse_value(value: str) -> float:
+  """Convert a NightHawk value, such as "0s 000ms 512us" or "1024.0", into a number.
+
+  Durations are converted into seconds.
+  """
+  value = value.strip()
+  duration = _DURATION_PATTERN.match(value)
+  if duration:
+    seconds, milliseconds, microseconds = map(int, duration.groups())
+    return seconds + milliseconds / 1e3 + microseconds / 1e6
+  return float(value)
+
+
+def parse_nighthawk_results(output: str) -> Dict[str, float]:
+  """Extract the metrics from the human readable output of NightHawk.
+
+  Args:
+    output: The content of a nighthawk-human.txt file
+
+  Returns:
+    the value of each metric, by name. Statistics and percentiles are
+      named after their section, eg "benchmark_http_client.latency_2xx.p50",
+      and counters are prefixed with "counter.". Durations are in seconds
+  """
+  metrics = {}
+  section = None
+  in_counters = False
+  for line in output.splitlines():
+    if _COUNTER_HEADER_PATTERN.match(line):
+      section, in_counters = None, True
+      continue
+
+    match = _SECTION_PATTERN.match(line)
+    if match:
+      section, in_counters = match.group(1), False
+      metrics[f"{section}.samples"] = float(match.group(2))
+      continue
+
+    if in_counters:
+      match = _COUNTER_PATTERN.match(line.strip())
+      if match:
+        metrics[f"counter.{match.group(1)}"] = float(match.group(2))
+        metrics[f"counter.{match.group(1)}.per_second"] = float(match.group(3))
+      continue
+
+    if not section:
+      continue
+
+    try:
+      if 'min:' in line:
+        for name, value in _STATISTIC_PATTERN.findall(line):
+          metrics[f"{section}.{name}"] = _parse_value(value)
+        continue
+
+      match = _PERCENTILE_PATTERN.match(line)
+      if match:
+        metrics[f"{section}.p{float(match.group(1)) * 100:g}"] = _parse_value(match.group(3))
+    except ValueError:
+      log.debug(f"Ignoring the unexpected NightHawk output: [{line}]")
+
+  return metrics
+
+
+def parse_percentile_tables(output: str) -> Dict[str, List[Tuple[float, int, float]]]:
+  """Extract the percentile tables of the histograms from the human readable output of NightHawk.
+
+  Args:
+    output: The content of a nighthawk-human.txt file
+
+  Returns:
+    the (percentile, cumulative count, value) rows of each histogram with a
+      table, by section. Durations are in seconds
+  """
+  tables = {}
+  section = None
+  for line in output.splitlines():
+    match = _SECTION_PATTERN.match(line)
+    if match:
+      section = match.group(1)
+      continue
+    if _COUNTER_HEADER_PATTERN.match(line):
+      section = None
+      continue
+
+    match = _PERCENTILE_PATTERN.match(line) if section else None
+    if match:
+      try:
+        tables.setdefault(section, []).append(
+            (float(match.group(1)), int(match.group(2)), _parse_value(match.group(3))))
+      except ValueError:
+        log.debug(f"Ignoring the unexpected NightHawk output: [{line}]")
+
+  return tables
+
+
+def build_sketches(output: str) -> Dict[str, latency_sketch.LatencySketch]:
+  """Summarize each histogram of the NightHawk output with a percentile table in a sketch.
+
+  Args:
+    output: The content of a nighthawk-human.txt file
+
+  Returns:
+    the sketch of each histogram, by section
+  """
+  metrics = parse_nighthawk_results(output)
+  sketches = {}
+  for section, percentiles in parse_percentile_tables(output).items():
+    samples = int(metrics.get(f"{section}.samples", 0))
+    values = [value for _, _, value in percentiles]
+    sketches[section] = latency_sketch.from_percentiles(percentiles, samples,
+                                                        metrics.get(f"{section}.min", min(values)),
+                                                        metrics.get(f"{section}.max", max(values)),
+                                                        metrics.get(f"{section}.mean"))
+  return sketches
+
+
+def find_test_results(output_dir: str) -> Dict[str, str]:
+  """Find the NightHawk results of the tests of a benchmark.
+
+  Args:
+    output_dir: The output directory of the benchmark
+
+  Returns:
+    the path of each results file, by test. A test is named after the
+      directory of its results, relative to the output directory
+  """
+  results = {}
+  for root, dirs, files in os.walk(output_dir):
+    dirs.sort()
+    if RESULTS_FILE in files:
+      results[os.path.relpath(root, output_dir)] = os.path.join(root, RESULTS_FILE)
+  return results
+
+
+class ResultsDatabase(object):
+  """The SQLite database recording the results of the benchmarks."""
+
+  def __init__(self, path: str) -> None:
+    """Open the database, creating it if it does not exist.
+
+    Args:
+      path: The path of the database file
+
+    Raises:
+      ResultsDatabaseError: if the database cannot be opened
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+      os.makedirs(directory, exist_ok=True)
+      self._connection = sqlite3.connect(path, timeout=30)
+      with self._connection:
+        version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        for statement in _TABLES:
+          self._connection.execute(statement)
+        if version:
+          for migration_version, statements in sorted(_MIGRATIONS.items()):
+            if migration_version > version:
+              for statement in statements:
+                self._connection.execute(statement)
+        for statement in _INDEXES:
+          self._connection.execute(statement)
+        self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    except (OSError, sqlite3.Error) as open_error:
+      raise ResultsDatabaseError(f"Unable to open the results database [{path}]: {open_error}")
+
+  def __enter__(self) -> 'ResultsDatabase':
+    """Return the open database."""
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Close the database."""
+    self.close()
+
+  def close(self) -> None:
+    """Close the database."""
+    self._connection.close()
+
+  def record_benchmark(self,
+                       output_dir: str,
+                       commit_hash: str,
+                       image: str = '',
+                       image_digest: str = '',
+                       benchmark: str = '',
+                       timestamp: Optional[float] = None,
+                       host_profile: str = '',
+                       role: str = '') -> int:
+    """Record the results found in the output directory of a benchmark.
+
+    A test is a repetition of the tests recorded by earlier runs of the same
+    commit, numbered from zero. The latency histograms of each test are also
+    recorded as sketches, which merge into the distribution of any set of
+    runs.
+
+    Args:
+      output_dir: The output directory of the benchmark
+      commit_hash: The commit hash or tag of the Envoy tested
+      image: The name of the Envoy image tested, if any
+      image_digest: The digest of the Envoy image tested, if any
+      benchmark: The name of the benchmark
+      timestamp: The time of the run. If unspecified, the current time
+      host_profile: The name of the host configuration that ran the benchmark
+      role: ROLE_BASELINE or ROLE_CANDIDATE, if the role of the run is known
+
+    Returns:
+      the identifier of the recorded run
+
+    Raises:
+      ResultsDatabaseError: if the results cannot be read or recorded
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+
+    test_metrics, test_sketches = {}, {}
+    for test, results_path in find_test_results(output_dir).items():
+      try:
+        with open(results_path) as results_file:
+          output = results_file.read()
+      except OSError as read_error:
+        raise ResultsDatabaseError(f"Unable to read the results of [{test}]: {read_error}")
+      test_metrics[test] = parse_nighthawk_results(output)
+      test_sketches[test] = build_sketches(output)
+
+    try:
+      with self._connection:
+        run_id = self._connection.execute(
+            "INSERT INTO runs (timestamp, commit_hash, image, image_digest, benchmark, output_dir, "
+            "host_profile, role) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (timestamp, commit_hash, image, image_digest, benchmark, os.path.abspath(output_dir),
+             host_profile, role)).lastrowid
+
+        for test, metrics in test_metrics.items():
+          repetition = self._connection.execute(
+              "SELECT COUNT(DISTINCT run_id) FROM results WHERE commit_hash = ? AND test = ?",
+              (commit_hash, test)).fetchone()[0]
+          self._connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                       [(run_id, timestamp, commit_hash, image_digest, test,
+                                         repetition, metric, value, host_profile, role)
+                                        for metric, value in sorted(metrics.items())])
+          self._connection.executemany(
+              "INSERT INTO sketches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+              [(run_id, timestamp, commit_hash, test, repetition, histogram, host_profile, role,
+                sketch.to_json()) for histogram, sketch in sorted(test_sketches[test].items())])
+    except sqlite3.Error as insert_error:
+      raise ResultsDatabaseError(f"Unable to record the results of [{output_dir}]: {insert_error}")
+
+    log.info(f"Recorded {sum(map(len, test_metrics.values()))} metrics of "
+             f"{len(test_metrics)} tests for [{commit_hash}] as run {run_id}")
+    return run_id
+
+  def query(self,
+            test: str = '',
+            metric: str = '',
+            commits: Optional[List[str]] = None,
+            last_commits: int = 0,
+            since: float = 0.0,
+            limit: int = 0) -> List[Result]:
+    """Return the recorded results matching all of the criteria.
+
+    Args:
+      test: The name of the test. A pattern if it contains "*"
+      metric: The name of the metric. A pattern if it contains "*"
+      commits: The commit hashes or tags of the results
+      last_commits: The number of most recently recorded commits, among the
+        results matching the other criteria
+      since: The earliest timestamp of the results
+      limit: The largest number of results returned
+
+    Returns:
+      the results, ordered by timestamp, test and metric
+
+    Raises:
+      ResultsDatabaseError: if the database cannot be queried
+    """
+    conditions, parameters = [], []
+    for column, value in [('test', test), ('metric', metric)]:
+      if value:
+        conditions.append(f"{column} GLOB ?" if '*' in value else f"{column} = ?")
+        parameters.append(value)
+    if commits:
+      conditions.append(f"commit_hash IN ({', '.join('?' * len(commits))})")
+      parameters += commits
+    if since:
+      conditions.append("timestamp >= ?")
+      parameters.append(since)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    if last_commits:
+      commit_filter = (f"commit_hash IN (SELECT commit_hash FROM results {where} "
+                       "GROUP BY commit_hash ORDER BY MAX(timestamp) DESC LIMIT ?)")
+      where = f"{where} AND {commit_filter}" if where else f"WHERE {commit_filter}"
+      parameters = parameters + parameters + [last_commits]
+
+    statement = (f"SELECT run_id, timestamp, commit_hash, image_digest, test, repetition, "
+                 f"metric, value, host_profile, role FROM results {where} "
+                 "ORDER BY timestamp, test, metric")
+    if limit:
+      statement += " LIMIT ?"
+      parameters.append(limit)
+
+    try:
+      return [Result(*row) for row in self._connection.execute(statement, parameters)]
+    except sqlite3.Error as query_error:
+      raise ResultsDatabaseError(f"Unable to query the results: {query_error}")
+
+  def get_baseline_history(self, test: str, host_profile: str,
+                           window: int) -> Dict[str, List[float]]:
+    """Return the values of the metrics of a test in its most recent baseline runs.
+
+    Args:
+      test: The name of the test
+      host_profile: The host configuration of the runs
+      window: The largest number of baseline runs, starting from the most
+        recent one
+
+    Returns:
+      the values of each metric, from the oldest run to the most recent one
+
+    Raises:
+      ResultsDatabaseError: if the database cannot be queried
+    """
+    try:
+      rows = self._connection.execute(
+          "SELECT metric, value FROM results WHERE test = ? AND host_profile = ? AND role = ? "
+          "AND run_id IN (SELECT DISTINCT run_id FROM results WHERE test = ? "
+          "AND host_profile = ? AND role = ? ORDER BY run_id DESC LIMIT ?) ORDER BY run_id",
+          (test, host_profile, ROLE_BASELINE, test, host_profile, ROLE_BASELINE, window))
+      history = {}
+      for metric, value in rows:
+        history.setdefault(metric, []).append(value)
+      return history
+    except sqlite3.Error as query_error:
+      raise ResultsDatabaseError(f"Unable to query the history of [{test}]: {query_error}")
+
+  def list_tests(self, host_profile: str = '', test: str = '') -> List[str]:
+    """Return the names of the tests recorded in the database.
+
+    Args:
+      host_profile: Only return the tests run on this host configuration, if set
+      test: Only return this test, or the tests matching this pattern, if set
+
+    Raises:
+      ResultsDatabaseError: if the database cannot be queried
+    """
+    conditions, parameters = [], []
+    if host_profile:
+      conditions.append("host_profile = ?")
+      parameters.append(host_profile)
+    if test:
+      conditions.append("test GLOB ?" if '*' in test else "test = ?")
+      parameters.append(test)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    try:
+      return [
+          row[0] for row in self._connection.execute(
+              f"SELECT DISTINCT test FROM results{where} ORDER BY test", parameters)
+      ]
+    except sqlite3.Error as query_error:
+      raise ResultsDatabaseError(f"Unable to list the recorded tests: {query_error}")
+
+  def get_commit_series(self,
+                        test: str,
+                        metric: str,
+                        host_profile: str = '') -> Dict[str, List[Tuple[str, float]]]:
+    """Return the value of the metrics of a test for each recorded commit.
+
+    The value for a commit is the median of its repetitions, and the commits
+    are ordered by the time they were first recorded.
+
+    Args:
+      test: The name of the test
+      metric: The name of the metric, or a pattern matching several metrics
+      host_profile: Only use the runs of this host configuration, if set
+
+    Returns:
+      the (commit hash, value) series of each metric
+
+    Raises:
+      ResultsDatabaseError: if the database cannot be queried
+    """
+    conditions = ["test = ?", "metric GLOB ?" if '*' in metric else "metric = ?"]
+    parameters = [test, metric]
+    if host_profile:
+      conditions.append("host_profile = ?")
+      parameters.append(host_profile)
+
+    try:
+      rows = self._connection.execute(
+          f"SELECT metric, commit_hash, value FROM results WHERE {' AND '.join(conditions)} "
+          "ORDER BY timestamp, run_id", parameters)
+      values = {}
+      for metric_name, commit_hash, value in rows:
+        values.setdefault(metric_name, {}).setdefault(commit_hash, []).append(value)
+    except sqlite3.Error as query_error:
+      raise ResultsDatabaseError(f"Unable to query the series of [{test}]: {query_error}")
+
+    # Dictionaries keep the order in which the commits were first seen
+    return {
+        metric_name: [(commit_hash, statistics.median(repetitions))
+                      for commit_hash, repetitions in commits.items()
+                     ] for metric_name, commits in sorted(values.items())
+    }
+
+  def merge_sketches(self,
+                     histogram: str,
+                     test: str = '',
+                     commits: Optional[List[str]] = None,
+                     host_profile: str = '',
+                     role: str = '',
+                     since: float = 0.0) -> Tuple[latency_sketch.LatencySketch, int]:
+    """Merge the sketches of a histogram recorded by every run matching all criteria.
+
+    Args:
+      histogram: The histogram, eg "benchmark_http_client.latency_2xx"
+      test: The test, or a pattern matching several tests, if set
+      commits: The commit hashes or tags of the runs, if set
+      host_profile: The host configuration of the runs, if set
+      role: The role of the runs, if set
+      since: The earliest time of the runs, if set
+
+    Returns:
+      the merged sketch, and the number of sketches merged
+
+    Raises:
+      ResultsDatabaseError: if the database cannot be queried or holds an
+        invalid sketch
+    """
+    conditions, parameters = ["histogram = ?"], [histogram]
+    for column, value in [('test', test), ('host_profile', host_profile), ('role', role)]:
+      if value:
+        conditions.append(f"{column} GLOB ?" if '*' in value else f"{column} = ?")
+        parameters.append(value)
+    if commits:
+      conditions.append(f"commit_hash IN ({', '.join('?' * len(commits))})")
+      parameters += commits
+    if since:
+      conditions.append("timestamp >= ?")
+      parameters.append(since)
+
+    try:
+      rows = self._connection.execute(
+          f"SELECT sketch FROM sketches WHERE {' AND '.join(conditions)}", parameters).fetchall()
+      return latency_sketch.merge_sketches(
+          [latency_sketch.LatencySketch.from_json(row[0]) for row in rows]), len(rows)
+    except sqlite3.Error as query_error:
+      raise ResultsDatabaseError(f"Unable to query the sketches of [{histogram}]: {query_error}")
+    except latency_sketch.LatencySketchError as sketch_error:
+      raise ResultsDatabaseError(f"Invalid sketch of [{histogram}]: {sketch_error}")
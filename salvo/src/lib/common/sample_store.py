@@ -0,0 +1,271 @@
+"""Store raw latency samples in a compact binary file read through a memory map.
+
+The samples are latencies in integer nanoseconds, in the order the requests
+completed. A file holds a header, the blocks of samples, then the index of
+the blocks:
+
+  header  MAGIC, the format version, the number of samples per block, the
+          number of blocks and samples, and the offset of the index
+  blocks  the differences between consecutive samples of a block, starting
+          from zero so that every block decodes on its own. A block is
+          stored in the narrowest signed integer type holding its
+          differences and is aligned on 8 bytes
+  index   the offset, sample count, integer width, minimum, maximum and sum
+          of each block
+
+The reader maps the file into NumPy arrays without copying it, so a scan
+decodes one block at a time with vectorized operations, and statistics
+answered by the index skip the blocks entirely.
+"""
+import logging
+import os
+import struct
+from typing import (Iterator, List, Optional, Sequence)
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+SAMPLES_FILE = 'latency_samples.bin'
+MAGIC = b'SALVOLAT'
+FORMAT_VERSION = 1
+DEFAULT_BLOCK_SIZE = 65536
+
+_HEADER = struct.Struct('<8sIIQQQ')
+_HEADER_SIZE = 64
+_ALIGNMENT = 8
+
+_INDEX_TYPE = np.dtype([('offset', '<u8'), ('count', '<u4'), ('width', '<u4'), ('minimum', '<i8'),
+                        ('maximum', '<i8'), ('total', '<i8')])
+
+_WIDTH_TYPES = {1: np.dtype('<i1'), 2: np.dtype('<i2'), 4: np.dtype('<i4'), 8: np.dtype('<i8')}
+
+
+class SampleStoreError(Exception):
+  """Raised when samples cannot be written or a sample file is invalid."""
+
+
+def _get_width(deltas: np.ndarray) -> int:
+  """Return the narrowest integer width, in bytes, holding every difference."""
+  low, high = int(deltas.min()), int(deltas.max())
+  for width, integer_type in _WIDTH_TYPES.items():
+    limits = np.iinfo(integer_type)
+    if limits.min <= low and high <= limits.max:
+      return width
+  return 8
+
+
+class SampleWriter(object):
+  """Write latency samples to a sample file, one block at a time."""
+
+  def __init__(self, path: str, block_size: int = DEFAULT_BLOCK_SIZE) -> None:
+    """Create the sample file.
+
+    The file is written to a temporary path and moved into place when the
+    writer is closed, so readers never see a partial file.
+
+    Args:
+      path: The path of the sample file
+      block_size: The number of samples of each block
+
+    Raises:
+      SampleStoreError: if the file cannot be created
+    """
+    self._path = path
+    self._temporary_path = f"{path}.tmp"
+    self._block_size = block_size
+    self._pending: List[np.ndarray] = []
+    self._pending_count = 0
+    self._index: List[tuple] = []
+    self._sample_count = 0
+    try:
+      os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+      self._file = open(self._temporary_path, 'wb')
+      self._file.write(b'\0' * _HEADER_SIZE)
+    except OSError as open_error:
+      raise SampleStoreError(f"Unable to create the sample file [{path}]: {open_error}")
+
+  def __enter__(self) -> 'SampleWriter':
+    """Return the writer."""
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Complete the file, unless an exception is raised."""
+    if type_param is None:
+      self.close()
+    else:
+      self._file.close()
+      os.remove(self._temporary_path)
+
+  def _write_block(self, samples: np.ndarray) -> None:
+    """Append a block of samples to the file."""
+    deltas = np.diff(samples, prepend=0)
+    width = _get_width(deltas)
+    offset = self._file.tell()
+    self._file.write(deltas.astype(_WIDTH_TYPES[width]).tobytes())
+    self._file.write(b'\0' * (-self._file.tell() % _ALIGNMENT))
+    self._index.append((offset, len(samples), width, samples.min(), samples.max(), samples.sum()))
+    self._sample_count += len(samples)
+
+  def write(self, samples: Sequence[int]) -> None:
+    """Append samples to the file.
+
+    Args:
+      samples: The latencies in nanoseconds, as a sequence or an array
+
+    Raises:
+      SampleStoreError: if the samples cannot be written
+    """
+    self._pending.append(np.asarray(samples, dtype=np.int64).ravel())
+    self._pending_count += len(self._pending[-1])
+    if self._pending_count < self._block_size:
+      return
+
+    pending = np.concatenate(self._pending)
+    complete = len(pending) - len(pending) % self._block_size
+    try:
+      for start in range(0, complete, self._block_size):
+        self._write_block(pending[start:start + self._block_size])
+    except OSError as write_error:
+      raise SampleStoreError(f"Unable to write the samples to [{self._path}]: {write_error}")
+    self._pending = [pending[complete:]]
+    self._pending_count = len(pending) - complete
+
+  def close(self) -> None:
+    """Write the last block, the index and the header, and move the file into place.
+
+    Raises:
+      SampleStoreError: if the file cannot be completed
+    """
+    try:
+      if self._pending_count:
+        self._write_block(np.concatenate(self._pending))
+      self._pending, self._pending_count = [], 0
+
+      index_offset = self._file.tell()
+      self._file.write(np.array(self._index, dtype=_INDEX_TYPE).tobytes())
+      self._file.seek(0)
+      self._file.write(
+          _HEADER.pack(MAGIC, FORMAT_VERSION, self._block_size, len(self._index),
+                       self._sample_count, index_offset))
+      self._file.close()
+      os.replace(self._temporary_path, self._path)
+    except OSError as close_error:
+      raise SampleStoreError(f"Unable to complete the sample file [{self._path}]: {close_error}")
+    log.debug(f"Wrote {self._sample_count} samples in {len(self._index)} blocks to [{self._path}]")
+
+
+class SampleReader(object):
+  """Read a sample file through a memory map."""
+
+  def __init__(self, path: str) -> None:
+    """Map the sample file and its index.
+
+    Args:
+      path: The path of the sample file
+
+    Raises:
+      SampleStoreError: if the file cannot be read or is not a valid sample
+        file
+    """
+    self._path = path
+    try:
+      self._data = np.memmap(path, dtype=np.uint8, mode='r')
+    except (OSError, ValueError) as open_error:
+      raise SampleStoreError(f"Unable to map the sample file [{path}]: {open_error}")
+
+    if len(self._data) < _HEADER_SIZE:
+      raise SampleStoreError(f"[{path}] is too short to be a sample file")
+    magic, version, self._block_size, block_count, self._sample_count, index_offset = (
+        _HEADER.unpack(self._data[:_HEADER.size].tobytes()))
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise SampleStoreError(f"[{path}] is not a sample file of version {FORMAT_VERSION}")
+
+    index_end = index_offset + block_count * _INDEX_TYPE.itemsize
+    if index_end > len(self._data):
+      raise SampleStoreError(f"The index of [{path}] is truncated")
+    self._index = self._data[index_offset:index_end].view(_INDEX_TYPE)
+    if (self._index['offset'] + self._index['count'] * self._index['width'] > index_offset).any():
+      raise SampleStoreError(f"A block of [{path}] overlaps its index")
+
+  def __enter__(self) -> 'SampleReader':
+    """Return the reader."""
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Release the memory map."""
+    self.close()
+
+  def close(self) -> None:
+    """Release the memory map, once no array returned by get_deltas refers to it."""
+    self._index = self._index[:0]
+    self._data = self._data[:0]
+
+  def get_sample_count(self) -> int:
+    """Return the number of samples."""
+    return self._sample_count
+
+  def get_block_count(self) -> int:
+    """Return the number of blocks."""
+    return len(self._index)
+
+  def get_min(self) -> Optional[int]:
+    """Return the smallest sample, or None if there are no samples."""
+    return int(self._index['minimum'].min()) if len(self._index) else None
+
+  def get_max(self) -> Optional[int]:
+    """Return the largest sample, or None if there are no samples."""
+    return int(self._index['maximum'].max()) if len(self._index) else None
+
+  def get_mean(self) -> Optional[float]:
+    """Return the mean of the samples, or None if there are no samples."""
+    return float(self._index['total'].sum()) / self._sample_count if self._sample_count else None
+
+  def get_deltas(self, block: int) -> np.ndarray:
+    """Return the stored differences of a block, without copying them out of the file."""
+    offset, count, width = (
+        int(self._index[block][field]) for field in ('offset', 'count', 'width'))
+    return self._data[offset:offset + count * width].view(_WIDTH_TYPES[width])
+
+  def read_block(self, block: int) -> np.ndarray:
+    """Return the samples of a block."""
+    return np.cumsum(self.get_deltas(block), dtype=np.int64)
+
+  def iter_blocks(self) -> Iterator[np.ndarray]:
+    """Yield the samples of every block in order."""
+    for block in range(len(self._index)):
+      yield self.read_block(block)
+
+  def read_all(self) -> np.ndarray:
+    """Return every sample in one array."""
+    samples = np.empty(self._sample_count, dtype=np.int64)
+    start = 0
+    for block in range(len(self._index)):
+      deltas = self.get_deltas(block)
+      np.cumsum(deltas, dtype=np.int64, out=samples[start:start + len(deltas)])
+      start += len(deltas)
+    return samples
+
+  def count_at_most(self, threshold: int) -> int:
+    """Return the number of samples lower than or equal to a threshold.
+
+    Only the blocks whose range contains the threshold are decoded.
+    """
+    below = self._index['maximum'] <= threshold
+    count = int(self._index['count'][below].sum())
+    for block in np.flatnonzero(~below & (self._index['minimum'] <= threshold)):
+      count += int(np.count_nonzero(self.read_block(block) <= threshold))
+    return count
+
+  def get_quantiles(self, quantiles: Sequence[float]) -> List[float]:
+    """Return the exact values of quantiles of the samples.
+
+    Args:
+      quantiles: The quantiles, between 0 and 1
+
+    Raises:
+      SampleStoreError: if there are no samples
+    """
+    if not self._sample_count:
+      raise SampleStoreError(f"[{self._path}] holds no samples")
+    return [float(value) for value in np.quantile(self.read_all(), quantiles)]
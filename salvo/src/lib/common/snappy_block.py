@@ -0,0 +1,185 @@
+"""Compress and decompress data in the snappy block format.
+
+Prometheus remote-write requests are protobuf messages compressed as a
+single snappy block. This module implements the block format in Python so
+that exporting metrics needs no native library. The compressor follows the
+reference implementation: the input is split into 64KiB fragments, and
+4-byte sequences are looked up in a hash table of their last position to
+emit copies of earlier data. Runs without matches are skipped over with a
+growing stride, so incompressible data is passed through quickly.
+"""
+# Compressed data refers to earlier data of the same fragment only, so every
+# copy offset fits in two bytes
+FRAGMENT_SIZE = 1 << 16
+
+_MIN_MATCH = 4
+_MAX_COPY = 64
+
+_TAG_LITERAL = 0
+_TAG_COPY_1 = 1
+_TAG_COPY_2 = 2
+_TAG_COPY_4 = 3
+
+
+class SnappyError(Exception):
+  """Raised when compressed data is not a valid snappy block."""
+
+
+def _encode_varint(value: int) -> bytes:
+  """Return the little-endian base 128 encoding of an unsigned integer."""
+  encoded = bytearray()
+  while value >= 0x80:
+    encoded.append((value & 0x7f) | 0x80)
+    value >>= 7
+  encoded.append(value)
+  return bytes(encoded)
+
+
+def _emit_literal(output: bytearray, literal: memoryview) -> None:
+  """Append a literal element holding the bytes as they are."""
+  length = len(literal) - 1
+  if length < 60:
+    output.append(length << 2 | _TAG_LITERAL)
+  else:
+    size = (length.bit_length() + 7) // 8
+    output.append((59 + size) << 2 | _TAG_LITERAL)
+    output += length.to_bytes(size, 'little')
+  output += literal
+
+
+def _emit_copy(output: bytearray, offset: int, length: int) -> None:
+  """Append the copy elements repeating length bytes found offset bytes earlier."""
+  while length > 0:
+    chunk = min(length, _MAX_COPY)
+    if _MIN_MATCH <= chunk < 12 and offset < 2048:
+      output.append((offset >> 8) << 5 | (chunk - 4) << 2 | _TAG_COPY_1)
+      output.append(offset & 0xff)
+    else:
+      output.append((chunk - 1) << 2 | _TAG_COPY_2)
+      output += offset.to_bytes(2, 'little')
+    length -= chunk
+
+
+def _compress_fragment(fragment: memoryview, output: bytearray) -> None:
+  """Append the elements encoding a fragment of at most FRAGMENT_SIZE bytes."""
+  size = len(fragment)
+  data = bytes(fragment)
+  table = {}
+  literal_start = 0
+  position = 0
+  misses = 32
+  while position + _MIN_MATCH <= size:
+    key = data[position:position + _MIN_MATCH]
+    candidate = table.get(key)
+    table[key] = position
+    if candidate is None:
+      # Move faster through data that does not compress
+      position += misses >> 5
+      misses += 1
+      continue
+
+    length = _MIN_MATCH
+    while position + length + 8 <= size:
+      source, target = candidate + length, position + length
+      if data[source:source + 8] != data[target:target + 8]:
+        break
+      length += 8
+    while position + length < size and data[candidate + length] == data[position + length]:
+      length += 1
+
+    if literal_start < position:
+      _emit_literal(output, fragment[literal_start:position])
+    _emit_copy(output, position - candidate, length)
+    position += length
+    literal_start = position
+    misses = 32
+
+  if literal_start < size:
+    _emit_literal(output, fragment[literal_start:])
+
+
+def compress(data: bytes) -> bytes:
+  """Compress data into a snappy block.
+
+  Args:
+    data: The uncompressed data
+
+  Returns:
+    the length of the data followed by the elements encoding it
+  """
+  output = bytearray(_encode_varint(len(data)))
+  view = memoryview(data)
+  for start in range(0, len(data), FRAGMENT_SIZE):
+    _compress_fragment(view[start:start + FRAGMENT_SIZE], output)
+  return bytes(output)
+
+
+def decompress(data: bytes) -> bytes:
+  """Decompress a snappy block.
+
+  Args:
+    data: The compressed block
+
+  Returns:
+    the uncompressed data
+
+  Raises:
+    SnappyError: if the block is truncated or refers to data before its start
+  """
+  length, shift, position = 0, 0, 0
+  while True:
+    if position >= len(data) or shift > 28:
+      raise SnappyError("Invalid length of the uncompressed data")
+    byte = data[position]
+    position += 1
+    length |= (byte & 0x7f) << shift
+    shift += 7
+    if byte < 0x80:
+      break
+
+  output = bytearray()
+  try:
+    while position < len(data):
+      tag = data[position]
+      element = tag & 0x03
+      if element == _TAG_LITERAL:
+        literal_length = tag >> 2
+        position += 1
+        if literal_length >= 60:
+          size = literal_length - 59
+          literal_length = int.from_bytes(data[position:position + size], 'little')
+          position += size
+        literal_length += 1
+        if position + literal_length > len(data):
+          raise SnappyError("Truncated literal")
+        output += data[position:position + literal_length]
+        position += literal_length
+        continue
+
+      if element == _TAG_COPY_1:
+        copy_length = ((tag >> 2) & 0x07) + 4
+        offset = (tag >> 5) << 8 | data[position + 1]
+        position += 2
+      else:
+        size = 2 if element == _TAG_COPY_2 else 4
+        if position + 1 + size > len(data):
+          raise SnappyError("Truncated copy")
+        copy_length = (tag >> 2) + 1
+        offset = int.from_bytes(data[position + 1:position + 1 + size], 'little')
+        position += 1 + size
+
+      if not 0 < offset <= len(output):
+        raise SnappyError(f"Invalid copy offset {offset}")
+      start = len(output) - offset
+      if copy_length <= offset:
+        output += output[start:start + copy_length]
+      else:
+        # The copy repeats the bytes it produces
+        for _ in range(copy_length):
+          output.append(output[-offset])
+  except IndexError:
+    raise SnappyError("Truncated copy")
+
+  if len(output) != length:
+    raise SnappyError(f"Decompressed {len(output)} bytes instead of {length}")
+  return bytes(output)
@@ -0,0 +1,103 @@
+"""Test packing benchmark artifacts into the store and reading them back."""
+import json
+import os
+import tempfile
+import pytest
+
+from src.lib.common import artifact_store
+
+
+def _write_run(run_dir, result, config="static_resources: {}\n"):
+  """Write the artifacts of a benchmark run."""
+  os.makedirs(os.path.join(run_dir, 'configs'), exist_ok=True)
+  with open(os.path.join(run_dir, 'nighthawk-human.txt'), 'w') as result_file:
+    result_file.write(result)
+  with open(os.path.join(run_dir, 'configs', 'envoy.yaml'), 'w') as config_file:
+    config_file.write(config)
+
+
+def test_pack_and_read():
+  """Verify that repeated content is stored once and every file reads back unchanged."""
+  with tempfile.TemporaryDirectory() as path:
+    store_dir = os.path.join(path, 'store')
+    run_dirs = [os.path.join(path, 'v1'), os.path.join(path, 'v2')]
+    _write_run(run_dirs[0], "rps 1000\n" * 100)
+    _write_run(run_dirs[1], "rps 2000\n" * 100)
+
+    runs = artifact_store.ArtifactPacker(store_dir).pack(run_dirs)
+    assert runs == {run_dirs[0]: 'v1', run_dirs[1]: 'v2'}
+
+    # The originals are replaced by the marker
+    assert os.listdir(run_dirs[0]) == [artifact_store.MARKER_FILE]
+
+    reader = artifact_store.ArtifactReader(store_dir)
+    assert reader.list_runs() == ['v1', 'v2']
+    assert reader.list_files('v1') == ['configs/envoy.yaml', 'nighthawk-human.txt']
+    assert reader.read_bytes('v2', 'nighthawk-human.txt') == b"rps 2000\n" * 100
+
+    with open(os.path.join(store_dir, 'runs', 'v1.index.json')) as index_file:
+      index = json.load(index_file)
+    assert index['files']['configs/envoy.yaml']['object']
+    assert 'offset' in index['files']['nighthawk-human.txt']
+
+    objects = [files for _, _, files in os.walk(os.path.join(store_dir, 'objects')) if files]
+    assert len(objects) == 1
+
+    with artifact_store.open_artifact(run_dirs[1], 'configs/envoy.yaml') as config_file:
+      assert config_file.read() == "static_resources: {}\n"
+
+
+def test_pack_into_existing_store():
+  """Verify that content already in the store is shared and run names are not reused."""
+  with tempfile.TemporaryDirectory() as path:
+    store_dir = os.path.join(path, 'store')
+    first_run, second_run = os.path.join(path, 'first', 'v1'), os.path.join(path, 'second', 'v1')
+    _write_run(first_run, "rps 1000\n", config="shared\n")
+    _write_run(second_run, "rps 1000\n", config="shared\n")
+
+    artifact_store.ArtifactPacker(store_dir).pack([first_run])
+    runs = artifact_store.ArtifactPacker(store_dir).pack([second_run], keep_originals=True)
+    assert runs == {second_run: 'v1.1'}
+
+    reader = artifact_store.ArtifactReader(store_dir)
+    with open(os.path.join(store_dir, 'runs', 'v1.1.index.json')) as index_file:
+      index = json.load(index_file)
+    assert index['files']['configs/envoy.yaml']['object']
+    assert reader.read_bytes('v1.1', 'configs/envoy.yaml') == b"shared\n"
+
+    # Kept originals are read from disk
+    assert os.path.isfile(os.path.join(second_run, 'nighthawk-human.txt'))
+    with artifact_store.open_artifact(second_run, 'nighthawk-human.txt', 'rb') as result_file:
+      assert result_file.read() == b"rps 1000\n"
+
+
+def test_read_missing_file():
+  """Verify that we raise an error for files that were not packed."""
+  with tempfile.TemporaryDirectory() as path:
+    run_dir = os.path.join(path, 'v1')
+    _write_run(run_dir, "rps 1000\n")
+    artifact_store.ArtifactPacker(os.path.join(path, 'store')).pack([run_dir])
+
+    with pytest.raises(artifact_store.ArtifactStoreError):
+      artifact_store.open_artifact(run_dir, 'nighthawk-output.json')
+    with pytest.raises(FileNotFoundError):
+      artifact_store.open_artifact(path, 'nighthawk-output.json')
+
+
+def test_read_corrupted_archive():
+  """Verify that we raise an error if an archive was modified."""
+  with tempfile.TemporaryDirectory() as path:
+    store_dir = os.path.join(path, 'store')
+    run_dir = os.path.join(path, 'v1')
+    _write_run(run_dir, "rps 1000\n")
+    artifact_store.ArtifactPacker(store_dir).pack([run_dir])
+
+    with open(os.path.join(store_dir, 'runs', 'v1.pack'), 'r+b') as pack_file:
+      pack_file.write(b'\0' * 8)
+
+    with pytest.raises(artifact_store.ArtifactStoreError):
+      artifact_store.ArtifactReader(store_dir).read_bytes('v1', 'nighthawk-human.txt')
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,132 @@
+"""Test the CPU list helpers and cgroup control."""
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib.common import cgroup
+
+
+def test_parse_cpu_list():
+  """Verify that CPUs and CPU ranges are expanded."""
+  assert cgroup.parse_cpu_list("0-3, 8,10-11") == {0, 1, 2, 3, 8, 10, 11}
+  assert cgroup.parse_cpu_list("") == set()
+
+
+@pytest.mark.parametrize('cpu_list', ["0-", "a", "3-1", "-2", "1-2-3"])
+def test_parse_cpu_list_invalid(cpu_list):
+  """Verify that we raise an error for a malformed CPU list."""
+  with pytest.raises(cgroup.CgroupError):
+    cgroup.parse_cpu_list(cpu_list)
+
+
+def test_format_cpu_list():
+  """Verify that consecutive CPUs are collapsed into ranges."""
+  assert cgroup.format_cpu_list({8, 0, 1, 2, 3, 10}) == "0-3,8,10"
+  assert cgroup.format_cpu_list(set()) == ""
+
+
+def test_get_process_cgroup():
+  """Verify that the cgroup is read from the unified hierarchy entry."""
+  contents = "4:memory:/salvo\n0::/user.slice/session-1.scope\n"
+  with mock.patch('builtins.open', mock.mock_open(read_data=contents)):
+    assert cgroup.get_process_cgroup() == '/user.slice/session-1.scope'
+
+  with mock.patch('builtins.open', mock.mock_open(read_data="4:memory:/salvo\n")):
+    with pytest.raises(cgroup.CgroupError):
+      cgroup.get_process_cgroup()
+
+
+def test_create_without_cgroup_v2():
+  """Verify that we raise an error if the unified hierarchy is not mounted."""
+  with tempfile.TemporaryDirectory() as root, \
+      mock.patch.object(cgroup, 'CGROUP_ROOT', root):
+    with pytest.raises(cgroup.CgroupError) as cgroup_error:
+      cgroup.Cgroup.create('salvo_build')
+
+  assert str(cgroup_error.value) == "The cgroup v2 hierarchy is not mounted"
+
+
+def test_cgroup_control():
+  """Verify that the cgroup interface files are written to control its processes."""
+  with tempfile.TemporaryDirectory() as path:
+    build_cgroup = cgroup.Cgroup(path)
+    with open(build_cgroup.get_procs_path(), 'w') as procs_file:
+      procs_file.write("12\n34\n")
+    assert build_cgroup.get_processes() == [12, 34]
+
+    build_cgroup.freeze()
+    with open(os.path.join(path, 'cgroup.freeze')) as freeze_file:
+      assert freeze_file.read() == '1'
+
+    build_cgroup.thaw()
+    with open(os.path.join(path, 'cgroup.freeze')) as freeze_file:
+      assert freeze_file.read() == '0'
+
+    with mock.patch('os.kill') as mock_kill:
+      build_cgroup.kill()
+      mock_kill.assert_has_calls([mock.call(12, mock.ANY), mock.call(34, mock.ANY)])
+
+    open(os.path.join(path, 'cgroup.kill'), 'w').close()
+    with mock.patch('os.kill') as mock_kill:
+      build_cgroup.kill()
+      mock_kill.assert_not_called()
+    with open(os.path.join(path, 'cgroup.kill')) as kill_file:
+      assert kill_file.read() == '1'
+
+    with pytest.raises(cgroup.CgroupError):
+      build_cgroup.remove()
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
+
+
+def test_read_stat():
+  """Verify that flat keyed statistics are parsed."""
+  with tempfile.TemporaryDirectory() as path:
+    with open(os.path.join(path, 'cpu.stat'), 'w') as stat_file:
+      stat_file.write("usage_usec 1000\nnr_periods 20\nnr_throttled 5\nthrottled_usec 300\n")
+
+    envoy_cgroup = cgroup.Cgroup(path)
+    assert envoy_cgroup.read_stat('cpu.stat')['nr_throttled'] == 5
+
+    with pytest.raises(cgroup.CgroupError):
+      envoy_cgroup.read_stat('memory.events')
+
+
+def test_read_value_and_io_stat():
+  """Verify that single values and the io.stat counters of every device are read."""
+  with tempfile.TemporaryDirectory() as path:
+    with open(os.path.join(path, 'memory.peak'), 'w') as peak_file:
+      peak_file.write("52428800\n")
+    with open(os.path.join(path, 'io.stat'), 'w') as stat_file:
+      stat_file.write("8:0 rbytes=4096 wbytes=1000 rios=1 wios=2 dbytes=0 dios=0\n"
+                      "259:0 rbytes=0 wbytes=24 rios=0 wios=1 dbytes=0 dios=0\n")
+
+    container_cgroup = cgroup.Cgroup(path)
+    assert container_cgroup.read_value('memory.peak') == 52428800
+    assert container_cgroup.read_io_stat()['wbytes'] == 1024
+    assert container_cgroup.read_io_stat()['rios'] == 1
+
+    with pytest.raises(cgroup.CgroupError):
+      container_cgroup.read_value('memory.current')
+
+
+def test_create_with_controllers():
+  """Verify that a limiting cgroup is created beside Salvo's cgroup with its controllers enabled."""
+  with tempfile.TemporaryDirectory() as root, \
+      mock.patch.object(cgroup, 'CGROUP_ROOT', root), \
+      mock.patch.object(cgroup, 'get_process_cgroup', return_value='/salvo.slice/salvo.scope'):
+    open(os.path.join(root, 'cgroup.controllers'), 'w').close()
+    slice_dir = os.path.join(root, 'salvo.slice')
+    os.makedirs(os.path.join(slice_dir, 'salvo.scope'))
+    with open(os.path.join(slice_dir, 'cgroup.subtree_control'), 'w') as control_file:
+      control_file.write("cpu\n")
+
+    with mock.patch('os.access', return_value=True):
+      envoy_cgroup = cgroup.Cgroup.create('salvo_envoy', ['cpu', 'memory'])
+
+    assert envoy_cgroup.get_path() == os.path.join(slice_dir, 'salvo_envoy')
+    with open(os.path.join(slice_dir, 'cgroup.subtree_control')) as control_file:
+      assert control_file.read() == "+memory"
@@ -0,0 +1,115 @@
+"""Test detecting the commits where a metric changed in the recorded history."""
+import json
+import os
+import random
+import tempfile
+import pytest
+
+import api.analysis_pb2 as proto_analysis
+
+from src.lib.common import (change_points, results_db)
+
+
+def _get_series(levels, length=30, noise=1.0, seed=1):
+  """Return a noisy series with the given mean over consecutive segments of the length."""
+  rng = random.Random(seed)
+  return [rng.gauss(level, noise) for level in levels for _ in range(length)]
+
+
+def test_pelt():
+  """Verify that PELT finds the positions of the steps of a series."""
+  values = _get_series([100.0, 110.0, 95.0])
+  penalty = 2 * change_points.estimate_noise(values) * 4.5
+
+  assert change_points.pelt(values, penalty, 3) == [30, 60]
+  assert change_points.pelt(_get_series([100.0]), penalty, 3) == []
+  assert change_points.pelt(values[:5], penalty, 3) == []
+
+
+def test_pelt_long_series():
+  """Verify that pruning keeps the detection fast over thousands of commits."""
+  values = _get_series([100.0, 105.0], length=2500)
+  penalty = 2 * change_points.estimate_noise(values) * 8.5
+
+  assert change_points.pelt(values, penalty, 3) == [2500]
+
+
+def test_estimate_noise():
+  """Verify that the noise estimate is not inflated by a step."""
+  assert change_points.estimate_noise(_get_series([0.0, 50.0],
+                                                  length=500)) == pytest.approx(1.0, rel=0.15)
+
+
+def test_permutation_p_value():
+  """Verify that a step is significant and the best split of unchanged values is not."""
+  values = _get_series([10.0, 15.0], length=10)
+  assert change_points.permutation_p_value(values, 10, 99, 3) == pytest.approx(0.01)
+
+  unchanged = _get_series([10.0], length=20)
+  best_split = max(range(3, 18),
+                   key=lambda position: abs(
+                       sum(unchanged[position:]) /
+                       (20 - position) - sum(unchanged[:position]) / position))
+  assert change_points.permutation_p_value(unchanged, best_split, 99, 3) > 0.05
+
+
+def test_detect_change_points():
+  """Verify the commit, magnitude and significance of a detected step."""
+  values = _get_series([100.0, 120.0])
+  series = [(f"commit_{index}", value) for index, value in enumerate(values)]
+
+  change_point, = change_points.detect_change_points('test_h1', 'latency', series,
+                                                     proto_analysis.ChangePointOptions())
+  assert (change_point.commit_hash, change_point.index) == ('commit_30', 30)
+  assert change_point.magnitude == pytest.approx(20.0, abs=1.0)
+  assert change_point.relative == pytest.approx(0.2, abs=0.01)
+  assert change_point.p_value < 0.05
+
+  # A constant metric has no noise and no change point
+  assert not change_points.detect_change_points('test_h1', 'counter', [('a', 1.0)] * 10,
+                                                proto_analysis.ChangePointOptions())
+
+
+def test_analyze_database():
+  """Verify that the median of the repetitions of each commit forms the series."""
+  options = proto_analysis.ChangePointOptions(metrics=['latency.*'], min_segment=2)
+  levels = [500, 502, 499, 501, 500, 540, 541, 539, 542, 540]
+
+  with tempfile.TemporaryDirectory() as path:
+    with results_db.ResultsDatabase(os.path.join(path, 'results.db')) as database:
+      for index, latency in enumerate(levels):
+        # A noisy repetition of each commit is outvoted by the two others
+        for repetition, noisy_latency in enumerate([latency, latency + 1, 700]):
+          output_dir = os.path.join(path, f"run_{index}_{repetition}")
+          os.makedirs(os.path.join(output_dir, 'test_h1'))
+          with open(os.path.join(output_dir, 'test_h1', results_db.RESULTS_FILE),
+                    'w') as results_file:
+            results_file.write(
+                f"latency (10 samples)\n  min: 0s 000ms {noisy_latency}us | mean: 0s 000ms 600us\n")
+          database.record_benchmark(output_dir,
+                                    f"commit_{index}",
+                                    timestamp=1000.0 + 10 * index + repetition)
+
+      detected = change_points.analyze_database(database, options)
+
+    report_path = change_points.write_report(detected, path)
+    with open(report_path) as report_file:
+      report = json.load(report_file)
+
+  change_point, = detected
+  assert (change_point.metric, change_point.commit_hash) == ('latency.min', 'commit_5')
+  assert change_point.before == pytest.approx(501.4e-6)
+  assert report[0]['commit_hash'] == 'commit_5'
+
+
+def test_format_change_points():
+  """Verify that the change points are formatted as aligned columns."""
+  change_point = change_points.ChangePoint('test_h1', 'latency.p50', 'cccc', 30, 0.5, 0.6, 0.1, 0.2,
+                                           0.005)
+  header, row = change_points.format_change_points([change_point]).splitlines()
+  assert header.split() == ['commit', 'test', 'metric', 'before', 'after', 'change', 'p-value']
+  assert row.split() == ['cccc', 'test_h1', 'latency.p50', '0.5', '0.6', '+20.0%', '0.005']
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,164 @@
+"""Test the accounting of the resources consumed by a job."""
+import json
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib.common import (cost_accounting, trace)
+
+
+@pytest.fixture(autouse=True)
+def reset_usage():
+  """Start each test without recorded usage or spans."""
+  cost_accounting.reset()
+  trace.reset()
+  yield
+  cost_accounting.reset()
+  trace.reset()
+
+
+def _write_cgroup(path, usage_usec, memory, wbytes=None, peak=True):
+  """Write the interface files of a container cgroup."""
+  os.makedirs(path, exist_ok=True)
+  with open(os.path.join(path, 'cpu.stat'), 'w') as stat_file:
+    stat_file.write(f"usage_usec {usage_usec}\nuser_usec {usage_usec}\nsystem_usec 0\n")
+  with open(os.path.join(path, 'memory.peak' if peak else 'memory.current'), 'w') as memory_file:
+    memory_file.write(f"{memory}\n")
+  if wbytes is not None:
+    with open(os.path.join(path, 'io.stat'), 'w') as io_file:
+      io_file.write(f"8:0 rbytes=0 wbytes={wbytes} rios=0 wios=1 dbytes=0 dios=0\n")
+
+
+def _get_usage(phase, kind, cpu_seconds, peak_rss_bytes, disk_write_bytes=0):
+  """Return a usage of the given phase and kind."""
+  return cost_accounting.Usage(phase=phase,
+                               kind=kind,
+                               name='command',
+                               cpu_seconds=cpu_seconds,
+                               peak_rss_bytes=peak_rss_bytes,
+                               disk_write_bytes=disk_write_bytes,
+                               wall_seconds=1.0)
+
+
+def test_read_cgroup_usage():
+  """Verify that the counters of a cgroup are read, with fallbacks for missing files."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    _write_cgroup(os.path.join(tmp_dir, 'full'), 2500000, 4096, wbytes=8192)
+    _write_cgroup(os.path.join(tmp_dir, 'old_kernel'), 1000, 2048, peak=False)
+
+    assert cost_accounting.read_cgroup_usage(os.path.join(tmp_dir, 'full')) == {
+        'usage_usec': 2500000,
+        'memory_peak': 4096,
+        'wbytes': 8192
+    }
+    assert cost_accounting.read_cgroup_usage(os.path.join(tmp_dir, 'old_kernel')) == {
+        'usage_usec': 1000,
+        'memory_peak': 2048,
+        'wbytes': 0
+    }
+
+
+def test_container_monitor():
+  """Verify that the latest sample of each container is recorded in the phase of the run."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, 'docker-nighthawk.scope')
+    _write_cgroup(path, 1000000, 1 << 20, wbytes=100, peak=False)
+    cgroups = {'nighthawk': path, 'exited': os.path.join(tmp_dir, 'missing')}
+
+    with trace.span('execute_benchmark'), mock.patch('src.lib.common.cgroup.get_unified_root',
+                                                     return_value=''):
+      with cost_accounting.ContainerMonitor(lambda: cgroups) as monitor:
+        monitor.sample()
+        _write_cgroup(path, 3000000, 1 << 19, wbytes=300, peak=False)
+        monitor.sample()
+
+  usages = cost_accounting.get_usages()
+  assert len(usages) == 1
+  assert usages[0].phase == 'execute_benchmark'
+  assert usages[0].kind == cost_accounting.KIND_CONTAINER
+  assert usages[0].name == 'nighthawk'
+  assert usages[0].cpu_seconds == 3.0
+  # The peak is the largest sampled memory without memory.peak
+  assert usages[0].peak_rss_bytes == 1 << 20
+  assert usages[0].disk_write_bytes == 300
+
+
+def test_record_container_keeps_largest_counters():
+  """Verify that a container sampled by several monitors keeps its largest counters."""
+  cost_accounting.record_container(
+      '/cg/a', _get_usage('shard', cost_accounting.KIND_CONTAINER, 5.0, 100, 10))
+  cost_accounting.record_container(
+      '/cg/a', _get_usage('other', cost_accounting.KIND_CONTAINER, 4.0, 200, 10))
+
+  usage, = cost_accounting.get_usages()
+  assert (usage.phase, usage.cpu_seconds, usage.peak_rss_bytes) == ('shard', 5.0, 200)
+
+
+def test_summarize():
+  """Verify that usage is aggregated by phase with the wall time of the phase's spans."""
+  spans = [
+      trace.Span(name='build', start=0.0, duration=30.0, pid=1, tid=1, args={}),
+      trace.Span(name='build', start=40.0, duration=10.0, pid=1, tid=1, args={}),
+      trace.Span(name='pull', start=50.0, duration=5.0, pid=1, tid=1, args={}),
+  ]
+  usages = [
+      _get_usage('build', cost_accounting.KIND_PROCESS, 60.0, 2 << 30, 1000),
+      _get_usage('build', cost_accounting.KIND_PROCESS, 20.0, 1 << 30, 500),
+      _get_usage('benchmark', cost_accounting.KIND_CONTAINER, 90.0, 1 << 28),
+  ]
+
+  costs = cost_accounting.summarize(usages, spans)
+
+  assert list(costs) == ['benchmark', 'build', 'pull']
+  assert costs['build'] == cost_accounting.PhaseCost(cpu_seconds=80.0,
+                                                     peak_rss_bytes=2 << 30,
+                                                     disk_write_bytes=1500,
+                                                     wall_seconds=40.0,
+                                                     processes=2,
+                                                     containers=0)
+  assert costs['benchmark'].containers == 1
+  assert costs['benchmark'].wall_seconds == 0.0
+  assert costs['pull'].cpu_seconds == 0.0
+
+  job = cost_accounting.get_job_cost(usages, 120.0)
+  assert job.cpu_seconds == 170.0
+  assert job.peak_rss_bytes == 2 << 30
+  assert job.wall_seconds == 120.0
+
+
+def test_write_manifest():
+  """Verify that the cost of the job and of its phases is written to the run manifest."""
+  with trace.span('build'):
+    cost_accounting.record_process(
+        cost_accounting.Usage(phase=trace.get_current_phase(),
+                              kind=cost_accounting.KIND_PROCESS,
+                              name='bazel',
+                              cpu_seconds=12.5,
+                              peak_rss_bytes=1 << 30,
+                              disk_write_bytes=4096,
+                              wall_seconds=3.0))
+  cost_accounting.record_fetch(
+      cost_accounting.Fetch(source='SRCID_ENVOY',
+                            strategy='FETCH_SHALLOW',
+                            operation='clone',
+                            fetched_bytes=1 << 20,
+                            wall_seconds=2.0))
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    manifest_path = cost_accounting.write_manifest(tmp_dir, 10.0)
+    with open(manifest_path) as manifest_file:
+      manifest = json.load(manifest_file)
+
+  assert os.path.basename(manifest_path) == cost_accounting.MANIFEST_FILE
+  assert manifest['job']['cpu_seconds'] == 12.5
+  assert manifest['job']['wall_seconds'] == 10.0
+  assert manifest['job']['processes'] == 1
+  assert manifest['phases']['build']['disk_write_bytes'] == 4096
+  assert manifest['salvo_cpu_seconds'] > 0
+  assert manifest['fetches'][0]['strategy'] == 'FETCH_SHALLOW'
+  assert manifest['fetches'][0]['fetched_bytes'] == 1 << 20
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,95 @@
+"""Test the HTML report comparing the Envoy versions of a job."""
+import json
+import os
+import tempfile
+import pytest
+
+from src.lib.common import (html_report, resource_limits, results_db)
+
+
+def _get_metrics(scale, throughput=1000.0):
+  """Return the latency percentiles and throughput of a test run, in seconds."""
+  metrics = {
+      f"{html_report.LATENCY_HISTOGRAM}.min": 0.0002 * scale,
+      f"{html_report.LATENCY_HISTOGRAM}.max": 0.01 * scale,
+      html_report.THROUGHPUT_METRIC: throughput,
+  }
+  for percentile, value in [(50, 0.0005), (90, 0.0007), (99.0625, 0.001)]:
+    metrics[f"{html_report.LATENCY_HISTOGRAM}.p{percentile:g}"] = value * scale
+  return metrics
+
+
+def test_downsample():
+  """Verify that down-sampling keeps the first and last points of a series."""
+  points = list(range(1000))
+  sampled = html_report.downsample(points, 10)
+
+  assert len(sampled) == 10
+  assert sampled[0] == 0 and sampled[-1] == 999
+  assert html_report.downsample(points[:5], 10) == points[:5]
+
+
+def test_confidence_interval():
+  """Verify the bounds of the confidence interval of the mean."""
+  assert html_report.confidence_interval([4.0]) == (4.0, 4.0, 4.0)
+
+  mean, low, high = html_report.confidence_interval([1.0, 2.0, 3.0])
+  assert mean == 2.0
+  assert high - mean == pytest.approx(4.303 / 3**0.5)
+  assert mean - low == pytest.approx(high - mean)
+
+
+def test_load_version_results():
+  """Verify that the repetitions of a version are loaded from the results database."""
+  with tempfile.TemporaryDirectory() as path:
+    output_dir = os.path.join(path, 'v1')
+    os.makedirs(os.path.join(output_dir, 'test_h1'))
+    with open(os.path.join(output_dir, 'test_h1', results_db.RESULTS_FILE), 'w') as results_file:
+      results_file.write("Counter  Value  Per second\nbenchmark.http_2xx  100  10.0\n")
+    with open(os.path.join(output_dir, resource_limits.REPORT_FILE), 'w') as resources_file:
+      json.dump({'summary': {'throttled_ratio': 0.25}}, resources_file)
+
+    version = html_report.load_version_results('v1', output_dir)
+    assert version.tests == {
+        'test_h1': [{
+            'counter.benchmark.http_2xx': 100.0,
+            'counter.benchmark.http_2xx.per_second': 10.0
+        }]
+    }
+    assert version.resources == {'throttled_ratio': 0.25}
+
+    with results_db.ResultsDatabase(os.path.join(path, 'results.db')) as database:
+      database.record_benchmark(output_dir, 'v1')
+      database.record_benchmark(output_dir, 'v1')
+      version = html_report.load_version_results('v1', output_dir, database)
+
+  assert len(version.tests['test_h1']) == 2
+
+
+def test_write_report():
+  """Verify that the report compares the versions with inline charts."""
+  baseline = html_report.VersionResults(
+      version='v1',
+      tests={'test_h1<ipv4>': [_get_metrics(1.0), _get_metrics(1.1)]},
+      resources={'throttled_ratio': 0.1})
+  candidate = html_report.VersionResults(version='v2',
+                                         tests={'test_h1<ipv4>': [_get_metrics(1.5, 900.0)]},
+                                         resources={})
+
+  with tempfile.TemporaryDirectory() as path:
+    report_path = html_report.write_report([baseline, candidate],
+                                           os.path.join(path, html_report.REPORT_FILE), "v1 vs v2")
+    with open(report_path) as report_file:
+      report = report_file.read()
+
+  assert report.startswith('<!DOCTYPE html>')
+  assert 'test_h1&lt;ipv4&gt;' in report
+  assert report.count('<svg') == 3
+  assert 'class="worse">+42.9%' in report
+  assert 'class="worse">-10.0%' in report
+  assert 'throttled_ratio' in report
+  assert '<script' not in report
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,125 @@
+"""Test the mergeable latency sketches."""
+import math
+import random
+import pytest
+
+from src.lib.common import latency_sketch
+
+_NIGHTHAWK_PERCENTILES = [0, 0.5, 0.75, 0.8, 0.9, 0.95, 0.990625, 0.999023, 1]
+
+
+def _get_samples(median, count=20000, seed=0):
+  """Return sorted log-normal latencies in seconds."""
+  rng = random.Random(seed)
+  return sorted(rng.lognormvariate(math.log(median), 0.5) for _ in range(count))
+
+
+def _get_exact_quantile(samples, quantile):
+  """Return the sample at a quantile of sorted samples."""
+  return samples[int(quantile * (len(samples) - 1))]
+
+
+def _get_percentile_table(samples):
+  """Return the NightHawk percentile table of sorted samples."""
+  rows = []
+  for percentile in _NIGHTHAWK_PERCENTILES:
+    count = max(1, math.ceil(percentile * len(samples)))
+    rows.append((percentile, count, samples[count - 1]))
+  return rows
+
+
+def test_quantiles_within_relative_accuracy():
+  """Verify that the quantiles of added values are within the relative accuracy."""
+  samples = _get_samples(500e-6)
+  sketch = latency_sketch.LatencySketch(0.01)
+  for sample in samples:
+    sketch.add(sample)
+
+  assert sketch.get_count() == len(samples)
+  for quantile in [0.01, 0.5, 0.9, 0.99, 0.999]:
+    exact = _get_exact_quantile(samples, quantile)
+    assert sketch.get_quantile(quantile) == pytest.approx(exact, rel=0.01)
+  assert sketch.get_quantile(1) == samples[-1]
+  assert latency_sketch.LatencySketch().get_quantile(0.5) is None
+
+
+def test_merge():
+  """Verify that merged sketches give the quantiles of the pooled values."""
+  runs = [_get_samples(median, seed=seed) for seed, median in enumerate([400e-6, 600e-6])]
+  sketches = []
+  for samples in runs:
+    sketch = latency_sketch.LatencySketch()
+    for sample in samples:
+      sketch.add(sample)
+    sketches.append(sketch)
+
+  merged = latency_sketch.merge_sketches(sketches)
+  pooled = sorted(runs[0] + runs[1])
+  assert merged.get_count() == len(pooled)
+  assert merged.get_quantile(0.99) == pytest.approx(_get_exact_quantile(pooled, 0.99), rel=0.01)
+  assert merged.get_mean() == pytest.approx(sum(pooled) / len(pooled))
+
+  with pytest.raises(latency_sketch.LatencySketchError):
+    merged.merge(latency_sketch.LatencySketch(0.05))
+
+
+def test_collapse_lowest_buckets():
+  """Verify that the number of buckets is bounded without losing the tail."""
+  sketch = latency_sketch.LatencySketch(0.01, max_buckets=100)
+  for exponent in range(-9000, 0):
+    sketch.add(10**(exponent / 1000))
+
+  assert sketch.get_count() == 9000
+  assert sketch.get_quantile(0.99) == pytest.approx(10**(-91 / 1000), rel=0.01)
+
+
+def test_from_percentiles():
+  """Verify that a sketch built from a percentile table keeps its percentiles and mean."""
+  samples = _get_samples(500e-6)
+  sketch = latency_sketch.from_percentiles(_get_percentile_table(samples), len(samples), samples[0],
+                                           samples[-1],
+                                           sum(samples) / len(samples))
+
+  assert sketch.get_count() == pytest.approx(len(samples))
+  assert sketch.get_mean() == pytest.approx(sum(samples) / len(samples))
+  for percentile in [0.5, 0.9, 0.990625]:
+    exact = _get_exact_quantile(samples, percentile)
+    assert sketch.get_quantile(percentile) == pytest.approx(exact, rel=0.02)
+
+  constant = latency_sketch.from_percentiles([(0.5, 5, 1e-3)], 10, 1e-3, 1e-3)
+  assert (constant.get_count(), constant.get_quantile(0.5)) == (10, 1e-3)
+
+
+def test_pooled_tail_from_percentiles():
+  """Verify that the tail of pooled runs is estimated from their percentile tables alone."""
+  runs = [_get_samples(median, seed=seed) for seed, median in enumerate([400e-6, 500e-6, 700e-6])]
+  merged = latency_sketch.merge_sketches([
+      latency_sketch.from_percentiles(_get_percentile_table(samples), len(samples), samples[0],
+                                      samples[-1]) for samples in runs
+  ])
+
+  pooled = sorted(sum(runs, []))
+  for quantile in [0.9, 0.99]:
+    assert merged.get_quantile(quantile) == pytest.approx(_get_exact_quantile(pooled, quantile),
+                                                          rel=0.03)
+
+
+def test_json_round_trip():
+  """Verify that a decoded sketch is identical to the encoded one."""
+  sketch = latency_sketch.LatencySketch()
+  for sample in _get_samples(500e-6, count=1000):
+    sketch.add(sample)
+  sketch.add(0.0)
+
+  decoded = latency_sketch.LatencySketch.from_json(sketch.to_json())
+  assert decoded.get_count() == sketch.get_count()
+  assert decoded.get_min() == 0.0
+  for quantile in [0.0, 0.001, 0.5, 0.99]:
+    assert decoded.get_quantile(quantile) == sketch.get_quantile(quantile)
+
+  with pytest.raises(latency_sketch.LatencySketchError):
+    latency_sketch.LatencySketch.from_json('{"count": 1}')
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
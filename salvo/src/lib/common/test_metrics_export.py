@@ -0,0 +1,122 @@
+"""Test exporting benchmark results as OpenMetrics text and to remote-write."""
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+import api.remote_write_pb2 as proto_remote_write
+
+from src.lib.common import (metrics_export, results_db, snappy_block)
+
+_NIGHTHAWK_OUTPUT = """benchmark_http_client.latency_2xx (100 samples)
+  min: 0s 000ms 360us | mean: 0s 000ms 546us | max: 0s 010ms 441us | pstdev: 0s 000ms 198us
+
+  Percentile  Count       Value
+  0.5         50          0s 000ms 512us
+  0.990625    99          0s 001ms 029us
+
+Counter                                 Value       Per second
+benchmark.http_2xx                      100         10.00
+"""
+
+
+def test_to_sample():
+  """Verify the names and labels of the samples of percentiles and counters."""
+  sample = metrics_export.to_sample('benchmark_http_client.latency_2xx.p99.0625',
+                                    0.001,
+                                    1000.0,
+                                    commit='abcd',
+                                    test='test_h1',
+                                    host_profile='c5.metal',
+                                    role='')
+  assert sample.name == 'salvo_benchmark_http_client_latency_2xx'
+  assert sample.labels == (('commit', 'abcd'), ('host_profile', 'c5.metal'),
+                           ('quantile', '0.990625'), ('test', 'test_h1'))
+
+  sample = metrics_export.to_sample('counter.benchmark.http_2xx.per_second', 10.0, 1000.0)
+  assert (sample.name, sample.labels) == ('salvo_counter_benchmark_http_2xx_per_second', ())
+
+
+def test_write_openmetrics():
+  """Verify that the metrics of a run are written grouped by family, ending with EOF."""
+  with tempfile.TemporaryDirectory() as path:
+    os.makedirs(os.path.join(path, 'test_h1'))
+    with open(os.path.join(path, 'test_h1', results_db.RESULTS_FILE), 'w') as results_file:
+      results_file.write(_NIGHTHAWK_OUTPUT)
+
+    samples = metrics_export.collect_run_samples(path, 'abcd', 'c5.metal', 'candidate', 1000.0)
+    export_path = metrics_export.write_openmetrics(samples, os.path.join(path, 'metrics.txt'))
+    with open(export_path) as export_file:
+      lines = export_file.read().splitlines()
+
+  assert lines[-1] == '# EOF'
+  families = [line.split()[2] for line in lines if line.startswith('# TYPE')]
+  assert families == sorted(set(families))
+  assert ('salvo_benchmark_http_client_latency_2xx{commit="abcd",host_profile="c5.metal",'
+          'quantile="0.5",role="candidate",test="test_h1"} 0.000512 1000.000') in lines
+  assert ('salvo_counter_benchmark_http_2xx{commit="abcd",host_profile="c5.metal",'
+          'role="candidate",test="test_h1"} 100.0 1000.000') in lines
+
+
+def test_format_openmetrics_escapes_labels():
+  """Verify that quotes in label values are escaped."""
+  sample = metrics_export.to_sample('latency.mean', 1.0, 1000.0, test='test_h1<"ipv4">')
+  assert 'salvo_latency_mean{test="test_h1<\\"ipv4\\">"} 1.0 1000.000' in (
+      metrics_export.format_openmetrics([sample]))
+
+
+def test_get_batches():
+  """Verify that batches hold whole series and split series larger than the batch size."""
+  samples = [
+      metrics_export.to_sample('latency.mean', float(index), 1000.0 + index, test=test)
+      for test, count in [('test_a', 3), ('test_b', 2), ('test_c', 6)]
+      for index in range(count)
+  ]
+  batches = metrics_export.RemoteWriter('http://localhost', batch_size=4).get_batches(samples)
+
+  assert [{
+      key[1][0][1]: len(series) for key, series in batch.items()
+  } for batch in batches] == [{
+      'test_a': 3
+  }, {
+      'test_b': 2
+  }, {
+      'test_c': 4
+  }, {
+      'test_c': 2
+  }]
+
+
+@mock.patch('requests.post')
+def test_push(mock_post):
+  """Verify that a single compressed request holds every series, with sorted labels."""
+  mock_post.return_value = mock.Mock(status_code=204)
+  samples = [
+      metrics_export.to_sample('latency.p50', 0.5, 1000.0 + index, test=f"test_{index % 10}")
+      for index in range(1000)
+  ]
+
+  assert metrics_export.RemoteWriter('http://localhost:9090/api/v1/write').push(samples) == 1
+
+  (url,), kwargs = mock_post.call_args
+  assert url == 'http://localhost:9090/api/v1/write'
+  assert kwargs['headers']['Content-Encoding'] == 'snappy'
+  request = proto_remote_write.WriteRequest()
+  request.ParseFromString(snappy_block.decompress(kwargs['data']))
+  assert len(request.timeseries) == 10
+  assert [label.name for label in request.timeseries[0].labels] == ['__name__', 'quantile', 'test']
+  assert [sample.timestamp for sample in request.timeseries[0].samples][:2] == [1000000, 1010000]
+
+
+@mock.patch('requests.post')
+def test_push_rejected(mock_post):
+  """Verify that a rejected request raises an error."""
+  mock_post.return_value = mock.Mock(status_code=400, text='out of order sample')
+  sample = metrics_export.to_sample('latency.p50', 0.5, 1000.0)
+
+  with pytest.raises(metrics_export.MetricsExportError, match='out of order sample'):
+    metrics_export.RemoteWriter('http://localhost:9090/api/v1/write').push([sample])
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,91 @@
+"""Test scoring candidate results against the rolling noise model of the baselines."""
+import json
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+import api.analysis_pb2 as proto_analysis
+
+from src.lib.common import (noise_model, results_db)
+
+
+def _write_results(output_dir, latency_us):
+  """Write NightHawk results with the given mean latency and a constant counter."""
+  test_dir = os.path.join(output_dir, 'test_h1')
+  os.makedirs(test_dir, exist_ok=True)
+  with open(os.path.join(test_dir, results_db.RESULTS_FILE), 'w') as results_file:
+    results_file.write(
+        f"latency (10 samples)\n  min: 0s 000ms 100us | mean: 0s 000ms {latency_us}us\n"
+        "Counter  Value  Per second\nupstream_cx_total  1  0.03\n")
+
+
+def test_build_model():
+  """Verify the median and MAD of a metric, which ignore a single noisy run."""
+  model = noise_model.build_model([10.0, 11.0, 9.0, 10.0, 50.0])
+  assert model == noise_model.MetricModel(median=10.0, mad=1.0, samples=5)
+
+
+def test_score_value():
+  """Verify the robust z-score of candidate values."""
+  model = noise_model.MetricModel(median=10.0, mad=1.0, samples=5)
+
+  score = noise_model.score_value('latency.mean', 16.0, model, 3.5)
+  assert score.score == pytest.approx(6.0 / noise_model.MAD_SCALE)
+  assert score.outlier
+
+  assert not noise_model.score_value('latency.mean', 13.0, model, 3.5).outlier
+
+  constant = noise_model.MetricModel(median=1.0, mad=0.0, samples=5)
+  assert noise_model.score_value('counter.upstream_cx_total', 1.0, constant, 3.5).score == 0.0
+  assert noise_model.score_value('counter.upstream_cx_total', 2.0, constant, 3.5).outlier
+
+
+def test_score_run():
+  """Verify that only recent baseline runs of the same host profile form the model."""
+  options = proto_analysis.NoiseModelOptions(window=4, min_samples=3)
+
+  with tempfile.TemporaryDirectory() as path, \
+      results_db.ResultsDatabase(os.path.join(path, 'results.db')) as database:
+    # Old baseline runs, runs of another host and candidate runs are ignored
+    history = [(900, 'host_a', results_db.ROLE_BASELINE), (500, 'host_b', results_db.ROLE_BASELINE),
+               (900, 'host_a', results_db.ROLE_CANDIDATE)]
+    history += [(latency, 'host_a', results_db.ROLE_BASELINE) for latency in [500, 510, 490, 505]]
+    for index, (latency, host_profile, role) in enumerate(history):
+      output_dir = os.path.join(path, f"run_{index}")
+      _write_results(output_dir, latency)
+      database.record_benchmark(output_dir, f"commit_{index}", host_profile=host_profile, role=role)
+
+    model = noise_model.NoiseModel(options, database, 'host_a')
+    models = model.get_models('test_h1')
+    assert models['latency.mean'].samples == 4
+    assert models['latency.mean'].median == pytest.approx(502.5e-6)
+
+    candidate_dir = os.path.join(path, 'candidate')
+    scores = model.score_run({'test_h1': {'latency.mean': 600e-6, 'latency.max': 1.0}})
+    with mock.patch.object(noise_model.log, 'warning') as mock_warning:
+      scores_path = model.write_scores(scores, candidate_dir)
+
+    with open(scores_path) as scores_file:
+      report = json.load(scores_file)
+
+  assert [score.metric for score in scores['test_h1']] == ['latency.mean']
+  assert scores['test_h1'][0].outlier
+  mock_warning.assert_called_once()
+  assert report['host_profile'] == 'host_a'
+  assert report['tests']['test_h1'][0]['metric'] == 'latency.mean'
+
+
+def test_insufficient_history():
+  """Verify that metrics are not scored before enough baseline runs are recorded."""
+  with tempfile.TemporaryDirectory() as path, \
+      results_db.ResultsDatabase(os.path.join(path, 'results.db')) as database:
+    _write_results(os.path.join(path, 'run'), 500)
+    database.record_benchmark(os.path.join(path, 'run'), 'commit', role=results_db.ROLE_BASELINE)
+
+    model = noise_model.NoiseModel(proto_analysis.NoiseModelOptions(), database, '')
+    assert model.score_run({'test_h1': {'latency.mean': 1.0}}) == {'test_h1': []}
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
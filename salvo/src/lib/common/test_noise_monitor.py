@@ -0,0 +1,71 @@
+"""Test the monitoring of host pressure during a benchmark."""
+import json
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib.common import noise_monitor
+
+
+def _write_pressure(pressure_dir, resource, avg10):
+  """Write a pressure file in the format of /proc/pressure."""
+  with open(os.path.join(pressure_dir, resource), 'w') as pressure_file:
+    pressure_file.write(f"some avg10={avg10:.2f} avg60=1.00 avg300=0.50 total=1234\n"
+                        "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n")
+
+
+def test_read_pressure():
+  """Verify that the "some avg10" value is read from a pressure file."""
+  with tempfile.TemporaryDirectory() as pressure_dir:
+    _write_pressure(pressure_dir, 'cpu', 12.5)
+    assert noise_monitor.read_pressure('cpu', pressure_dir) == 12.5
+
+    with pytest.raises(noise_monitor.NoiseMonitorError):
+      noise_monitor.read_pressure('io', pressure_dir)
+
+
+def test_sample_pauses_and_resumes():
+  """Verify that work is paused above the threshold and resumed below half of it."""
+  pause = mock.Mock()
+  resume = mock.Mock()
+
+  with tempfile.TemporaryDirectory() as pressure_dir:
+    monitor = noise_monitor.NoiseMonitor(20.0, 100, pause, resume, pressure_dir)
+    _write_pressure(pressure_dir, 'cpu', 5.0)
+
+    for cpu_pressure, io_pressure in [(5.0, 30.0), (15.0, 0.0), (5.0, 0.0), (25.0, 0.0)]:
+      _write_pressure(pressure_dir, 'cpu', cpu_pressure)
+      _write_pressure(pressure_dir, 'io', io_pressure)
+      monitor.sample()
+
+    assert pause.call_count == 2
+    assert resume.call_count == 1
+
+    monitor.__exit__(None, None, None)
+    assert resume.call_count == 2
+
+    report_path = monitor.write_report(os.path.join(pressure_dir, 'output'))
+    with open(report_path) as report_file:
+      report = json.load(report_file)
+
+  assert report['samples'] == 4
+  assert report['max_pressure'] == 30.0
+  assert report['mean_pressure'] == 18.75
+  assert report['interference_events'] == 2
+  assert report['paused_seconds'] >= 0
+
+
+def test_monitor_without_pressure_information():
+  """Verify that the monitor is disabled if the kernel does not report pressure."""
+  with tempfile.TemporaryDirectory() as pressure_dir:
+    with noise_monitor.NoiseMonitor(0, 0, pressure_dir=pressure_dir) as monitor:
+      pass
+
+  report = monitor.get_report()
+  assert report['samples'] == 0
+  assert report['threshold'] == noise_monitor.DEFAULT_PRESSURE_THRESHOLD
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
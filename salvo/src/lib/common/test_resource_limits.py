@@ -0,0 +1,117 @@
+"""Test the resource limits of the Envoy under test and the throttling monitor."""
+import json
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+import api.env_pb2 as proto_env
+
+from src.lib.common import (cgroup, resource_limits)
+
+
+def _write_stats(path, nr_periods, nr_throttled, oom_kill=0):
+  """Write the cpu.stat and memory.events files of a cgroup."""
+  os.makedirs(path, exist_ok=True)
+  with open(os.path.join(path, 'cpu.stat'), 'w') as stat_file:
+    stat_file.write(f"usage_usec 5000\nnr_periods {nr_periods}\n"
+                    f"nr_throttled {nr_throttled}\nthrottled_usec 700\n")
+  with open(os.path.join(path, 'memory.events'), 'w') as events_file:
+    events_file.write(f"low 0\nhigh 0\nmax 3\noom 0\noom_kill {oom_kill}\n")
+
+
+@pytest.mark.parametrize('size, expected', [("1024", 1024), ("512m", 512 << 20), ("2G", 2 << 30),
+                                            ("64k", 64 << 10)])
+def test_parse_memory_size(size, expected):
+  """Verify that memory sizes with unit suffixes are converted into bytes."""
+  assert resource_limits.parse_memory_size(size) == expected
+
+
+def test_parse_memory_size_invalid():
+  """Verify that we raise an error for a malformed memory size."""
+  with pytest.raises(resource_limits.ResourceLimitsError):
+    resource_limits.parse_memory_size("1.5g")
+
+
+def test_get_docker_arguments():
+  """Verify that the limits are converted into "docker run" options."""
+  limits = proto_env.ResourceLimits(cpu_quota=150000, cpuset="2,3", mem_limit="256m")
+
+  assert resource_limits.is_limited(limits)
+  assert resource_limits.get_docker_arguments(limits) == [
+      '--cpu-quota', '150000', '--cpu-period', '100000', '--cpuset-cpus', '2-3', '--memory',
+      str(256 << 20)
+  ]
+  assert resource_limits.get_docker_arguments(proto_env.ResourceLimits()) == []
+
+
+def test_create_limited_cgroup():
+  """Verify that the limits are written to the cgroup interface files."""
+  limits = proto_env.ResourceLimits(cpu_quota=50000, cpu_period=50000, mem_limit="1g")
+
+  with tempfile.TemporaryDirectory() as path, \
+      mock.patch.object(cgroup.Cgroup, 'create') as mock_create:
+    mock_create.return_value = cgroup.Cgroup(path)
+    envoy_cgroup = resource_limits.create_limited_cgroup(limits, 'salvo_envoy')
+
+    mock_create.assert_called_once_with('salvo_envoy', ['cpu', 'memory'])
+    with open(os.path.join(path, 'cpu.max')) as cpu_max:
+      assert cpu_max.read() == "50000 50000"
+    with open(os.path.join(path, 'memory.max')) as memory_max:
+      assert memory_max.read() == str(1 << 30)
+
+    wrapper_path = resource_limits.create_cgroup_wrapper(envoy_cgroup, '/usr/bin/envoy',
+                                                         os.path.join(path, 'wrapper'))
+    with open(wrapper_path) as wrapper:
+      assert f'> "{path}/cgroup.procs" && exec "/usr/bin/envoy" "$@"' in wrapper.read()
+
+
+def test_create_limited_cgroup_unavailable():
+  """Verify that we raise an error if the limiting cgroup cannot be created."""
+  with mock.patch.object(cgroup.Cgroup, 'create') as mock_create:
+    mock_create.side_effect = cgroup.CgroupError("not permitted")
+    with pytest.raises(resource_limits.ResourceLimitsError):
+      resource_limits.create_limited_cgroup(proto_env.ResourceLimits(cpuset="0"), 'salvo_envoy')
+
+
+def test_throttling_monitor():
+  """Verify that the last sample of each cgroup is summarized in the report."""
+  limits = proto_env.ResourceLimits(cpu_quota=100000, sample_interval_ms=10)
+
+  with tempfile.TemporaryDirectory() as path:
+    cgroups = {
+        'envoy_1': os.path.join(path, 'envoy_1'),
+        'envoy_2': os.path.join(path, 'envoy_2'),
+    }
+    _write_stats(cgroups['envoy_1'], 100, 20)
+    _write_stats(cgroups['envoy_2'], 100, 30, oom_kill=1)
+
+    monitor = resource_limits.ThrottlingMonitor(limits, lambda: cgroups, path)
+    with monitor:
+      pass
+
+    # A cgroup removed with its container keeps its last sample
+    del cgroups['envoy_2']
+    monitor.sample()
+
+    summary = monitor.get_summary()
+    monitor.write_report()
+    with open(os.path.join(path, resource_limits.REPORT_FILE)) as report_file:
+      report = json.load(report_file)
+
+  assert summary['nr_throttled'] == 50
+  assert summary['throttled_ratio'] == 0.25
+  assert summary['memory_oom_kill'] == 1
+  assert summary['memory_max'] == 6
+  assert sorted(report['cgroups']) == ['envoy_1', 'envoy_2']
+
+
+def test_disabled_throttling_monitor():
+  """Verify that Envoy is not monitored without resource limits."""
+  get_cgroups = mock.Mock()
+  with tempfile.TemporaryDirectory() as path:
+    with resource_limits.ThrottlingMonitor(proto_env.ResourceLimits(), get_cgroups, path):
+      pass
+
+    assert not os.path.exists(os.path.join(path, resource_limits.REPORT_FILE))
+  get_cgroups.assert_not_called()
@@ -0,0 +1,184 @@
+"""Test recording benchmark results in the results database and querying them."""
+import os
+import sqlite3
+import tempfile
+import pytest
+
+import api.storage_pb2 as proto_storage
+
+from src.lib.common import results_db
+
+_NIGHTHAWK_OUTPUT = """Nighthawk - A layer 7 protocol benchmarking tool.
+
+benchmark_http_client.latency_2xx (29999 samples)
+  min: 0s 000ms 360us | mean: 0s 000ms 546us | max: 0s 010ms 441us | pstdev: 0s 000ms 198us
+
+  Percentile  Count       Value
+  0.5         15000       0s 000ms 512us
+  0.990625    29718       0s 001ms 029us
+
+Response body size in bytes (29999 samples)
+  min: 1024 | mean: 1024.0 | max: 1024 | pstdev: 0.0
+
+Counter                                 Value       Per second
+benchmark.http_2xx                      29999       999.97
+upstream_cx_total                       1           0.03
+"""
+
+
+def _write_results(output_dir, test, latency_us):
+  """Write the NightHawk results of a test with the given median latency."""
+  test_dir = os.path.join(output_dir, test)
+  os.makedirs(test_dir, exist_ok=True)
+  with open(os.path.join(test_dir, results_db.RESULTS_FILE), 'w') as results_file:
+    results_file.write(
+        _NIGHTHAWK_OUTPUT.replace("15000       0s 000ms 512us",
+                                  f"15000       0s 000ms {latency_us}us"))
+
+
+def test_parse_nighthawk_results():
+  """Verify that statistics, percentiles and counters are extracted from the NightHawk output."""
+  metrics = results_db.parse_nighthawk_results(_NIGHTHAWK_OUTPUT)
+
+  assert metrics['benchmark_http_client.latency_2xx.samples'] == 29999
+  assert metrics['benchmark_http_client.latency_2xx.mean'] == pytest.approx(546e-6)
+  assert metrics['benchmark_http_client.latency_2xx.p50'] == pytest.approx(512e-6)
+  assert metrics['benchmark_http_client.latency_2xx.p99.0625'] == pytest.approx(1.029e-3)
+  assert metrics['Response body size in bytes.max'] == 1024
+  assert metrics['counter.benchmark.http_2xx'] == 29999
+  assert metrics['counter.upstream_cx_total.per_second'] == 0.03
+
+
+def test_parse_percentile_tables():
+  """Verify that the cumulative counts of the percentiles are extracted by histogram."""
+  tables = results_db.parse_percentile_tables(_NIGHTHAWK_OUTPUT)
+
+  assert list(tables) == ['benchmark_http_client.latency_2xx']
+  assert tables['benchmark_http_client.latency_2xx'] == [(0.5, 15000, pytest.approx(512e-6)),
+                                                         (0.990625, 29718, pytest.approx(1.029e-3))]
+
+
+def test_merge_sketches():
+  """Verify that the sketches of the selected runs are merged."""
+  with tempfile.TemporaryDirectory() as path:
+    with results_db.ResultsDatabase(os.path.join(path, 'results.db')) as database:
+      for index, (commit, latency_us) in enumerate([('aaaa', 500), ('aaaa', 520), ('bbbb', 900)]):
+        output_dir = os.path.join(path, f"run_{index}")
+        _write_results(output_dir, 'test_http_h1', latency_us)
+        database.record_benchmark(output_dir, commit, timestamp=1000.0 + index)
+
+      sketch, runs = database.merge_sketches('benchmark_http_client.latency_2xx', commits=['aaaa'])
+      _, all_runs = database.merge_sketches('benchmark_http_client.latency_2xx', test='test_*')
+      _, no_runs = database.merge_sketches('benchmark_http_client.latency_2xx', since=2000)
+
+  assert (runs, all_runs, no_runs) == (2, 3, 0)
+  assert sketch.get_count() == pytest.approx(2 * 29999)
+  assert 500e-6 < sketch.get_quantile(0.5) < 525e-6
+  assert sketch.get_mean() == pytest.approx(546e-6)
+
+
+def test_get_database_path():
+  """Verify that the database defaults to the output directory of the job."""
+  assert results_db.get_database_path(proto_storage.ResultsDatabase(),
+                                      '/output') == '/output/results.db'
+  assert results_db.get_database_path(proto_storage.ResultsDatabase(path='/shared/results.db'),
+                                      '/output') == '/shared/results.db'
+
+
+def test_record_and_query():
+  """Verify that repeated runs of a commit are numbered and the last commits are queried."""
+  with tempfile.TemporaryDirectory() as path:
+    database_path = os.path.join(path, 'results.db')
+    with results_db.ResultsDatabase(database_path) as database:
+      for index, commit in enumerate(['aaaa', 'bbbb', 'cccc', 'cccc']):
+        output_dir = os.path.join(path, f"run_{index}")
+        _write_results(output_dir, 'test_http_h1', 500 + index)
+        _write_results(output_dir, 'test_http_h2', 600 + index)
+        database.record_benchmark(output_dir,
+                                  commit,
+                                  image_digest=f"sha256:{commit}",
+                                  timestamp=1000.0 + index)
+
+    with results_db.ResultsDatabase(database_path) as database:
+      results = database.query(test='test_http_h1',
+                               metric='benchmark_http_client.latency_2xx.p50',
+                               last_commits=2)
+
+      assert [(r.commit_hash, r.repetition) for r in results] == [('bbbb', 0), ('cccc', 0),
+                                                                  ('cccc', 1)]
+      assert results[-1].value == pytest.approx(503e-6)
+      assert results[-1].image_digest == 'sha256:cccc'
+
+      results = database.query(test='test_http_*', metric='counter.benchmark.http_2xx', since=1003)
+      assert [r.test for r in results] == ['test_http_h1', 'test_http_h2']
+
+      assert len(database.query(commits=['aaaa'], limit=5)) == 5
+
+
+def test_get_commit_series():
+  """Verify that each commit has the median of its repetitions, in recording order."""
+  with tempfile.TemporaryDirectory() as path:
+    with results_db.ResultsDatabase(os.path.join(path, 'results.db')) as database:
+      runs = [('bbbb', 500, 'host_a'), ('aaaa', 600, 'host_a'), ('bbbb', 510, 'host_a'),
+              ('bbbb', 700, 'host_a'), ('cccc', 900, 'host_b')]
+      for index, (commit, latency, host_profile) in enumerate(runs):
+        output_dir = os.path.join(path, f"run_{index}")
+        _write_results(output_dir, 'test_http_h1', latency)
+        database.record_benchmark(output_dir,
+                                  commit,
+                                  timestamp=1000.0 + index,
+                                  host_profile=host_profile)
+
+      assert database.list_tests('host_a') == ['test_http_h1']
+      assert database.list_tests(test='test_grpc_*') == []
+      series = database.get_commit_series('test_http_h1', 'benchmark_http_client.latency_2xx.p*0',
+                                          'host_a')
+
+  assert list(series) == ['benchmark_http_client.latency_2xx.p50']
+  assert series['benchmark_http_client.latency_2xx.p50'] == [('bbbb', pytest.approx(510e-6)),
+                                                             ('aaaa', pytest.approx(600e-6))]
+
+
+def test_upgrade_schema():
+  """Verify that a database of the first schema version is upgraded in place."""
+  with tempfile.TemporaryDirectory() as path:
+    database_path = os.path.join(path, 'results.db')
+    connection = sqlite3.connect(database_path)
+    with connection:
+      connection.execute("CREATE TABLE runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "timestamp REAL NOT NULL, commit_hash TEXT NOT NULL, image TEXT NOT NULL, "
+                         "image_digest TEXT NOT NULL, benchmark TEXT NOT NULL, "
+                         "output_dir TEXT NOT NULL)")
+      connection.execute("CREATE TABLE results (run_id INTEGER NOT NULL, timestamp REAL NOT NULL, "
+                         "commit_hash TEXT NOT NULL, image_digest TEXT NOT NULL, "
+                         "test TEXT NOT NULL, repetition INTEGER NOT NULL, metric TEXT NOT NULL, "
+                         "value REAL NOT NULL)")
+      connection.execute("INSERT INTO results VALUES (1, 1000.0, 'aaaa', '', 'test_h1', 0, 'm', 1)")
+      connection.execute("PRAGMA user_version = 1")
+    connection.close()
+
+    output_dir = os.path.join(path, 'run')
+    _write_results(output_dir, 'test_h1', 500)
+    with results_db.ResultsDatabase(database_path) as database:
+      database.record_benchmark(output_dir,
+                                'bbbb',
+                                host_profile='c5.metal',
+                                role=results_db.ROLE_BASELINE)
+      old_result, = database.query(commits=['aaaa'])
+      new_results = database.query(commits=['bbbb'])
+
+  assert (old_result.host_profile, old_result.role) == ('', '')
+  assert {(r.host_profile, r.role) for r in new_results} == {('c5.metal', 'baseline')}
+
+
+def test_format_results():
+  """Verify that the results are formatted as aligned columns."""
+  result = results_db.Result(1, 0.0, 'cccc', '', 'test_http_h1', 0, 'counter.upstream_cx_total',
+                             1.0)
+  header, row = results_db.format_results([result]).splitlines()
+  assert header.split() == ['time', 'commit', 'test', 'repetition', 'metric', 'value']
+  assert row.split()[2:] == ['cccc', 'test_http_h1', '0', 'counter.upstream_cx_total', '1']
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,142 @@
+"""Test the binary store of raw latency samples."""
+import os
+import tempfile
+import numpy as np
+import pytest
+
+from src.lib.common import sample_store
+
+
+def _get_samples(count, seed=0):
+  """Return log-normal latencies in nanoseconds."""
+  rng = np.random.default_rng(seed)
+  return rng.lognormal(np.log(500e3), 0.5, count).astype(np.int64)
+
+
+def _write_samples(path, samples, block_size=1000, chunk=333):
+  """Write samples to a sample file in chunks of a given size."""
+  with sample_store.SampleWriter(path, block_size) as writer:
+    for start in range(0, len(samples), chunk):
+      writer.write(samples[start:start + chunk])
+
+
+def test_round_trip():
+  """Verify that the samples are read back in order and the index summarizes them."""
+  samples = _get_samples(10500)
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    _write_samples(path, samples)
+    assert not os.path.exists(f"{path}.tmp")
+
+    with sample_store.SampleReader(path) as reader:
+      assert reader.get_sample_count() == len(samples)
+      assert reader.get_block_count() == 11
+      np.testing.assert_array_equal(reader.read_all(), samples)
+      np.testing.assert_array_equal(np.concatenate(list(reader.iter_blocks())), samples)
+      np.testing.assert_array_equal(reader.read_block(10), samples[10000:])
+      assert reader.get_min() == samples.min()
+      assert reader.get_max() == samples.max()
+      assert reader.get_mean() == pytest.approx(samples.mean())
+
+
+def test_blocks_use_narrowest_width():
+  """Verify that each block is stored in the narrowest integer type of its differences."""
+  steady = np.full(1000, 250000, dtype=np.int64) + np.arange(1000) % 100
+  spiky = steady.copy()
+  spiky[500] = 10**10
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    _write_samples(path, np.concatenate([steady, spiky]))
+
+    with sample_store.SampleReader(path) as reader:
+      # The first difference of a block is its first sample
+      assert reader.get_deltas(0).dtype == np.int32
+      assert reader.get_deltas(1).dtype == np.int64
+      np.testing.assert_array_equal(reader.read_block(1), spiky)
+    assert os.path.getsize(path) < 64 + 1000 * 4 + 1000 * 8 + 2 * 48
+
+
+def test_deltas_are_not_copied():
+  """Verify that the stored differences are views of the memory map."""
+  samples = _get_samples(2000)
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    _write_samples(path, samples)
+
+    reader = sample_store.SampleReader(path)
+    deltas = reader.get_deltas(1)
+    assert isinstance(deltas.base, np.memmap) or isinstance(deltas.base.base, np.memmap)
+    assert not deltas.flags.writeable
+    assert deltas[0] == samples[1000]
+    del deltas
+    reader.close()
+
+
+def test_count_at_most():
+  """Verify that samples are counted against a threshold across skipped and decoded blocks."""
+  samples = np.sort(_get_samples(5000))
+  np.random.default_rng(1).shuffle(samples[2000:])
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    _write_samples(path, samples)
+
+    with sample_store.SampleReader(path) as reader:
+      for threshold in [0, samples[999], samples[1500], samples[3000], samples.max()]:
+        assert reader.count_at_most(threshold) == np.count_nonzero(samples <= threshold)
+
+
+def test_get_quantiles():
+  """Verify that quantiles are exact."""
+  samples = _get_samples(3000)
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    _write_samples(path, samples)
+
+    with sample_store.SampleReader(path) as reader:
+      assert reader.get_quantiles([0.5, 0.99]) == list(np.quantile(samples, [0.5, 0.99]))
+
+
+def test_empty_store():
+  """Verify that a store without samples is read back."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    _write_samples(path, np.array([], dtype=np.int64))
+
+    with sample_store.SampleReader(path) as reader:
+      assert reader.get_sample_count() == 0
+      assert reader.read_all().size == 0
+      assert reader.get_mean() is None
+      assert reader.get_max() is None
+      with pytest.raises(sample_store.SampleStoreError):
+        reader.get_quantiles([0.5])
+
+
+def test_failed_write_leaves_no_file():
+  """Verify that an exception while writing discards the partial file."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    with pytest.raises(RuntimeError):
+      with sample_store.SampleWriter(path) as writer:
+        writer.write([1, 2, 3])
+        raise RuntimeError("interrupted")
+    assert os.listdir(tmp_dir) == []
+
+
+def test_invalid_file():
+  """Verify that a file which is not a sample file is rejected."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, sample_store.SAMPLES_FILE)
+    with open(path, 'wb') as invalid_file:
+      invalid_file.write(b'{"latencies": [1, 2, 3]}' * 4)
+    with pytest.raises(sample_store.SampleStoreError):
+      sample_store.SampleReader(path)
+
+    _write_samples(path, _get_samples(100))
+    with open(path, 'r+b') as truncated_file:
+      truncated_file.truncate(os.path.getsize(path) - 8)
+    with pytest.raises(sample_store.SampleStoreError):
+      sample_store.SampleReader(path)
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
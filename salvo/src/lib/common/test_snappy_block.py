@@ -0,0 +1,42 @@
+"""Test the snappy block compression used by remote-write requests."""
+import os
+import pytest
+
+from src.lib.common import snappy_block
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'a',
+    b'abcd' * 5000,
+    os.urandom(100000),
+    b''.join(f'series{{test="test_h{i % 7}"}} {i}\n'.encode() for i in range(20000)),
+])
+def test_compress_round_trip(data):
+  """Verify that compressed data decompresses to the original data."""
+  assert snappy_block.decompress(snappy_block.compress(data)) == data
+
+
+def test_compress_repeated_data():
+  """Verify that repeated data is encoded as copies of earlier data."""
+  data = b'salvo_benchmark_http_client_latency_2xx' * 1000
+  assert len(snappy_block.compress(data)) < len(data) / 20
+
+
+def test_decompress_reference_block():
+  """Verify the decoding of a block with a literal and an overlapping copy."""
+  # 12 bytes: the literal "ab" and a copy of 10 bytes from 2 bytes back
+  block = bytes([12, 1 << 2, ord('a'), ord('b'), 6 << 2 | 1, 2])
+  assert snappy_block.decompress(block) == b'ab' * 6
+
+
+def test_decompress_invalid_block():
+  """Verify that truncated blocks and copies before the start are rejected."""
+  with pytest.raises(snappy_block.SnappyError):
+    snappy_block.decompress(snappy_block.compress(b'abcd' * 100)[:-1])
+  with pytest.raises(snappy_block.SnappyError):
+    snappy_block.decompress(bytes([4, 0 << 2 | 1, 1]))
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
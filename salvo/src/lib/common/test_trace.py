@@ -0,0 +1,163 @@
+"""Test the recording of phase spans."""
+import json
+import os
+import tempfile
+import pytest
+
+from src.lib.common import trace
+
+
+@pytest.fixture(autouse=True)
+def reset_trace():
+  """Start each test with an empty trace."""
+  trace.reset()
+  yield
+  trace.reset()
+
+
+def test_span():
+  """Verify that a span records its name, duration and arguments."""
+  with trace.span('docker_build', image='envoyproxy/envoy:v1.16.0'):
+    pass
+
+  spans = trace.get_spans()
+  assert len(spans) == 1
+  assert spans[0].name == 'docker_build'
+  assert spans[0].duration >= 0
+  assert spans[0].pid == os.getpid()
+  assert spans[0].args == {'image': 'envoyproxy/envoy:v1.16.0'}
+
+
+def test_get_current_phase():
+  """Verify that the innermost span in progress on a thread is the current phase."""
+  assert trace.get_current_phase() == ''
+  with trace.span('salvo'):
+    with trace.span('execute_shard'):
+      assert trace.get_current_phase() == 'execute_shard'
+    assert trace.get_current_phase() == 'salvo'
+
+    with pytest.raises(RuntimeError):
+      with trace.span('build'):
+        raise RuntimeError("failed")
+    assert trace.get_current_phase() == 'salvo'
+  assert trace.get_current_phase() == ''
+
+
+def test_span_records_error():
+  """Verify that a span is recorded when the phase raises an exception."""
+  with pytest.raises(RuntimeError):
+    with trace.span('pull'):
+      raise RuntimeError("network unreachable")
+
+  assert trace.get_spans()[0].args == {'error': 'RuntimeError'}
+
+
+def test_traced():
+  """Verify that decorated functions record a span with the selected arguments."""
+
+  class Builder(object):
+
+    @trace.traced()
+    def build(self, target):
+      return target
+
+    @trace.traced('pull_image', 'image_name')
+    def pull(self, image_name, retries=3):
+      return retries
+
+  builder = Builder()
+  assert builder.build('//:nighthawk') == '//:nighthawk'
+  assert builder.pull(image_name='envoyproxy/envoy:v1.16.0') == 3
+
+  spans = trace.get_spans()
+  assert [s.name for s in spans] == ['test_traced.<locals>.Builder.build', 'pull_image']
+  assert spans[0].args == {}
+  assert spans[1].args == {'image_name': 'envoyproxy/envoy:v1.16.0'}
+
+
+def test_write_chrome_trace():
+  """Verify that spans are written as complete events in microseconds."""
+  trace.record_span(trace.Span('pull', 10.5, 2.25, 1, 2, {'url': 'origin'}))
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    trace_path = os.path.join(output_dir, trace.TRACE_DIRECTORY, 'trace.json')
+    trace.write_chrome_trace(trace_path)
+
+    with open(trace_path) as trace_file:
+      document = json.load(trace_file)
+
+  assert document['traceEvents'] == [{
+      'name': 'pull',
+      'cat': 'salvo',
+      'ph': 'X',
+      'ts': 10500000,
+      'dur': 2250000,
+      'pid': 1,
+      'tid': 2,
+      'args': {
+          'url': 'origin'
+      },
+  }]
+
+
+def test_format_summary():
+  """Verify that phases are aggregated by name and ordered by total time."""
+  spans = [
+      trace.Span('pull', 0.0, 10.0, 1, 1, {}),
+      trace.Span('build', 10.0, 60.0, 1, 1, {}),
+      trace.Span('pull', 70.0, 30.0, 1, 1, {}),
+  ]
+
+  summary = trace.summarize(spans)
+  assert summary == [
+      trace.PhaseSummary('build', 1, 60.0, 60.0, 60.0),
+      trace.PhaseSummary('pull', 2, 40.0, 20.0, 30.0),
+  ]
+
+  table = trace.format_summary(spans, 100.0).split('\n')
+  assert table[0].split() == ['Phase', 'Count', 'Total(s)', 'Mean(s)', 'Max(s)', 'Share']
+  assert table[1].split() == ['build', '1', '60.00', '60.00', '60.00', '60.0%']
+  assert table[2].split() == ['pull', '2', '40.00', '20.00', '30.00', '40.0%']
+
+
+def _event(name, start, duration, tid=1):
+  """Build a complete trace event with times in seconds."""
+  return {'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': 1, 'tid': tid}
+
+
+def test_get_exclusive_durations():
+  """Verify that the time spent in nested phases is subtracted from their parent."""
+  events = [
+      _event('salvo', 0, 100),
+      _event('benchmark', 10, 80),
+      _event('build', 10, 30),
+      _event('clone', 12, 5),
+      _event('build', 50, 20),
+      _event('pull', 0, 40, tid=2),
+  ]
+
+  assert trace.get_exclusive_durations(events) == {
+      'salvo': [20.0],
+      'benchmark': [30.0],
+      'build': [25.0, 20.0],
+      'clone': [5.0],
+      'pull': [40.0],
+  }
+
+
+def test_load_phase_durations():
+  """Verify that durations are read from all traces in a directory."""
+  with tempfile.TemporaryDirectory() as trace_dir:
+    for index, duration in enumerate([10, 30]):
+      with open(os.path.join(trace_dir, f"salvo_trace_{index}.json"), 'w') as trace_file:
+        json.dump({'traceEvents': [_event('build', 0, duration)]}, trace_file)
+
+    with open(os.path.join(trace_dir, "salvo_trace_2.json"), 'w') as trace_file:
+      trace_file.write("{truncated")
+
+    assert trace.load_phase_durations(trace_dir) == {'build': [10.0, 30.0]}
+    assert trace.load_phase_durations(os.path.join(trace_dir, 'missing')) == {}
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
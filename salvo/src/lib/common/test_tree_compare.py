@@ -0,0 +1,185 @@
+"""Test comparing the results of two output directories."""
+import csv
+import json
+import os
+import tempfile
+import pytest
+
+from src.lib.common import (results_db, tree_compare)
+
+_NIGHTHAWK_OUTPUT = """Nighthawk - A layer 7 protocol benchmarking tool.
+
+benchmark_http_client.latency_2xx (30000 samples)
+  min: 0s 000ms 300us | mean: 0s 000ms {mean}us | max: 0s 005ms 000us | pstdev: 0s 000ms 200us
+
+  Percentile  Count       Value
+  0.5         15000       0s 000ms {p50}us
+  0.75        22500       0s 000ms {p75}us
+  0.9         27000       0s 000ms {p90}us
+  0.990625    29719       0s 001ms 200us
+
+Counter                                 Value       Per second
+benchmark.http_2xx                      30000       {rate}
+"""
+
+
+def _write_results(output_dir, test, latency_us=500, rate=1000.0):
+  """Write the NightHawk results of a test with the given median latency."""
+  test_dir = os.path.join(output_dir, test)
+  os.makedirs(test_dir, exist_ok=True)
+  with open(os.path.join(test_dir, results_db.RESULTS_FILE), 'w') as results_file:
+    results_file.write(
+        _NIGHTHAWK_OUTPUT.format(mean=latency_us + 40,
+                                 p50=latency_us,
+                                 p75=latency_us + 100,
+                                 p90=latency_us + 200,
+                                 rate=rate))
+
+
+def test_load_trees_in_parallel(monkeypatch):
+  """Verify that the results parsed in a process pool match those parsed serially."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    baseline_dir, candidate_dir = os.path.join(tmp_dir, 'a'), os.path.join(tmp_dir, 'b')
+    for index in range(4):
+      _write_results(baseline_dir, f"test_{index}/h1")
+      _write_results(candidate_dir, f"test_{index}/h1", latency_us=500 + index)
+    _write_results(candidate_dir, "test_only_candidate")
+
+    serial = tree_compare.load_trees(baseline_dir, candidate_dir, workers=1)
+    monkeypatch.setattr(tree_compare, 'MIN_PARALLEL_FILES', 0)
+    parallel = tree_compare.load_trees(baseline_dir, candidate_dir, workers=2)
+
+  assert sorted(serial[1]) == [f"test_{index}/h1" for index in range(4)] + ["test_only_candidate"]
+  for serial_tree, parallel_tree in zip(serial, parallel):
+    assert {test: results.metrics for test, results in serial_tree.items()} == \
+        {test: results.metrics for test, results in parallel_tree.items()}
+  assert parallel[1]["test_3/h1"].metrics['benchmark_http_client.latency_2xx.p50'] == \
+      pytest.approx(503e-6)
+  assert 'benchmark_http_client.latency_2xx' in parallel[0]["test_0/h1"].sketches
+
+
+def test_load_trees_without_results():
+  """Verify that a directory without results is rejected."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    _write_results(os.path.join(tmp_dir, 'a'), "test")
+    with pytest.raises(tree_compare.TreeCompareError):
+      tree_compare.load_trees(os.path.join(tmp_dir, 'a'), os.path.join(tmp_dir, 'b'))
+
+
+def test_compare_trees():
+  """Verify that large latency changes are flagged, and small or untested changes are not."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    baseline_dir, candidate_dir = os.path.join(tmp_dir, 'a'), os.path.join(tmp_dir, 'b')
+    _write_results(baseline_dir, "test_slower")
+    _write_results(candidate_dir, "test_slower", latency_us=600)
+    _write_results(baseline_dir, "test_unchanged")
+    _write_results(candidate_dir, "test_unchanged", latency_us=501, rate=990.0)
+    deltas = tree_compare.compare_trees(*tree_compare.load_trees(baseline_dir, candidate_dir))
+
+  by_metric = {(delta.test, delta.metric): delta for delta in deltas}
+  slower = by_metric[("test_slower", 'benchmark_http_client.latency_2xx.p50')]
+  assert slower.relative == pytest.approx(0.2)
+  assert slower.p_value < 0.001
+  assert slower.significant
+  assert by_metric[("test_slower", 'benchmark_http_client.latency_2xx.mean')].significant
+
+  unchanged = by_metric[("test_unchanged", 'benchmark_http_client.latency_2xx.p50')]
+  assert unchanged.p_value > 0.05
+  assert not unchanged.significant
+
+  throughput = by_metric[("test_unchanged", 'counter.benchmark.http_2xx.per_second')]
+  assert throughput.relative == pytest.approx(-0.01)
+  assert throughput.p_value is None
+  assert not throughput.significant
+
+  # The largest changes come first
+  assert deltas[0] == slower
+  assert [abs(delta.relative) for delta in deltas] == \
+      sorted((abs(delta.relative) for delta in deltas), reverse=True)
+
+
+def test_compare_trees_selected_metrics():
+  """Verify that only the selected metrics are compared."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    baseline_dir, candidate_dir = os.path.join(tmp_dir, 'a'), os.path.join(tmp_dir, 'b')
+    _write_results(baseline_dir, "test")
+    _write_results(candidate_dir, "test")
+    deltas = tree_compare.compare_trees(*tree_compare.load_trees(baseline_dir, candidate_dir),
+                                        metrics=['counter.*'])
+
+  assert [delta.metric for delta in deltas
+         ] == ['counter.benchmark.http_2xx', 'counter.benchmark.http_2xx.per_second']
+
+
+def test_compare_trees_min_change():
+  """Verify that significant changes smaller than the minimum relative change are not flagged."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    baseline_dir, candidate_dir = os.path.join(tmp_dir, 'a'), os.path.join(tmp_dir, 'b')
+    _write_results(baseline_dir, "test")
+    _write_results(candidate_dir, "test", latency_us=510)
+    trees = tree_compare.load_trees(baseline_dir, candidate_dir)
+    metrics = ['benchmark_http_client.latency_2xx.mean']
+
+    default = tree_compare.compare_trees(*trees, metrics=metrics)
+    sensitive = tree_compare.compare_trees(*trees, metrics=metrics, min_change=0.01)
+
+  assert default[0].relative == pytest.approx(10 / 540)
+  assert default[0].p_value < 0.001
+  assert not default[0].significant
+  assert sensitive[0].significant
+
+
+def test_adjust_p_values():
+  """Verify the Benjamini-Hochberg adjustment of p-values."""
+  adjusted = tree_compare.adjust_p_values([0.01, None, 0.04, 0.03, 0.5])
+
+  assert adjusted[0] == pytest.approx(0.04)
+  assert adjusted[1] is None
+  assert adjusted[2] == pytest.approx(0.16 / 3)
+  assert adjusted[3] == pytest.approx(0.16 / 3)
+  assert adjusted[4] == pytest.approx(0.5)
+
+
+def test_write_comparison():
+  """Verify that the comparison is formatted and written as CSV and JSON."""
+  deltas = [
+      tree_compare.MetricDelta(test="test",
+                               metric='benchmark_http_client.latency_2xx.p50',
+                               baseline=5e-4,
+                               candidate=6e-4,
+                               relative=0.2,
+                               p_value=0.0001,
+                               significant=True),
+      tree_compare.MetricDelta(test="test",
+                               metric='counter.upstream_cx_total',
+                               baseline=0,
+                               candidate=1,
+                               relative=None,
+                               p_value=None,
+                               significant=False),
+  ]
+  table = tree_compare.format_deltas(deltas).splitlines()
+  assert table[1].split() == [
+      'test', 'benchmark_http_client.latency_2xx.p50', '0.0005', '0.0006', '+20.0%', '0.000', '*'
+  ]
+  assert table[2].split()[-2:] == ['+1', '-']
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    csv_path = tree_compare.write_csv(deltas, os.path.join(tmp_dir, 'compare.csv'))
+    with open(csv_path) as csv_file:
+      rows = list(csv.DictReader(csv_file))
+    json_path = tree_compare.write_json(deltas, os.path.join(tmp_dir, 'compare.json'), {
+        'a': [],
+        'b': ['test_new']
+    })
+    with open(json_path) as json_file:
+      written = json.load(json_file)
+
+  assert rows[0]['relative'] == '0.2'
+  assert rows[1]['significant'] == 'False'
+  assert written['deltas'][0]['p_value'] == 0.0001
+  assert written['unmatched']['b'] == ['test_new']
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,168 @@
+"""Test the watchdog aborting benchmark runs with unusable results."""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import pytest
+from unittest import mock
+
+import api.watchdog_pb2 as proto_watchdog
+
+from src.lib import cmd_exec
+from src.lib.common import watchdog
+
+_COUNTER_HEADER = "Counter                                 Value       Per second"
+
+
+def _create_watchdog(**options):
+  """Create an enabled watchdog with the supplied options."""
+  return watchdog.Watchdog(proto_watchdog.WatchdogOptions(enabled=True, **options))
+
+
+def test_disabled_watchdog_never_aborts():
+  """Verify that a disabled watchdog ignores the benchmark output."""
+  run_watchdog = watchdog.Watchdog(proto_watchdog.WatchdogOptions())
+
+  run_watchdog.feed(_COUNTER_HEADER)
+  run_watchdog.feed("benchmark.http_5xx                      1000        100.00")
+
+  assert not run_watchdog.is_enabled()
+  assert run_watchdog.get_failure() is None
+
+
+def test_feed_aborts_on_error_rate():
+  """Verify that the error rate is computed from the NightHawk counters."""
+  run_watchdog = _create_watchdog()
+  callback = mock.Mock()
+  run_watchdog.add_abort_callback(callback)
+
+  run_watchdog.feed(_COUNTER_HEADER)
+  run_watchdog.feed("benchmark.http_2xx                      900         90.00")
+  run_watchdog.feed("benchmark.http_5xx                      40          4.00")
+  assert run_watchdog.get_failure() is None
+
+  run_watchdog.feed("benchmark.stream_resets                 60          6.00")
+  failure = run_watchdog.get_failure()
+  assert failure.signal == watchdog.SIGNAL_ERROR_RATE
+  assert failure.source == watchdog.SOURCE_NIGHTHAWK
+  assert failure.value == pytest.approx(0.1)
+  callback.assert_called_once()
+
+  with pytest.raises(watchdog.WatchdogAbort):
+    run_watchdog.check()
+
+
+def test_feed_resets_counters_for_each_run():
+  """Verify that the counters of an earlier NightHawk run are not counted again."""
+  run_watchdog = _create_watchdog(max_connection_failures=10)
+
+  run_watchdog.feed(_COUNTER_HEADER)
+  run_watchdog.feed("upstream_cx_connect_fail                8           0.80")
+  run_watchdog.feed(_COUNTER_HEADER)
+  run_watchdog.feed("benchmark.pool_connection_failure       8           0.80")
+  assert run_watchdog.get_failure() is None
+
+  run_watchdog.feed("upstream_cx_connect_fail                3           0.30")
+  assert run_watchdog.get_failure().signal == watchdog.SIGNAL_CONNECTION_FAILURES
+
+
+def test_evaluate_client_saturation():
+  """Verify that pool overflows abort a run whose client limits the throughput."""
+  run_watchdog = _create_watchdog(max_client_saturation=0.2)
+
+  assert run_watchdog.evaluate({
+      'benchmark.pool_overflow': 10,
+      'upstream_rq_total': 90
+  }, watchdog.SOURCE_NIGHTHAWK) is None
+
+  failure = run_watchdog.evaluate({
+      'benchmark.pool_overflow': 30,
+      'upstream_rq_total': 90
+  }, watchdog.SOURCE_NIGHTHAWK)
+  assert failure.signal == watchdog.SIGNAL_CLIENT_SATURATION
+  assert failure.value == pytest.approx(0.25)
+
+
+def test_evaluate_requires_minimum_requests():
+  """Verify that rates are not evaluated on too few responses."""
+  run_watchdog = _create_watchdog(min_requests=50)
+
+  assert run_watchdog.evaluate({'benchmark.http_5xx': 10}, watchdog.SOURCE_NIGHTHAWK) is None
+
+
+def test_poll_envoy_uses_counters_since_start():
+  """Verify that the Envoy counters are evaluated relative to their values at start."""
+  run_watchdog = _create_watchdog(envoy_admin_url='http://localhost:9901')
+
+  with mock.patch.object(watchdog.Watchdog, 'read_envoy_counters') as mock_read:
+    mock_read.return_value = {
+        'http.ingress.downstream_rq_completed': 1000,
+        'http.ingress.downstream_rq_5xx': 500
+    }
+    run_watchdog.poll_envoy()
+    assert run_watchdog.get_failure() is None
+
+    mock_read.return_value = {
+        'http.ingress.downstream_rq_completed': 1200,
+        'http.ingress.downstream_rq_5xx': 550
+    }
+    run_watchdog.poll_envoy()
+
+  failure = run_watchdog.get_failure()
+  assert failure.source == watchdog.SOURCE_ENVOY
+  assert failure.value == pytest.approx(0.25)
+
+
+def test_add_abort_callback_after_abort():
+  """Verify that a callback registered after the abort is invoked immediately."""
+  run_watchdog = _create_watchdog()
+  run_watchdog.abort(
+      watchdog.FailureReason(watchdog.SIGNAL_EXIT_STATUS, 1, 0, watchdog.SOURCE_CONTAINER,
+                             "failed"))
+
+  callback = mock.Mock()
+  run_watchdog.add_abort_callback(callback)
+  callback.assert_called_once()
+
+
+def test_run_command_aborts_process():
+  """Verify that a command is terminated once its output crosses a threshold."""
+  script = ("import time\n"
+            f"print({_COUNTER_HEADER!r})\n"
+            "print('benchmark.http_5xx  500  50.00', flush=True)\n"
+            "time.sleep(60)\n")
+
+  with tempfile.TemporaryDirectory() as work_dir:
+    run_watchdog = _create_watchdog()
+    params = cmd_exec.CommandParameters(cwd=work_dir)
+    with pytest.raises(watchdog.WatchdogAbort) as abort:
+      run_watchdog.run_command(f"{sys.executable} -c \"{script}\"", params)
+
+  assert abort.value.reason.signal == watchdog.SIGNAL_ERROR_RATE
+
+
+def test_run_command_returns_output():
+  """Verify that the output of a command is returned, and failures are raised."""
+  with tempfile.TemporaryDirectory() as work_dir:
+    run_watchdog = _create_watchdog()
+    params = cmd_exec.CommandParameters(cwd=work_dir)
+    assert run_watchdog.run_command("echo benchmark done", params) == "benchmark done"
+
+    with pytest.raises(subprocess.CalledProcessError):
+      run_watchdog.run_command("false", params)
+
+
+def test_write_failure_report():
+  """Verify that the failure reason is written as JSON."""
+  reason = watchdog.FailureReason(watchdog.SIGNAL_CONNECTION_FAILURES, 150, 100,
+                                  watchdog.SOURCE_ENVOY, "150 connection failures")
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    report_path = watchdog.write_failure_report(output_dir, reason)
+    with open(report_path) as report_file:
+      report = json.load(report_file)
+
+  assert os.path.basename(report_path) == watchdog.FAILURE_REPORT_FILE
+  assert report['signal'] == 'connection_failures'
+  assert report['threshold'] == 100
@@ -0,0 +1,311 @@
+"""Module to record the time spent in each phase of a Salvo job.
+
+Phases are recorded as spans, either with the span() context manager or by
+decorating a function with traced(). Spans are kept in memory for the
+lifetime of the process and written in the Chrome trace event format, which
+can be loaded in chrome://tracing or https://ui.perfetto.dev.
+
+https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+"""
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from typing import (Callable, Dict, Iterator, List, NamedTuple)
+
+log = logging.getLogger(__name__)
+
+# The directory, relative to the job's output directory, where traces are
+# written
+TRACE_DIRECTORY = 'traces'
+
+# The category assigned to all Salvo trace events
+_TRACE_CATEGORY = 'salvo'
+
+
+class Span(NamedTuple):
+  """A completed phase of the job."""
+
+  name: str
+  start: float  # Wall clock time in seconds when the phase started
+  duration: float  # Duration of the phase in seconds
+  pid: int
+  tid: int
+  args: Dict[str, str]
+
+
+class PhaseSummary(NamedTuple):
+  """The aggregated durations of all spans sharing a name."""
+
+  name: str
+  count: int
+  total: float
+  mean: float
+  maximum: float
+
+
+_spans = []
+_spans_lock = threading.Lock()
+
+# The names of the spans in progress on each thread, innermost last
+_active = threading.local()
+
+
+def record_span(completed: Span) -> None:
+  """Add a completed span to the trace."""
+  with _spans_lock:
+    _spans.append(completed)
+
+
+def get_spans() -> List[Span]:
+  """Return the spans recorded so far, ordered by start time."""
+  with _spans_lock:
+    return sorted(_spans, key=lambda s: s.start)
+
+
+def get_current_phase() -> str:
+  """Return the name of the innermost phase in progress on the current thread, if any."""
+  active = getattr(_active, 'names', [])
+  return active[-1] if active else ''
+
+
+def reset() -> None:
+  """Discard all recorded spans."""
+  with _spans_lock:
+    _spans.clear()
+
+
+@contextlib.contextmanager
+def span(name: str, **args) -> Iterator[None]:
+  """Record the duration of a phase.
+
+  For example:
+
+    with trace.span('docker_build', image=image_name):
+      ...
+
+  Args:
+    name: The name of the phase
+    args: Additional details stored with the span, such as the image
+      or commit being processed. If the phase raises an exception, its
+      type is stored as well
+  """
+  span_args = {key: str(value) for key, value in args.items()}
+  start = time.time()
+  counter = time.perf_counter()
+  if not hasattr(_active, 'names'):
+    _active.names = []
+  _active.names.append(name)
+  try:
+    yield
+  except BaseException as phase_error:
+    span_args['error'] = type(phase_error).__name__
+    raise
+  finally:
+    _active.names.pop()
+    record_span(
+        Span(name=name,
+             start=start,
+             duration=time.perf_counter() - counter,
+             pid=os.getpid(),
+             tid=threading.get_ident(),
+             args=span_args))
+
+
+def traced(name: str = '', *arg_names: str) -> Callable:
+  """Decorate a function so that each call is recorded as a span.
+
+  Args:
+    name: The name of the phase. The qualified name of the function is
+      used if unspecified
+    arg_names: The names of the function arguments whose values are stored
+      with the span
+
+  Returns:
+    the decorator wrapping the function
+  """
+
+  def _decorator(function: Callable) -> Callable:
+    span_name = name or function.__qualname__
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def _wrapper(*args, **kwargs):
+      span_args = {}
+      if arg_names:
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        span_args = {arg: bound.arguments[arg] for arg in arg_names if arg in bound.arguments}
+
+      with span(span_name, **span_args):
+        return function(*args, **kwargs)
+
+    return _wrapper
+
+  return _decorator
+
+
+def get_chrome_trace() -> Dict:
+  """Convert the recorded spans into a Chrome trace document.
+
+  Each span becomes a complete ("X") event. Timestamps and durations are
+  expressed in microseconds.
+  """
+  events = []
+  for recorded in get_spans():
+    events.append({
+        'name': recorded.name,
+        'cat': _TRACE_CATEGORY,
+        'ph': 'X',
+        'ts': int(recorded.start * 1e6),
+        'dur': int(recorded.duration * 1e6),
+        'pid': recorded.pid,
+        'tid': recorded.tid,
+        'args': recorded.args,
+    })
+
+  return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(path: str) -> None:
+  """Write the recorded spans to a Chrome trace file.
+
+  Args:
+    path: The path of the trace file. Missing directories are created
+  """
+  trace_dir = os.path.dirname(path)
+  if trace_dir and not os.path.isdir(trace_dir):
+    os.makedirs(trace_dir, 0o755)
+
+  with open(path, 'w') as trace_file:
+    json.dump(get_chrome_trace(), trace_file, indent=1)
+
+  log.info(f"Trace written to {path}")
+
+
+def summarize(spans: List[Span]) -> List[PhaseSummary]:
+  """Aggregate the spans by name.
+
+  Args:
+    spans: The spans to aggregate
+
+  Returns:
+    a list of PhaseSummary objects ordered by decreasing total duration
+  """
+  durations = {}
+  for recorded in spans:
+    durations.setdefault(recorded.name, []).append(recorded.duration)
+
+  summary = [
+      PhaseSummary(name=name,
+                   count=len(values),
+                   total=sum(values),
+                   mean=sum(values) / len(values),
+                   maximum=max(values)) for name, values in durations.items()
+  ]
+  summary.sort(key=lambda s: (-s.total, s.name))
+  return summary
+
+
+def format_summary(spans: List[Span], wall_time: float) -> str:
+  """Format a table listing the time spent in each phase.
+
+  Nested phases are included in the time of the phase containing them, so
+  the shares do not add up to 100%.
+
+  Args:
+    spans: The spans to summarize
+    wall_time: The total duration of the job in seconds
+
+  Returns:
+    the formatted table
+  """
+  name_width = max([len(s.name) for s in spans] + [len('Phase')])
+  lines = [
+      f"{'Phase':<{name_width}} {'Count':>6} {'Total(s)':>10} {'Mean(s)':>10} {'Max(s)':>10} "
+      f"{'Share':>7}"
+  ]
+
+  for phase in summarize(spans):
+    share = phase.total / wall_time * 100 if wall_time else 0.0
+    lines.append(f"{phase.name:<{name_width}} {phase.count:>6} {phase.total:>10.2f} "
+                 f"{phase.mean:>10.2f} {phase.maximum:>10.2f} {share:>6.1f}%")
+
+  return '\n'.join(lines)
+
+
+def get_exclusive_durations(events: List[Dict]) -> Dict[str, List[float]]:
+  """Compute the time spent in each phase, excluding the phases it contains.
+
+  A benchmark execution that builds Nighthawk contains the span of the
+  build. Subtracting nested spans attributes each second to exactly one
+  phase, so that the durations of distinct phases can be added.
+
+  Args:
+    events: The complete events of a Chrome trace
+
+  Returns:
+    a dictionary mapping each phase name to the exclusive durations, in
+      seconds, of each of its spans
+  """
+  threads = {}
+  for event in events:
+    if event.get('ph') == 'X':
+      threads.setdefault((event['pid'], event['tid']), []).append(event)
+
+  durations = {}
+  for thread_events in threads.values():
+    # Parents start no later than their children and are longer when they
+    # start at the same time
+    thread_events.sort(key=lambda e: (e['ts'], -e['dur']))
+    stack = []
+    exclusive = {}
+    for index, event in enumerate(thread_events):
+      while stack and thread_events[stack[-1]]['ts'] + thread_events[stack[-1]]['dur'] <= \
+          event['ts']:
+        stack.pop()
+
+      exclusive[index] = event['dur']
+      if stack:
+        exclusive[stack[-1]] -= event['dur']
+      stack.append(index)
+
+    for index, event in enumerate(thread_events):
+      durations.setdefault(event['name'], []).append(max(exclusive[index], 0) / 1e6)
+
+  return durations
+
+
+def load_phase_durations(trace_dir: str) -> Dict[str, List[float]]:
+  """Read the exclusive phase durations from the traces of previous jobs.
+
+  Args:
+    trace_dir: The directory containing the traces
+
+  Returns:
+    a dictionary mapping each phase name to the durations, in seconds,
+      recorded across all traces
+  """
+  durations = {}
+  if not os.path.isdir(trace_dir):
+    return durations
+
+  for trace_name in sorted(os.listdir(trace_dir)):
+    if not trace_name.endswith('.json'):
+      continue
+
+    try:
+      with open(os.path.join(trace_dir, trace_name), 'r') as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    except (OSError, ValueError, KeyError) as trace_error:
+      log.warning(f"Skipping unreadable trace {trace_name}: {trace_error}")
+      continue
+
+    for name, values in get_exclusive_durations(events).items():
+      durations.setdefault(name, []).extend(values)
+
+  return durations
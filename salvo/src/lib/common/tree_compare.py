@@ -0,0 +1,303 @@
+"""Compare the NightHawk results of two output directories test by test.
+
+The tests of both directories are matched by the directory of their results
+relative to each output directory, and the results files are parsed in a
+pool of processes. Every selected metric of a matched test is compared, and
+the change of a latency histogram is tested for significance from the
+NightHawk output of each side alone: the mean with a two sample z-test
+using the standard deviation and the number of samples of the histogram,
+and a percentile with the standard error of its estimate, derived from the
+distribution-free confidence interval of the quantile. The p-values of all
+comparisons are adjusted for the number of comparisons with the
+Benjamini-Hochberg procedure, so a tree of hundreds of tests does not flag
+changes by chance. A single run per side measures the error of sampling
+within the run, but not the variation between runs of the same Envoy, so a
+change is flagged only if it is also larger than a minimum relative change.
+"""
+import concurrent.futures
+import csv
+import fnmatch
+import json
+import logging
+import math
+import os
+import re
+import statistics
+from typing import (Dict, List, NamedTuple, Optional, Sequence, Tuple)
+
+from src.lib.common import (latency_sketch, results_db)
+
+log = logging.getLogger(__name__)
+
+# The metrics compared unless others are selected
+DEFAULT_METRICS = [
+    'benchmark_http_client.latency_2xx.mean',
+    'benchmark_http_client.latency_2xx.p50',
+    'benchmark_http_client.latency_2xx.p99*',
+    'counter.benchmark.http_2xx.per_second',
+]
+DEFAULT_SIGNIFICANCE = 0.05
+DEFAULT_MIN_CHANGE = 0.02
+
+# Fewer results files than this are parsed without starting a process pool
+MIN_PARALLEL_FILES = 16
+
+_PERCENTILE_PATTERN = re.compile(r'^(.*)\.p(\d+(?:\.\d+)?)$')
+
+# The normal quantile of the 95% confidence interval of a percentile
+_INTERVAL_QUANTILE = 1.96
+
+
+class TreeCompareError(Exception):
+  """Raised when the results of a tree cannot be read or the comparison written."""
+
+
+class TestResults(NamedTuple):
+  """The parsed NightHawk results of a test."""
+
+  metrics: Dict[str, float]
+  # The sketch of each histogram with a percentile table
+  sketches: Dict[str, latency_sketch.LatencySketch]
+
+
+class MetricDelta(NamedTuple):
+  """The change of a metric of a test between the two trees."""
+
+  test: str
+  metric: str
+  baseline: float
+  candidate: float
+  # The change relative to the baseline, or None if the baseline is zero
+  relative: Optional[float]
+  # The p-value of the change, or None if its significance is unknown
+  p_value: Optional[float]
+  # Whether the change is significant once adjusted for the number of
+  # comparisons, and larger than the minimum relative change
+  significant: bool
+
+
+def load_test_results(results_path: str) -> TestResults:
+  """Parse the NightHawk results of a test.
+
+  Args:
+    results_path: The path of the nighthawk-human.txt file
+
+  Returns:
+    the metrics and the sketches of the test
+
+  Raises:
+    TreeCompareError: if the file cannot be read
+  """
+  try:
+    with open(results_path) as results_file:
+      output = results_file.read()
+  except OSError as read_error:
+    raise TreeCompareError(f"Unable to read the results [{results_path}]: {read_error}")
+  return TestResults(metrics=results_db.parse_nighthawk_results(output),
+                     sketches=results_db.build_sketches(output))
+
+
+def load_trees(baseline_dir: str,
+               candidate_dir: str,
+               workers: int = 0) -> Tuple[Dict[str, TestResults], Dict[str, TestResults]]:
+  """Parse the results of every test of two output directories.
+
+  Args:
+    baseline_dir: The output directory of the baseline
+    candidate_dir: The output directory of the candidate
+    workers: The number of processes parsing the results. The default is
+      the number of processors
+
+  Returns:
+    the results of each test of the baseline and of the candidate
+
+  Raises:
+    TreeCompareError: if a directory has no results or a results file
+      cannot be read
+  """
+  trees = []
+  for output_dir in [baseline_dir, candidate_dir]:
+    tests = results_db.find_test_results(output_dir)
+    if not tests:
+      raise TreeCompareError(f"No NightHawk results found in [{output_dir}]")
+    trees.append(tests)
+
+  paths = [path for tests in trees for path in tests.values()]
+  if workers == 1 or len(paths) < MIN_PARALLEL_FILES:
+    parsed = [load_test_results(path) for path in paths]
+  else:
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+      parsed = list(
+          pool.map(load_test_results, paths, chunksize=max(1,
+                                                           len(paths) // (4 * workers))))
+
+  baseline = dict(zip(trees[0], parsed[:len(trees[0])]))
+  candidate = dict(zip(trees[1], parsed[len(trees[0]):]))
+  return baseline, candidate
+
+
+def _get_p_value(baseline: float, candidate: float, baseline_error: float,
+                 candidate_error: float) -> Optional[float]:
+  """Return the two sided p-value of the difference of two estimates with standard errors."""
+  error = math.hypot(baseline_error, candidate_error)
+  if not error:
+    return None
+  return 2 * (1 - statistics.NormalDist().cdf(abs(candidate - baseline) / error))
+
+
+def _get_standard_error(results: TestResults, metric: str) -> Optional[float]:
+  """Return the standard error of a latency mean or percentile, or None if it is unknown."""
+  if metric.endswith('.mean'):
+    histogram = metric[:-len('.mean')]
+    deviation = results.metrics.get(f"{histogram}.pstdev")
+    samples = results.metrics.get(f"{histogram}.samples")
+    return deviation / math.sqrt(samples) if deviation is not None and samples else None
+
+  percentile = _PERCENTILE_PATTERN.match(metric)
+  sketch = results.sketches.get(percentile.group(1)) if percentile else None
+  if not sketch or sketch.get_count() < 2:
+    return None
+
+  # The ranks bounding the quantile with 95% confidence follow from the
+  # binomial distribution of the number of samples below it
+  quantile = float(percentile.group(2)) / 100
+  margin = _INTERVAL_QUANTILE * math.sqrt(quantile * (1 - quantile) / sketch.get_count())
+  low = sketch.get_quantile(max(0.0, quantile - margin))
+  high = sketch.get_quantile(min(1.0, quantile + margin))
+  # The resolution of the sketch bounds the error from below
+  return max((high - low) / (2 * _INTERVAL_QUANTILE),
+             sketch.get_relative_accuracy() * results.metrics[metric])
+
+
+def adjust_p_values(p_values: Sequence[Optional[float]]) -> List[Optional[float]]:
+  """Adjust p-values for the number of comparisons with the Benjamini-Hochberg procedure.
+
+  Unknown p-values are left out of the comparisons and remain unknown.
+  """
+  known = sorted((p_value, index) for index, p_value in enumerate(p_values) if p_value is not None)
+  adjusted = [None] * len(p_values)
+  smallest = 1.0
+  for rank in range(len(known), 0, -1):
+    p_value, index = known[rank - 1]
+    smallest = min(smallest, p_value * len(known) / rank)
+    adjusted[index] = smallest
+  return adjusted
+
+
+def _select_metrics(metrics: Dict[str, float], patterns: Sequence[str]) -> List[str]:
+  """Return the metrics matching any pattern, in name order."""
+  return sorted(metric for metric in metrics if any(
+      fnmatch.fnmatchcase(metric, pattern) for pattern in patterns))
+
+
+def compare_trees(baseline: Dict[str, TestResults],
+                  candidate: Dict[str, TestResults],
+                  metrics: Optional[Sequence[str]] = None,
+                  significance: float = DEFAULT_SIGNIFICANCE,
+                  min_change: float = DEFAULT_MIN_CHANGE) -> List[MetricDelta]:
+  """Compare the metrics of the tests found in both trees.
+
+  Args:
+    baseline: The results of each test of the baseline
+    candidate: The results of each test of the candidate
+    metrics: The metrics compared, or patterns with "*". The default is
+      DEFAULT_METRICS
+    significance: The adjusted p-value below which a change is significant
+    min_change: The smallest relative change flagged as significant
+
+  Returns:
+    the change of every metric measured in both trees, the largest
+    relative changes first
+  """
+  compared = []
+  for test in sorted(set(baseline) & set(candidate)):
+    baseline_results, candidate_results = baseline[test], candidate[test]
+    for metric in _select_metrics(baseline_results.metrics, metrics or DEFAULT_METRICS):
+      if metric not in candidate_results.metrics:
+        continue
+      baseline_value = baseline_results.metrics[metric]
+      candidate_value = candidate_results.metrics[metric]
+      baseline_error = _get_standard_error(baseline_results, metric)
+      candidate_error = _get_standard_error(candidate_results, metric)
+      p_value = None
+      if baseline_error is not None and candidate_error is not None:
+        p_value = _get_p_value(baseline_value, candidate_value, baseline_error, candidate_error)
+      compared.append((test, metric, baseline_value, candidate_value, p_value))
+
+  adjusted = adjust_p_values([p_value for *_, p_value in compared])
+  deltas = []
+  for (test, metric, baseline_value, candidate_value,
+       p_value), adjusted_p_value in zip(compared, adjusted):
+    relative = (candidate_value - baseline_value) / abs(baseline_value) if baseline_value else None
+    large = relative is None or abs(relative) >= min_change
+    deltas.append(
+        MetricDelta(test=test,
+                    metric=metric,
+                    baseline=baseline_value,
+                    candidate=candidate_value,
+                    relative=relative,
+                    p_value=p_value,
+                    significant=large and adjusted_p_value is not None and
+                    adjusted_p_value < significance))
+  return sorted(deltas,
+                key=lambda delta:
+                (delta.relative is None, -abs(delta.relative or 0.0), delta.test, delta.metric))
+
+
+def format_deltas(deltas: List[MetricDelta]) -> str:
+  """Format changes as a table, one metric per line.
+
+  Significant changes are flagged with "*", and "-" marks changes whose
+  significance is unknown.
+  """
+  columns = ['test', 'metric', 'baseline', 'candidate', 'change', 'p-value', '']
+  rows = [columns] + [[
+      delta.test, delta.metric, f"{delta.baseline:g}", f"{delta.candidate:g}",
+      f"{delta.relative:+.1%}"
+      if delta.relative is not None else f"{delta.candidate - delta.baseline:+g}",
+      f"{delta.p_value:.3f}" if delta.p_value is not None else '-', '*' if delta.significant else ''
+  ] for delta in deltas]
+  widths = [max(len(row[column]) for row in rows) for column in range(len(columns))]
+  return '\n'.join(
+      '  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def write_csv(deltas: List[MetricDelta], path: str) -> str:
+  """Write changes to a CSV file with a header row.
+
+  Raises:
+    TreeCompareError: if the file cannot be written
+  """
+  try:
+    with open(path, 'w', newline='') as csv_file:
+      writer = csv.writer(csv_file)
+      writer.writerow(MetricDelta._fields)
+      writer.writerows(deltas)
+  except OSError as write_error:
+    raise TreeCompareError(f"Unable to write the comparison to [{path}]: {write_error}")
+  return path
+
+
+def write_json(deltas: List[MetricDelta], path: str, unmatched: Dict[str, List[str]]) -> str:
+  """Write changes to a JSON file.
+
+  Args:
+    deltas: The changes of the metrics
+    path: The path of the file
+    unmatched: The tests found in a single tree, by tree
+
+  Raises:
+    TreeCompareError: if the file cannot be written
+  """
+  try:
+    with open(path, 'w') as json_file:
+      json.dump({
+          'deltas': [delta._asdict() for delta in deltas],
+          'unmatched': unmatched
+      },
+                json_file,
+                indent=2)
+  except OSError as write_error:
+    raise TreeCompareError(f"Unable to write the comparison to [{path}]: {write_error}")
+  return path
@@ -0,0 +1,380 @@
+"""Abort a benchmark run whose results are unusable while it is still in progress.
+
+The watchdog reads the counters that NightHawk prints for each test from the
+benchmark output as it is produced and, optionally, polls the admin
+endpoint of the Envoy under test. When the error rate, the connection
+failures or the saturation of the client cross their thresholds, the
+watchdog records the reason and invokes the abort callbacks registered by
+the benchmark, which stop the running commands or containers.
+"""
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from typing import (Callable, Dict, List, NamedTuple, Optional)
+
+import requests
+
+import api.watchdog_pb2 as proto_watchdog
+
+from src.lib import cmd_exec
+
+log = logging.getLogger(__name__)
+
+FAILURE_REPORT_FILE = 'failure.json'
+
+DEFAULT_MAX_ERROR_RATE = 0.05
+DEFAULT_MAX_CONNECTION_FAILURES = 100
+DEFAULT_MAX_CLIENT_SATURATION = 0.1
+DEFAULT_MIN_REQUESTS = 100
+DEFAULT_POLL_INTERVAL_MS = 1000
+
+# The signals recorded as the reason of a failure
+SIGNAL_ERROR_RATE = 'error_rate'
+SIGNAL_CONNECTION_FAILURES = 'connection_failures'
+SIGNAL_CLIENT_SATURATION = 'client_saturation'
+SIGNAL_EXIT_STATUS = 'exit_status'
+
+# Where the failing signal was observed
+SOURCE_NIGHTHAWK = 'nighthawk'
+SOURCE_ENVOY = 'envoy_admin'
+SOURCE_CONTAINER = 'container'
+
+# Matches a row of the NightHawk counter table: the name, value and rate
+_COUNTER_PATTERN = re.compile(r'(?:^|\s)([a-z][\w.]*)\s+(\d+)\s+\d+(?:\.\d+)?\s*$')
+
+# Matches the header starting the counter table of each NightHawk run
+_COUNTER_HEADER_PATTERN = re.compile(r'Counter\s+Value\s+Per second')
+
+# The time allowed for an aborted command to exit after it is terminated
+_TERMINATE_TIMEOUT = 10.0
+
+# The time between reads of the output of a watched command
+_TAIL_INTERVAL = 0.2
+
+# Encapsulates why a run was aborted
+FailureReason = NamedTuple(
+    'FailureReason',
+    [
+        ('signal', str),  # The signal that crossed its threshold
+        ('value', float),  # The observed value of the signal
+        ('threshold', float),  # The threshold of the signal
+        ('source', str),  # Where the counters were read from
+        ('message', str),  # A description of the failure
+    ])
+
+
+class WatchdogAbort(Exception):
+  """Error raised when the watchdog aborts a run."""
+
+  def __init__(self, reason: FailureReason) -> None:
+    """Initialize the error with the reason of the abort."""
+    super(WatchdogAbort, self).__init__(reason.message)
+    self.reason = reason
+
+
+def write_failure_report(output_dir: str, reason: FailureReason) -> str:
+  """Record why a run failed in its output directory.
+
+  Args:
+    output_dir: The output directory of the run
+    reason: The reason of the failure
+
+  Returns:
+    the path of the written report
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  report_path = os.path.join(output_dir, FAILURE_REPORT_FILE)
+  with open(report_path, 'w') as report_file:
+    json.dump(reason._asdict(), report_file, indent=2)
+  return report_path
+
+
+def _sum_counters(counters: Dict[str, int], suffixes: List[str]) -> int:
+  """Sum the counters whose names end with any of the suffixes."""
+  return sum(value for name, value in counters.items()
+             if any(name == suffix or name.endswith('.' + suffix) for suffix in suffixes))
+
+
+class Watchdog(object):
+  """Follow the progress of a benchmark run and abort it when its results become unusable.
+
+  The watchdog is a context manager. While active, it polls the Envoy
+  admin endpoint, if one is configured, from a background thread. Output
+  lines are passed to feed() by the code running the benchmark. A disabled
+  watchdog never aborts.
+  """
+
+  def __init__(self, options: proto_watchdog.WatchdogOptions) -> None:
+    """Initialize the watchdog.
+
+    Args:
+      options: The watchdog options from the job control document
+    """
+    self._options = options
+    self._max_error_rate = options.max_error_rate or DEFAULT_MAX_ERROR_RATE
+    self._max_connection_failures = \
+        options.max_connection_failures or DEFAULT_MAX_CONNECTION_FAILURES
+    self._max_client_saturation = options.max_client_saturation or DEFAULT_MAX_CLIENT_SATURATION
+    self._min_requests = options.min_requests or DEFAULT_MIN_REQUESTS
+    self._interval = (options.poll_interval_ms or DEFAULT_POLL_INTERVAL_MS) / 1000.0
+
+    self._lock = threading.Lock()
+    self._abort_callbacks = []
+    self._failure = None
+    # Concurrent shards feed their output from separate threads
+    self._local = threading.local()
+    self._envoy_baseline = None
+
+    self._stop = threading.Event()
+    self._thread = None
+
+  def is_enabled(self) -> bool:
+    """Return whether the watchdog may abort the run."""
+    return self._options.enabled
+
+  def __enter__(self) -> 'Watchdog':
+    """Start polling the Envoy counters, if an admin address is configured."""
+    if self.is_enabled() and self._options.envoy_admin_url:
+      self._thread = threading.Thread(target=self._poll, name='watchdog', daemon=True)
+      self._thread.start()
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Stop polling the Envoy counters."""
+    if self._thread:
+      self._stop.set()
+      self._thread.join()
+
+  def get_failure(self) -> Optional[FailureReason]:
+    """Return the reason the run was aborted, or None if it was not."""
+    return self._failure
+
+  def check(self) -> None:
+    """Raise the abort of the run, if the watchdog aborted it.
+
+    Raises:
+      WatchdogAbort: if a threshold was crossed
+    """
+    if self._failure:
+      raise WatchdogAbort(self._failure)
+
+  def add_abort_callback(self, callback: Callable[[], None]) -> None:
+    """Register a function stopping part of the run when the watchdog aborts it.
+
+    The callback is invoked immediately if the run was already aborted.
+
+    Args:
+      callback: The function stopping a command or container
+    """
+    with self._lock:
+      self._abort_callbacks.append(callback)
+      aborted = self._failure is not None
+
+    if aborted:
+      callback()
+
+  def remove_abort_callback(self, callback: Callable[[], None]) -> None:
+    """Unregister a callback once the command or container it stops has exited."""
+    with self._lock:
+      if callback in self._abort_callbacks:
+        self._abort_callbacks.remove(callback)
+
+  def abort(self, reason: FailureReason) -> None:
+    """Record the reason of the abort and stop the run.
+
+    Only the first reason is recorded. The run is stopped even if the
+    watchdog is disabled, for instance when one shard of the run fails.
+
+    Args:
+      reason: Why the run is aborted
+    """
+    with self._lock:
+      if self._failure:
+        return
+      self._failure = reason
+      callbacks = list(self._abort_callbacks)
+
+    log.error(f"Aborting the benchmark: {reason.message}")
+    for callback in callbacks:
+      try:
+        callback()
+      except Exception as callback_error:
+        log.error(f"Unable to stop the benchmark: {callback_error}")
+
+  def evaluate(self, counters: Dict[str, int], source: str) -> Optional[FailureReason]:
+    """Compare counters with the thresholds, aborting the run if one is crossed.
+
+    Args:
+      counters: The counter values, by name
+      source: Where the counters were read from
+
+    Returns:
+      the reason the run is aborted, if a threshold is crossed
+    """
+    if not self.is_enabled():
+      return None
+
+    if source == SOURCE_NIGHTHAWK:
+      responses = _sum_counters(counters, [
+          'benchmark.http_2xx', 'benchmark.http_3xx', 'benchmark.http_4xx', 'benchmark.http_5xx',
+          'benchmark.stream_resets'
+      ])
+      errors = _sum_counters(
+          counters, ['benchmark.http_4xx', 'benchmark.http_5xx', 'benchmark.stream_resets'])
+      connection_failures = _sum_counters(
+          counters, ['upstream_cx_connect_fail', 'benchmark.pool_connection_failure'])
+      overflows = _sum_counters(counters, ['benchmark.pool_overflow'])
+      requests_issued = _sum_counters(counters, ['upstream_rq_total'])
+    else:
+      responses = _sum_counters(counters, ['downstream_rq_completed'])
+      errors = _sum_counters(counters, ['downstream_rq_4xx', 'downstream_rq_5xx'])
+      connection_failures = _sum_counters(counters, ['upstream_cx_connect_fail'])
+      overflows = _sum_counters(counters, ['upstream_rq_pending_overflow'])
+      requests_issued = _sum_counters(counters, ['upstream_rq_total'])
+
+    reason = None
+    if connection_failures > self._max_connection_failures:
+      reason = FailureReason(
+          SIGNAL_CONNECTION_FAILURES, connection_failures, self._max_connection_failures, source,
+          f"{connection_failures} connection failures exceed the limit of "
+          f"{self._max_connection_failures} ({source})")
+    elif responses >= self._min_requests and errors / responses > self._max_error_rate:
+      reason = FailureReason(
+          SIGNAL_ERROR_RATE, errors / responses, self._max_error_rate, source,
+          f"{errors} of {responses} responses are errors, exceeding the "
+          f"{self._max_error_rate:.1%} limit ({source})")
+    elif requests_issued + overflows >= self._min_requests and \
+        overflows / (requests_issued + overflows) > self._max_client_saturation:
+      saturation = overflows / (requests_issued + overflows)
+      reason = FailureReason(
+          SIGNAL_CLIENT_SATURATION, saturation, self._max_client_saturation, source,
+          f"The client could not issue {saturation:.1%} of its requests, exceeding the "
+          f"{self._max_client_saturation:.1%} limit. The client limits the throughput "
+          f"({source})")
+
+    if reason:
+      self.abort(reason)
+    return reason
+
+  def feed(self, line: str) -> None:
+    """Read the counters printed by NightHawk from a line of benchmark output.
+
+    Each NightHawk run prints a table of counters. The counters are
+    evaluated as the rows of a table are read and reset at the next table.
+
+    Args:
+      line: A line of benchmark output
+    """
+    if not self.is_enabled():
+      return
+
+    if _COUNTER_HEADER_PATTERN.search(line):
+      self._local.counters = {}
+      return
+
+    match = _COUNTER_PATTERN.search(line)
+    if match:
+      counters = getattr(self._local, 'counters', {})
+      counters[match.group(1)] = int(match.group(2))
+      self._local.counters = counters
+      self.evaluate(counters, SOURCE_NIGHTHAWK)
+
+  def read_envoy_counters(self) -> Dict[str, int]:
+    """Read the counters of the Envoy under test from its admin endpoint.
+
+    Returns:
+      the counter values, by name
+    """
+    response = requests.get(f"{self._options.envoy_admin_url.rstrip('/')}/stats",
+                            params={'format': 'json'},
+                            timeout=self._interval)
+    response.raise_for_status()
+    return {
+        stat['name']: stat['value']
+        for stat in response.json().get('stats', [])
+        if isinstance(stat.get('value'), int)
+    }
+
+  def poll_envoy(self) -> None:
+    """Evaluate the Envoy counters accumulated since the watchdog started.
+
+    Envoy is unreachable while the harness restarts it between tests, so
+    failed requests are ignored.
+    """
+    try:
+      counters = self.read_envoy_counters()
+    except (requests.exceptions.RequestException, ValueError) as poll_error:
+      log.debug(f"Unable to read the Envoy counters: {poll_error}")
+      return
+
+    if self._envoy_baseline is None or any(
+        counters.get(name, 0) < value for name, value in self._envoy_baseline.items()):
+      # A new Envoy started, so its counters are counted from zero
+      self._envoy_baseline = {name: 0 for name in counters} \
+          if self._envoy_baseline is not None else counters
+    self.evaluate(
+        {
+            name: value - self._envoy_baseline.get(name, 0) for name, value in counters.items()
+        }, SOURCE_ENVOY)
+
+  def _poll(self) -> None:
+    """Poll the Envoy counters until the watchdog is stopped or aborts the run."""
+    while not self._stop.wait(self._interval):
+      self.poll_envoy()
+      if self._failure:
+        return
+
+  def run_command(self, cmd: str, parameters: cmd_exec.CommandParameters) -> str:
+    """Run a command, following its output until it exits or the run is aborted.
+
+    Args:
+      cmd: The command to be executed
+      parameters: The parameters of the command. See cmd_exec.run_command
+
+    Returns:
+      the output produced by the command
+
+    Raises:
+      WatchdogAbort: if a threshold was crossed. The command is terminated
+      subprocess.CalledProcessError: if the command exits with a non-zero exit
+        code
+    """
+    with tempfile.NamedTemporaryFile(mode='w+', dir=parameters.cwd,
+                                     prefix='cmd_output') as output_file:
+      process = cmd_exec.start_command(cmd, parameters, output_file)
+
+      def terminate():
+        process.terminate()
+
+      self.add_abort_callback(terminate)
+      output = []
+      pending = ''
+      try:
+        with open(output_file.name) as tail:
+          while True:
+            exited = process.poll() is not None
+            pending += tail.read()
+            *lines, pending = pending.split('\n')
+            for line in lines:
+              output.append(line)
+              self.feed(line)
+            if exited:
+              break
+            self._stop.wait(_TAIL_INTERVAL)
+      finally:
+        self.remove_abort_callback(terminate)
+        try:
+          process.wait(timeout=_TERMINATE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+          process.kill()
+          process.wait()
+
+    output.append(pending)
+    self.check()
+    if process.returncode:
+      raise subprocess.CalledProcessError(process.returncode, cmd, '\n'.join(output))
+    return '\n'.join(output).strip()
@@ -0,0 +1,177 @@
+"""Keep the containers started by the dockerized benchmarks warm across test cases.
+
+The Nighthawk test harness starts the test server and Envoy in new
+containers for every test case. When pooling is enabled, the pooled_docker
+script shadows the docker client used by the harness and runs these
+commands in long running containers instead. This module installs the
+script, provides the environment selecting it, and removes the pooled
+containers once the benchmark completes.
+
+The script is installed as well when the Envoy under test has resource
+limits, which it applies to the containers of the Envoy image.
+"""
+import collections
+import logging
+import os
+import shlex
+import shutil
+import stat
+import uuid
+from typing import (Dict, List, Optional)
+
+from src.lib.docker_management import (docker_image, pooled_docker)
+
+log = logging.getLogger(__name__)
+
+POOL_DIRECTORY = 'container_pool'
+EVENT_LOG_FILE = 'events.log'
+
+
+class ContainerPool(object):
+  """Install the pooled docker client for a benchmark and clean up its containers.
+
+  The pool is a context manager. The containers are created by the pooled
+  docker client while the benchmark executes and are removed on exit. A
+  disabled pool without resource limits leaves the benchmark unchanged.
+  """
+
+  def __init__(self,
+               enabled: bool,
+               image: docker_image.DockerImage,
+               output_dir: str,
+               limited_image: str = '',
+               limits: Optional[List[str]] = None) -> None:
+    """Initialize the pool.
+
+    Args:
+      enabled: Whether the containers are pooled
+      image: The docker image object whose client removes the containers
+      output_dir: The output directory of the benchmark. It is mounted at the
+        same path in the containers started by the harness and holds their
+        per test configuration
+      limited_image: The image whose containers receive the resource limits
+      limits: The "docker run" options applying resource limits to the
+        containers of the limited image
+    """
+    self._enabled = enabled
+    self._image = image
+    self._output_dir = output_dir
+    self._pool_dir = os.path.join(output_dir, POOL_DIRECTORY)
+    self._pool_id = uuid.uuid4().hex[:12]
+    self._limited_image = limited_image
+    self._limits = limits or []
+
+  def is_enabled(self) -> bool:
+    """Return whether the containers are pooled."""
+    return self._enabled
+
+  def is_installed(self) -> bool:
+    """Return whether the pooled docker client shadows the docker client of the harness."""
+    return self._enabled or bool(self._limits)
+
+  def get_bin_directory(self) -> str:
+    """Return the directory containing the pooled docker client."""
+    return os.path.join(self._pool_dir, 'bin')
+
+  def get_event_log(self) -> str:
+    """Return the file to which the pooled docker client records its events."""
+    return os.path.join(self._pool_dir, EVENT_LOG_FILE)
+
+  def __enter__(self) -> 'ContainerPool':
+    """Install the pooled docker client in the output directory."""
+    if not self.is_installed():
+      return self
+
+    os.makedirs(self.get_bin_directory(), exist_ok=True)
+
+    client_path = os.path.join(self.get_bin_directory(), 'docker')
+    shutil.copyfile(pooled_docker.__file__, client_path)
+    os.chmod(client_path, os.stat(client_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    open(self.get_event_log(), 'w').close()
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Remove the pooled containers and summarize their use."""
+    if not self._enabled:
+      return
+
+    self.remove_containers()
+
+    summary = self.get_summary()
+    log.info(f"Container pool: {summary[pooled_docker.EVENT_STARTED]} started, "
+             f"{summary[pooled_docker.EVENT_REUSED]} reused, "
+             f"{summary[pooled_docker.EVENT_RECYCLED]} recycled")
+
+  def get_environment(self, cpus: str = '') -> Dict[str, str]:
+    """Return the environment variables selecting the pool for the harness.
+
+    Args:
+      cpus: The cpuset list to which the pooled containers are pinned, such
+        as the CPUs of a shard. If empty the containers are not pinned
+
+    Returns:
+      the variables to set in the environment of the benchmark
+    """
+    environment = {}
+    if self._limits:
+      environment[pooled_docker.LIMITED_IMAGE_VARIABLE] = self._limited_image
+      environment[pooled_docker.LIMITS_VARIABLE] = ' '.join(map(shlex.quote, self._limits))
+
+    if not self._enabled:
+      return environment
+
+    environment.update({
+        pooled_docker.POOL_ID_VARIABLE: self._pool_id,
+        pooled_docker.SHARED_DIR_VARIABLE: self._output_dir,
+        pooled_docker.EVENT_LOG_VARIABLE: self.get_event_log(),
+    })
+    if cpus:
+      environment[pooled_docker.CPUS_VARIABLE] = cpus
+    return environment
+
+  def wrap_command(self, command: List[str]) -> List[str]:
+    """Run a command with the pooled docker client ahead of the docker client on the PATH.
+
+    The shell expands the PATH of the host or container in which the
+    command executes.
+
+    Args:
+      command: The benchmark command
+
+    Returns:
+      the command prefixed with a shell prepending the pooled client to the
+        PATH
+    """
+    if not self.is_installed():
+      return command
+
+    return ['sh', '-c', f'PATH="{self.get_bin_directory()}:$PATH" exec "$@"', 'sh'] + command
+
+  def remove_containers(self) -> None:
+    """Remove the containers started for this pool."""
+    client = self._image.get_docker_client()
+    containers = client.containers.list(
+        all=True, filters={'label': f"{pooled_docker.POOL_LABEL}={self._pool_id}"})
+    for container in containers:
+      log.debug(f"Removing pooled container {container.name}")
+      container.remove(force=True)
+
+  def get_summary(self) -> Dict[str, int]:
+    """Count the containers started, reused and recycled by the pool.
+
+    Returns:
+      the number of occurrences of each pool event
+    """
+    summary = collections.Counter({
+        pooled_docker.EVENT_STARTED: 0,
+        pooled_docker.EVENT_REUSED: 0,
+        pooled_docker.EVENT_RECYCLED: 0
+    })
+    try:
+      with open(self.get_event_log()) as event_log:
+        summary.update(line.split()[0] for line in event_log if line.strip())
+    except FileNotFoundError:
+      pass
+
+    return dict(summary)
@@ -5,7 +5,10 @@ import requests
 
 # Ref: https://docker-py.readthedocs.io/en/stable/index.html
 import docker
-from typing import List, Union
+from typing import Dict, List, Optional, Union
+
+from src.lib import cmd_exec
+from src.lib.common import (cost_accounting, resource_limits, trace, watchdog)
 
 log = logging.getLogger(__name__)
 
@@ -19,14 +22,36 @@ DockerRunParameters = collections.namedtuple(
         'command',  # a lexical split string containing the command to execute
         'volumes',  # a dict with the volumes mounted in the container
         'network_mode',  # a string that specifies the network stack used
-        'tty'  # a boolean indicating if a pseudo-tty is allocated
-    ])
+        'tty',  # a boolean indicating if a pseudo-tty is allocated
+        'cpuset_cpus',  # an optional cpuset list to which the container is pinned
+    ],
+    defaults=[None])
+
+# The docker client shared by the images of a Salvo server, which keeps its
+# connection to the docker daemon between jobs
+_shared_client = None
+
+
+def share_client() -> None:
+  """Use a single docker client for all the images created from now on."""
+  global _shared_client
+  if _shared_client is None:
+    _shared_client = docker.from_env()
 
 
 class DockerImagePullError(Exception):
   """This error is raised if an image pull is unsuccessful."""
 
 
+class DockerRunError(Exception):
+  """This error is raised if a container exits with a non-zero status."""
+
+  def __init__(self, message: str, exit_status: int) -> None:
+    """Initialize the error with the exit status of the container."""
+    super(DockerRunError, self).__init__(message)
+    self.exit_status = exit_status
+
+
 class DockerImage():
   """This class is a wrapper to encapsulate docker operations.
 
@@ -36,9 +61,10 @@ class DockerImage():
 
   def __init__(self) -> None:
     """Initialize the docker client context."""
-    self._client = docker.from_env()
+    self._client = _shared_client or docker.from_env()
     self._existing_tags = []
 
+  @trace.traced('DockerImage.pull_image', 'image_name')
   def pull_image(self, image_name: str) -> docker.models.containers.Image:
     """Pull the identified docker image.
 
@@ -70,6 +96,25 @@ class DockerImage():
 
     return image
 
+  def is_image_in_registry(self, image_name: str) -> bool:
+    """Determine whether an image can be pulled without pulling it.
+
+    Only the image manifest is requested from the registry.
+
+    Args:
+        image_name: The name of the docker image
+
+    Returns:
+        True if the registry has the image
+    """
+    try:
+      self._client.images.get_registry_data(image_name)
+    except docker.errors.APIError as api_error:
+      log.debug(f"Image {image_name} is not available from its registry: {api_error}")
+      return False
+
+    return True
+
   def list_images(self) -> List[str]:
     """List all available docker image tags.
 
@@ -85,6 +130,25 @@ class DockerImage():
 
     return self._existing_tags
 
+  def get_image_digest(self, image_name: str) -> str:
+    """Return the digest identifying the content of a local image.
+
+    Args:
+      image_name: The name of the docker image
+
+    Returns:
+      the registry digest of the image if it was pulled, its image id
+        otherwise, or an empty string if the image is not available
+    """
+    try:
+      image = self._client.images.get(image_name)
+    except docker.errors.APIError as api_error:
+      log.debug(f"Unable to inspect image {image_name}: {api_error}")
+      return ''
+
+    repo_digests = image.attrs.get('RepoDigests') or []
+    return repo_digests[0].split('@')[-1] if repo_digests else image.id
+
   def get_docker_client(self) -> docker.client:
     """Return an instance of the docker client for use by the controller.
 
@@ -93,8 +157,10 @@ class DockerImage():
     """
     return self._client
 
-  def run_image(self, image_name: str,
-                run_parameters: DockerRunParameters) -> Union[bytearray, None]:
+  def run_image(self,
+                image_name: str,
+                run_parameters: DockerRunParameters,
+                run_watchdog: Optional[watchdog.Watchdog] = None) -> Union[bytearray, None]:
     """Execute the identified docker image using the docker controller.
 
     This method runs the specified image using the arguments specified in
@@ -105,14 +171,17 @@ class DockerImage():
         image_name: The image that is to be executed
         run_parameters: argumments to pass to the invocation of the docker
           image.
+        run_watchdog: An optional watchdog following the output of the
+          container and stopping it when the run is aborted
 
     Returns:
         A bytearray containing the output produced from executing the specified
           container
     """
     output = ''
-    with DockerImageController(self) as docker_controller:
-      output = docker_controller.run(image_name, run_parameters)
+    with DockerImageController(self) as docker_controller, cost_accounting.ContainerMonitor(
+        lambda: resource_limits.get_process_cgroups(self.get_container_pids(image_name))):
+      output = docker_controller.run(image_name, run_parameters, run_watchdog)
 
     return output
 
@@ -121,6 +190,21 @@ class DockerImage():
     image_filter = {'status': 'running'}
     return [container.name for container in self._client.containers.list(filters=image_filter)]
 
+  def get_container_pids(self, image_name: str) -> Dict[str, int]:
+    """Return the init process of each running container of an image.
+
+    Args:
+      image_name: The image whose containers are listed
+
+    Returns:
+      the host process identifiers, by container name
+    """
+    image_filter = {'status': 'running', 'ancestor': image_name}
+    return {
+        container.name: container.attrs['State']['Pid']
+        for container in self._client.containers.list(filters=image_filter)
+    }
+
   def stop_image(self, image_name: str) -> None:
     """Stop a running container."""
     container = self._client.containers.get(image_name)
@@ -161,7 +245,10 @@ class DockerImageController():
       log.debug(f"Stopping image: {image_name}")
       self._image.stop_image(image_name)
 
-  def run(self, image_name: str, run_parameters: DockerRunParameters) -> Union[bytearray, None]:
+  def run(self,
+          image_name: str,
+          run_parameters: DockerRunParameters,
+          run_watchdog: Optional[watchdog.Watchdog] = None) -> Union[bytearray, None]:
     """Use the docker client to execute the specified container.
 
     Args:
@@ -169,12 +256,27 @@ class DockerImageController():
       run_parameters: argumments to pass to the invocation of the docker
         image. The list of supported options is quite long and they are
         documented here https://docker-py.readthedocs.io/en/stable/index.html
+      run_watchdog: An optional watchdog. Its container output is fed to the
+        watchdog as it is produced and the container is killed if the
+        watchdog aborts the run
 
     Returns:
       A bytearray containing the output produced from executing the specified
         container
+
+    Raises:
+      DockerRunError: if the container exits with a non-zero status
+      watchdog.WatchdogAbort: if the watchdog aborts the run
     """
     client = self._image.get_docker_client()
+    # Containers started by a placed thread, such as the builds of a
+    # pipeline, run on the CPUs of the thread unless pinned explicitly
+    if run_parameters.cpuset_cpus is None and cmd_exec.get_placement_cpus():
+      run_parameters = run_parameters._replace(cpuset_cpus=cmd_exec.get_placement_cpus())
+
+    if run_watchdog and run_watchdog.is_enabled():
+      return self._run_watched(client, image_name, run_parameters, run_watchdog)
+
     try:
       return client.containers.run(image_name,
                                    stdout=True,
@@ -186,4 +288,54 @@ class DockerImageController():
       log.error(
           f"Failed to run benchmarking test in image: {image_name}, error message: {e}, container logs: {error_logs}"
       )
-      exit()
+      raise DockerRunError(f"Failed to run benchmarking test in image: {image_name}: {e}",
+                           e.exit_status)
+
+  def _run_watched(self, client: docker.client, image_name: str,
+                   run_parameters: DockerRunParameters,
+                   run_watchdog: watchdog.Watchdog) -> bytearray:
+    """Execute a container, feeding its output to a watchdog as it is produced.
+
+    Args:
+      client: The docker client
+      image_name: The image that is to be executed
+      run_parameters: argumments to pass to the invocation of the docker
+        image
+      run_watchdog: The watchdog following the output of the container
+
+    Returns:
+      A bytearray containing the output produced from executing the container
+
+    Raises:
+      DockerRunError: if the container exits with a non-zero status
+      watchdog.WatchdogAbort: if the watchdog aborts the run
+    """
+    container = client.containers.run(image_name,
+                                      stdout=True,
+                                      stderr=True,
+                                      detach=True,
+                                      **run_parameters._asdict())
+    run_watchdog.add_abort_callback(container.kill)
+    output = bytearray()
+    try:
+      pending = b''
+      for chunk in container.logs(stdout=True, stderr=True, stream=True, follow=True):
+        output += chunk
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+          run_watchdog.feed(line.decode('utf-8', errors='replace'))
+      status = container.wait()
+    finally:
+      run_watchdog.remove_abort_callback(container.kill)
+      container.remove(force=True)
+
+    run_watchdog.check()
+    exit_status = status.get('StatusCode', 0)
+    if exit_status != 0:
+      log.error(f"Failed to run benchmarking test in image: {image_name}, "
+                f"container logs: {bytes(output)}")
+      raise DockerRunError(
+          f"Failed to run benchmarking test in image: {image_name}, exit status {exit_status}",
+          exit_status)
+    return output
@@ -0,0 +1,183 @@
+"""Assemble docker images from a minimal build context streamed through the Docker API.
+
+Rather than sending a whole source tree to the docker daemon, only the
+Dockerfile and the files its COPY and ADD instructions refer to are packed
+into the build context.
+"""
+import glob
+import json
+import logging
+import os
+import re
+import tarfile
+import tempfile
+from typing import (Dict, IO, List)
+
+import docker
+
+from src.lib import cmd_exec
+from src.lib.docker_management import docker_image
+
+log = logging.getLogger(__name__)
+
+# Matches ${VARIABLE} and $VARIABLE references in Dockerfile instructions
+_VARIABLE_PATTERN = re.compile(r'\$\{?(\w+)\}?')
+
+
+class ImageAssemblerError(Exception):
+  """Error raised when the build context cannot be assembled or the image build fails."""
+
+
+def _get_instruction_sources(arguments: str) -> List[str]:
+  """Return the sources of a COPY or ADD instruction.
+
+  Args:
+    arguments: The text following the instruction keyword
+
+  Returns:
+    the source paths, or an empty list if the sources come from another
+      build stage
+  """
+  arguments = arguments.strip()
+  if arguments.startswith('['):
+    tokens = json.loads(arguments)
+  else:
+    tokens = arguments.split()
+
+  if any(token.startswith('--from=') for token in tokens):
+    return []
+
+  paths = [token for token in tokens if not token.startswith('--')]
+  return paths[:-1]
+
+
+def get_context_paths(context_dir: str, dockerfile: str, build_args: Dict[str, str]) -> List[str]:
+  """Determine the files needed in the build context of a Dockerfile.
+
+  Build arguments, or the defaults declared by ARG instructions, are
+  substituted in the sources of each COPY and ADD instruction. Arguments
+  without a value match any text.
+
+  Args:
+    context_dir: The directory containing the files copied into the image
+    dockerfile: The path of the Dockerfile relative to the context directory
+    build_args: The build arguments supplied to the build
+
+  Returns:
+    the sorted paths, relative to the context directory, of the files and
+      directories to include
+
+  Raises:
+    ImageAssemblerError: if a source of the Dockerfile matches no file
+  """
+  with open(os.path.join(context_dir, dockerfile)) as dockerfile_file:
+    # Join continuation lines before splitting instructions
+    instructions = dockerfile_file.read().replace('\\\n', ' ').splitlines()
+
+  arg_values = {}
+
+  def substitute(match):
+    return arg_values.get(match.group(1), '*')
+
+  paths = set()
+  for instruction in instructions:
+    keyword, _, arguments = instruction.strip().partition(' ')
+    if keyword.upper() == 'ARG':
+      name, has_default, default = arguments.strip().partition('=')
+      if name in build_args:
+        arg_values[name] = build_args[name]
+      elif has_default:
+        arg_values[name] = default.strip('"\'')
+      continue
+
+    if keyword.upper() not in ['COPY', 'ADD']:
+      continue
+
+    for source in _get_instruction_sources(arguments):
+      pattern = os.path.normpath(_VARIABLE_PATTERN.sub(substitute, source))
+      matches = glob.glob(os.path.join(context_dir, pattern))
+      if not matches:
+        raise ImageAssemblerError(f"No files in {context_dir} match [{source}] from {dockerfile}")
+      paths.update(os.path.relpath(match, context_dir) for match in matches)
+
+  return sorted(paths)
+
+
+def create_context(context_dir: str, dockerfile: str, paths: List[str]) -> IO[bytes]:
+  """Pack the Dockerfile and the files it copies into a tar archive.
+
+  Symbolic links are followed so that staged binaries are included rather
+  than links into the Bazel output tree.
+
+  Args:
+    context_dir: The directory containing the files
+    dockerfile: The path of the Dockerfile relative to the context directory
+    paths: The paths relative to the context directory to include
+
+  Returns:
+    a temporary file, positioned at its start, holding the archive. The
+      caller closes the file
+  """
+  context = tempfile.TemporaryFile()
+  with tarfile.open(fileobj=context, mode='w', dereference=True) as archive:
+    for path in [dockerfile] + paths:
+      archive.add(os.path.join(context_dir, path), arcname=path)
+
+  context.seek(0)
+  return context
+
+
+class ImageAssembler(object):
+  """Build images from a minimal context using the Docker API."""
+
+  def __init__(self, image: docker_image.DockerImage) -> None:
+    """Initialize the assembler.
+
+    Args:
+      image: The docker image object whose client builds the images
+    """
+    self._image = image
+
+  def assemble(self, context_dir: str, dockerfile: str, tag: str, build_args: Dict[str,
+                                                                                   str]) -> None:
+    """Build an image from the files a Dockerfile copies out of a directory.
+
+    The daemon's layer cache is used, so only the layers whose inputs
+    changed are rebuilt.
+
+    Args:
+      context_dir: The directory containing the Dockerfile and its sources
+      dockerfile: The path of the Dockerfile relative to the context directory
+      tag: The name and tag of the built image
+      build_args: The build arguments supplied to the Dockerfile
+
+    Raises:
+      ImageAssemblerError: if the daemon reports a build error
+    """
+    paths = get_context_paths(context_dir, dockerfile, build_args)
+    log.debug(f"Building {tag} with context {paths}")
+
+    # The build containers of a placed thread, such as the builds of a
+    # pipeline, run on the CPUs of the thread
+    container_limits = {}
+    if cmd_exec.get_placement_cpus():
+      container_limits['cpusetcpus'] = cmd_exec.get_placement_cpus()
+
+    client = self._image.get_docker_client()
+    with create_context(context_dir, dockerfile, paths) as context:
+      try:
+        output = client.api.build(fileobj=context,
+                                  custom_context=True,
+                                  dockerfile=dockerfile,
+                                  tag=tag,
+                                  buildargs=build_args,
+                                  rm=True,
+                                  container_limits=container_limits,
+                                  decode=True)
+        for chunk in output:
+          if 'error' in chunk:
+            raise ImageAssemblerError(f"Unable to build {tag}: {chunk['error']}")
+          if 'stream' in chunk:
+            log.debug(chunk['stream'].rstrip())
+      except docker.errors.APIError as api_error:
+        raise ImageAssemblerError(f"Unable to build {tag}: {api_error}")
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""Run the containers started by the Nighthawk benchmarks in warm, pooled containers.
+
+This script is installed as "docker" ahead of the docker client on the PATH
+of the benchmark. The test harness starts the Nighthawk test server and
+Envoy for every test case with "docker run --rm". Instead of creating a
+container each time, the command is executed in a long running container
+of the same image, network, volumes and environment. The container is
+created on first use, health checked before each use, and recycled when
+it stopped or still runs processes from an earlier test. The command is
+executed as "docker run" would execute it, following the entrypoint of the
+image and defaulting to the command of the image. Images whose command
+cannot be determined are run in their own container.
+
+When the pool is given a cpuset list, its containers are pinned to those
+CPUs, so that shards of a benchmark executing in parallel do not share
+CPUs.
+
+The script also applies resource limits, such as a CPU quota, to the
+containers of one image, the Envoy under test. Limits are applied whether
+or not the containers are pooled.
+
+Volumes below the shared directory, which holds the per test
+configuration, are replaced with a mount of the shared directory so that
+test cases differing only in their configuration share a container.
+
+All other docker commands are passed to the docker client unchanged. The
+script runs inside the benchmark image and depends only on the standard
+library.
+"""
+import hashlib
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+from typing import (List, NamedTuple, Optional)
+
+POOL_LABEL = 'salvo.pool'
+KEY_LABEL = 'salvo.pool.key'
+
+# The environment variables configuring the pool
+POOL_ID_VARIABLE = 'SALVO_POOL_ID'
+SHARED_DIR_VARIABLE = 'SALVO_POOL_SHARED_DIR'
+EVENT_LOG_VARIABLE = 'SALVO_POOL_LOG'
+CPUS_VARIABLE = 'SALVO_POOL_CPUS'
+LIMITED_IMAGE_VARIABLE = 'SALVO_LIMITED_IMAGE'
+LIMITS_VARIABLE = 'SALVO_LIMITS'
+
+# Events recorded in the event log
+EVENT_STARTED = 'started'
+EVENT_REUSED = 'reused'
+EVENT_RECYCLED = 'recycled'
+
+# Encapsulates a "docker run" invocation that can be served from the pool
+RunRequest = NamedTuple('RunRequest', [
+    ('image', str),
+    ('command', List[str]),
+    ('volumes', List[str]),
+    ('environment', List[str]),
+    ('network', str),
+])
+
+_VALUE_OPTIONS = {
+    '-v': 'volumes',
+    '--volume': 'volumes',
+    '-e': 'environment',
+    '--env': 'environment',
+    '--network': 'network',
+    '--net': 'network',
+}
+
+
+def parse_run_arguments(args: List[str]) -> Optional[RunRequest]:
+  """Parse the arguments of a "docker run" invocation.
+
+  Args:
+    args: The arguments following "docker"
+
+  Returns:
+    the parsed invocation, or None if the invocation must start its own
+      container. This is the case for other commands, for containers that
+      are not removed on exit and for unsupported options
+  """
+  if not args or args[0] != 'run':
+    return None
+
+  options = {'volumes': [], 'environment': [], 'network': 'default'}
+  remove = False
+  index = 1
+  while index < len(args) and args[index].startswith('-'):
+    name, has_value, value = args[index].partition('=')
+    index += 1
+
+    if name == '--rm':
+      remove = True
+      continue
+
+    option = _VALUE_OPTIONS.get(name)
+    if not option:
+      return None
+
+    if not has_value:
+      if index >= len(args):
+        return None
+      value = args[index]
+      index += 1
+
+    if option == 'network':
+      options[option] = value
+    else:
+      options[option].append(value)
+
+  if not remove or index >= len(args):
+    return None
+
+  return RunRequest(image=args[index], command=args[index + 1:], **options)
+
+
+def normalize_volumes(volumes: List[str], shared_dir: str) -> List[str]:
+  """Replace the volumes below the shared directory with a mount of the shared directory.
+
+  Args:
+    volumes: The volumes in "source:destination[:mode]" format
+    shared_dir: The directory mounted at the same path in every container
+
+  Returns:
+    the sorted, de-duplicated volumes
+  """
+  normalized = set()
+  for volume in volumes:
+    source, _, destination = volume.partition(':')
+    destination = destination.split(':')[0]
+    if shared_dir and source == destination and \
+        (source == shared_dir or source.startswith(shared_dir.rstrip('/') + '/')):
+      volume = f"{shared_dir}:{shared_dir}"
+    normalized.add(volume)
+
+  return sorted(normalized)
+
+
+def get_pool_key(request: RunRequest,
+                 shared_dir: str,
+                 cpus: str = '',
+                 limits: Optional[List[str]] = None) -> str:
+  """Return the key identifying the containers able to serve a request.
+
+  Args:
+    request: The parsed "docker run" invocation
+    shared_dir: The directory mounted at the same path in every container
+    cpus: The cpuset list to which the containers are pinned, if any
+    limits: The resource limit options of the containers, if any
+
+  Returns:
+    a hexadecimal digest of the image, network, volumes, environment, CPUs
+      and limits
+  """
+  configuration = [
+      request.image, request.network,
+      normalize_volumes(request.volumes, shared_dir),
+      sorted(request.environment), cpus
+  ]
+  if limits:
+    configuration.append(limits)
+  return hashlib.sha256(json.dumps(configuration).encode('utf-8')).hexdigest()[:16]
+
+
+def apply_limits(args: List[str], image: str, limits: List[str]) -> List[str]:
+  """Add resource limit options to a "docker run" invocation of an image.
+
+  Args:
+    args: The arguments following "docker"
+    image: The image whose containers are limited
+    limits: The "docker run" options applying the limits
+
+  Returns:
+    the arguments with the limits following "run", or the unchanged
+      arguments for other commands and images
+  """
+  if not (image and limits and args and args[0] == 'run' and image in args[1:]):
+    return args
+  return ['run'] + limits + args[1:]
+
+
+def find_docker_client() -> str:
+  """Return the path of the docker client that this script shadows on the PATH."""
+  this_dir = os.path.dirname(os.path.realpath(__file__))
+  for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+    candidate = os.path.join(path_dir, 'docker')
+    if os.path.realpath(path_dir) != this_dir and os.access(candidate, os.X_OK):
+      return candidate
+
+  raise SystemExit("pooled_docker: no docker client found on the PATH")
+
+
+class PooledRunner(object):
+  """Serve "docker run" invocations from warm containers."""
+
+  def __init__(self,
+               docker_client: str,
+               pool_id: str,
+               shared_dir: str,
+               event_log: str,
+               cpus: str = '',
+               limited_image: str = '',
+               limits: Optional[List[str]] = None) -> None:
+    """Initialize the pool.
+
+    Args:
+      docker_client: The path to the docker client
+      pool_id: The identifier labelling the containers of this pool
+      shared_dir: The directory mounted at the same path in every container
+      event_log: The file to which pool events are appended
+      cpus: The cpuset list to which the containers are pinned. If empty
+        the containers may run on any CPU
+      limited_image: The image whose containers receive the limits
+      limits: The "docker run" options applying resource limits
+    """
+    self._docker = docker_client
+    self._pool_id = pool_id
+    self._shared_dir = shared_dir
+    self._event_log = event_log
+    self._cpus = cpus
+    self._limited_image = limited_image
+    self._limits = limits or []
+
+  def _get_limits(self, request: RunRequest) -> List[str]:
+    """Return the resource limit options of the containers serving a request."""
+    return self._limits if request.image == self._limited_image else []
+
+  def _run_docker(self, args: List[str]) -> subprocess.CompletedProcess:
+    """Run a docker command, capturing its output."""
+    return subprocess.run([self._docker] + args,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+  def _record(self, event: str, name: str) -> None:
+    """Append an event to the event log."""
+    if self._event_log:
+      with open(self._event_log, 'a') as log_file:
+        log_file.write(f"{event} {name}\n")
+
+  def is_healthy(self, name: str) -> bool:
+    """Determine whether a pooled container can serve a request.
+
+    A healthy container is running and runs only its idle process.
+
+    Args:
+      name: The container name
+
+    Returns:
+      True if the container is ready for the next command
+    """
+    state = self._run_docker(['inspect', '--format', '{{.State.Running}}', name])
+    if state.returncode != 0 or state.stdout.strip() != 'true':
+      return False
+
+    processes = self._run_docker(['top', name, '-o', 'pid'])
+    return processes.returncode == 0 and len(processes.stdout.split()) == 2
+
+  def _start(self, name: str, key: str, request: RunRequest) -> None:
+    """Start an idle container for a configuration.
+
+    Args:
+      name: The container name
+      key: The pool key of the configuration
+      request: The invocation providing the configuration
+    """
+    args = [
+        'run', '--detach', '--name', name, '--label', f"{POOL_LABEL}={self._pool_id}", '--label',
+        f"{KEY_LABEL}={key}", '--network', request.network, '--entrypoint', 'sleep'
+    ]
+    if self._cpus:
+      args += ['--cpuset-cpus', self._cpus]
+    # A cpuset in the limits follows, and takes precedence over, the CPUs
+    # of the pool
+    args += self._get_limits(request)
+    for volume in normalize_volumes(request.volumes, self._shared_dir):
+      args += ['--volume', volume]
+    for variable in request.environment:
+      args += ['--env', variable]
+
+    started = self._run_docker(args + [request.image, 'infinity'])
+    if started.returncode != 0:
+      raise SystemExit(f"pooled_docker: unable to start {request.image}: {started.stderr}")
+
+  def acquire(self, request: RunRequest) -> str:
+    """Return a healthy container for a request, starting or recycling it as needed.
+
+    Args:
+      request: The parsed "docker run" invocation
+
+    Returns:
+      the name of the container
+    """
+    key = get_pool_key(request, self._shared_dir, self._cpus, self._get_limits(request))
+    name = f"salvo_pool_{self._pool_id}_{key}"
+
+    if self.is_healthy(name):
+      self._record(EVENT_REUSED, name)
+      return name
+
+    if self._run_docker(['inspect', '--format', '{{.Id}}', name]).returncode == 0:
+      self._run_docker(['rm', '--force', name])
+      self._record(EVENT_RECYCLED, name)
+
+    self._start(name, key, request)
+    self._record(EVENT_STARTED, name)
+    return name
+
+  def get_command(self, request: RunRequest) -> Optional[List[str]]:
+    """Return the arguments that "docker run" executes for a request.
+
+    The pooled containers are started with their own entrypoint, so the
+    entrypoint of the image is prepended to the command of the request, or
+    to the command of the image if the request has none.
+
+    Args:
+      request: The parsed "docker run" invocation
+
+    Returns:
+      the executed arguments, or None if the image cannot be inspected or
+        defines no command to execute
+    """
+    inspected = self._run_docker(
+        ['image', 'inspect', '--format', '{{json .Config}}', request.image])
+    if inspected.returncode != 0:
+      return None
+
+    try:
+      config = json.loads(inspected.stdout) or {}
+    except ValueError:
+      return None
+
+    command = (config.get('Entrypoint') or []) + (request.command or config.get('Cmd') or [])
+    return command or None
+
+  def run(self, request: RunRequest, command: List[str]) -> int:
+    """Execute a command in a pooled container.
+
+    Termination signals received by this script are forwarded to the
+    command, as "docker run" does.
+
+    Args:
+      request: The parsed "docker run" invocation
+      command: The arguments to execute, as returned by get_command
+
+    Returns:
+      the exit status of the command
+    """
+    name = self.acquire(request)
+    pid_file = f"/tmp/salvo_pool_{os.getpid()}.pid"
+
+    process = subprocess.Popen(
+        [self._docker, 'exec', name, 'sh', '-c', 'echo $$ > "$0" && exec "$@"', pid_file] + command)
+
+    def forward_signal(signum, _):
+      self._run_docker(['exec', name, 'sh', '-c', f'kill -{signum} "$(cat {pid_file})"'])
+
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+      signal.signal(signum, forward_signal)
+
+    return process.wait()
+
+
+def main(args: List[str]) -> int:
+  """Serve a docker invocation from the pool or pass it to the docker client.
+
+  Args:
+    args: The arguments following "docker"
+
+  Returns:
+    the exit status of the invocation
+  """
+  docker_client = find_docker_client()
+  request = parse_run_arguments(args)
+  pool_id = os.environ.get(POOL_ID_VARIABLE, '')
+  limited_image = os.environ.get(LIMITED_IMAGE_VARIABLE, '')
+  limits = shlex.split(os.environ.get(LIMITS_VARIABLE, ''))
+  if not (request and pool_id):
+    os.execv(docker_client, [docker_client] + apply_limits(args, limited_image, limits))
+
+  pool = PooledRunner(docker_client, pool_id, os.environ.get(SHARED_DIR_VARIABLE, ''),
+                      os.environ.get(EVENT_LOG_VARIABLE, ''), os.environ.get(CPUS_VARIABLE, ''),
+                      limited_image, limits)
+  command = pool.get_command(request)
+  if not command:
+    os.execv(docker_client, [docker_client] + apply_limits(args, limited_image, limits))
+  return pool.run(request, command)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,76 @@
+"""Test the installation and cleanup of the warm container pool."""
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib.docker_management import (container_pool, pooled_docker)
+
+
+def test_pool_lifecycle():
+  """Verify that the pooled client is installed and the pooled containers are removed."""
+  mock_image = mock.Mock()
+  mock_container = mock.Mock()
+  mock_image.get_docker_client.return_value.containers.list.return_value = [mock_container]
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    pool = container_pool.ContainerPool(True, mock_image, output_dir)
+    with pool:
+      client_path = os.path.join(pool.get_bin_directory(), 'docker')
+      assert os.access(client_path, os.X_OK)
+
+      environment = pool.get_environment()
+      assert environment[pooled_docker.SHARED_DIR_VARIABLE] == output_dir
+      assert environment[pooled_docker.EVENT_LOG_VARIABLE] == pool.get_event_log()
+
+      with open(pool.get_event_log(), 'a') as event_log:
+        event_log.write("started salvo_pool_a\nreused salvo_pool_a\nreused salvo_pool_a\n")
+
+    assert pool.get_summary() == {'started': 1, 'reused': 2, 'recycled': 0}
+
+  pool_id = environment[pooled_docker.POOL_ID_VARIABLE]
+  mock_image.get_docker_client.return_value.containers.list.assert_called_once_with(
+      all=True, filters={'label': f"salvo.pool={pool_id}"})
+  mock_container.remove.assert_called_once_with(force=True)
+
+
+def test_wrap_command():
+  """Verify that the pooled client is placed ahead of the docker client on the PATH."""
+  pool = container_pool.ContainerPool(True, mock.Mock(), '/output')
+  assert pool.wrap_command(['./benchmarks', '-vvvv']) == [
+      'sh', '-c', 'PATH="/output/container_pool/bin:$PATH" exec "$@"', 'sh', './benchmarks', '-vvvv'
+  ]
+
+
+def test_disabled_pool():
+  """Verify that a disabled pool leaves the benchmark unchanged."""
+  mock_image = mock.Mock()
+  with tempfile.TemporaryDirectory() as output_dir:
+    pool = container_pool.ContainerPool(False, mock_image, output_dir)
+    with pool:
+      assert pool.get_environment() == {}
+      assert pool.wrap_command(['./benchmarks']) == ['./benchmarks']
+
+    assert not os.path.exists(os.path.join(output_dir, container_pool.POOL_DIRECTORY))
+  mock_image.get_docker_client.assert_not_called()
+
+
+def test_limits_without_pooling():
+  """Verify that the client is installed to apply resource limits when pooling is disabled."""
+  mock_image = mock.Mock()
+  with tempfile.TemporaryDirectory() as output_dir:
+    pool = container_pool.ContainerPool(False, mock_image, output_dir, 'envoyproxy/envoy:v1',
+                                        ['--cpuset-cpus', '2-3'])
+    with pool:
+      assert os.access(os.path.join(pool.get_bin_directory(), 'docker'), os.X_OK)
+      assert pool.get_environment() == {
+          pooled_docker.LIMITED_IMAGE_VARIABLE: 'envoyproxy/envoy:v1',
+          pooled_docker.LIMITS_VARIABLE: '--cpuset-cpus 2-3'
+      }
+      assert pool.wrap_command(['./benchmarks'])[-1] == './benchmarks'
+
+  mock_image.get_docker_client.assert_not_called()
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
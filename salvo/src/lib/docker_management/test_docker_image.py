@@ -4,6 +4,10 @@ import docker
 import requests
 from unittest import mock
 
+import api.watchdog_pb2 as proto_watchdog
+
+from src.lib import cmd_exec
+from src.lib.common import watchdog
 from src.lib.docker_management import docker_image
 
 
@@ -61,6 +65,55 @@ def test_pull_image_return_existing(mock_pull, mock_list_images):
   assert container is not None
 
 
+@mock.patch('docker.from_env')
+def test_share_client(mock_from_env, monkeypatch):
+  """Verify that the images share a single docker client once it is shared."""
+  monkeypatch.setattr(docker_image, '_shared_client', None)
+  mock_from_env.side_effect = lambda: mock.MagicMock()
+
+  assert docker_image.DockerImage().get_docker_client() is not \
+      docker_image.DockerImage().get_docker_client()
+
+  docker_image.share_client()
+  assert docker_image.DockerImage().get_docker_client() is \
+      docker_image.DockerImage().get_docker_client()
+
+
+@mock.patch.object(docker.models.images.ImageCollection, 'get_registry_data')
+def test_is_image_in_registry(mock_get_registry_data):
+  """Verify that we query the registry for an image without pulling it."""
+  mock_get_registry_data.return_value = mock.MagicMock()
+
+  new_docker_image = docker_image.DockerImage()
+  assert new_docker_image.is_image_in_registry("envoyproxy/envoy:v1.16.0")
+  mock_get_registry_data.assert_called_once_with("envoyproxy/envoy:v1.16.0")
+
+
+@mock.patch.object(docker.models.images.ImageCollection, 'get_registry_data')
+def test_is_image_in_registry_not_found(mock_get_registry_data):
+  """Verify that an image missing from the registry is reported as unavailable."""
+  mock_get_registry_data.side_effect = docker.errors.NotFound("manifest unknown")
+
+  new_docker_image = docker_image.DockerImage()
+  assert not new_docker_image.is_image_in_registry("envoyproxy/envoy-dev:deadbeef")
+
+
+@mock.patch.object(docker.models.images.ImageCollection, 'get')
+def test_get_image_digest(mock_get):
+  """Verify that the registry digest of an image is preferred over its id."""
+  mock_get.return_value = mock.Mock(id='sha256:1234',
+                                    attrs={'RepoDigests': ['envoyproxy/envoy@sha256:abcd']})
+
+  new_docker_image = docker_image.DockerImage()
+  assert new_docker_image.get_image_digest("envoyproxy/envoy:v1.16.0") == 'sha256:abcd'
+
+  mock_get.return_value = mock.Mock(id='sha256:1234', attrs={'RepoDigests': []})
+  assert new_docker_image.get_image_digest("envoyproxy/envoy-dev:local") == 'sha256:1234'
+
+  mock_get.side_effect = docker.errors.ImageNotFound("image_not_found")
+  assert new_docker_image.get_image_digest("envoyproxy/envoy-dev:missing") == ''
+
+
 @mock.patch.object(docker.models.images.ImageCollection, 'list')
 def test_list_images(mock_list_images):
   """Verify that we can list all existing cached docker images."""
@@ -110,6 +163,85 @@ def test_run_image(mock_docker_run, mock_docker_list, mock_docker_stop):
                                           **run_parameters._asdict())
 
 
+@mock.patch.object(docker_image.DockerImage, 'stop_image')
+@mock.patch.object(docker_image.DockerImage, 'list_processes')
+@mock.patch.object(docker.models.containers.ContainerCollection, 'run')
+def test_run_image_placed(mock_docker_run, mock_docker_list, mock_docker_stop):
+  """Verify that the containers of a placed thread run on its CPUs unless pinned explicitly."""
+  mock_docker_list.return_value = []
+  new_docker_image = docker_image.DockerImage()
+  run_parameters = docker_image.DockerRunParameters(environment={},
+                                                    command='bash',
+                                                    volumes={},
+                                                    network_mode='host',
+                                                    tty=False)
+
+  with cmd_exec.process_placement({4, 5, 6}):
+    new_docker_image.run_image('test_image', run_parameters)
+    assert mock_docker_run.call_args[1]['cpuset_cpus'] == '4-6'
+
+    new_docker_image.run_image('test_image', run_parameters._replace(cpuset_cpus='1'))
+    assert mock_docker_run.call_args[1]['cpuset_cpus'] == '1'
+
+  new_docker_image.run_image('test_image', run_parameters)
+  assert mock_docker_run.call_args[1]['cpuset_cpus'] is None
+
+
+@mock.patch.object(docker_image.DockerImage, 'stop_image')
+@mock.patch.object(docker_image.DockerImage, 'list_processes')
+@mock.patch.object(docker.models.containers.ContainerCollection, 'run')
+def test_run_image_container_error(mock_docker_run, mock_docker_list, mock_docker_stop):
+  """Verify that a failed container raises an error rather than exiting."""
+  container = mock.Mock()
+  container.logs.return_value = b"benchmark failed"
+  mock_docker_run.side_effect = docker.errors.ContainerError(container, 2, 'bash', 'test_image',
+                                                             b"error")
+  mock_docker_list.return_value = []
+
+  new_docker_image = docker_image.DockerImage()
+  run_parameters = docker_image.DockerRunParameters(
+      environment={},
+      command='bash',
+      volumes={},
+      network_mode='host',
+      tty=False,
+  )
+  with pytest.raises(docker_image.DockerRunError) as run_error:
+    new_docker_image.run_image('test_image', run_parameters)
+
+  assert run_error.value.exit_status == 2
+
+
+@mock.patch.object(docker_image.DockerImage, 'stop_image')
+@mock.patch.object(docker_image.DockerImage, 'list_processes')
+@mock.patch.object(docker.models.containers.ContainerCollection, 'run')
+def test_run_image_with_watchdog(mock_docker_run, mock_docker_list, mock_docker_stop):
+  """Verify that the container output is fed to the watchdog, which kills the container."""
+  container = mock.Mock()
+  container.logs.return_value = [
+      b"Counter       Value       Per second\nbenchmark.http_5", b"xx  500  50.00\n"
+  ]
+  container.wait.return_value = {'StatusCode': 137}
+  mock_docker_run.return_value = container
+  mock_docker_list.return_value = []
+
+  run_watchdog = watchdog.Watchdog(proto_watchdog.WatchdogOptions(enabled=True))
+  new_docker_image = docker_image.DockerImage()
+  run_parameters = docker_image.DockerRunParameters(
+      environment={},
+      command='bash',
+      volumes={},
+      network_mode='host',
+      tty=False,
+  )
+  with pytest.raises(watchdog.WatchdogAbort):
+    new_docker_image.run_image('test_image', run_parameters, run_watchdog)
+
+  container.kill.assert_called_once()
+  container.remove.assert_called_once_with(force=True)
+  assert mock_docker_run.call_args[1]['detach']
+
+
 def test_list_processes():
   """Verify that we can list running images."""
   expected_name_list = ["prefix/image_1", "prefix/image_2", "prefix/image_3"]
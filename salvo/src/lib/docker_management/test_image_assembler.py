@@ -0,0 +1,127 @@
+"""Test the assembly of docker images from a minimal build context."""
+import os
+import tarfile
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib import cmd_exec
+from src.lib.docker_management import image_assembler
+
+_DOCKERFILE = """FROM ubuntu:focal
+ARG TARGETPLATFORM
+ARG ENVOY_BINARY=envoy
+RUN mkdir -p /etc/envoy
+COPY --chown=0:0 ${TARGETPLATFORM}/build_release_stripped/${ENVOY_BINARY} \\
+    /usr/local/bin/envoy
+ADD ["build_release/su-exec", "/usr/local/bin/su-exec"]
+COPY --from=builder /etc/envoy.yaml /etc/envoy/envoy.yaml
+COPY configs/*.yaml /etc/envoy/
+"""
+
+
+def _create_source_tree(source_dir: str) -> None:
+  """Write a Dockerfile and the files it copies to a directory."""
+  for path in [
+      'ci/Dockerfile-envoy', 'build_release_stripped/envoy', 'build_release/su-exec',
+      'configs/envoy.yaml', 'configs/google.yaml', 'source/exe/main.cc'
+  ]:
+    os.makedirs(os.path.join(source_dir, os.path.dirname(path)), exist_ok=True)
+    with open(os.path.join(source_dir, path), 'w') as source_file:
+      source_file.write(_DOCKERFILE if path.endswith('Dockerfile-envoy') else path)
+
+
+def test_get_context_paths():
+  """Verify that only the sources copied by the Dockerfile are included in the context."""
+  with tempfile.TemporaryDirectory() as source_dir:
+    _create_source_tree(source_dir)
+    paths = image_assembler.get_context_paths(source_dir, 'ci/Dockerfile-envoy',
+                                              {'TARGETPLATFORM': '.'})
+
+  assert paths == [
+      'build_release/su-exec', 'build_release_stripped/envoy', 'configs/envoy.yaml',
+      'configs/google.yaml'
+  ]
+
+
+def test_get_context_paths_missing_source():
+  """Verify that an error is raised when a copied file does not exist."""
+  with tempfile.TemporaryDirectory() as source_dir:
+    _create_source_tree(source_dir)
+    os.remove(os.path.join(source_dir, 'build_release/su-exec'))
+
+    with pytest.raises(image_assembler.ImageAssemblerError) as assembler_error:
+      image_assembler.get_context_paths(source_dir, 'ci/Dockerfile-envoy', {'TARGETPLATFORM': '.'})
+
+  assert "build_release/su-exec" in str(assembler_error.value)
+
+
+def test_assemble():
+  """Verify that the minimal context is streamed to the docker daemon."""
+  mock_image = mock.Mock()
+  mock_api = mock_image.get_docker_client.return_value.api
+  archived_paths = []
+
+  def build_side_effect(fileobj, **kwargs):
+    with tarfile.open(fileobj=fileobj) as archive:
+      archived_paths.extend(archive.getnames())
+    return [{'stream': 'Step 1/6 : FROM ubuntu:focal\n'}]
+
+  mock_api.build.side_effect = build_side_effect
+
+  with tempfile.TemporaryDirectory() as source_dir:
+    _create_source_tree(source_dir)
+    assembler = image_assembler.ImageAssembler(mock_image)
+    assembler.assemble(source_dir, 'ci/Dockerfile-envoy', 'envoyproxy/envoy-dev:v1.16.0',
+                       {'TARGETPLATFORM': '.'})
+
+  assert sorted(archived_paths) == [
+      'build_release/su-exec', 'build_release_stripped/envoy', 'ci/Dockerfile-envoy',
+      'configs/envoy.yaml', 'configs/google.yaml'
+  ]
+  mock_api.build.assert_called_once_with(fileobj=mock.ANY,
+                                         custom_context=True,
+                                         dockerfile='ci/Dockerfile-envoy',
+                                         tag='envoyproxy/envoy-dev:v1.16.0',
+                                         buildargs={'TARGETPLATFORM': '.'},
+                                         rm=True,
+                                         container_limits={},
+                                         decode=True)
+
+
+def test_assemble_placed():
+  """Verify that the build containers of a placed thread run on its CPUs."""
+  mock_image = mock.Mock()
+  mock_api = mock_image.get_docker_client.return_value.api
+  mock_api.build.return_value = []
+
+  with tempfile.TemporaryDirectory() as source_dir:
+    _create_source_tree(source_dir)
+    assembler = image_assembler.ImageAssembler(mock_image)
+    with cmd_exec.process_placement({2, 3}):
+      assembler.assemble(source_dir, 'ci/Dockerfile-envoy', 'envoyproxy/envoy-dev:v1.16.0',
+                         {'TARGETPLATFORM': '.'})
+
+  assert mock_api.build.call_args[1]['container_limits'] == {'cpusetcpus': '2-3'}
+
+
+def test_assemble_build_error():
+  """Verify that an error reported by the docker daemon is raised."""
+  mock_image = mock.Mock()
+  mock_image.get_docker_client.return_value.api.build.return_value = [{
+      'stream': 'Step 1/6 : FROM ubuntu:focal\n'
+  }, {
+      'error': 'COPY failed'
+  }]
+
+  with tempfile.TemporaryDirectory() as source_dir:
+    _create_source_tree(source_dir)
+    assembler = image_assembler.ImageAssembler(mock_image)
+    with pytest.raises(image_assembler.ImageAssemblerError) as assembler_error:
+      assembler.assemble(source_dir, 'ci/Dockerfile-envoy', 'envoy:test', {'TARGETPLATFORM': '.'})
+
+  assert str(assembler_error.value) == "Unable to build envoy:test: COPY failed"
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
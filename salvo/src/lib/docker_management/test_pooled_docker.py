@@ -0,0 +1,171 @@
+"""Test the docker client shim serving containers from the pool."""
+import os
+import subprocess
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib.docker_management import pooled_docker
+
+_SERVER_ARGS = [
+    'run', '--network=host', '--rm', '-v', '/output/test_1/tmp:/output/test_1/tmp', '-e',
+    'ENVOY_UID=0', 'envoyproxy/envoy:v1.16.0', 'envoy', '--config-path',
+    '/output/test_1/tmp/envoy.yaml'
+]
+
+
+def test_parse_run_arguments():
+  """Verify that the image, options and command of a docker run invocation are parsed."""
+  request = pooled_docker.parse_run_arguments(_SERVER_ARGS)
+
+  assert request == pooled_docker.RunRequest(
+      image='envoyproxy/envoy:v1.16.0',
+      command=['envoy', '--config-path', '/output/test_1/tmp/envoy.yaml'],
+      volumes=['/output/test_1/tmp:/output/test_1/tmp'],
+      environment=['ENVOY_UID=0'],
+      network='host')
+
+
+@pytest.mark.parametrize('args', [
+    ['ps'],
+    ['run', '--network=host', 'envoyproxy/envoy:v1.16.0'],
+    ['run', '--rm', '--privileged', 'envoyproxy/envoy:v1.16.0'],
+    ['run', '--rm', '-v'],
+])
+def test_parse_run_arguments_unsupported(args):
+  """Verify that invocations the pool cannot serve are passed to the docker client."""
+  assert pooled_docker.parse_run_arguments(args) is None
+
+
+def test_pool_key_ignores_per_test_directories():
+  """Verify that test cases differing only in their configuration share a pool key."""
+  first = pooled_docker.parse_run_arguments(_SERVER_ARGS)
+  second = pooled_docker.parse_run_arguments(
+      [arg.replace('test_1', 'test_2') for arg in _SERVER_ARGS])
+
+  assert pooled_docker.normalize_volumes(first.volumes, '/output') == ['/output:/output']
+  assert pooled_docker.get_pool_key(first, '/output') == \
+      pooled_docker.get_pool_key(second, '/output')
+  assert pooled_docker.get_pool_key(first, '') != pooled_docker.get_pool_key(second, '')
+
+
+def _completed(returncode, stdout=''):
+  """Return the result of a docker command."""
+  return subprocess.CompletedProcess([], returncode, stdout=stdout, stderr='')
+
+
+@mock.patch('subprocess.run')
+def test_acquire(mock_run):
+  """Verify that containers are reused while healthy and recycled otherwise."""
+  request = pooled_docker.parse_run_arguments(_SERVER_ARGS)
+  key = pooled_docker.get_pool_key(request, '/output')
+  name = f"salvo_pool_pool1_{key}"
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    event_log = os.path.join(tmp_dir, 'events.log')
+    runner = pooled_docker.PooledRunner('/usr/bin/docker', 'pool1', '/output', event_log)
+
+    # A healthy container runs only its idle process
+    mock_run.side_effect = [_completed(0, 'true\n'), _completed(0, 'PID\n1234\n')]
+    assert runner.acquire(request) == name
+
+    # A container still running a process from an earlier test is recycled
+    mock_run.side_effect = [
+        _completed(0, 'true\n'),
+        _completed(0, 'PID\n1234\n1300\n'),
+        _completed(0, 'abcdef\n'),
+        _completed(0),
+        _completed(0, 'abcdef\n'),
+    ]
+    assert runner.acquire(request) == name
+    start_args = mock_run.call_args_list[-1][0][0]
+    assert start_args[:4] == ['/usr/bin/docker', 'run', '--detach', '--name']
+    assert start_args[-2:] == ['envoyproxy/envoy:v1.16.0', 'infinity']
+    assert start_args[start_args.index('--volume') + 1] == '/output:/output'
+    mock_run.assert_any_call(['/usr/bin/docker', 'rm', '--force', name],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True)
+
+    # A missing container is started
+    mock_run.side_effect = [_completed(1), _completed(1), _completed(0, 'abcdef\n')]
+    assert runner.acquire(request) == name
+
+    with open(event_log) as log_file:
+      assert [line.split()[0] for line in log_file] == ['reused', 'recycled', 'started', 'started']
+
+
+@mock.patch('subprocess.run')
+def test_acquire_pinned_container(mock_run):
+  """Verify that the containers of a pool given a cpuset list are pinned to it."""
+  request = pooled_docker.parse_run_arguments(_SERVER_ARGS)
+  runner = pooled_docker.PooledRunner('/usr/bin/docker', 'pool1', '/output', '', '2-3')
+
+  mock_run.side_effect = [_completed(1), _completed(1), _completed(0, 'abcdef\n')]
+  name = runner.acquire(request)
+
+  assert name == f"salvo_pool_pool1_{pooled_docker.get_pool_key(request, '/output', '2-3')}"
+  assert name != f"salvo_pool_pool1_{pooled_docker.get_pool_key(request, '/output')}"
+  start_args = mock_run.call_args_list[-1][0][0]
+  assert start_args[start_args.index('--cpuset-cpus') + 1] == '2-3'
+
+
+@mock.patch('subprocess.run')
+def test_get_command(mock_run):
+  """Verify that commands follow the entrypoint of the image and default to its command."""
+  request = pooled_docker.parse_run_arguments(_SERVER_ARGS)
+  runner = pooled_docker.PooledRunner('/usr/bin/docker', 'pool1', '/output', '')
+  config = '{"Entrypoint":["/docker-entrypoint.sh"],"Cmd":["envoy","-c","/etc/envoy.yaml"]}'
+
+  mock_run.side_effect = [_completed(0, config)]
+  assert runner.get_command(request) == [
+      '/docker-entrypoint.sh', 'envoy', '--config-path', '/output/test_1/tmp/envoy.yaml'
+  ]
+  mock_run.assert_called_once_with(
+      ['/usr/bin/docker', 'image', 'inspect', '--format', '{{json .Config}}', request.image],
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      universal_newlines=True)
+
+  mock_run.side_effect = [_completed(0, config)]
+  assert runner.get_command(request._replace(command=[])) == \
+      ['/docker-entrypoint.sh', 'envoy', '-c', '/etc/envoy.yaml']
+
+  # Images without a command, or that cannot be inspected, run in their own container
+  mock_run.side_effect = [_completed(0, '{"Entrypoint":null,"Cmd":null}')]
+  assert runner.get_command(request._replace(command=[])) is None
+  mock_run.side_effect = [_completed(1)]
+  assert runner.get_command(request) is None
+
+
+def test_apply_limits():
+  """Verify that resource limits are added only to runs of the limited image."""
+  limits = ['--cpu-quota', '150000', '--cpu-period', '100000']
+  args = ['run', '--rm', '--network=host', 'envoyproxy/envoy:v1', 'envoy', '-c', 'config.yaml']
+
+  assert pooled_docker.apply_limits(args, 'envoyproxy/envoy:v1', limits) == \
+      ['run'] + limits + args[1:]
+  assert pooled_docker.apply_limits(args, 'nighthawk:latest', limits) == args
+  assert pooled_docker.apply_limits(['ps'], 'envoyproxy/envoy:v1', limits) == ['ps']
+  assert pooled_docker.apply_limits(args, 'envoyproxy/envoy:v1', []) == args
+
+
+@mock.patch('subprocess.run')
+def test_acquire_limited_container(mock_run):
+  """Verify that pooled containers of the limited image receive the resource limits."""
+  request = pooled_docker.parse_run_arguments(_SERVER_ARGS)
+  limits = ['--memory', '536870912']
+  runner = pooled_docker.PooledRunner('/usr/bin/docker', 'pool1', '/output', '', '', request.image,
+                                      limits)
+
+  mock_run.side_effect = [_completed(1), _completed(1), _completed(0, 'abcdef\n')]
+  name = runner.acquire(request)
+
+  assert name == \
+      f"salvo_pool_pool1_{pooled_docker.get_pool_key(request, '/output', '', limits)}"
+  start_args = mock_run.call_args_list[-1][0][0]
+  assert start_args[start_args.index('--memory') + 1] == '536870912'
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
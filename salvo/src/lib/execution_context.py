@@ -0,0 +1,93 @@
+"""The environment in which a job, builder or benchmark runs its commands.
+
+An execution context carries the environment variables, the HOME directory,
+the working directory and the CPUs of the commands started on behalf of a
+job. Contexts are immutable, their environment being a read-only copy, and
+derived from the environment of Salvo when it starts, so jobs, builders and benchmarks running concurrently in one
+process each pass their own context to cmd_exec and to the containers they
+run, instead of changing the environment of the process.
+"""
+import contextlib
+import os
+import types
+from typing import (Dict, FrozenSet, Iterable, Iterator, Mapping, NamedTuple)
+
+from src.lib import cmd_exec
+
+
+class ExecutionContext(NamedTuple):
+  """The environment, directories and CPUs of the commands of a job."""
+
+  # The complete environment of the commands, read-only in the contexts
+  # returned by from_process and derived from them
+  env: Mapping[str, str]
+  # The default working directory of the commands
+  cwd: str = ''
+  # The CPUs on which the commands run, or all CPUs if empty
+  cpus: FrozenSet[int] = frozenset()
+
+  def get_home(self) -> str:
+    """Return the HOME directory of the commands."""
+    return self.env.get('HOME', '')
+
+  def with_home(self, home: str) -> 'ExecutionContext':
+    """Return a copy of the context with another HOME directory."""
+    return self.with_variables({'HOME': home})
+
+  def with_variables(self, variables: Dict[str, str]) -> 'ExecutionContext':
+    """Return a copy of the context with variables added to or replaced in its environment."""
+    return self._replace(env=_freeze(dict(self.env, **variables)))
+
+  def without_variables(self, names: Iterable[str]) -> 'ExecutionContext':
+    """Return a copy of the context with variables removed from its environment."""
+    names = set(names)
+    return self._replace(env=_freeze({
+        key: value for key, value in self.env.items() if key not in names
+    }))
+
+  def with_cwd(self, cwd: str) -> 'ExecutionContext':
+    """Return a copy of the context with another working directory."""
+    return self._replace(cwd=cwd)
+
+  def with_cpus(self, cpus: Iterable[int]) -> 'ExecutionContext':
+    """Return a copy of the context whose commands run on the given CPUs."""
+    return self._replace(cpus=frozenset(cpus))
+
+  def get_command_parameters(self, cwd: str = '') -> cmd_exec.CommandParameters:
+    """Return the parameters of a command run in the context.
+
+    Args:
+      cwd: The working directory of the command. The default is the working
+        directory of the context
+
+    Returns:
+      the parameters passed to cmd_exec
+    """
+    return cmd_exec.CommandParameters(cwd=cwd or self.cwd, env=dict(self.env))
+
+  @contextlib.contextmanager
+  def placement(self) -> Iterator[None]:
+    """Place the commands started by the current thread on the CPUs of the context."""
+    if not self.cpus:
+      yield
+      return
+    with cmd_exec.process_placement(set(self.cpus)):
+      yield
+
+
+def _freeze(env: Dict[str, str]) -> Mapping[str, str]:
+  """Return a read-only view of an environment that no one else references."""
+  return types.MappingProxyType(env)
+
+
+def from_process(cwd: str = '') -> ExecutionContext:
+  """Return a context with a copy of the environment of Salvo.
+
+  Args:
+    cwd: The default working directory of the commands. The default is the
+      working directory of Salvo
+
+  Returns:
+    the context, independent from later changes to the environment of Salvo
+  """
+  return ExecutionContext(env=_freeze(dict(os.environ)), cwd=cwd or os.getcwd())
@@ -0,0 +1,344 @@
+"""Module to determine the steps of a job without executing them.
+
+The plan mirrors the decisions taken by the BenchmarkRunner. Commit hashes
+are resolved with the SourceManager and the local docker images and
+registries are queried, but nothing is pulled, built or benchmarked. Each
+step is annotated with an estimate taken from the phase timings recorded in
+the traces of previous jobs.
+"""
+import datetime
+import logging
+import os
+import statistics
+from typing import (Dict, List, NamedTuple, Optional, Set)
+
+import docker
+
+from src.lib import source_manager
+from src.lib.common import trace
+from src.lib.docker_management import (docker_image, docker_image_builder)
+
+import api.control_pb2 as proto_control
+import api.source_pb2 as proto_source
+
+log = logging.getLogger(__name__)
+
+# The phase names below match the spans recorded during a job
+_PHASE_PULL_IMAGE = 'DockerImage.pull_image'
+_PHASE_PULL_SOURCE = 'SourceTree.pull'
+_PHASE_COPY_SOURCE = 'SourceTree.copy_source_directory'
+_PHASE_BUILD_ENVOY = 'EnvoyBuilder.build_envoy'
+_PHASE_ENVOY_IMAGE = 'EnvoyBuilder.create_docker_image'
+_PHASE_BUILD_NIGHTHAWK_BINARIES = 'NightHawkBuilder.build_nighthawk_binaries'
+_PHASE_BUILD_NIGHTHAWK_BENCHMARKS = 'NightHawkBuilder.build_nighthawk_benchmarks'
+_PHASE_NIGHTHAWK_IMAGE = 'NightHawkBuilder.create_docker_image'
+_PHASE_SCAVENGING_BENCHMARK = 'ScavengingBenchmark.execute_benchmark'
+_PHASE_DOCKERIZED_BENCHMARK = 'FullyDockerizedBenchmark.execute_benchmark'
+_PHASE_BINARY_BENCHMARK = 'BinaryBenchmark.execute_benchmark'
+
+
+class ExecutionPlanError(Exception):
+  """Raised when the plan of a job cannot be determined."""
+
+
+class PlanStep(NamedTuple):
+  """A unit of work performed by the job."""
+
+  identifier: int
+  phase: str  # The name of the span recorded when the step executes, if any
+  description: str
+  depends_on: List[int]
+  from_source: bool  # Whether the step builds an Envoy artifact from source
+
+
+class ExecutionPlan(object):
+  """The directed acyclic graph of the steps performed by a job."""
+
+  def __init__(self, benchmark_name: str) -> None:
+    """Initialize an empty plan.
+
+    Args:
+      benchmark_name: The name of the benchmark executed by the job
+    """
+    self._benchmark_name = benchmark_name
+    self._steps = []
+
+  def add_step(self,
+               phase: str,
+               description: str,
+               depends_on: List[int],
+               from_source: bool = False) -> int:
+    """Add a step to the plan.
+
+    Args:
+      phase: The name of the span recorded when the step executes
+      description: A description of the step shown to the user
+      depends_on: The identifiers of the steps that must complete first
+      from_source: Whether the step builds an Envoy artifact from source
+
+    Returns:
+      the identifier of the new step
+    """
+    identifier = len(self._steps) + 1
+    self._steps.append(
+        PlanStep(identifier=identifier,
+                 phase=phase,
+                 description=description,
+                 depends_on=sorted(set(depends_on)),
+                 from_source=from_source))
+    return identifier
+
+  def get_steps(self) -> List[PlanStep]:
+    """Return the steps of the plan in execution order."""
+    return list(self._steps)
+
+  def get_benchmark_name(self) -> str:
+    """Return the name of the benchmark executed by the job."""
+    return self._benchmark_name
+
+
+def estimate_phase_durations(history: Dict[str, List[float]]) -> Dict[str, float]:
+  """Estimate the duration of each phase as the median of its previous durations.
+
+  Args:
+    history: The durations recorded for each phase in previous jobs
+
+  Returns:
+    a dictionary mapping each phase name to its estimated duration in
+      seconds
+  """
+  return {phase: statistics.median(durations) for phase, durations in history.items() if durations}
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+  """Format a duration as hours, minutes and seconds."""
+  if seconds is None:
+    return "unknown"
+  return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def format_plan(plan: ExecutionPlan, estimates: Dict[str, float]) -> str:
+  """Format the plan and its estimated duration.
+
+  Steps execute sequentially, so the estimated duration of the job is the
+  sum of the estimates of its steps. Steps without a phase, such as using
+  a local image, take no time.
+
+  Args:
+    plan: The plan to format
+    estimates: The estimated duration of each phase
+
+  Returns:
+    the formatted plan
+  """
+  steps = plan.get_steps()
+  width = max([len(step.description) for step in steps] + [len('Step')])
+  lines = [
+      f"Execution plan for the {plan.get_benchmark_name()}", "",
+      f"{'#':>3}  {'Step':<{width}}  {'Estimate':>9}  After"
+  ]
+
+  total = 0.0
+  unknown = 0
+  for step in steps:
+    estimate = estimates.get(step.phase) if step.phase else 0.0
+    if estimate is None:
+      unknown += 1
+    else:
+      total += estimate
+
+    after = ', '.join([str(dependency) for dependency in step.depends_on]) or '-'
+    lines.append(f"{step.identifier:>3}  {step.description:<{width}}  "
+                 f"{_format_duration(estimate):>9}  {after}")
+
+  lines.append("")
+  lines.append(f"Estimated duration: {_format_duration(total)}")
+  if unknown:
+    lines.append(f"{unknown} step(s) have no recorded timings and are not included in the estimate")
+
+  source_builds = len([step for step in steps if step.from_source])
+  if source_builds:
+    lines.append(f"WARNING: {source_builds} step(s) build Envoy from source")
+
+  return '\n'.join(lines)
+
+
+class ExecutionPlanner(object):
+  """Determine the steps a BenchmarkRunner performs for a job control document."""
+
+  def __init__(self, control: proto_control.JobControl) -> None:
+    """Initialize the planner.
+
+    Args:
+      control: The Job Control object dictating the parameters governing the
+        benchmark
+    """
+    self._control = control
+    self._source_manager = source_manager.SourceManager(control)
+    self._docker_image = None
+    self._local_images = None
+
+  def _get_docker_image(self) -> Optional[docker_image.DockerImage]:
+    """Connect to docker, returning None if the daemon is not reachable."""
+    if self._local_images is None:
+      self._local_images = set()
+      try:
+        self._docker_image = docker_image.DockerImage()
+        self._local_images.update(self._docker_image.list_images())
+      except docker.errors.DockerException as docker_error:
+        log.warning(f"Unable to query docker images: {docker_error}")
+        self._docker_image = None
+
+    return self._docker_image
+
+  def _is_image_local(self, image_name: str) -> bool:
+    """Return whether an image is present on the local host."""
+    self._get_docker_image()
+    return image_name in self._local_images
+
+  def _is_image_pullable(self, image_name: str) -> bool:
+    """Return whether an image can be pulled from its registry."""
+    manager = self._get_docker_image()
+    return manager is not None and manager.is_image_in_registry(image_name)
+
+  def _add_source_steps(self, plan: ExecutionPlan,
+                        source_id: proto_source.SourceRepository.SourceIdentity) -> List[int]:
+    """Add the step retrieving the source of a repository before it is built."""
+    source_repo = self._source_manager.get_source_repository(source_id)
+    source_name = proto_source.SourceRepository.SourceIdentity.Name(source_id)
+    if source_repo.source_path:
+      return [
+          plan.add_step(_PHASE_COPY_SOURCE, f"copy {source_name} from {source_repo.source_path}",
+                        [])
+      ]
+
+    return [
+        plan.add_step(_PHASE_PULL_SOURCE, f"clone {source_name} from {source_repo.source_url}", [])
+    ]
+
+  def _add_image_steps(self, plan: ExecutionPlan, image_name: str, build_phases: List[str],
+                       always_build: bool, from_source: bool) -> List[int]:
+    """Add the steps that pull an image, and build it if the pull fails.
+
+    Args:
+      plan: The plan receiving the steps
+      image_name: The name of the docker image
+      build_phases: The phases performed, in order, to build the image
+      always_build: Whether the image is rebuilt even if it is available
+      from_source: Whether the build compiles Envoy
+
+    Returns:
+      the identifiers of the steps the consumers of the image depend on
+    """
+    if self._is_image_local(image_name) and not always_build:
+      return [plan.add_step('', f"use local image {image_name}", [])]
+
+    if self._is_image_pullable(image_name) and not always_build:
+      return [plan.add_step(_PHASE_PULL_IMAGE, f"pull {image_name}", [])]
+
+    source_id = proto_source.SourceRepository.SRCID_ENVOY if from_source else \
+        proto_source.SourceRepository.SRCID_NIGHTHAWK
+    dependencies = self._add_source_steps(plan, source_id)
+    for phase in build_phases:
+      dependencies = [
+          plan.add_step(phase, f"{phase.split('.')[-1]} for {image_name}", dependencies,
+                        from_source and phase == _PHASE_BUILD_ENVOY)
+      ]
+
+    return dependencies
+
+  def _plan_image_benchmark(self, plan: ExecutionPlan, benchmark_phase: str) -> None:
+    """Add the steps of a benchmark using docker images."""
+    images = self._control.images
+    if not (images.nighthawk_benchmark_image and images.nighthawk_binary_image):
+      raise ExecutionPlanError("No NightHawk images specified")
+
+    nighthawk_images = [
+        (images.nighthawk_benchmark_image, _PHASE_BUILD_NIGHTHAWK_BENCHMARKS),
+        (images.nighthawk_binary_image, _PHASE_BUILD_NIGHTHAWK_BINARIES),
+    ]
+
+    nighthawk_steps = []
+    for image_name, build_phase in nighthawk_images:
+      nighthawk_steps.extend(
+          self._add_image_steps(plan,
+                                image_name, [build_phase, _PHASE_NIGHTHAWK_IMAGE],
+                                always_build=False,
+                                from_source=False))
+
+    have_build_options = self._source_manager.have_build_options(
+        proto_source.SourceRepository.SourceIdentity.SRCID_ENVOY)
+
+    previous_benchmark = []
+    for image_hash in sorted(self._get_envoy_hashes()):
+      image_name = docker_image_builder.generate_envoy_image_name_from_tag(image_hash)
+      envoy_steps = self._add_image_steps(plan,
+                                          image_name, [_PHASE_BUILD_ENVOY, _PHASE_ENVOY_IMAGE],
+                                          always_build=have_build_options,
+                                          from_source=True)
+      previous_benchmark = [
+          plan.add_step(benchmark_phase, f"benchmark {image_name}",
+                        envoy_steps + nighthawk_steps + previous_benchmark)
+      ]
+
+  def _plan_binary_benchmark(self, plan: ExecutionPlan) -> None:
+    """Add the steps of a binary benchmark.
+
+    Each benchmark builds Nighthawk, and Envoy unless ENVOY_PATH specifies
+    a binary, before executing the Nighthawk benchmarks.
+    """
+    envoy_binary = self._control.environment.variables.get('ENVOY_PATH', '')
+
+    previous_benchmark = []
+    for envoy_hash in sorted(self._get_envoy_hashes()):
+      dependencies = self._add_source_steps(plan, proto_source.SourceRepository.SRCID_NIGHTHAWK)
+      for phase in [_PHASE_BUILD_NIGHTHAWK_BINARIES, _PHASE_BUILD_NIGHTHAWK_BENCHMARKS]:
+        dependencies = [
+            plan.add_step(phase, f"{phase.split('.')[-1]} for Envoy {envoy_hash}", dependencies)
+        ]
+
+      if not envoy_binary:
+        envoy_steps = self._add_source_steps(plan, proto_source.SourceRepository.SRCID_ENVOY)
+        dependencies.append(
+            plan.add_step(_PHASE_BUILD_ENVOY, f"build_envoy {envoy_hash}", envoy_steps, True))
+
+      previous_benchmark = [
+          plan.add_step(_PHASE_BINARY_BENCHMARK, f"benchmark Envoy {envoy_hash}",
+                        dependencies + previous_benchmark)
+      ]
+
+  def _get_envoy_hashes(self) -> Set[str]:
+    """Resolve the commit hashes or tags of the Envoy versions to benchmark."""
+    try:
+      return self._source_manager.get_envoy_hashes_for_benchmark()
+    except source_manager.SourceManagerError as source_error:
+      raise ExecutionPlanError(f"Unable to resolve the Envoy versions: {source_error}")
+
+  def create_plan(self) -> ExecutionPlan:
+    """Determine the steps performed by the job.
+
+    Returns:
+      the plan of the job
+
+    Raises:
+      ExecutionPlanError: if the job control does not define a benchmark or
+        the Envoy versions cannot be resolved
+    """
+    if self._control.scavenging_benchmark:
+      plan = ExecutionPlan("Scavenging Benchmark")
+      self._plan_image_benchmark(plan, _PHASE_SCAVENGING_BENCHMARK)
+    elif self._control.dockerized_benchmark:
+      plan = ExecutionPlan("Fully Dockerized Benchmark")
+      self._plan_image_benchmark(plan, _PHASE_DOCKERIZED_BENCHMARK)
+    elif self._control.binary_benchmark:
+      plan = ExecutionPlan("Binary Benchmark")
+      self._plan_binary_benchmark(plan)
+    else:
+      raise ExecutionPlanError("No benchmark is defined in the job control")
+
+    return plan
+
+  def get_estimates(self) -> Dict[str, float]:
+    """Estimate the phase durations from the traces in the job's output directory."""
+    trace_dir = os.path.join(self._control.environment.output_dir, trace.TRACE_DIRECTORY)
+    return estimate_phase_durations(trace.load_phase_durations(trace_dir))
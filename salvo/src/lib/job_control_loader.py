@@ -2,6 +2,7 @@
 import json
 import logging
 import yaml
+from typing import Optional
 
 from google.protobuf import json_format
 import api.control_pb2 as proto_control
@@ -100,3 +101,25 @@ def load_control_doc(filename: str) -> proto_control.JobControl:
         log.info(f"Parsing {filename} as YAML failed.")
 
   return contents
+
+
+def parse_control_doc(document: str) -> Optional[proto_control.JobControl]:
+  """Return a JobControl object from the contents of a JSON or YAML document.
+
+  Args:
+      document: The contents of a job control document, such as the body of
+        a request to the Salvo server. JSON is parsed as YAML
+
+  Returns:
+      A JobControl object populated with the contents of the document, or
+        None if the document cannot be parsed
+  """
+  try:
+    contents = yaml.safe_load(document)
+    if not isinstance(contents, dict):
+      log.error("The job control document is not a mapping")
+      return None
+    return json_format.Parse(json.dumps(contents), proto_control.JobControl())
+  except (yaml.YAMLError, json_format.Error) as parse_error:
+    log.error(f"Unable to parse the job control document: {parse_error}")
+  return None
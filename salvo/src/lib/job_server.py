@@ -0,0 +1,417 @@
+"""Accept job control documents over HTTP and run them from a priority queue.
+
+A Salvo server runs the jobs submitted to it one at a time, highest
+priority first and in the order of submission for equal priorities, so that
+the benchmarks of a job are not disturbed by those of another. The caches
+kept by the process, such as the source trees and the build cache, are
+warm for every job after the first.
+
+The server answers the following requests:
+
+  POST   /jobs?priority=N    submit a JSON or YAML job control document
+  GET    /jobs               list the jobs and their states
+  GET    /jobs/<id>          return the state and results of a job
+  GET    /jobs/<id>/events   stream the progress of a job as JSON lines until
+                             the job is finished
+  DELETE /jobs/<id>          cancel a queued job
+"""
+import heapq
+import http.server
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from typing import (Callable, Dict, List, Optional, Tuple)
+
+from src.lib import job_control_loader
+from src.lib.common import cost_accounting
+
+import api.control_pb2 as proto_control
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 8086
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_SUCCEEDED = 'succeeded'
+STATE_FAILED = 'failed'
+STATE_CANCELLED = 'cancelled'
+
+_FINISHED_STATES = frozenset([STATE_SUCCEEDED, STATE_FAILED, STATE_CANCELLED])
+
+# The longest time a client streaming the events of a job waits for news
+# before the server checks whether the client is still connected
+_EVENT_WAIT_SECONDS = 1.0
+
+
+class JobServerError(Exception):
+  """Raised when a job cannot be found or changed as requested."""
+
+
+class Job(object):
+  """A job control document submitted to the server, and its progress."""
+
+  def __init__(self, job_id: str, control: proto_control.JobControl, priority: int) -> None:
+    """Queue a job.
+
+    Args:
+      job_id: The identifier of the job in the requests to the server
+      control: The job control document
+      priority: The priority of the job. Jobs with a higher priority run
+        first
+    """
+    self.job_id = job_id
+    self.control = control
+    self.priority = priority
+    self.state = STATE_QUEUED
+    self.submitted = time.time()
+    self.started = 0.0
+    self.finished = 0.0
+    self.exit_status = None
+    self.error = ''
+    self.events = []
+
+  def is_finished(self) -> bool:
+    """Return whether the job succeeded, failed or was cancelled."""
+    return self.state in _FINISHED_STATES
+
+  def to_dict(self) -> Dict:
+    """Return the state and results of the job, without its events."""
+    output_dir = self.control.environment.output_dir
+    manifest_path = os.path.join(output_dir, cost_accounting.MANIFEST_FILE)
+    return {
+        'id': self.job_id,
+        'priority': self.priority,
+        'state': self.state,
+        'submitted': self.submitted,
+        'started': self.started,
+        'finished': self.finished,
+        'exit_status': self.exit_status,
+        'error': self.error,
+        'output_dir': output_dir,
+        'manifest': manifest_path if os.path.exists(manifest_path) else '',
+    }
+
+
+class JobQueue(object):
+  """Run the queued jobs one at a time, highest priority first."""
+
+  def __init__(self, runner: Callable[[proto_control.JobControl], int]) -> None:
+    """Create an empty queue.
+
+    Args:
+      runner: The function running a job control document, returning 0 if
+        the job succeeded
+    """
+    self._runner = runner
+    self._condition = threading.Condition()
+    self._jobs = {}
+    # Entries of (-priority, sequence, job), so that equal priorities run in
+    # the order of submission
+    self._queue = []
+    self._sequence = itertools.count(1)
+    self._running = None
+    self._stopped = False
+    self._worker = None
+    self._log_handler = _JobLogHandler(self)
+
+  def submit(self, control: proto_control.JobControl, priority: int = 0) -> Job:
+    """Queue a job control document.
+
+    Args:
+      control: The job control document
+      priority: The priority of the job. Jobs with a higher priority run
+        first
+
+    Returns:
+      the queued job
+    """
+    with self._condition:
+      sequence = next(self._sequence)
+      job = Job(str(sequence), control, priority)
+      self._jobs[job.job_id] = job
+      heapq.heappush(self._queue, (-priority, sequence, job))
+      self._add_event(job, {'type': 'state', 'state': STATE_QUEUED})
+      self._condition.notify_all()
+    log.info(f"Queued job {job.job_id} with priority {priority}")
+    return job
+
+  def get_job(self, job_id: str) -> Job:
+    """Return a job from its identifier.
+
+    Raises:
+      JobServerError: if no job has this identifier
+    """
+    with self._condition:
+      if job_id not in self._jobs:
+        raise JobServerError(f"No job [{job_id}]")
+      return self._jobs[job_id]
+
+  def list_jobs(self) -> List[Job]:
+    """Return the jobs, in the order of submission."""
+    with self._condition:
+      return sorted(self._jobs.values(), key=lambda job: int(job.job_id))
+
+  def cancel(self, job_id: str) -> Job:
+    """Cancel a queued job.
+
+    Raises:
+      JobServerError: if the job does not exist or is no longer queued
+    """
+    job = self.get_job(job_id)
+    with self._condition:
+      if job.state != STATE_QUEUED:
+        raise JobServerError(f"Job [{job_id}] is {job.state} and cannot be cancelled")
+      self._queue = [entry for entry in self._queue if entry[2] is not job]
+      heapq.heapify(self._queue)
+      job.finished = time.time()
+      self._set_state(job, STATE_CANCELLED)
+    log.info(f"Cancelled job {job_id}")
+    return job
+
+  def get_events(self, job_id: str, first: int, timeout: float) -> Tuple[List[Dict], bool]:
+    """Return the events of a job from a position, waiting for one if there is none yet.
+
+    Args:
+      job_id: The identifier of the job
+      first: The position of the first event returned
+      timeout: The longest time waited for an event
+
+    Returns:
+      the events, and whether the job is finished so that no event follows
+    """
+    job = self.get_job(job_id)
+    with self._condition:
+      self._condition.wait_for(lambda: len(job.events) > first or job.is_finished(), timeout)
+      events = job.events[first:]
+      return events, job.is_finished() and first + len(events) == len(job.events)
+
+  def run_next(self, timeout: Optional[float] = None) -> Optional[Job]:
+    """Run the queued job with the highest priority.
+
+    Args:
+      timeout: The longest time waited for a job to be queued. The default
+        is to wait until a job is queued or the queue is stopped
+
+    Returns:
+      the job, or None if no job was queued in time
+    """
+    with self._condition:
+      if not self._condition.wait_for(lambda: self._queue or self._stopped, timeout):
+        return None
+      if self._stopped:
+        return None
+      _, _, job = heapq.heappop(self._queue)
+      self._running = job
+      job.started = time.time()
+      self._set_state(job, STATE_RUNNING)
+
+    log.info(f"Running job {job.job_id}")
+    try:
+      exit_status = self._runner(job.control)
+    except Exception as job_error:
+      log.exception(f"Job {job.job_id} failed: {job_error}")
+      job.error = str(job_error)
+      exit_status = 1
+
+    with self._condition:
+      self._running = None
+      job.exit_status = exit_status
+      job.finished = time.time()
+      self._set_state(job, STATE_SUCCEEDED if exit_status == 0 else STATE_FAILED)
+    log.info(f"Job {job.job_id} finished with status {exit_status} in "
+             f"{job.finished - job.started:.1f}s")
+    return job
+
+  def start(self) -> None:
+    """Run the queued jobs in a background thread until the queue is stopped.
+
+    The log records of the running job are added to its events.
+    """
+    logging.getLogger().addHandler(self._log_handler)
+    self._worker = threading.Thread(target=self._run, name='salvo-jobs', daemon=True)
+    self._worker.start()
+
+  def stop(self) -> None:
+    """Stop running jobs once the running job, if any, is finished."""
+    with self._condition:
+      self._stopped = True
+      self._condition.notify_all()
+    if self._worker:
+      self._worker.join()
+      self._worker = None
+    logging.getLogger().removeHandler(self._log_handler)
+
+  def record_log(self, record: logging.LogRecord, message: str) -> None:
+    """Add a log record to the events of the running job, if any."""
+    with self._condition:
+      if self._running is not None:
+        self._add_event(self._running, {
+            'type': 'log',
+            'level': record.levelname,
+            'message': message
+        })
+
+  def _run(self) -> None:
+    """Run the queued jobs until the queue is stopped."""
+    while not self._stopped:
+      self.run_next()
+
+  def _set_state(self, job: Job, state: str) -> None:
+    """Change the state of a job and add the change to its events. The lock must be held."""
+    job.state = state
+    event = {'type': 'state', 'state': state}
+    if job.is_finished():
+      event['result'] = job.to_dict()
+    self._add_event(job, event)
+
+  def _add_event(self, job: Job, event: Dict) -> None:
+    """Add an event to a job and wake up the clients streaming them. The lock must be held."""
+    job.events.append(dict(event, time=time.time()))
+    self._condition.notify_all()
+
+
+class _JobLogHandler(logging.Handler):
+  """Forward the log records emitted while a job runs to its events."""
+
+  def __init__(self, queue: JobQueue) -> None:
+    super(_JobLogHandler, self).__init__(logging.INFO)
+    self._queue = queue
+
+  def emit(self, record: logging.LogRecord) -> None:
+    """Add the record to the running job, unless it was emitted by the server itself."""
+    if record.name == __name__:
+      return
+    self._queue.record_log(record, record.getMessage())
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+  """Answer the requests to the server, described in the module documentation."""
+
+  server_version = 'Salvo'
+
+  def log_message(self, message_format: str, *args) -> None:
+    """Log the requests with the logger of the module instead of the standard error."""
+    log.debug(f"{self.address_string()} {message_format % args}")
+
+  def _get_route(self) -> Tuple[List[str], Dict[str, List[str]]]:
+    """Return the components of the requested path and the parameters of its query."""
+    url = urllib.parse.urlparse(self.path)
+    return [part for part in url.path.split('/') if part], urllib.parse.parse_qs(url.query)
+
+  def _send_json(self, status: int, contents: Dict) -> None:
+    body = json.dumps(contents, indent=2).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _send_error(self, status: int, message: str) -> None:
+    self._send_json(status, {'error': message})
+
+  def do_GET(self) -> None:
+    """List the jobs, return a job or stream its events."""
+    parts, _ = self._get_route()
+    queue = self.server.job_queue
+    try:
+      if parts == ['jobs']:
+        self._send_json(200, {'jobs': [job.to_dict() for job in queue.list_jobs()]})
+      elif len(parts) == 2 and parts[0] == 'jobs':
+        self._send_json(200, queue.get_job(parts[1]).to_dict())
+      elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+        queue.get_job(parts[1])
+        self._stream_events(parts[1])
+      else:
+        self._send_error(404, f"Unknown path [{self.path}]")
+    except JobServerError as server_error:
+      self._send_error(404, str(server_error))
+
+  def do_POST(self) -> None:
+    """Queue the job control document in the body of the request."""
+    parts, query = self._get_route()
+    if parts != ['jobs']:
+      self._send_error(404, f"Unknown path [{self.path}]")
+      return
+
+    try:
+      priority = int(query.get('priority', ['0'])[0])
+    except ValueError:
+      self._send_error(400, "The priority must be an integer")
+      return
+
+    length = int(self.headers.get('Content-Length', 0))
+    document = self.rfile.read(length).decode('utf-8')
+    control = job_control_loader.parse_control_doc(document)
+    if control is None:
+      self._send_error(400, "Unable to parse the job control document")
+      return
+
+    job = self.server.job_queue.submit(control, priority)
+    self._send_json(201, job.to_dict())
+
+  def do_DELETE(self) -> None:
+    """Cancel a queued job."""
+    parts, _ = self._get_route()
+    if len(parts) != 2 or parts[0] != 'jobs':
+      self._send_error(404, f"Unknown path [{self.path}]")
+      return
+
+    queue = self.server.job_queue
+    try:
+      queue.get_job(parts[1])
+    except JobServerError as server_error:
+      self._send_error(404, str(server_error))
+      return
+    try:
+      self._send_json(200, queue.cancel(parts[1]).to_dict())
+    except JobServerError as server_error:
+      self._send_error(409, str(server_error))
+
+  def _stream_events(self, job_id: str) -> None:
+    """Write the events of a job as JSON lines as they happen, until the job is finished."""
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/x-ndjson')
+    self.end_headers()
+
+    position = 0
+    finished = False
+    try:
+      while not finished:
+        events, finished = self.server.job_queue.get_events(job_id, position, _EVENT_WAIT_SECONDS)
+        for event in events:
+          self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+        self.wfile.flush()
+        position += len(events)
+    except (BrokenPipeError, ConnectionResetError):
+      log.debug(f"The client streaming the events of job {job_id} disconnected")
+
+
+class JobServer(http.server.ThreadingHTTPServer):
+  """An HTTP server queuing the submitted jobs."""
+
+  daemon_threads = True
+
+  def __init__(self,
+               job_queue: JobQueue,
+               address: str = DEFAULT_ADDRESS,
+               port: int = DEFAULT_PORT) -> None:
+    """Listen on an address for the requests to a job queue.
+
+    Args:
+      job_queue: The queue receiving the submitted jobs
+      address: The address on which the server listens. The default only
+        accepts local clients
+      port: The port on which the server listens, or 0 for any free port
+    """
+    super(JobServer, self).__init__((address, port), _RequestHandler)
+    self.job_queue = job_queue
+
+  def get_port(self) -> int:
+    """Return the port on which the server listens."""
+    return self.server_address[1]
@@ -0,0 +1,224 @@
+"""Overlap the builds of a job with the execution of its benchmarks.
+
+The artifacts for each benchmark are built in a background thread while the
+previous benchmark executes. Benchmarks run on the CPUs reserved for them.
+Commands started by the builds, and the daemons they spawn, are pinned to
+the remaining CPUs and placed in a cgroup that is frozen whenever the noise
+monitor detects that the host is under pressure.
+"""
+import logging
+import os
+import threading
+import time
+from typing import (Callable, List, NamedTuple, Optional)
+
+import api.scheduling_pb2 as proto_scheduling
+
+from src.lib import cmd_exec
+from src.lib.common import (cgroup, noise_monitor)
+
+log = logging.getLogger(__name__)
+
+BUILD_CGROUP_NAME = 'salvo_build'
+
+# The time allowed for killed build processes to exit
+_BUILD_EXIT_TIMEOUT = 10.0
+
+
+class PipelineError(Exception):
+  """Error raised when the pipeline cannot fence the builds from the benchmarks."""
+
+
+# Encapsulates the steps preparing and executing one benchmark
+PipelineStage = NamedTuple(
+    'PipelineStage',
+    [
+        ('prepare', Callable[[], None]),  # Pull or build the artifacts of the benchmark
+        ('execute', Callable[[], None]),  # Execute the benchmark
+        ('output_dir', str),  # The directory receiving the noise report
+    ])
+
+
+class BenchmarkPipeline(object):
+  """Execute each benchmark as soon as its artifacts are built."""
+
+  def __init__(self, options: proto_scheduling.PipelineOptions) -> None:
+    """Determine the CPUs used by the builds and by the benchmarks.
+
+    Args:
+      options: The pipeline options from the job control document
+
+    Raises:
+      PipelineError: if the benchmark CPUs are unavailable or leave no CPU
+        for the builds
+    """
+    self._options = options
+    self._benchmark_cpus = set()
+    self._build_cpus = set()
+    self._build_cgroup = None
+
+    try:
+      self._benchmark_cpus = cgroup.parse_cpu_list(options.benchmark_cpus)
+    except cgroup.CgroupError as cpu_list_error:
+      raise PipelineError(str(cpu_list_error))
+
+    if not self._benchmark_cpus:
+      log.warning("No benchmark CPUs are specified. Builds may compete with the benchmarks for CPU")
+      return
+
+    available_cpus = os.sched_getaffinity(0)
+    unavailable_cpus = self._benchmark_cpus - available_cpus
+    if unavailable_cpus:
+      raise PipelineError(f"Benchmark CPUs [{cgroup.format_cpu_list(unavailable_cpus)}] "
+                          f"are not available to Salvo")
+
+    self._build_cpus = available_cpus - self._benchmark_cpus
+    if not self._build_cpus:
+      raise PipelineError(f"No CPUs remain for the builds once CPUs "
+                          f"[{options.benchmark_cpus}] are reserved for the benchmarks")
+
+  def get_benchmark_cpus(self) -> str:
+    """Return the cpuset list reserved for the benchmarks."""
+    return cgroup.format_cpu_list(self._benchmark_cpus)
+
+  def get_build_cpus(self) -> str:
+    """Return the cpuset list to which the builds are pinned."""
+    return cgroup.format_cpu_list(self._build_cpus)
+
+  def _create_build_cgroup(self) -> None:
+    """Create the cgroup holding the build commands so that they can be paused."""
+    try:
+      self._build_cgroup = cgroup.Cgroup.create(f"{BUILD_CGROUP_NAME}_{os.getpid()}")
+    except cgroup.CgroupError as cgroup_error:
+      log.warning(f"Builds cannot be paused when the host is under pressure: {cgroup_error}")
+
+  def _kill_builds(self) -> None:
+    """Kill the build processes so that a running build fails promptly."""
+    if not self._build_cgroup:
+      return
+
+    try:
+      self._build_cgroup.thaw()
+      self._build_cgroup.kill()
+    except cgroup.CgroupError as cgroup_error:
+      log.error(f"Unable to stop the build processes: {cgroup_error}")
+
+  def _remove_build_cgroup(self) -> None:
+    """Remove the build cgroup once its remaining processes are killed.
+
+    Bazel servers started by the builds outlive them and are killed here.
+    """
+    if not self._build_cgroup:
+      return
+
+    if self._build_cgroup.get_processes():
+      self._kill_builds()
+
+    deadline = time.monotonic() + _BUILD_EXIT_TIMEOUT
+    while self._build_cgroup.get_processes() and time.monotonic() < deadline:
+      time.sleep(0.1)
+
+    try:
+      self._build_cgroup.remove()
+    except cgroup.CgroupError as cgroup_error:
+      log.warning(str(cgroup_error))
+
+  def _build(self, setup: Optional[Callable[[], None]], stages: List[PipelineStage],
+             ready: List[threading.Event], errors: List[Optional[Exception]],
+             stop: threading.Event) -> None:
+    """Prepare each stage in order, signalling when its artifacts are available.
+
+    Once a stage fails, the remaining stages are marked as failed with the
+    same error.
+
+    Args:
+      setup: The preparation shared by all stages, if any
+      stages: The stages to prepare
+      ready: The events signalled when each stage is prepared
+      errors: Receives the error preventing each stage from executing
+      stop: Signalled when the remaining stages should not be prepared
+    """
+    if self._build_cpus:
+      # Only the affinity of this thread changes
+      os.sched_setaffinity(0, self._build_cpus)
+
+    cgroup_procs = self._build_cgroup.get_procs_path() if self._build_cgroup else ''
+    preparations = [setup or (lambda: None)] + [stage.prepare for stage in stages]
+
+    with cmd_exec.process_placement(self._build_cpus, cgroup_procs):
+      for index, prepare in enumerate(preparations):
+        try:
+          if stop.is_set():
+            raise PipelineError("The pipeline was stopped")
+          prepare()
+        except Exception as build_error:
+          for stage_index in range(max(index - 1, 0), len(stages)):
+            errors[stage_index] = build_error
+            ready[stage_index].set()
+          return
+
+        if index > 0:
+          ready[index - 1].set()
+
+  def _execute_stage(self, stage: PipelineStage) -> None:
+    """Execute a benchmark while monitoring the pressure on the host.
+
+    Args:
+      stage: The prepared stage
+    """
+    pause = self._build_cgroup.freeze if self._build_cgroup else None
+    resume = self._build_cgroup.thaw if self._build_cgroup else None
+    monitor = noise_monitor.NoiseMonitor(self._options.pressure_threshold,
+                                         self._options.monitor_interval_ms, pause, resume)
+    with monitor:
+      stage.execute()
+
+    report_path = monitor.write_report(stage.output_dir)
+    log.info(f"Noise report written to {report_path}")
+
+  def execute(self,
+              stages: List[PipelineStage],
+              setup: Optional[Callable[[], None]] = None) -> None:
+    """Prepare and execute the stages, overlapping each preparation with the previous benchmark.
+
+    Args:
+      stages: The benchmarks to execute, in order
+      setup: The preparation shared by all stages, such as pulling the
+        Nighthawk images. It runs before the first stage is prepared
+
+    Raises:
+      Exception: the error preventing a stage from being prepared or
+        executed. No further stages are executed
+    """
+    if self._benchmark_cpus:
+      log.info(f"Running benchmarks on CPUs [{self.get_benchmark_cpus()}] and "
+               f"builds on CPUs [{self.get_build_cpus()}]")
+
+    self._create_build_cgroup()
+
+    ready = [threading.Event() for _ in stages]
+    errors = [None] * len(stages)
+    stop = threading.Event()
+    builder = threading.Thread(target=self._build,
+                               args=(setup, stages, ready, errors, stop),
+                               name='salvo_build')
+
+    previous_cpus = os.sched_getaffinity(0)
+    builder.start()
+    try:
+      if self._benchmark_cpus:
+        os.sched_setaffinity(0, self._benchmark_cpus)
+
+      for index, stage in enumerate(stages):
+        ready[index].wait()
+        if errors[index]:
+          raise errors[index]
+        self._execute_stage(stage)
+    except BaseException:
+      stop.set()
+      self._kill_builds()
+      raise
+    finally:
+      builder.join()
+      os.sched_setaffinity(0, previous_cpus)
+      self._remove_build_cgroup()
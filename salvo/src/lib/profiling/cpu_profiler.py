@@ -0,0 +1,222 @@
+"""Module to capture CPU profiles from the Envoy under test.
+
+Two profilers are supported. With perf, we sample all CPUs on the host for
+the duration of the benchmark and keep the stacks that contain frames from
+the Envoy binary. This works for Envoy binaries and Envoy containers alike.
+With gperftools, CPUPROFILE is set for an Envoy binary linked with the
+gperftools profiler. The Nighthawk processes started by the benchmark
+harness are built with the same options, so rather than exporting the
+variable to the whole benchmark, we point the harness to a wrapper script
+that sets it for Envoy only. The wrapper includes the process id in the
+profile path so that each Envoy process writes its own profile, which is
+converted with pprof.
+
+Both profilers produce a single file with folded stacks per benchmark run.
+"""
+import glob
+import logging
+import os
+import signal
+import subprocess
+from typing import Dict
+
+from src.lib import cmd_exec
+from src.lib.profiling import flame_graph
+
+import api.profiling_pb2 as proto_profiling
+
+log = logging.getLogger(__name__)
+
+# The directory, relative to a benchmark's output directory, where profiles
+# are written
+PROFILE_DIRECTORY = 'profiles'
+
+# The name of the file containing the folded CPU stacks of a benchmark run
+CPU_PROFILE_FOLDED = 'envoy.cpu.folded'
+
+_DEFAULT_PERF_FREQUENCY = 99
+
+# The perf samples are kept only if a frame belongs to a dso with this prefix
+_ENVOY_DSO_PREFIX = 'envoy'
+
+_PERF_DATA = 'perf.data'
+_PERF_LOG = 'perf.log'
+_GPERFTOOLS_PROFILE_PREFIX = 'envoy.cpu.prof'
+_ENVOY_WRAPPER = 'envoy_cpu_profile.sh'
+
+# The amount of time we wait for perf to flush its data after we stop it
+_PERF_STOP_TIMEOUT_SECONDS = 120
+
+
+class CpuProfilerError(Exception):
+  """Raised when a CPU profile is not able to be captured or processed."""
+
+
+class CpuProfiler(object):
+  """Capture a CPU profile from Envoy while a benchmark is running.
+
+  The profiler is used as a context manager around the benchmark execution.
+  Once the benchmark completes, collect() converts the recorded samples
+  into folded stacks.
+  """
+
+  def __init__(self, options: proto_profiling.ProfilingOptions, output_dir: str) -> None:
+    """Initialize the profiler.
+
+    Args:
+      options: The profiling options from the job control document
+      output_dir: The output directory of the benchmark run. Profiles are
+        written to a subdirectory of this location
+    """
+    self._options = options
+    self._profile_dir = os.path.join(output_dir, PROFILE_DIRECTORY)
+    self._perf_process = None
+    self._perf_log = None
+
+  def is_enabled(self) -> bool:
+    """Return whether a CPU profile is to be captured."""
+    return self._options.cpu_profiler != proto_profiling.ProfilingOptions.CPU_PROFILER_UNSPECIFIED
+
+  def uses_gperftools(self) -> bool:
+    """Return whether the profile is captured by gperftools inside the Envoy process."""
+    return self._options.cpu_profiler == proto_profiling.ProfilingOptions.CPU_PROFILER_GPERFTOOLS
+
+  def get_profile_directory(self) -> str:
+    """Return the directory where the profiles of this run are written."""
+    return self._profile_dir
+
+  def get_folded_profile_path(self) -> str:
+    """Return the path of the folded stacks generated for this run."""
+    return os.path.join(self._profile_dir, CPU_PROFILE_FOLDED)
+
+  def create_envoy_wrapper(self, envoy_binary: str) -> str:
+    """Write a script that starts Envoy with the gperftools CPU profiler enabled.
+
+    Args:
+      envoy_binary: The path to the Envoy binary under test
+
+    Returns:
+      the path to the script, to be used in place of the Envoy binary
+    """
+    self._create_profile_directory()
+
+    prefix = os.path.join(self._profile_dir, _GPERFTOOLS_PROFILE_PREFIX)
+    wrapper_path = os.path.join(self._profile_dir, _ENVOY_WRAPPER)
+
+    with open(wrapper_path, 'w') as wrapper:
+      wrapper.write("#!/bin/sh\n"
+                    f"CPUPROFILE=\"{prefix}.$$\" exec \"{envoy_binary}\" \"$@\"\n")
+    os.chmod(wrapper_path, 0o755)
+
+    log.debug(f"Envoy CPU profile wrapper written to {wrapper_path}")
+    return wrapper_path
+
+  def _create_profile_directory(self) -> None:
+    """Create the directory receiving the profiles."""
+    if not os.path.isdir(self._profile_dir):
+      os.makedirs(self._profile_dir, 0o755)
+
+  def _start_perf(self) -> None:
+    """Start recording the stacks on all CPUs."""
+    self._create_profile_directory()
+
+    frequency = self._options.perf_frequency or _DEFAULT_PERF_FREQUENCY
+    cmd = "perf record -F {frequency} -a -g -o {data}".format(frequency=frequency, data=_PERF_DATA)
+
+    self._perf_log = open(os.path.join(self._profile_dir, _PERF_LOG), 'w')
+    cmd_params = cmd_exec.CommandParameters(cwd=self._profile_dir)
+    try:
+      self._perf_process = cmd_exec.start_command(cmd, cmd_params, self._perf_log)
+    except OSError as os_error:
+      self._perf_log.close()
+      raise CpuProfilerError(f"Unable to start perf: {os_error}")
+
+  def _stop_perf(self) -> None:
+    """Stop perf, allowing it to write the recorded samples."""
+    if not self._perf_process:
+      return
+
+    self._perf_process.send_signal(signal.SIGINT)
+    try:
+      self._perf_process.wait(timeout=_PERF_STOP_TIMEOUT_SECONDS)
+    except subprocess.TimeoutExpired:
+      log.error("perf did not exit after being stopped. Killing it")
+      self._perf_process.kill()
+      self._perf_process.wait()
+
+    self._perf_process = None
+    self._perf_log.close()
+
+  def __enter__(self):
+    """Start the profiler if it samples the host."""
+    if self.is_enabled() and not self.uses_gperftools():
+      self._start_perf()
+    return self
+
+  def __exit__(self, type_param, value, traceback) -> None:
+    """Stop the profiler if it samples the host."""
+    self._stop_perf()
+
+  def _collect_perf(self) -> Dict[str, int]:
+    """Convert the perf recording into folded stacks."""
+    cmd = "perf script -i {data}".format(data=_PERF_DATA)
+    cmd_params = cmd_exec.CommandParameters(cwd=self._profile_dir)
+    script_output = cmd_exec.run_command(cmd, cmd_params)
+
+    return flame_graph.fold_perf_script(script_output, _ENVOY_DSO_PREFIX)
+
+  def _collect_gperftools(self, envoy_binary: str) -> Dict[str, int]:
+    """Convert the profiles written by each Envoy process into folded stacks.
+
+    Args:
+      envoy_binary: The Envoy binary that wrote the profiles. pprof uses it
+        to symbolize the profile.
+
+    Raises:
+      CpuProfilerError: if the binary is not specified
+    """
+    if not envoy_binary:
+      raise CpuProfilerError("The Envoy binary is required to symbolize gperftools profiles")
+
+    profiles = sorted(glob.glob(os.path.join(self._profile_dir, _GPERFTOOLS_PROFILE_PREFIX + '*')))
+    log.debug(f"Found gperftools CPU profiles: {profiles}")
+
+    cmd_params = cmd_exec.CommandParameters(cwd=self._profile_dir)
+    stacks = []
+    for profile in profiles:
+      cmd = "pprof --collapsed {binary} {profile}".format(binary=envoy_binary, profile=profile)
+      stacks.append(flame_graph.parse_folded(cmd_exec.run_command(cmd, cmd_params)))
+
+    return flame_graph.merge_folded(*stacks)
+
+  def collect(self, envoy_binary: str = '') -> str:
+    """Write the folded stacks captured during the benchmark.
+
+    Args:
+      envoy_binary: The path to the Envoy binary under test. This is
+        required when profiling with gperftools.
+
+    Returns:
+      the path to the file containing the folded stacks, or an empty string
+        if profiling is disabled
+
+    Raises:
+      CpuProfilerError: if no Envoy samples were captured
+      subprocess.CalledProcessError: if the profile conversion fails
+    """
+    if not self.is_enabled():
+      return ''
+
+    if self.uses_gperftools():
+      stacks = self._collect_gperftools(envoy_binary)
+    else:
+      stacks = self._collect_perf()
+
+    if not stacks:
+      raise CpuProfilerError(f"No Envoy samples were captured in {self._profile_dir}")
+
+    folded_path = self.get_folded_profile_path()
+    flame_graph.write_folded(folded_path, stacks)
+    log.info(f"CPU profile written to {folded_path}")
+
+    return folded_path
@@ -0,0 +1,348 @@
+"""Module to fold sampled stacks and generate differential flame graphs.
+
+Stacks are kept in the "folded" format consumed by the FlameGraph tools:
+one line per unique stack with the frames separated by semicolons, ordered
+from the root to the leaf, followed by the number of samples seen for
+the stack.
+
+https://github.com/brendangregg/FlameGraph
+"""
+import html
+import logging
+import os
+import re
+from typing import (Dict, List, NamedTuple, Tuple)
+
+log = logging.getLogger(__name__)
+
+# _PERF_FRAME_REGEX matches the frame lines emitted by "perf script". For
+# example from:
+#     55d0c0a1b2c3 Envoy::Network::ConnectionImpl::onRead+0x23 (/usr/local/bin/envoy)
+# we extract the symbol and the dso in enumerated groups
+_PERF_FRAME_REGEX = r'^\s+[0-9a-fA-F]+\s+(.+?)\s+\((.*)\)$'
+
+# _SYMBOL_OFFSET_REGEX matches the offset perf appends to a symbol name
+_SYMBOL_OFFSET_REGEX = r'\+0x[0-9a-fA-F]+$'
+
+# The folded stacks for a diff map a stack to its (baseline, candidate) counts
+DiffStacks = Dict[str, Tuple[float, float]]
+
+# Dimensions used when rendering a flame graph
+_SVG_WIDTH = 1200
+_FRAME_HEIGHT = 16
+_FONT_SIZE = 11
+_FONT_WIDTH = 0.59
+_MIN_FRAME_WIDTH = 0.1
+_TITLE_HEIGHT = 40
+
+
+class FunctionDelta(NamedTuple):
+  """Sample shares of a function in the baseline and candidate profiles."""
+
+  function: str
+  baseline_self: float
+  candidate_self: float
+  baseline_total: float
+  candidate_total: float
+
+
+class FlameGraphError(Exception):
+  """Raised when stacks are not able to be folded or compared."""
+
+
+def _fold_perf_frame(symbol: str, dso: str) -> str:
+  """Strip the offset from a perf frame and name unknown symbols by their dso."""
+  if symbol == '[unknown]':
+    return '[{dso}]'.format(dso=os.path.basename(dso))
+  return re.sub(_SYMBOL_OFFSET_REGEX, '', symbol)
+
+
+def fold_perf_script(script_output: str, dso_filter: str = '') -> Dict[str, int]:
+  """Fold the samples produced by "perf script" into stacks.
+
+  Args:
+    script_output: The text output of "perf script"
+    dso_filter: If specified, only samples where at least one frame
+      belongs to a dso whose name starts with this string are kept. This
+      isolates the Envoy samples in a system wide recording
+
+  Returns:
+    a dictionary mapping each folded stack to its sample count
+  """
+  stacks = {}
+  comm = ''
+  frames = []
+  keep = False
+
+  def _finish_sample():
+    if comm and frames and (keep or not dso_filter):
+      stack = ';'.join([comm] + frames[::-1])
+      stacks[stack] = stacks.get(stack, 0) + 1
+
+  for line in script_output.split('\n'):
+    if not line.strip():
+      _finish_sample()
+      comm = ''
+      frames = []
+      keep = False
+      continue
+
+    if not line[0].isspace():
+      # A new sample header, such as:
+      # envoy 12345 [003] 12345.678901:   10101010 cycles:
+      _finish_sample()
+      comm = line.split()[0]
+      frames = []
+      keep = False
+      continue
+
+    match = re.match(_PERF_FRAME_REGEX, line)
+    if not match:
+      continue
+
+    symbol, dso = match.group(1), match.group(2)
+    frames.append(_fold_perf_frame(symbol, dso))
+    if dso_filter and os.path.basename(dso).startswith(dso_filter):
+      keep = True
+
+  _finish_sample()
+
+  return stacks
+
+
+def parse_folded(folded_output: str) -> Dict[str, int]:
+  """Parse text in the folded format.
+
+  Args:
+    folded_output: Lines containing a folded stack and a sample count
+
+  Returns:
+    a dictionary mapping each folded stack to its sample count
+  """
+  stacks = {}
+  for line in folded_output.split('\n'):
+    line = line.strip()
+    if not line:
+      continue
+
+    stack, _, count = line.rpartition(' ')
+    try:
+      samples = int(float(count))
+    except ValueError:
+      log.debug(f"Skipping unparsable folded line: [{line}]")
+      continue
+
+    if stack:
+      stacks[stack] = stacks.get(stack, 0) + samples
+
+  return stacks
+
+
+def read_folded(path: str) -> Dict[str, int]:
+  """Read a file containing folded stacks."""
+  with open(path, 'r') as folded_file:
+    return parse_folded(folded_file.read())
+
+
+def write_folded(path: str, stacks: Dict[str, int]) -> None:
+  """Write stacks to a file in the folded format, sorted by stack."""
+  with open(path, 'w') as folded_file:
+    for stack in sorted(stacks):
+      folded_file.write(f"{stack} {stacks[stack]}\n")
+
+
+def merge_folded(*all_stacks: Dict[str, int]) -> Dict[str, int]:
+  """Add the sample counts of several sets of folded stacks."""
+  merged = {}
+  for stacks in all_stacks:
+    for stack, count in stacks.items():
+      merged[stack] = merged.get(stack, 0) + count
+
+  return merged
+
+
+def diff_folded(baseline: Dict[str, int], candidate: Dict[str, int]) -> DiffStacks:
+  """Combine two profiles into a differential profile.
+
+  The baseline counts are scaled so that both profiles contain the same
+  number of samples. This is equivalent to "difffolded.pl -n" and allows
+  comparing profiles recorded over runs of different lengths.
+
+  Args:
+    baseline: The folded stacks of the baseline Envoy
+    candidate: The folded stacks of the Envoy being evaluated
+
+  Returns:
+    a dictionary mapping each stack to its (baseline, candidate) counts
+
+  Raises:
+    FlameGraphError: if either profile contains no samples
+  """
+  baseline_total = sum(baseline.values())
+  candidate_total = sum(candidate.values())
+  if not baseline_total or not candidate_total:
+    raise FlameGraphError("Unable to compare profiles that contain no samples")
+
+  scale = candidate_total / baseline_total
+  diff = {}
+  for stack in set(baseline) | set(candidate):
+    diff[stack] = (baseline.get(stack, 0) * scale, float(candidate.get(stack, 0)))
+
+  return diff
+
+
+def write_diff_folded(path: str, diff: DiffStacks) -> None:
+  """Write a differential profile in the two column format used by flamegraph.pl."""
+  with open(path, 'w') as folded_file:
+    for stack in sorted(diff):
+      baseline, candidate = diff[stack]
+      folded_file.write(f"{stack} {round(baseline)} {round(candidate)}\n")
+
+
+def get_function_deltas(baseline: Dict[str, int], candidate: Dict[str, int]) -> List[FunctionDelta]:
+  """Compute the share of samples each function has in both profiles.
+
+  The self share counts samples where the function is the leaf frame. The
+  total share counts samples where the function appears anywhere in the
+  stack.
+
+  Args:
+    baseline: The folded stacks of the baseline Envoy
+    candidate: The folded stacks of the Envoy being evaluated
+
+  Returns:
+    a list of FunctionDelta objects sorted by decreasing growth of the self
+      share in the candidate profile
+  """
+
+  def _shares(stacks: Dict[str, int]) -> Tuple[Dict[str, float], Dict[str, float]]:
+    total = sum(stacks.values())
+    self_share = {}
+    total_share = {}
+    if not total:
+      return self_share, total_share
+
+    for stack, count in stacks.items():
+      frames = stack.split(';')
+      self_share[frames[-1]] = self_share.get(frames[-1], 0.0) + count / total
+      for frame in set(frames):
+        total_share[frame] = total_share.get(frame, 0.0) + count / total
+
+    return self_share, total_share
+
+  baseline_self, baseline_total = _shares(baseline)
+  candidate_self, candidate_total = _shares(candidate)
+
+  deltas = []
+  for function in set(baseline_total) | set(candidate_total):
+    deltas.append(
+        FunctionDelta(function=function,
+                      baseline_self=baseline_self.get(function, 0.0),
+                      candidate_self=candidate_self.get(function, 0.0),
+                      baseline_total=baseline_total.get(function, 0.0),
+                      candidate_total=candidate_total.get(function, 0.0)))
+
+  deltas.sort(key=lambda d:
+              (d.candidate_self - d.baseline_self, d.candidate_total - d.baseline_total),
+              reverse=True)
+  return deltas
+
+
+class _Frame(object):
+  """A node in the tree of frames built from folded stacks."""
+
+  def __init__(self, name: str) -> None:
+    """Initialize an empty frame with the specified function name."""
+    self.name = name
+    self.baseline = 0.0
+    self.candidate = 0.0
+    self.children = {}
+
+
+def _build_frame_tree(diff: DiffStacks) -> _Frame:
+  """Build a tree of frames holding the inclusive counts of each stack prefix."""
+  root = _Frame('all')
+  for stack, (baseline, candidate) in diff.items():
+    node = root
+    node.baseline += baseline
+    node.candidate += candidate
+    for frame in stack.split(';'):
+      node = node.children.setdefault(frame, _Frame(frame))
+      node.baseline += baseline
+      node.candidate += candidate
+
+  return root
+
+
+def _get_frame_color(frame: _Frame, total: float) -> str:
+  """Color frames that got hotter in red and frames that cooled down in blue."""
+  delta = (frame.candidate - frame.baseline) / total if total else 0.0
+  intensity = min(1.0, abs(delta) * 20)
+  fade = int(255 - 205 * intensity)
+  if delta > 0:
+    return f"rgb(255,{fade},{fade})"
+  if delta < 0:
+    return f"rgb({fade},{fade},255)"
+  return "rgb(255,255,255)"
+
+
+def render_diff_svg(diff: DiffStacks, title: str) -> str:
+  """Render a differential flame graph as a self contained SVG document.
+
+  Frame widths are proportional to the candidate samples. Frames are colored
+  red when they received a larger share of samples in the candidate and blue
+  when their share decreased.
+
+  Args:
+    diff: The differential profile produced by diff_folded
+    title: The title placed above the graph
+
+  Returns:
+    a string containing the SVG document
+  """
+  root = _build_frame_tree(diff)
+  total = root.candidate
+
+  def _max_depth(frame: _Frame) -> int:
+    return 1 + max([_max_depth(child) for child in frame.children.values()] + [0])
+
+  depth = _max_depth(root)
+  height = _TITLE_HEIGHT + depth * _FRAME_HEIGHT + _FRAME_HEIGHT
+  rectangles = []
+
+  def _render(frame: _Frame, x_offset: float, level: int) -> None:
+    width = frame.candidate / total * _SVG_WIDTH if total else 0.0
+    if width < _MIN_FRAME_WIDTH:
+      return
+
+    y_offset = height - _FRAME_HEIGHT * (level + 2)
+    delta = (frame.candidate - frame.baseline) / total * 100 if total else 0.0
+    tooltip = html.escape(f"{frame.name} (baseline {frame.baseline:.0f}, "
+                          f"candidate {frame.candidate:.0f}, {delta:+.2f}%)")
+
+    max_chars = int(width / (_FONT_SIZE * _FONT_WIDTH))
+    label = frame.name if len(frame.name) <= max_chars else ''
+    if not label and max_chars > 3:
+      label = frame.name[:max_chars - 2] + '..'
+
+    rectangles.append(f'<g><title>{tooltip}</title>'
+                      f'<rect x="{x_offset:.2f}" y="{y_offset}" width="{width:.2f}" '
+                      f'height="{_FRAME_HEIGHT - 1}" fill="{_get_frame_color(frame, total)}" '
+                      f'rx="2" ry="2"/>'
+                      f'<text x="{x_offset + 3:.2f}" y="{y_offset + _FRAME_HEIGHT - 5}">'
+                      f'{html.escape(label)}</text></g>')
+
+    child_offset = x_offset
+    for child in sorted(frame.children.values(), key=lambda c: c.name):
+      _render(child, child_offset, level + 1)
+      child_offset += child.candidate / total * _SVG_WIDTH
+
+  _render(root, 0.0, 0)
+
+  return ('<?xml version="1.0" standalone="no"?>\n'
+          f'<svg version="1.1" width="{_SVG_WIDTH}" height="{height}" '
+          f'viewBox="0 0 {_SVG_WIDTH} {height}" xmlns="http://www.w3.org/2000/svg">\n'
+          f'<style>text {{ font-family: Verdana; font-size: {_FONT_SIZE}px; }}</style>\n'
+          f'<rect width="100%" height="100%" fill="rgb(250,250,250)"/>\n'
+          f'<text x="{_SVG_WIDTH / 2}" y="24" text-anchor="middle" font-size="17">'
+          f'{html.escape(title)}</text>\n' + '\n'.join(rectangles) + '\n</svg>\n')
@@ -0,0 +1,335 @@
+"""Module to capture heap profiles from the Envoy under test.
+
+The gperftools heap profiler is enabled by setting HEAPPROFILE in the
+environment of an Envoy linked with gperftools. The benchmark harness and
+the Nighthawk processes inherit the same environment, so instead of
+exporting the variable for the whole benchmark, we point the harness to a
+wrapper script that sets the variable for Envoy only. The wrapper includes
+the process id in the profile prefix so that each Envoy instance started by
+the benchmark writes its own series of dumps.
+
+The gperftools heap profile header contains the bytes currently in use and
+the cumulative bytes allocated since the process started:
+
+  heap profile:   120:  1048576 [  4500: 73400320] @ heapprofile
+
+The allocation rate of a process is measured between its first and last
+dump, and its heap growth is the change of the bytes in use between them.
+
+The Envoy processes are started by the tests of the benchmark harness,
+which pytest names in the PYTEST_CURRENT_TEST variable inherited by the
+wrapper. The wrapper records it beside the dumps of each process, so that
+the allocations and heap growth are also summarized per test.
+"""
+import glob
+import json
+import logging
+import os
+import re
+from typing import (Dict, List, NamedTuple)
+
+from src.lib import cmd_exec
+from src.lib.profiling import (cpu_profiler, flame_graph)
+
+import api.profiling_pb2 as proto_profiling
+
+log = logging.getLogger(__name__)
+
+# The name of the file containing the allocated bytes of each stack,
+# merged across all Envoy processes of a benchmark run
+HEAP_PROFILE_FOLDED = 'envoy.heap.folded'
+
+# The name of the file summarizing the heap profiles of a benchmark run
+HEAP_PROFILE_SUMMARY = 'envoy.heap.json'
+
+_DEFAULT_DUMP_INTERVAL_SECONDS = 10
+
+_HEAP_PROFILE_PREFIX = 'envoy.heap'
+_ENVOY_WRAPPER = 'envoy_heap_profile.sh'
+
+# The number of allocation sites kept in the summary of a run
+_TOP_ALLOCATION_SITES = 25
+
+# _HEAP_DUMP_REGEX matches the dumps written by gperftools for the prefix
+# set in the wrapper. For example from:
+#   envoy.heap.4242.0003.heap
+# we extract the process id and the dump sequence in enumerated groups
+_HEAP_DUMP_REGEX = r'^' + re.escape(_HEAP_PROFILE_PREFIX) + r'\.(\d+)\.(\d+)\.heap$'
+
+# The suffix of the file naming the test that started an Envoy process
+_TEST_FILE_SUFFIX = '.test'
+
+# The test of the processes started outside of a test of the harness
+UNATTRIBUTED_TEST = 'unattributed'
+
+# _PYTEST_PHASE_REGEX matches the phase appended by pytest to the name of the
+# running test. For example from:
+#   benchmarks/test_http.py::test_http_h1_small_request_small_reply (setup)
+# we remove " (setup)"
+_PYTEST_PHASE_REGEX = r'\s+\((setup|call|teardown)\)$'
+
+# _HEAP_HEADER_REGEX matches the first line of a heap profile and extracts
+# the in use objects and bytes, and the allocated objects and bytes
+_HEAP_HEADER_REGEX = r'^heap profile:\s*(\d+):\s*(\d+)\s*\[\s*(\d+):\s*(\d+)\s*\]'
+
+
+class HeapProfilerError(Exception):
+  """Raised when a heap profile is not able to be captured or processed."""
+
+
+class HeapDump(NamedTuple):
+  """The totals recorded in a single heap profile dump."""
+
+  path: str
+  timestamp: float
+  inuse_objects: int
+  inuse_bytes: int
+  alloc_objects: int
+  alloc_bytes: int
+
+
+def parse_heap_dump_header(path: str) -> HeapDump:
+  """Read the totals from the header of a gperftools heap profile.
+
+  Args:
+    path: The path to the heap profile dump
+
+  Returns:
+    a HeapDump object containing the totals and the time the dump was
+      written
+
+  Raises:
+    HeapProfilerError: if the file is not a heap profile
+  """
+  with open(path, 'r', errors='replace') as dump_file:
+    header = dump_file.readline()
+
+  match = re.match(_HEAP_HEADER_REGEX, header)
+  if not match:
+    raise HeapProfilerError(f"{path} is not a gperftools heap profile")
+
+  inuse_objects, inuse_bytes, alloc_objects, alloc_bytes = [int(g) for g in match.groups()]
+  return HeapDump(path=path,
+                  timestamp=os.path.getmtime(path),
+                  inuse_objects=inuse_objects,
+                  inuse_bytes=inuse_bytes,
+                  alloc_objects=alloc_objects,
+                  alloc_bytes=alloc_bytes)
+
+
+def get_allocation_rate(dumps: List[HeapDump]) -> float:
+  """Compute the bytes allocated per second between the first and last dump.
+
+  Args:
+    dumps: The dumps written by one process ordered by sequence
+
+  Returns:
+    the allocation rate in bytes per second, or 0.0 if the dumps do not
+      span a measurable interval
+  """
+  if len(dumps) < 2:
+    return 0.0
+
+  elapsed = dumps[-1].timestamp - dumps[0].timestamp
+  if elapsed <= 0:
+    return 0.0
+
+  return (dumps[-1].alloc_bytes - dumps[0].alloc_bytes) / elapsed
+
+
+def get_top_allocation_sites(stacks: Dict[str, int], count: int) -> List[Dict]:
+  """Sum the bytes allocated by each leaf function and return the largest.
+
+  Args:
+    stacks: The folded stacks weighted by allocated bytes
+    count: The number of allocation sites to return
+
+  Returns:
+    a list of dictionaries containing the function and its allocated bytes,
+      ordered by decreasing bytes
+  """
+  sites = {}
+  for stack, allocated in stacks.items():
+    function = stack.split(';')[-1]
+    sites[function] = sites.get(function, 0) + allocated
+
+  ordered = sorted(sites.items(), key=lambda site: (-site[1], site[0]))
+  return [{'function': function, 'bytes': allocated} for function, allocated in ordered[:count]]
+
+
+def summarize_tests(processes: List[Dict]) -> Dict[str, Dict]:
+  """Sum the allocations and heap growth of the Envoy processes of each test.
+
+  Args:
+    processes: The totals of each process, as listed in the summary of a run
+
+  Returns:
+    a dictionary mapping each test to the number of its processes, the
+      bytes they allocated and by which their heap grew, and their
+      allocation rate weighed by the interval over which it was measured
+  """
+  tests = {}
+  for process in processes:
+    tests.setdefault(process['test'], []).append(process)
+
+  summaries = {}
+  for test, test_processes in sorted(tests.items()):
+    seconds = sum([process['seconds'] for process in test_processes])
+    allocated = sum([process['alloc_rate'] * process['seconds'] for process in test_processes])
+    summaries[test] = {
+        'processes': len(test_processes),
+        'alloc_bytes': sum([process['alloc_bytes'] for process in test_processes]),
+        'inuse_growth_bytes': sum([process['inuse_growth_bytes'] for process in test_processes]),
+        'alloc_rate': allocated / seconds if seconds else 0.0,
+    }
+  return summaries
+
+
+class HeapProfiler(object):
+  """Capture heap profiles from the Envoy processes started by a benchmark."""
+
+  def __init__(self, options: proto_profiling.ProfilingOptions, output_dir: str) -> None:
+    """Initialize the profiler.
+
+    Args:
+      options: The profiling options from the job control document
+      output_dir: The output directory of the benchmark run. Profiles are
+        written to a subdirectory of this location
+    """
+    self._options = options
+    self._profile_dir = os.path.join(output_dir, cpu_profiler.PROFILE_DIRECTORY)
+
+  def is_enabled(self) -> bool:
+    """Return whether heap profiles are to be captured."""
+    return self._options.heap_profile
+
+  def get_profile_directory(self) -> str:
+    """Return the directory where the profiles of this run are written."""
+    return self._profile_dir
+
+  def create_envoy_wrapper(self, envoy_binary: str) -> str:
+    """Write a script that starts Envoy with the heap profiler enabled.
+
+    Args:
+      envoy_binary: The path to the Envoy binary under test
+
+    Returns:
+      the path to the script, to be used in place of the Envoy binary
+    """
+    if not os.path.isdir(self._profile_dir):
+      os.makedirs(self._profile_dir, 0o755)
+
+    interval = self._options.heap_profile_interval or _DEFAULT_DUMP_INTERVAL_SECONDS
+    prefix = os.path.join(self._profile_dir, _HEAP_PROFILE_PREFIX)
+    wrapper_path = os.path.join(self._profile_dir, _ENVOY_WRAPPER)
+
+    with open(wrapper_path, 'w') as wrapper:
+      wrapper.write("#!/bin/sh\n"
+                    "printf '%s\\n' \"$PYTEST_CURRENT_TEST\" "
+                    f"> \"{prefix}.$${_TEST_FILE_SUFFIX}\"\n"
+                    f"HEAPPROFILE=\"{prefix}.$$\" "
+                    f"HEAP_PROFILE_TIME_INTERVAL={interval} "
+                    f"exec \"{envoy_binary}\" \"$@\"\n")
+    os.chmod(wrapper_path, 0o755)
+
+    log.debug(f"Envoy heap profile wrapper written to {wrapper_path}")
+    return wrapper_path
+
+  def _find_dumps(self) -> Dict[int, List[HeapDump]]:
+    """Find the dumps written by each Envoy process, ordered by sequence."""
+    dumps = {}
+    for path in glob.glob(os.path.join(self._profile_dir, _HEAP_PROFILE_PREFIX + '.*.heap')):
+      match = re.match(_HEAP_DUMP_REGEX, os.path.basename(path))
+      if not match:
+        continue
+
+      pid, sequence = int(match.group(1)), int(match.group(2))
+      dumps.setdefault(pid, []).append((sequence, path))
+
+    return {
+        pid: [parse_heap_dump_header(path) for _, path in sorted(process_dumps)]
+        for pid, process_dumps in dumps.items()
+    }
+
+  def _get_test(self, pid: int) -> str:
+    """Return the test of the harness that started an Envoy process."""
+    test_path = os.path.join(self._profile_dir, f"{_HEAP_PROFILE_PREFIX}.{pid}{_TEST_FILE_SUFFIX}")
+    if not os.path.exists(test_path):
+      return UNATTRIBUTED_TEST
+    with open(test_path, 'r') as test_file:
+      test = re.sub(_PYTEST_PHASE_REGEX, '', test_file.read().strip())
+    return test or UNATTRIBUTED_TEST
+
+  def _fold_allocations(self, envoy_binary: str, dump: HeapDump) -> Dict[str, int]:
+    """Symbolize a dump into stacks weighted by the bytes they allocated."""
+    cmd = "pprof --collapsed --alloc_space --show_bytes {binary} {profile}".format(
+        binary=envoy_binary, profile=dump.path)
+    cmd_params = cmd_exec.CommandParameters(cwd=self._profile_dir)
+    return flame_graph.parse_folded(cmd_exec.run_command(cmd, cmd_params))
+
+  def collect(self, envoy_binary: str) -> str:
+    """Summarize the heap profiles captured during the benchmark.
+
+    The last dump of each Envoy process holds the allocations made over
+    its lifetime. These are symbolized and merged into a folded profile.
+    The summary lists the totals of each process, the allocation rate of
+    the run and its top allocation sites, and the allocations and heap
+    growth of each test.
+
+    Args:
+      envoy_binary: The path to the Envoy binary under test. pprof uses it
+        to symbolize the dumps
+
+    Returns:
+      the path to the summary, or an empty string if heap profiling is
+        disabled
+
+    Raises:
+      HeapProfilerError: if no heap profile dumps were written
+      subprocess.CalledProcessError: if the profile conversion fails
+    """
+    if not self.is_enabled():
+      return ''
+
+    all_dumps = self._find_dumps()
+    if not all_dumps:
+      raise HeapProfilerError(f"No Envoy heap profiles were written in {self._profile_dir}")
+
+    processes = []
+    stacks = []
+    for pid, dumps in sorted(all_dumps.items()):
+      last_dump = dumps[-1]
+      processes.append({
+          'pid': pid,
+          'test': self._get_test(pid),
+          'dumps': len(dumps),
+          'seconds': last_dump.timestamp - dumps[0].timestamp,
+          'alloc_bytes': last_dump.alloc_bytes,
+          'alloc_objects': last_dump.alloc_objects,
+          'inuse_bytes': last_dump.inuse_bytes,
+          'inuse_growth_bytes': last_dump.inuse_bytes - dumps[0].inuse_bytes,
+          'alloc_rate': get_allocation_rate(dumps),
+      })
+      stacks.append(self._fold_allocations(envoy_binary, last_dump))
+
+    allocations = flame_graph.merge_folded(*stacks)
+    flame_graph.write_folded(os.path.join(self._profile_dir, HEAP_PROFILE_FOLDED), allocations)
+
+    # Weigh the rate of each process by the interval over which it was
+    # measured so that short lived processes do not skew the result
+    seconds = sum([process['seconds'] for process in processes])
+    allocated = sum([process['alloc_rate'] * process['seconds'] for process in processes])
+    summary = {
+        'processes': processes,
+        'alloc_bytes': sum([process['alloc_bytes'] for process in processes]),
+        'alloc_rate': allocated / seconds if seconds else 0.0,
+        'top_allocation_sites': get_top_allocation_sites(allocations, _TOP_ALLOCATION_SITES),
+        'tests': summarize_tests(processes),
+    }
+
+    summary_path = os.path.join(self._profile_dir, HEAP_PROFILE_SUMMARY)
+    with open(summary_path, 'w') as summary_file:
+      json.dump(summary, summary_file, indent=2)
+
+    log.info(f"Heap profile summary written to {summary_path}")
+    return summary_path
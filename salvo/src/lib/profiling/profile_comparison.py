@@ -0,0 +1,186 @@
+"""Module to compare the profiles captured for a baseline and a candidate Envoy."""
+import logging
+import os
+from typing import List
+
+from src.lib.common import file_ops
+from src.lib.profiling import (cpu_profiler, flame_graph, heap_profiler)
+
+log = logging.getLogger(__name__)
+
+# The number of functions listed in the text report of a comparison
+_TOP_FUNCTIONS = 25
+
+
+class ProfileComparisonError(Exception):
+  """Raised when the profiles of two benchmark runs cannot be compared."""
+
+
+def _get_report_prefix(report_dir: str, kind: str, baseline_label: str,
+                       candidate_label: str) -> str:
+  """Build the path prefix shared by the files of one comparison."""
+  if not os.path.isdir(report_dir):
+    os.makedirs(report_dir, 0o755)
+
+  return os.path.join(report_dir, f"{kind}_diff__{baseline_label}__{candidate_label}")
+
+
+def _format_function_report(deltas, header: List[str]) -> str:
+  """Format the functions that received the largest increase in samples."""
+  lines = header + [f"{'Self delta':>11} {'Self':>17} {'Total delta':>12} {'Total':>17}  Function"]
+
+  for delta in deltas[:_TOP_FUNCTIONS]:
+    self_delta = (delta.candidate_self - delta.baseline_self) * 100
+    total_delta = (delta.candidate_total - delta.baseline_total) * 100
+    lines.append(f"{self_delta:>+10.2f}% "
+                 f"{delta.baseline_self * 100:>7.2f}->{delta.candidate_self * 100:>6.2f}% "
+                 f"{total_delta:>+11.2f}% "
+                 f"{delta.baseline_total * 100:>7.2f}->{delta.candidate_total * 100:>6.2f}%  "
+                 f"{delta.function}")
+
+  return '\n'.join(lines) + '\n'
+
+
+def compare_cpu_profiles(baseline_dir: str, candidate_dir: str, report_dir: str,
+                         baseline_label: str, candidate_label: str) -> str:
+  """Generate a differential flame graph between two benchmark runs.
+
+  Three files are written to the report directory: the differential
+  folded stacks, the flame graph rendered as SVG and a text report listing
+  the functions that got hotter in the candidate.
+
+  Args:
+    baseline_dir: The output directory of the baseline benchmark run
+    candidate_dir: The output directory of the candidate benchmark run
+    report_dir: The directory where the comparison is written
+    baseline_label: The commit hash or tag of the baseline Envoy
+    candidate_label: The commit hash or tag of the candidate Envoy
+
+  Returns:
+    the path to the differential flame graph
+
+  Raises:
+    ProfileComparisonError: if either run has no CPU profile
+  """
+  profiles = []
+  for run_dir in [baseline_dir, candidate_dir]:
+    folded_path = os.path.join(run_dir, cpu_profiler.PROFILE_DIRECTORY,
+                               cpu_profiler.CPU_PROFILE_FOLDED)
+    if not os.path.exists(folded_path):
+      raise ProfileComparisonError(f"No CPU profile found at {folded_path}")
+    profiles.append(flame_graph.read_folded(folded_path))
+
+  baseline, candidate = profiles
+  try:
+    diff = flame_graph.diff_folded(baseline, candidate)
+  except flame_graph.FlameGraphError as flame_graph_error:
+    raise ProfileComparisonError(str(flame_graph_error))
+
+  prefix = _get_report_prefix(report_dir, 'cpu', baseline_label, candidate_label)
+  flame_graph.write_diff_folded(prefix + '.folded', diff)
+
+  title = f"Envoy CPU: {baseline_label} -> {candidate_label}"
+  with open(prefix + '.svg', 'w') as svg_file:
+    svg_file.write(flame_graph.render_diff_svg(diff, title))
+
+  header = [
+      f"CPU profile comparison: {baseline_label} (baseline) -> {candidate_label} (candidate)", ""
+  ]
+  deltas = flame_graph.get_function_deltas(baseline, candidate)
+  with open(prefix + '.txt', 'w') as report_file:
+    report_file.write(_format_function_report(deltas, header))
+
+  log.info(f"Differential CPU flame graph written to {prefix}.svg")
+  return prefix + '.svg'
+
+
+def _format_bytes(value: float) -> str:
+  """Format a number of bytes in MiB."""
+  return f"{value / (1024 * 1024):.2f} MiB"
+
+
+def _format_change(baseline: float, candidate: float) -> str:
+  """Format the relative change between two values."""
+  if not baseline:
+    return "n/a"
+  return f"{(candidate - baseline) / baseline * 100:+.2f}%"
+
+
+def compare_heap_profiles(baseline_dir: str, candidate_dir: str, report_dir: str,
+                          baseline_label: str, candidate_label: str) -> str:
+  """Compare the allocations of two benchmark runs.
+
+  A text report with the allocation rate of both runs, the heap growth of
+  each test found in both runs and the allocation sites whose share of the
+  allocated bytes grew the most is written to the report directory, along
+  with a differential flame graph of the allocated bytes.
+
+  Args:
+    baseline_dir: The output directory of the baseline benchmark run
+    candidate_dir: The output directory of the candidate benchmark run
+    report_dir: The directory where the comparison is written
+    baseline_label: The commit hash or tag of the baseline Envoy
+    candidate_label: The commit hash or tag of the candidate Envoy
+
+  Returns:
+    the path to the text report
+
+  Raises:
+    ProfileComparisonError: if either run has no heap profile
+  """
+  summaries = []
+  allocations = []
+  for run_dir in [baseline_dir, candidate_dir]:
+    profile_dir = os.path.join(run_dir, cpu_profiler.PROFILE_DIRECTORY)
+    summary_path = os.path.join(profile_dir, heap_profiler.HEAP_PROFILE_SUMMARY)
+    folded_path = os.path.join(profile_dir, heap_profiler.HEAP_PROFILE_FOLDED)
+    if not (os.path.exists(summary_path) and os.path.exists(folded_path)):
+      raise ProfileComparisonError(f"No heap profile found in {profile_dir}")
+    summaries.append(file_ops.open_json(summary_path))
+    allocations.append(flame_graph.read_folded(folded_path))
+
+  baseline_summary, candidate_summary = summaries
+  baseline, candidate = allocations
+  try:
+    diff = flame_graph.diff_folded(baseline, candidate)
+  except flame_graph.FlameGraphError as flame_graph_error:
+    raise ProfileComparisonError(str(flame_graph_error))
+
+  prefix = _get_report_prefix(report_dir, 'heap', baseline_label, candidate_label)
+  title = f"Envoy allocations: {baseline_label} -> {candidate_label}"
+  with open(prefix + '.svg', 'w') as svg_file:
+    svg_file.write(flame_graph.render_diff_svg(diff, title))
+
+  baseline_rate = baseline_summary['alloc_rate']
+  candidate_rate = candidate_summary['alloc_rate']
+  baseline_bytes = baseline_summary['alloc_bytes']
+  candidate_bytes = candidate_summary['alloc_bytes']
+  header = [
+      f"Heap profile comparison: {baseline_label} (baseline) -> {candidate_label} (candidate)", "",
+      f"Allocation rate: {_format_bytes(baseline_rate)}/s -> {_format_bytes(candidate_rate)}/s "
+      f"({_format_change(baseline_rate, candidate_rate)})",
+      f"Allocated bytes: {_format_bytes(baseline_bytes)} -> {_format_bytes(candidate_bytes)} "
+      f"({_format_change(baseline_bytes, candidate_bytes)})", ""
+  ]
+
+  # The summaries of runs profiled before the dumps were attributed to tests
+  # have no tests
+  baseline_tests = baseline_summary.get('tests', {})
+  candidate_tests = candidate_summary.get('tests', {})
+  common_tests = sorted(set(baseline_tests) & set(candidate_tests))
+  if common_tests:
+    header.append("Heap growth per test:")
+    for test in common_tests:
+      baseline_growth = baseline_tests[test]['inuse_growth_bytes']
+      candidate_growth = candidate_tests[test]['inuse_growth_bytes']
+      header.append(f"  {test}: {_format_bytes(baseline_growth)} -> "
+                    f"{_format_bytes(candidate_growth)} "
+                    f"({_format_change(baseline_growth, candidate_growth)})")
+    header.append("")
+
+  deltas = flame_graph.get_function_deltas(baseline, candidate)
+  with open(prefix + '.txt', 'w') as report_file:
+    report_file.write(_format_function_report(deltas, header))
+
+  log.info(f"Heap profile comparison written to {prefix}.txt")
+  return prefix + '.txt'
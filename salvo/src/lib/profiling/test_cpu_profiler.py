@@ -0,0 +1,130 @@
+"""Test the capture of CPU profiles."""
+import os
+import signal
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib.profiling import cpu_profiler
+
+import api.profiling_pb2 as proto_profiling
+
+_PERF_SCRIPT_OUTPUT = """
+envoy 1234 [001] 100.000001:   10101010 cycles:
+\t    55d0c0a1b2c3 Envoy::Http::ConnectionManagerImpl::onData+0x23 (/usr/local/bin/envoy)
+\t    55d0c0a1b000 main+0x10 (/usr/local/bin/envoy)
+"""
+
+
+def _get_options(profiler):
+  """Build profiling options using the specified profiler."""
+  return proto_profiling.ProfilingOptions(cpu_profiler=profiler)
+
+
+def test_profiler_disabled():
+  """Verify that no profile is captured unless a profiler is configured."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = cpu_profiler.CpuProfiler(proto_profiling.ProfilingOptions(), output_dir)
+
+    with profiler:
+      pass
+
+    assert not profiler.is_enabled()
+    assert profiler.collect() == ''
+    assert not os.path.exists(profiler.get_profile_directory())
+
+
+@mock.patch('src.lib.cmd_exec.run_command')
+@mock.patch('src.lib.cmd_exec.start_command')
+def test_perf_profile(mock_start_command, mock_run_command):
+  """Verify that perf runs for the duration of the benchmark and its samples are folded."""
+  mock_run_command.return_value = _PERF_SCRIPT_OUTPUT
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = cpu_profiler.CpuProfiler(
+        _get_options(proto_profiling.ProfilingOptions.CPU_PROFILER_PERF), output_dir)
+
+    with profiler:
+      mock_start_command.assert_called_once()
+      assert mock_start_command.call_args[0][0] == "perf record -F 99 -a -g -o perf.data"
+
+    perf_process = mock_start_command.return_value
+    perf_process.send_signal.assert_called_once_with(signal.SIGINT)
+    perf_process.wait.assert_called_once()
+
+    folded_path = profiler.collect()
+    assert mock_run_command.call_args[0][0] == "perf script -i perf.data"
+
+    with open(folded_path) as folded_file:
+      assert folded_file.read() == "envoy;main;Envoy::Http::ConnectionManagerImpl::onData 1\n"
+
+
+@mock.patch('src.lib.cmd_exec.run_command')
+def test_perf_profile_without_envoy_samples(mock_run_command):
+  """Verify that we raise an error if no Envoy samples are recorded."""
+  mock_run_command.return_value = "perf: no samples"
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = cpu_profiler.CpuProfiler(
+        _get_options(proto_profiling.ProfilingOptions.CPU_PROFILER_PERF), output_dir)
+
+    with pytest.raises(cpu_profiler.CpuProfilerError) as profiler_error:
+      profiler.collect()
+
+    assert "No Envoy samples were captured" in str(profiler_error.value)
+
+
+@mock.patch('src.lib.cmd_exec.run_command')
+def test_gperftools_profile(mock_run_command):
+  """Verify that each profile written by Envoy is converted with pprof and merged."""
+  mock_run_command.return_value = "main;onData 3\n"
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = cpu_profiler.CpuProfiler(
+        _get_options(proto_profiling.ProfilingOptions.CPU_PROFILER_GPERFTOOLS), output_dir)
+
+    profiler.create_envoy_wrapper('/tmp/envoy-static')
+    prefix = os.path.join(profiler.get_profile_directory(), 'envoy.cpu.prof')
+    for suffix in ['.4242', '.4343']:
+      open(prefix + suffix, 'w').close()
+
+    folded_path = profiler.collect('/tmp/envoy-static')
+
+    assert mock_run_command.call_count == 2
+    assert mock_run_command.call_args[0][0] == \
+        f"pprof --collapsed /tmp/envoy-static {prefix}.4343"
+    with open(folded_path) as folded_file:
+      assert folded_file.read() == "main;onData 6\n"
+
+
+def test_create_envoy_wrapper():
+  """Verify that the wrapper enables the CPU profiler for Envoy only, in a profile per process."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = cpu_profiler.CpuProfiler(
+        _get_options(proto_profiling.ProfilingOptions.CPU_PROFILER_GPERFTOOLS), output_dir)
+
+    wrapper_path = profiler.create_envoy_wrapper('/usr/local/bin/envoy')
+
+    assert os.access(wrapper_path, os.X_OK)
+    prefix = os.path.join(profiler.get_profile_directory(), 'envoy.cpu.prof')
+    with open(wrapper_path) as wrapper:
+      assert wrapper.read() == ("#!/bin/sh\n"
+                                f"CPUPROFILE=\"{prefix}.$$\" "
+                                "exec \"/usr/local/bin/envoy\" \"$@\"\n")
+
+
+def test_gperftools_profile_requires_binary():
+  """Verify that gperftools profiles are not converted without the Envoy binary."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = cpu_profiler.CpuProfiler(
+        _get_options(proto_profiling.ProfilingOptions.CPU_PROFILER_GPERFTOOLS), output_dir)
+
+    with pytest.raises(cpu_profiler.CpuProfilerError) as profiler_error:
+      profiler.collect()
+
+    assert str(profiler_error.value) == \
+        "The Envoy binary is required to symbolize gperftools profiles"
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
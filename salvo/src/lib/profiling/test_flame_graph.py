@@ -0,0 +1,107 @@
+"""Test the folding and comparison of sampled stacks."""
+import pytest
+
+from src.lib.profiling import flame_graph
+
+_PERF_SCRIPT_OUTPUT = """
+envoy 1234 [001] 100.000001:   10101010 cycles:
+\t    55d0c0a1b2c3 Envoy::Http::ConnectionManagerImpl::onData+0x23 (/usr/local/bin/envoy)
+\t    55d0c0a1b000 main+0x10 (/usr/local/bin/envoy)
+
+wrk:worker_0 1234/1240 [002] 100.000002:   10101010 cycles:
+\t    7f0000001000 __memcpy_avx_unaligned+0x10 (/usr/lib/x86_64-linux-gnu/libc-2.31.so)
+\t    55d0c0a1b2c3 Envoy::Buffer::OwnedImpl::add+0x4 (/usr/local/bin/envoy)
+\t    55d0c0a1b000 main+0x10 (/usr/local/bin/envoy)
+
+wrk:worker_0 1234/1240 [002] 100.000003:   10101010 cycles:
+\t    7f0000001000 __memcpy_avx_unaligned+0x10 (/usr/lib/x86_64-linux-gnu/libc-2.31.so)
+\t    55d0c0a1b2c3 Envoy::Buffer::OwnedImpl::add+0x8 (/usr/local/bin/envoy)
+\t    55d0c0a1b000 main+0x10 (/usr/local/bin/envoy)
+
+bash 999 [003] 100.000004:   10101010 cycles:
+\t    5500000000aa [unknown] (/usr/bin/bash)
+"""
+
+
+def test_fold_perf_script():
+  """Verify that perf samples are folded and filtered by dso."""
+  stacks = flame_graph.fold_perf_script(_PERF_SCRIPT_OUTPUT, 'envoy')
+
+  assert stacks == {
+      'envoy;main;Envoy::Http::ConnectionManagerImpl::onData': 1,
+      'wrk:worker_0;main;Envoy::Buffer::OwnedImpl::add;__memcpy_avx_unaligned': 2,
+  }
+
+
+def test_fold_perf_script_unknown_symbols():
+  """Verify that unknown symbols are named after their dso when no filter is used."""
+  stacks = flame_graph.fold_perf_script(_PERF_SCRIPT_OUTPUT)
+
+  assert stacks['bash;[bash]'] == 1
+  assert len(stacks) == 3
+
+
+def test_parse_and_merge_folded():
+  """Verify that we parse folded stacks and add their counts."""
+  first = flame_graph.parse_folded("a;b;c 10\na;b 5\nnot a valid line\n")
+  second = flame_graph.parse_folded("a;b;c 2\n")
+
+  assert first == {'a;b;c': 10, 'a;b': 5}
+  assert flame_graph.merge_folded(first, second) == {'a;b;c': 12, 'a;b': 5}
+
+
+def test_diff_folded_normalizes_baseline():
+  """Verify that the baseline counts are scaled to the candidate sample count."""
+  baseline = {'a;b': 50, 'a;c': 50}
+  candidate = {'a;b': 150, 'a;c': 50}
+
+  diff = flame_graph.diff_folded(baseline, candidate)
+
+  assert diff == {'a;b': (100.0, 150.0), 'a;c': (100.0, 50.0)}
+
+
+def test_diff_folded_empty_profile():
+  """Verify that we cannot compare a profile without samples."""
+  with pytest.raises(flame_graph.FlameGraphError) as flame_graph_error:
+    flame_graph.diff_folded({}, {'a': 1})
+
+  assert str(flame_graph_error.value) == "Unable to compare profiles that contain no samples"
+
+
+def test_get_function_deltas():
+  """Verify that functions that got hotter are listed first."""
+  baseline = {'main;parse': 50, 'main;encode': 50}
+  candidate = {'main;parse': 80, 'main;encode': 20}
+
+  deltas = flame_graph.get_function_deltas(baseline, candidate)
+
+  assert deltas[0].function == 'parse'
+  assert deltas[0].baseline_self == pytest.approx(0.5)
+  assert deltas[0].candidate_self == pytest.approx(0.8)
+  assert deltas[-1].function == 'encode'
+  main = next(filter(lambda d: d.function == 'main', deltas))
+  assert main.baseline_total == pytest.approx(1.0)
+  assert main.candidate_total == pytest.approx(1.0)
+
+
+def test_render_diff_svg():
+  """Verify that the rendered flame graph colors hotter and colder frames."""
+  diff = flame_graph.diff_folded({
+      'main;parse': 50,
+      'main;encode': 50
+  }, {
+      'main;parse': 80,
+      'main;encode<T>': 20
+  })
+
+  svg = flame_graph.render_diff_svg(diff, "baseline -> candidate")
+
+  assert svg.startswith('<?xml')
+  assert 'baseline -&gt; candidate' in svg
+  assert 'encode&lt;T&gt;' in svg
+  assert 'fill="rgb(255,' in svg
+  assert ',255)"' in svg
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
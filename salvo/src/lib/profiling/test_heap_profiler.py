@@ -0,0 +1,180 @@
+"""Test the capture of heap profiles."""
+import json
+import os
+import tempfile
+import pytest
+from unittest import mock
+
+from src.lib.profiling import heap_profiler
+
+import api.profiling_pb2 as proto_profiling
+
+_PPROF_OUTPUT = """
+main;Envoy::Buffer::OwnedImpl::add 3000
+main;Envoy::Http::HeaderMapImpl::addCopy 1000
+"""
+
+
+def _write_dump(profile_dir, pid, sequence, alloc_bytes, timestamp, inuse_bytes=2048):
+  """Write a heap profile dump with the specified totals and modification time."""
+  path = os.path.join(profile_dir, f"envoy.heap.{pid}.{sequence:04d}.heap")
+  with open(path, 'w') as dump_file:
+    dump_file.write(
+        f"heap profile:   10: {inuse_bytes:>6} [   20: {alloc_bytes:>8}] @ heapprofile\n"
+        "     1:     2048 [     2:     4096] @ 0x1 0x2\n"
+        "\nMAPPED_LIBRARIES:\n")
+  os.utime(path, (timestamp, timestamp))
+
+
+def test_parse_heap_dump_header():
+  """Verify that we extract the totals from a heap profile."""
+  with tempfile.TemporaryDirectory() as profile_dir:
+    _write_dump(profile_dir, 42, 1, 1048576, 1000)
+
+    dump = heap_profiler.parse_heap_dump_header(os.path.join(profile_dir,
+                                                             'envoy.heap.42.0001.heap'))
+
+    assert dump.inuse_objects == 10
+    assert dump.inuse_bytes == 2048
+    assert dump.alloc_objects == 20
+    assert dump.alloc_bytes == 1048576
+    assert dump.timestamp == 1000
+
+
+def test_parse_heap_dump_header_invalid():
+  """Verify that we raise an error for files that are not heap profiles."""
+  with tempfile.NamedTemporaryFile(mode='w', suffix='.heap') as dump_file:
+    dump_file.write("--- symbol\nbinary=envoy\n")
+    dump_file.flush()
+
+    with pytest.raises(heap_profiler.HeapProfilerError) as profiler_error:
+      heap_profiler.parse_heap_dump_header(dump_file.name)
+
+    assert "is not a gperftools heap profile" in str(profiler_error.value)
+
+
+def test_get_allocation_rate():
+  """Verify that the rate is measured between the first and last dumps."""
+  dumps = [
+      heap_profiler.HeapDump('a', 100.0, 0, 0, 0, 1000),
+      heap_profiler.HeapDump('b', 110.0, 0, 0, 0, 6000),
+      heap_profiler.HeapDump('c', 120.0, 0, 0, 0, 21000),
+  ]
+
+  assert heap_profiler.get_allocation_rate(dumps) == 1000.0
+  assert heap_profiler.get_allocation_rate(dumps[:1]) == 0.0
+
+
+def test_get_top_allocation_sites():
+  """Verify that the allocated bytes are summed by leaf function."""
+  stacks = {'main;a;alloc': 10, 'main;b;alloc': 20, 'main;c': 25, 'main;d': 5}
+
+  assert heap_profiler.get_top_allocation_sites(stacks, 2) == [
+      {
+          'function': 'alloc',
+          'bytes': 30
+      },
+      {
+          'function': 'c',
+          'bytes': 25
+      },
+  ]
+
+
+def test_profiler_disabled():
+  """Verify that no profile is collected unless heap profiling is enabled."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = heap_profiler.HeapProfiler(proto_profiling.ProfilingOptions(), output_dir)
+
+    assert not profiler.is_enabled()
+    assert profiler.collect('/usr/local/bin/envoy') == ''
+
+
+def test_create_envoy_wrapper():
+  """Verify that the wrapper enables the heap profiler for Envoy only."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    options = proto_profiling.ProfilingOptions(heap_profile=True, heap_profile_interval=5)
+    profiler = heap_profiler.HeapProfiler(options, output_dir)
+
+    wrapper_path = profiler.create_envoy_wrapper('/usr/local/bin/envoy')
+
+    assert os.access(wrapper_path, os.X_OK)
+    prefix = os.path.join(profiler.get_profile_directory(), 'envoy.heap')
+    with open(wrapper_path) as wrapper:
+      assert wrapper.read() == ("#!/bin/sh\n"
+                                "printf '%s\\n' \"$PYTEST_CURRENT_TEST\" "
+                                f"> \"{prefix}.$$.test\"\n"
+                                f"HEAPPROFILE=\"{prefix}.$$\" HEAP_PROFILE_TIME_INTERVAL=5 "
+                                "exec \"/usr/local/bin/envoy\" \"$@\"\n")
+
+
+@mock.patch('src.lib.cmd_exec.run_command')
+def test_collect_heap_profile(mock_run_command):
+  """Verify that the last dump of each process is symbolized and summarized."""
+  mock_run_command.return_value = _PPROF_OUTPUT
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = heap_profiler.HeapProfiler(proto_profiling.ProfilingOptions(heap_profile=True),
+                                          output_dir)
+    profile_dir = profiler.get_profile_directory()
+    os.makedirs(profile_dir)
+
+    # The first process allocates 1000 bytes/s over 20s, the second
+    # process allocates 4000 bytes/s over 5s
+    _write_dump(profile_dir, 100, 1, 1000, 1000)
+    _write_dump(profile_dir, 100, 2, 11000, 1010, inuse_bytes=3072)
+    _write_dump(profile_dir, 100, 3, 21000, 1020, inuse_bytes=4096)
+    _write_dump(profile_dir, 200, 1, 0, 2000)
+    _write_dump(profile_dir, 200, 2, 20000, 2005)
+    with open(os.path.join(profile_dir, 'envoy.heap.100.test'), 'w') as test_file:
+      test_file.write("benchmarks/test_http.py::test_http_h1 (setup)\n")
+
+    summary_path = profiler.collect('/usr/local/bin/envoy')
+
+    assert mock_run_command.call_count == 2
+    assert mock_run_command.call_args[0][0] == (
+        "pprof --collapsed --alloc_space --show_bytes /usr/local/bin/envoy "
+        f"{os.path.join(profile_dir, 'envoy.heap.200.0002.heap')}")
+
+    with open(summary_path) as summary_file:
+      summary = json.load(summary_file)
+
+    assert [process['pid'] for process in summary['processes']] == [100, 200]
+    assert summary['processes'][0]['dumps'] == 3
+    assert summary['processes'][0]['alloc_rate'] == 1000.0
+    assert summary['processes'][1]['alloc_rate'] == 4000.0
+    assert summary['alloc_bytes'] == 41000
+    assert summary['alloc_rate'] == 1600.0
+    assert [process['test'] for process in summary['processes']
+           ] == ['benchmarks/test_http.py::test_http_h1', heap_profiler.UNATTRIBUTED_TEST]
+    assert summary['tests']['benchmarks/test_http.py::test_http_h1'] == {
+        'processes': 1,
+        'alloc_bytes': 21000,
+        'inuse_growth_bytes': 2048,
+        'alloc_rate': 1000.0,
+    }
+    assert summary['tests'][heap_profiler.UNATTRIBUTED_TEST]['alloc_rate'] == 4000.0
+    assert summary['top_allocation_sites'][0] == {
+        'function': 'Envoy::Buffer::OwnedImpl::add',
+        'bytes': 6000
+    }
+
+    with open(os.path.join(profile_dir, heap_profiler.HEAP_PROFILE_FOLDED)) as folded_file:
+      assert folded_file.read() == ("main;Envoy::Buffer::OwnedImpl::add 6000\n"
+                                    "main;Envoy::Http::HeaderMapImpl::addCopy 2000\n")
+
+
+def test_collect_without_dumps():
+  """Verify that we raise an error if Envoy wrote no heap profiles."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    profiler = heap_profiler.HeapProfiler(proto_profiling.ProfilingOptions(heap_profile=True),
+                                          output_dir)
+
+    with pytest.raises(heap_profiler.HeapProfilerError) as profiler_error:
+      profiler.collect('/usr/local/bin/envoy')
+
+    assert "No Envoy heap profiles were written" in str(profiler_error.value)
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,125 @@
+"""Test the comparison of profiles between benchmark runs."""
+import json
+import os
+import tempfile
+import pytest
+
+from src.lib.profiling import (cpu_profiler, flame_graph, heap_profiler, profile_comparison)
+
+
+def _write_profile(run_dir, stacks):
+  """Write folded stacks where the benchmark stores its CPU profile."""
+  profile_dir = os.path.join(run_dir, cpu_profiler.PROFILE_DIRECTORY)
+  os.makedirs(profile_dir)
+  flame_graph.write_folded(os.path.join(profile_dir, cpu_profiler.CPU_PROFILE_FOLDED), stacks)
+
+
+def test_compare_cpu_profiles():
+  """Verify that a comparison writes the diff, flame graph and function report."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    baseline_dir = os.path.join(output_dir, 'baseline')
+    candidate_dir = os.path.join(output_dir, 'candidate')
+    report_dir = os.path.join(output_dir, 'profiles')
+    _write_profile(baseline_dir, {'main;parse': 50, 'main;encode': 50})
+    _write_profile(candidate_dir, {'main;parse': 90, 'main;encode': 10})
+
+    svg_path = profile_comparison.compare_cpu_profiles(baseline_dir, candidate_dir, report_dir,
+                                                       'v1.1.0', 'v1.2.0')
+
+    assert svg_path == os.path.join(report_dir, 'cpu_diff__v1.1.0__v1.2.0.svg')
+    assert os.path.exists(svg_path)
+    with open(os.path.join(report_dir, 'cpu_diff__v1.1.0__v1.2.0.folded')) as diff_file:
+      assert diff_file.read() == "main;encode 50 10\nmain;parse 50 90\n"
+
+    with open(os.path.join(report_dir, 'cpu_diff__v1.1.0__v1.2.0.txt')) as report_file:
+      report = report_file.read().split('\n')
+    assert report[0] == "CPU profile comparison: v1.1.0 (baseline) -> v1.2.0 (candidate)"
+    assert report[3].endswith('parse')
+    assert '+40.00%' in report[3]
+
+
+def test_compare_cpu_profiles_missing_profile():
+  """Verify that we raise an error if a run has no profile."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    with pytest.raises(profile_comparison.ProfileComparisonError) as comparison_error:
+      profile_comparison.compare_cpu_profiles(output_dir, output_dir, output_dir, 'a', 'b')
+
+    assert "No CPU profile found" in str(comparison_error.value)
+
+
+def _write_heap_profile(run_dir, stacks, alloc_rate, tests=None):
+  """Write the folded allocations and summary where the benchmark stores its heap profile."""
+  profile_dir = os.path.join(run_dir, cpu_profiler.PROFILE_DIRECTORY)
+  os.makedirs(profile_dir)
+  flame_graph.write_folded(os.path.join(profile_dir, heap_profiler.HEAP_PROFILE_FOLDED), stacks)
+  with open(os.path.join(profile_dir, heap_profiler.HEAP_PROFILE_SUMMARY), 'w') as summary_file:
+    summary = {'alloc_rate': alloc_rate, 'alloc_bytes': sum(stacks.values())}
+    if tests is not None:
+      summary['tests'] = tests
+    json.dump(summary, summary_file)
+
+
+def test_compare_heap_profiles():
+  """Verify that a comparison reports the allocation rate delta and allocation sites."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    baseline_dir = os.path.join(output_dir, 'baseline')
+    candidate_dir = os.path.join(output_dir, 'candidate')
+    report_dir = os.path.join(output_dir, 'profiles')
+    _write_heap_profile(baseline_dir, {'main;add': 1048576, 'main;copy': 1048576}, 1048576)
+    _write_heap_profile(candidate_dir, {'main;add': 3145728, 'main;copy': 1048576}, 2097152)
+
+    report_path = profile_comparison.compare_heap_profiles(baseline_dir, candidate_dir, report_dir,
+                                                           'v1.1.0', 'v1.2.0')
+
+    assert report_path == os.path.join(report_dir, 'heap_diff__v1.1.0__v1.2.0.txt')
+    assert os.path.exists(os.path.join(report_dir, 'heap_diff__v1.1.0__v1.2.0.svg'))
+    with open(report_path) as report_file:
+      report = report_file.read().split('\n')
+    assert report[0] == "Heap profile comparison: v1.1.0 (baseline) -> v1.2.0 (candidate)"
+    assert report[2] == "Allocation rate: 1.00 MiB/s -> 2.00 MiB/s (+100.00%)"
+    assert report[3] == "Allocated bytes: 2.00 MiB -> 4.00 MiB (+100.00%)"
+    assert report[6].endswith('add')
+    assert '+25.00%' in report[6]
+
+
+def test_compare_heap_profiles_per_test():
+  """Verify that a comparison reports the heap growth of the tests found in both runs."""
+  stacks = {'main;add': 1048576}
+  with tempfile.TemporaryDirectory() as output_dir:
+    baseline_dir = os.path.join(output_dir, 'baseline')
+    candidate_dir = os.path.join(output_dir, 'candidate')
+    _write_heap_profile(
+        baseline_dir, stacks, 1048576, {
+            'test_http_h1': {
+                'inuse_growth_bytes': 1048576
+            },
+            'test_baseline_only': {
+                'inuse_growth_bytes': 1048576
+            },
+        })
+    _write_heap_profile(candidate_dir, stacks, 1048576,
+                        {'test_http_h1': {
+                            'inuse_growth_bytes': 3145728
+                        }})
+
+    report_path = profile_comparison.compare_heap_profiles(baseline_dir, candidate_dir, output_dir,
+                                                           'a', 'b')
+
+    with open(report_path) as report_file:
+      report = report_file.read().split('\n')
+    assert report[5:8] == [
+        "Heap growth per test:", "  test_http_h1: 1.00 MiB -> 3.00 MiB (+200.00%)", ""
+    ]
+
+
+def test_compare_heap_profiles_missing_profile():
+  """Verify that we raise an error if a run has no heap profile."""
+  with tempfile.TemporaryDirectory() as output_dir:
+    with pytest.raises(profile_comparison.ProfileComparisonError) as comparison_error:
+      profile_comparison.compare_heap_profiles(output_dir, output_dir, output_dir, 'a', 'b')
+
+    assert "No heap profile found" in str(comparison_error.value)
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
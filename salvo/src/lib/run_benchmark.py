@@ -1,20 +1,26 @@
 """General benchmark wrapper that validates that the job control contains all dat required for \
   eachknown benchmark."""
+import functools
 import logging
 import os
-from typing import (List, Set)
+import time
+from typing import (List, Optional, Set)
 
 from src.lib.benchmark import fully_dockerized_benchmark as fulldocker
 from src.lib.benchmark import scavenging_benchmark as scavenging
 from src.lib.benchmark import binary_benchmark
 from src.lib.benchmark import base_benchmark
 
+from src.lib.common import (artifact_store, change_points, html_report, metrics_export, noise_model,
+                            results_db, watchdog)
 from src.lib.docker_management import (docker_image, docker_image_builder)
-from src.lib import source_manager
+from src.lib.profiling import (cpu_profiler, profile_comparison)
+from src.lib import (pipeline, source_manager)
 
 import api.control_pb2 as proto_control
 import api.source_pb2 as proto_source
 import api.image_pb2 as proto_image
+import api.profiling_pb2 as proto_profiling
 
 log = logging.getLogger(__name__)
 
@@ -23,10 +29,38 @@ class BenchmarkRunnerError(Exception):
   """An error raised if if an unrecoverable condition arises when executing a benchmark."""
 
 
+def _get_benchmark_version(benchmark: base_benchmark.BaseBenchmark) -> str:
+  """Return the commit hash or tag of the Envoy tested by a benchmark.
+
+  Args:
+    benchmark: The benchmark object. Its image is either a docker image
+      name such as "envoyproxy/envoy:v1.X.X" or a commit hash
+
+  Returns:
+    the tag or commit hash identifying the Envoy version
+  """
+  return benchmark.get_image().split(':')[-1]
+
+
+def _get_envoy_image_name(image_hash: str) -> str:
+  """Return the name of the Envoy image built from a commit hash or tag.
+
+  Args:
+    image_hash: The commit hash or tag of the Envoy version
+
+  Returns:
+    the image name, eg "envoyproxy/envoy:v1.X.X"
+  """
+  image_prefix = docker_image_builder.get_envoy_image_prefix(image_hash)
+  return "{prefix}:{hash}".format(prefix=image_prefix, hash=image_hash)
+
+
 class BenchmarkRunner(object):
   """This class contains the logic to validate input artifacts and perform a benchmark."""
 
-  def __init__(self, control: proto_control.JobControl) -> None:
+  def __init__(self,
+               control: proto_control.JobControl,
+               source_cache: Optional[source_manager.SourceCache] = None) -> None:
     """Initialize the benchmark object.
 
     Perform class member initialization and instantiate the underlying
@@ -35,14 +69,18 @@ class BenchmarkRunner(object):
     Args:
       control: The Job Control object dictating the parameters governing the
       benchmark
+      source_cache: The source trees and build cache kept between the jobs
+      of a Salvo server, if any
 
     Returns:
       None
     """
     self._control = control
-    self._source_manager = source_manager.SourceManager(self._control)
+    self._source_cache = source_cache
+    self._source_manager = source_manager.SourceManager(self._control, source_cache)
 
     self._test = []
+    self._failures = []
     self._setup_test()
 
   def _setup_test(self) -> None:
@@ -61,7 +99,7 @@ class BenchmarkRunner(object):
       job_control_list = self._generate_job_control_for_envoy_images()
 
       for job_control in job_control_list:
-        benchmark = scavenging.Benchmark(job_control, current_benchmark_name)
+        benchmark = scavenging.Benchmark(job_control, current_benchmark_name, self._source_cache)
         self._test.append(benchmark)
 
     elif self._control.dockerized_benchmark:
@@ -69,7 +107,7 @@ class BenchmarkRunner(object):
       job_control_list = self._generate_job_control_for_envoy_images()
 
       for job_control in job_control_list:
-        benchmark = fulldocker.Benchmark(job_control, current_benchmark_name)
+        benchmark = fulldocker.Benchmark(job_control, current_benchmark_name, self._source_cache)
         self._test.append(benchmark)
 
     elif self._control.binary_benchmark:
@@ -78,7 +116,8 @@ class BenchmarkRunner(object):
       job_control_list = self._generate_job_control_for_binaries()
 
       for job_control in job_control_list:
-        benchmark = binary_benchmark.Benchmark(job_control, current_benchmark_name)
+        benchmark = binary_benchmark.Benchmark(job_control, current_benchmark_name,
+                                               self._source_cache)
         self._test.append(benchmark)
 
     if not self._test:
@@ -89,17 +128,21 @@ class BenchmarkRunner(object):
     """Determine the required envoy images needed for the benchmark.
 
     Find the commit hashes or tags for all envoy images, build images if
-    necessary.
+    necessary. When the benchmarks are pipelined, the images are pulled or
+    built as the benchmarks execute.
     """
     # Get the images that we are benchmarking. Source Manager will
     # determine the commit hashes for the images used for benchmarks
     image_hashes = self._source_manager.get_envoy_hashes_for_benchmark()
 
-    envoy_images = self._pull_or_build_envoy_images_for_benchmark(image_hashes)
-    if not envoy_images:
-      raise Exception("Unable to find or build images for benchmark")
+    if self._control.pipeline.enabled:
+      envoy_images = set(map(_get_envoy_image_name, image_hashes))
+    else:
+      envoy_images = self._pull_or_build_envoy_images_for_benchmark(image_hashes)
+      if not envoy_images:
+        raise Exception("Unable to find or build images for benchmark")
 
-    self._pull_or_build_nighthawk_images_for_benchmark()
+      self._pull_or_build_nighthawk_images_for_benchmark()
 
     log.debug(f"Using {envoy_images} for benchmark")
     job_control_list = self._create_job_control_for_images(envoy_images)
@@ -195,8 +238,8 @@ class BenchmarkRunner(object):
       raise BenchmarkRunnerError("No NightHawk Binary Image specified")
 
     # TODO: If bazel options are specified, we need to build the images.
-    # Specific case is if we enable CpuProfiling, this is not available in
-    # the stock image.
+    # CPU profiles are sampled from the host with perf, so the stock images
+    # can be profiled. Profiling with gperftools requires the binary benchmark.
 
     self._pull_or_build_nh_benchmark_image(images)
     self._pull_or_build_nh_binary_image(images)
@@ -211,31 +254,36 @@ class BenchmarkRunner(object):
       a Set of envoy image tags required for the benchmark:
         eg ["envoyproxy/envoy:v1.X.X", ...]
     """
-    have_build_options = self._source_manager.have_build_options(
-        proto_source.SourceRepository.SourceIdentity.SRCID_ENVOY)
+    log.debug(f"Finding matching images for hashes: {image_hashes}")
 
-    envoy_images = set()
-    image_manager = docker_image.DockerImage()
+    return set(map(self._pull_or_build_envoy_image, image_hashes))
 
-    log.debug(f"Finding matching images for hashes: {image_hashes}")
+  def _pull_or_build_envoy_image(self, image_hash: str) -> str:
+    """Pull the docker image for an Envoy version. If the image is not available build it.
+
+    Args:
+      image_hash: The commit hash or tag of the Envoy version
 
-    for image_hash in image_hashes:
-      image_prefix = docker_image_builder.get_envoy_image_prefix(image_hash)
-      envoy_image = "{prefix}:{hash}".format(prefix=image_prefix, hash=image_hash)
+    Returns:
+      the name of the Envoy image, eg "envoyproxy/envoy:v1.X.X"
+    """
+    have_build_options = self._source_manager.have_build_options(
+        proto_source.SourceRepository.SourceIdentity.SRCID_ENVOY)
 
-      image_object = None
-      try:
-        image_object = image_manager.pull_image(envoy_image)
-      except docker_image.DockerImagePullError:
-        log.error(f"Image pull failed for {envoy_image}")
+    image_manager = docker_image.DockerImage()
+    envoy_image = _get_envoy_image_name(image_hash)
 
-      if have_build_options or not image_object:
-        log.debug(f"Attempting to build {envoy_image}")
-        docker_image_builder.build_envoy_image_from_source(self._source_manager, image_hash)
+    image_object = None
+    try:
+      image_object = image_manager.pull_image(envoy_image)
+    except docker_image.DockerImagePullError:
+      log.error(f"Image pull failed for {envoy_image}")
 
-      envoy_images.add(envoy_image)
+    if have_build_options or not image_object:
+      log.debug(f"Attempting to build {envoy_image}")
+      docker_image_builder.build_envoy_image_from_source(self._source_manager, image_hash)
 
-    return envoy_images
+    return envoy_image
 
   def _create_new_job_control(self, envoy_image) -> proto_control.JobControl:
     """Duplicate the job control for a specific benchmark run.
@@ -344,7 +392,8 @@ class BenchmarkRunner(object):
     output directory containing the artifacts for the image beign tested.  The
     target of the link is the tag or commit hash from which the docker image
     was created.  This is analogous to the set of bazel-* directories created
-    in a build.
+    in a build. A link left by an earlier job, such as a job of the Salvo
+    server writing to another output directory, is replaced.
 
     Args:
       output_dir: The location on disk where output artifacts are placed
@@ -353,12 +402,14 @@ class BenchmarkRunner(object):
     Returns:
       None
     """
-    if os.path.islink(image_tag) and output_dir == os.readlink(image_tag):
-      return
-
     if not os.path.isdir(output_dir):
       os.makedirs(output_dir, 0o755)
 
+    if os.path.islink(image_tag):
+      if output_dir == os.readlink(image_tag):
+        return
+      os.remove(image_tag)
+
     # Create a symbolic link pointing to 'output_dir' named 'image_tag'.
     os.symlink(output_dir, image_tag)
 
@@ -370,7 +421,8 @@ class BenchmarkRunner(object):
     operations deducing commits or hashes are incorrect we fail faster.
 
     The benchmarks are run sequentially so that they do not interfere with each
-    other.
+    other. If pipelining is enabled, the artifacts for a benchmark are built
+    while the previous benchmark executes.
 
     Raises:
       NotImplementedError: we have not implemented remote benchmarks yet.  This
@@ -381,8 +433,289 @@ class BenchmarkRunner(object):
       # Kick things off in parallel
       raise NotImplementedError("Remote benchmarks have not been implemented yet")
 
+    if self._control.pipeline.enabled:
+      self._execute_pipeline()
+    else:
+      for benchmark in self._test:
+        self._execute_benchmark(benchmark)
+
+    self._compare_profiles()
+    self._record_results()
+    self._export_metrics()
+    self._write_report()
+    self._pack_artifacts()
+
+  def _execute_benchmark(self, benchmark: base_benchmark.BaseBenchmark) -> None:
+    """Run one of the instantiated benchmarks.
+
+    Args:
+      benchmark: The benchmark to execute
+    """
     bar = '=' * 20
-    for benchmark in self._test:
-      log.info(f"{bar} Running {benchmark.get_name()} for "
-               f"{benchmark.get_image()} {bar}")
+    log.info(f"{bar} Running {benchmark.get_name()} for "
+             f"{benchmark.get_image()} {bar}")
+    try:
       benchmark.execute_benchmark()
+    except base_benchmark.BenchmarkAborted as aborted:
+      # The reason is recorded in the output directory of the benchmark.
+      # The remaining benchmarks still produce usable results
+      log.error(f"{benchmark.get_name()} for {benchmark.get_image()} was aborted, "
+                f"continuing with the next benchmark")
+      self._failures.append(aborted.reason)
+
+  def get_failures(self) -> List[watchdog.FailureReason]:
+    """Return the reasons of the benchmarks that were aborted."""
+    return self._failures
+
+  def _execute_pipeline(self) -> None:
+    """Run the benchmarks, building the artifacts of each one while the previous one executes.
+
+    Binary benchmarks build Nighthawk and Envoy from source. The other
+    benchmarks share the Nighthawk images, which are pulled or built first,
+    and pull or build the image of the Envoy they test.
+    """
+    stages = []
+    for benchmark in self._test:
+      if self._control.binary_benchmark:
+        prepare = benchmark.prepare_benchmark
+      else:
+        prepare = functools.partial(self._pull_or_build_envoy_image,
+                                    _get_benchmark_version(benchmark))
+
+      stages.append(
+          pipeline.PipelineStage(prepare=prepare,
+                                 execute=functools.partial(self._execute_benchmark, benchmark),
+                                 output_dir=benchmark.get_output_dir()))
+
+    setup = None
+    if not self._control.binary_benchmark:
+      setup = self._pull_or_build_nighthawk_images_for_benchmark
+
+    pipeline.BenchmarkPipeline(self._control.pipeline).execute(stages, setup)
+
+  def _get_candidate_version(self) -> str:
+    """Return the commit hash or tag of the Envoy being evaluated.
+
+    The candidate is the Envoy image or commit hash specified in the job
+    control document. All other tested versions are baselines.
+    """
+    envoy_image = self._control.images.envoy_image
+    if envoy_image:
+      return envoy_image.split(':')[-1]
+
+    envoy_source = self._source_manager.get_source_repository(
+        proto_source.SourceRepository.SourceIdentity.SRCID_ENVOY)
+    return envoy_source.commit_hash
+
+  def _get_candidate_benchmark(self) -> Optional[base_benchmark.BaseBenchmark]:
+    """Return the benchmark of the Envoy being evaluated, if it was instantiated."""
+    candidate_version = self._get_candidate_version()
+    return next(filter(lambda b: _get_benchmark_version(b) == candidate_version, self._test), None)
+
+  def _compare_profiles(self) -> None:
+    """Compare the profiles of each baseline run with the candidate run.
+
+    A differential flame graph is generated for CPU profiles, and the
+    allocation rate and sites are compared for heap profiles. The
+    comparisons are written to the profiles directory under the output
+    directory of the job.
+    """
+    profiling = self._control.profiling
+    compare_cpu = profiling.cpu_profiler != proto_profiling.ProfilingOptions.CPU_PROFILER_UNSPECIFIED
+    if not (compare_cpu or profiling.heap_profile):
+      return
+
+    candidate_version = self._get_candidate_version()
+    candidate = self._get_candidate_benchmark()
+    if not candidate:
+      log.warning(f"No benchmark found for candidate [{candidate_version}]. "
+                  "Skipping the profile comparison")
+      return
+
+    comparisons = []
+    if compare_cpu:
+      comparisons.append(profile_comparison.compare_cpu_profiles)
+    if profiling.heap_profile:
+      comparisons.append(profile_comparison.compare_heap_profiles)
+
+    report_dir = os.path.join(self._control.environment.output_dir, cpu_profiler.PROFILE_DIRECTORY)
+    for baseline in self._test:
+      if baseline is candidate:
+        continue
+
+      for compare in comparisons:
+        try:
+          compare(baseline.get_output_dir(), candidate.get_output_dir(), report_dir,
+                  _get_benchmark_version(baseline), candidate_version)
+        except profile_comparison.ProfileComparisonError as comparison_error:
+          log.error(f"Unable to compare profiles: {comparison_error}")
+
+  def _record_results(self) -> None:
+    """Record the results of the benchmarks in the results database.
+
+    The candidate and the baselines are recorded with their role and the
+    host profile. The candidate is then scored against the noise model,
+    and the change points of the recorded history detected, if enabled.
+    Aborted benchmarks are not recorded since their results are unusable.
+    A failure to record the results is logged without failing the job.
+    """
+    options = self._control.results_database
+    if not options.enabled:
+      if self._control.noise_model.enabled:
+        log.warning("The noise model requires the results database. Skipping the scoring")
+      if self._control.change_points.enabled:
+        log.warning("Change point detection requires the results database. Skipping it")
+      return
+
+    database_path = results_db.get_database_path(options, self._control.environment.output_dir)
+    host_profile = results_db.get_host_profile(options)
+    candidate = self._get_candidate_benchmark()
+    try:
+      with results_db.ResultsDatabase(database_path) as database:
+        for benchmark in self._test:
+          output_dir = benchmark.get_output_dir()
+          if os.path.exists(os.path.join(output_dir, watchdog.FAILURE_REPORT_FILE)):
+            continue
+
+          image, image_digest = '', ''
+          if not self._control.binary_benchmark:
+            image = benchmark.get_image()
+            image_digest = docker_image.DockerImage().get_image_digest(image)
+          role = results_db.ROLE_CANDIDATE if benchmark is candidate else results_db.ROLE_BASELINE
+          database.record_benchmark(output_dir,
+                                    _get_benchmark_version(benchmark),
+                                    image,
+                                    image_digest,
+                                    benchmark.get_name(),
+                                    host_profile=host_profile,
+                                    role=role)
+
+        if self._control.noise_model.enabled:
+          self._score_candidate(database, host_profile)
+        if self._control.change_points.enabled:
+          change_points.write_report(
+              change_points.analyze_database(database, self._control.change_points, host_profile),
+              self._control.environment.output_dir)
+    except results_db.ResultsDatabaseError as database_error:
+      log.error(f"Unable to record the benchmark results: {database_error}")
+
+  def _score_candidate(self, database: results_db.ResultsDatabase, host_profile: str) -> None:
+    """Score the results of the candidate against the noise model of the baselines.
+
+    The scores are written to the output directory of the candidate.
+
+    Args:
+      database: The results database, in which the runs of the job are
+        already recorded
+      host_profile: The host configuration of the job
+    """
+    candidate = self._get_candidate_benchmark()
+    if not candidate or os.path.exists(
+        os.path.join(candidate.get_output_dir(), watchdog.FAILURE_REPORT_FILE)):
+      log.warning("No candidate results to score against the noise model")
+      return
+
+    test_metrics = {}
+    for test, results_path in results_db.find_test_results(candidate.get_output_dir()).items():
+      with open(results_path) as results_file:
+        test_metrics[test] = results_db.parse_nighthawk_results(results_file.read())
+
+    model = noise_model.NoiseModel(self._control.noise_model, database, host_profile)
+    model.write_scores(model.score_run(test_metrics), candidate.get_output_dir())
+
+  def _export_metrics(self) -> None:
+    """Export the metrics of the benchmarks as OpenMetrics text and to remote-write.
+
+    The metrics of every completed benchmark are written to one file and
+    pushed to the remote-write endpoint, if specified, in a single batched
+    push. A failure to export the metrics is logged without failing the job.
+    """
+    options = self._control.metrics_export
+    if not options.enabled:
+      return
+
+    host_profile = results_db.get_host_profile(self._control.results_database)
+    candidate = self._get_candidate_benchmark()
+    timestamp = time.time()
+    try:
+      samples = []
+      for benchmark in self._test:
+        output_dir = benchmark.get_output_dir()
+        if os.path.exists(os.path.join(output_dir, watchdog.FAILURE_REPORT_FILE)):
+          continue
+        role = results_db.ROLE_CANDIDATE if benchmark is candidate else results_db.ROLE_BASELINE
+        samples += metrics_export.collect_run_samples(output_dir, _get_benchmark_version(benchmark),
+                                                      host_profile, role, timestamp)
+
+      metrics_export.write_openmetrics(
+          samples, metrics_export.get_export_path(options, self._control.environment.output_dir))
+      if options.remote_write_url:
+        metrics_export.RemoteWriter(options.remote_write_url, options.batch_size,
+                                    options.timeout_seconds).push(samples)
+    except metrics_export.MetricsExportError as export_error:
+      log.error(f"Unable to export the benchmark metrics: {export_error}")
+
+  def _write_report(self) -> None:
+    """Write the HTML report comparing the tested Envoy versions.
+
+    The baselines are followed by the candidate, and every version is
+    compared with the first baseline. When the results database is
+    enabled, every recorded repetition of each version is included.
+    Aborted benchmarks are left out of the report.
+    """
+    if not self._control.report.enabled:
+      return
+
+    candidate_version = self._get_candidate_version()
+    benchmarks = sorted(
+        (b for b in self._test
+         if not os.path.exists(os.path.join(b.get_output_dir(), watchdog.FAILURE_REPORT_FILE))),
+        key=lambda b: _get_benchmark_version(b) == candidate_version)
+    if not benchmarks:
+      log.warning("No benchmark completed. Skipping the report")
+      return
+
+    database = None
+    try:
+      if self._control.results_database.enabled:
+        database = results_db.ResultsDatabase(
+            results_db.get_database_path(self._control.results_database,
+                                         self._control.environment.output_dir))
+      versions = [
+          html_report.load_version_results(_get_benchmark_version(benchmark),
+                                           benchmark.get_output_dir(), database)
+          for benchmark in benchmarks
+      ]
+      html_report.write_report(
+          versions, os.path.join(self._control.environment.output_dir, html_report.REPORT_FILE),
+          f"{benchmarks[0].get_name()}: {' vs '.join(v.version for v in versions)}",
+          self._control.report.max_points)
+    except (OSError, ValueError, results_db.ResultsDatabaseError) as report_error:
+      log.error(f"Unable to write the report: {report_error}")
+    finally:
+      if database:
+        database.close()
+
+  def _pack_artifacts(self) -> None:
+    """Pack the output directories of the benchmarks into the artifact store.
+
+    The store is the "artifacts" directory under the output directory of the
+    job unless another directory is specified. Packing is attempted once all
+    benchmarks executed, so a failure leaves the artifacts in place.
+    """
+    packing = self._control.artifact_packing
+    if not packing.enabled:
+      return
+
+    store_dir = packing.store_dir or os.path.join(self._control.environment.output_dir, 'artifacts')
+    run_dirs = [
+        benchmark.get_output_dir()
+        for benchmark in self._test
+        if os.path.isdir(benchmark.get_output_dir())
+    ]
+    try:
+      artifact_store.ArtifactPacker(store_dir,
+                                    packing.compression_level).pack(run_dirs,
+                                                                    packing.keep_originals)
+    except artifact_store.ArtifactStoreError as packing_error:
+      log.error(f"Unable to pack the benchmark artifacts: {packing_error}")
@@ -1,6 +1,8 @@
 """This module abstracts the higher level functions of managing source code."""
 import logging
-from typing import Set
+import os
+import threading
+from typing import (Optional, Set)
 
 from src.lib import (constants, source_tree)
 
@@ -34,6 +36,71 @@ class SourceManagerError(Exception):
   """Raised when an unrecoverable error is encountered while working with a source tree."""
 
 
+class SourceCache(object):
+  """The source trees and the build cache kept between the jobs of a Salvo server.
+
+  Each job gets the source tree of a repository fetched by an earlier job
+  from the same location, brought up to date with a single fetch, and runs
+  its builds with the same HOME directory, so that the Bazel output base and
+  server of the previous build are reused.
+
+  A tree is leased to the job it is handed to until the next job starts, so
+  that the benchmarks of a job each build their commit in a working
+  directory of their own. A tree of an earlier job at the same commit is
+  preferred, since its build outputs are current.
+  """
+
+  def __init__(self, cache_dir: str) -> None:
+    """Keep the build cache in a directory.
+
+    Args:
+      cache_dir: The directory holding the build cache. It is created if it
+        does not exist
+    """
+    self._build_cache_dir = os.path.join(cache_dir, 'build')
+    self._source_trees = []
+    # The trees handed to the source managers of the running job
+    self._leased_trees = []
+    self._lock = threading.Lock()
+
+  def get_build_cache_dir(self) -> str:
+    """Return the HOME directory of the builders, creating it if needed."""
+    os.makedirs(self._build_cache_dir, exist_ok=True)
+    return self._build_cache_dir
+
+  def start_job(self) -> None:
+    """Make the source trees leased to the finished jobs available to the next job."""
+    with self._lock:
+      self._leased_trees = []
+
+  def get_source_tree(self, source_repo: proto_source.SourceRepository) -> source_tree.SourceTree:
+    """Return a source tree for a repository, reusing the tree of an earlier job if possible.
+
+    Args:
+      source_repo: The repository of the job
+
+    Returns:
+      a source tree managing the repository, which is not returned again
+        until the next job starts
+    """
+    with self._lock:
+      available = [
+          tree for tree in self._source_trees
+          if tree.matches(source_repo) and tree not in self._leased_trees
+      ]
+      same_revision = [tree for tree in available if tree.matches_revision(source_repo)]
+      for tree in same_revision + available:
+        reused = tree.refresh(source_repo)
+        log.debug(f"Reusing {tree} fetched by an earlier job. Refreshed: {reused}")
+        self._leased_trees.append(tree)
+        return tree
+
+      tree = source_tree.SourceTree(source_repo)
+      self._source_trees.append(tree)
+      self._leased_trees.append(tree)
+      return tree
+
+
 class SourceManager(object):
   """This class is a manager for SourceTree objects.
 
@@ -41,13 +108,18 @@ class SourceManager(object):
   code checked out on disk.
   """
 
-  def __init__(self, control: proto_control.JobControl) -> None:
+  def __init__(self,
+               control: proto_control.JobControl,
+               source_cache: Optional[SourceCache] = None) -> None:
     """Set the job control containing the source locations.
 
     Args:
       control: The JobControl object defining the parameters of the benchmark
+      source_cache: The source trees and build cache kept between jobs, if
+        any. By default, the sources are fetched and built from scratch
     """
     self._control = control
+    self._source_cache = source_cache
     self._builder = None
     self._source_tree = {}
     for source_id, _ in _KNOWN_REPOSITORIES.items():
@@ -288,8 +360,14 @@ class SourceManager(object):
       a source tree object managing the identified source repository
     """
     repo = self.get_source_repository(source_id)
+    if self._source_cache:
+      return self._source_cache.get_source_tree(repo)
     return source_tree.SourceTree(repo)
 
+  def get_build_cache_dir(self) -> str:
+    """Return the HOME directory kept between the builds of jobs, or an empty string if none."""
+    return self._source_cache.get_build_cache_dir() if self._source_cache else ''
+
   def get_source_tree(
       self, source_id: proto_source.SourceRepository.SourceIdentity) -> source_tree.SourceTree:
     """Return the source tree object identified by source_id.
@@ -4,10 +4,11 @@ import logging
 import os
 import shutil
 import subprocess
-from typing import List
+import time
+from typing import (List, Optional)
 
-from src.lib import (cmd_exec, constants)
-from src.lib.common import file_ops
+from src.lib import (cmd_exec, commit_index, constants)
+from src.lib.common import (cost_accounting, file_ops, trace)
 
 import api.source_pb2 as proto_source
 
@@ -30,6 +31,18 @@ _GIT_ORIGIN_REGEX = r'^origin\s*([\w:@\.\/-]+)\s\(fetch\)$'
 # We extract the branch 'original/master' and the digit '1'
 _REPO_STATUS_REGEX = r'.*ahead of \'(.*)\' by (\d+) commit'
 
+# _REV_LIST_CMD lists the commits merged through GitHub, excluding merge
+# commits, newest first
+_REV_LIST_CMD = "git rev-list --no-merges --committer='GitHub <noreply@github.com>'"
+
+# _FULL_HASH_REGEX matches complete commit hashes, the only commits that
+# can be fetched from a remote repository by hash
+_FULL_HASH_REGEX = r'^[0-9a-f]{40}$'
+
+# The number of commits fetched by the shallow strategy if unspecified: the
+# commit under test and its parent
+DEFAULT_FETCH_DEPTH = 2
+
 
 class SourceTreeError(Exception):
   """Raised if we encounter a condition from which we cannot recover, when manipulating SourceTree \
@@ -66,6 +79,14 @@ class SourceTree(object):
 
     self._source_repo = source_repo
 
+    # The source is fetched once, and the commits and tags are indexed on
+    # first use after each fetch
+    self._fetched = False
+    # Whether the history was fetched by the shallow strategy
+    self._shallow = False
+    self._commit_index = None
+    self._tag_index = None
+
   def __repr__(self) -> str:
     """Return a string representation of this class."""
     result = f"{type(self).__name__}: "
@@ -164,6 +185,7 @@ class SourceTree(object):
 
     return str(self._build_dir.name)
 
+  @trace.traced()
   def copy_source_directory(self) -> bool:
     """Clone the original source directory.
 
@@ -197,8 +219,12 @@ class SourceTree(object):
                     symlinks=False,
                     ignore=ignore_bazel)
 
+    self._invalidate_indexes()
+    self._fetched = True
+    self._shallow = False
     return True
 
+  @trace.traced()
   def pull(self) -> bool:
     """Retrieve the code from the repository.
 
@@ -220,6 +246,7 @@ class SourceTree(object):
 
     try:
       if self.is_up_to_date():
+        self._fetched = True
         return True
     except subprocess.CalledProcessError:
       log.info("Source likely does not exist on disk")
@@ -227,14 +254,250 @@ class SourceTree(object):
     if not self._source_repo.source_url:
       self._source_repo.source_url = self.get_origin()
 
-    # Clone into the working directory
-    cmd = "git clone {origin} .".format(origin=self._source_repo.source_url)
+    size_before = self._get_repository_size()
+    start = time.monotonic()
+    if self._source_repo.fetch_strategy == proto_source.SourceRepository.FETCH_SHALLOW:
+      self._fetched = self._fetch_shallow()
+      self._shallow = self._fetched
+    else:
+      self._fetched = self._clone()
+    self._record_fetch('clone', size_before, start)
+
+    self._invalidate_indexes()
+    return self._fetched
+
+  def matches(self, source_repo: proto_source.SourceRepository) -> bool:
+    """Return whether the tree fetches the source of a repository from the same location."""
+    return (self._source_repo.identity, self._source_repo.source_url,
+            self._source_repo.source_path, self._source_repo.fetch_strategy) == \
+        (source_repo.identity, source_repo.source_url, source_repo.source_path,
+         source_repo.fetch_strategy)
+
+  def matches_revision(self, source_repo: proto_source.SourceRepository) -> bool:
+    """Return whether the tree was last prepared for the same commit or branch of a repository."""
+    return (self._source_repo.commit_hash, self._source_repo.branch) == \
+        (source_repo.commit_hash, source_repo.branch)
+
+  @trace.traced()
+  def refresh(self, source_repo: proto_source.SourceRepository) -> bool:
+    """Reuse the working directory of the tree for the repository of another job.
+
+    A tree pulled for an earlier job is brought up to date with a single
+    fetch of the commit or branch of the repository, instead of a new clone.
+    Any other tree is fetched again on first use.
+
+    Args:
+      source_repo: The repository of the next job, from the same location
+        as the repository of the tree
+
+    Returns:
+      a boolean indicating whether the working directory was reused
+    """
+    fetched = self._fetched and os.path.isdir(os.path.join(self.get_source_directory(), '.git'))
+    self._source_repo = source_repo
+    self._invalidate_indexes()
+    self._fetched = False
+    if not fetched or not self._source_repo.source_url:
+      return False
+
+    ref = self._source_repo.commit_hash or self._source_repo.branch or 'HEAD'
+    # A shallow tree keeps its depth, and lists the tags of the remote
+    options = f"--depth={self._get_fetch_depth()}" if self._shallow else "--tags"
+    size_before = self._get_repository_size()
+    start = time.monotonic()
+    try:
+      self._run_git(f"git fetch {options} origin {ref}")
+      self._run_git("git checkout --detach FETCH_HEAD")
+    except subprocess.CalledProcessError as fetch_error:
+      log.error(f"Unable to refresh {ref} from {self._source_repo.source_url}: {fetch_error}")
+      # Start over from an empty directory, so that the source is cloned again
+      file_ops.delete_directory(self.get_source_directory())
+      os.mkdir(self.get_source_directory())
+      return False
+    finally:
+      self._record_fetch('refresh', size_before, start)
+
+    self._fetched = True
+    return True
+
+  def _run_git(self, cmd: str) -> str:
+    """Run a git command in the source directory and return its output."""
     cmd_params = cmd_exec.CommandParameters(cwd=self.get_source_directory())
-    output = cmd_exec.run_command(cmd, cmd_params)
+    return cmd_exec.run_command(cmd, cmd_params)
+
+  def _get_fetch_depth(self) -> int:
+    """Return the number of commits fetched by the shallow strategy."""
+    return self._source_repo.fetch_depth or DEFAULT_FETCH_DEPTH
+
+  def _clone(self) -> bool:
+    """Clone the repository into the working directory.
+
+    The blob-less strategy clones every commit without the file contents,
+    which are fetched by git when a commit is checked out.
+
+    Returns:
+      a boolean indicating whether the clone was successful
+    """
+    options = ''
+    if self._source_repo.fetch_strategy == proto_source.SourceRepository.FETCH_BLOBLESS:
+      options = '--filter=blob:none '
+
+    cmd = "git clone {options}{origin} .".format(options=options,
+                                                 origin=self._source_repo.source_url)
+    output = self._run_git(cmd)
     expected = 'Cloning into \'.\''
 
     return expected in output
 
+  def _fetch_shallow(self) -> bool:
+    """Fetch the commit under test and a limited number of its ancestors.
+
+    The commit under test is the commit hash of the repository, or else the
+    head of its branch or of its default branch.
+
+    Returns:
+      a boolean indicating whether the fetch was successful
+    """
+    ref = self._source_repo.commit_hash or self._source_repo.branch or 'HEAD'
+    commands = [
+        "git init",
+        f"git remote add origin {self._source_repo.source_url}",
+        f"git fetch --depth={self._get_fetch_depth()} origin {ref}",
+        "git checkout --detach FETCH_HEAD",
+    ]
+    try:
+      for cmd in commands:
+        self._run_git(cmd)
+    except subprocess.CalledProcessError as fetch_error:
+      log.error(f"Unable to fetch {ref} from {self._source_repo.source_url}: {fetch_error}")
+      return False
+
+    return True
+
+  def _deepen(self, revisions: int) -> bool:
+    """Deepen the history of a shallow fetch.
+
+    Args:
+      revisions: The number of commits by which the history is deepened at
+        least
+
+    Returns:
+      a boolean indicating whether the deepened history has more commits
+    """
+    index = self.get_commit_index()
+    if not index.get_head():
+      return False
+
+    depth = max(self._get_fetch_depth(), revisions)
+    log.debug(f"Deepening the history of {index.get_head()} by {depth} commits")
+    size_before = self._get_repository_size()
+    start = time.monotonic()
+    try:
+      self._run_git(f"git fetch --deepen={depth} origin {index.get_head()}")
+    except subprocess.CalledProcessError as fetch_error:
+      log.error(f"Unable to deepen the history: {fetch_error}")
+      return False
+    finally:
+      self._record_fetch('deepen', size_before, start)
+
+    self._commit_index = None
+    return len(self.get_commit_index()) > len(index)
+
+  def _fetch_commit(self, commit: str, revisions: int) -> None:
+    """Fetch a commit missing from a shallow fetch, with enough history to find its ancestors."""
+    if not re.match(_FULL_HASH_REGEX, commit):
+      return
+
+    depth = max(self._get_fetch_depth(), revisions)
+    size_before = self._get_repository_size()
+    start = time.monotonic()
+    try:
+      self._run_git(f"git fetch --depth={depth} origin {commit}")
+    except subprocess.CalledProcessError as fetch_error:
+      log.error(f"Unable to fetch {commit}: {fetch_error}")
+    finally:
+      self._record_fetch('fetch', size_before, start)
+
+  def _get_repository_size(self) -> int:
+    """Return the size in bytes of the git directory of the source."""
+    git_dir = os.path.join(self.get_source_directory(), '.git')
+    size = 0
+    for directory, _, files in os.walk(git_dir):
+      for name in files:
+        try:
+          size += os.path.getsize(os.path.join(directory, name))
+        except OSError:
+          # Files such as lock files are removed as git runs
+          pass
+    return size
+
+  def _record_fetch(self, operation: str, size_before: int, start: float) -> None:
+    """Record the strategy and the bytes fetched by an operation in the run manifest."""
+    fetch = cost_accounting.Fetch(
+        source=proto_source.SourceRepository.SourceIdentity.Name(self._source_repo.identity),
+        strategy=proto_source.SourceRepository.FetchStrategy.Name(self._source_repo.fetch_strategy),
+        operation=operation,
+        fetched_bytes=max(0,
+                          self._get_repository_size() - size_before),
+        wall_seconds=time.monotonic() - start)
+    log.info(f"The {fetch.operation} of {fetch.source} with {fetch.strategy} fetched "
+             f"{fetch.fetched_bytes} bytes in {fetch.wall_seconds:.1f}s")
+    cost_accounting.record_fetch(fetch)
+
+  def _invalidate_indexes(self) -> None:
+    """Discard the commit and tag indexes once the source is fetched again."""
+    self._commit_index = None
+    self._tag_index = None
+
+  def _fetch_once(self) -> None:
+    """Pull the source, or copy it if it cannot be pulled, unless it was already fetched."""
+    if self._fetched:
+      return
+
+    if not self.pull():
+      log.debug("Source pull failed. Copying source directory")
+      self.copy_source_directory()
+
+  def get_commit_index(self) -> commit_index.CommitIndex:
+    """Return the index of the commits of the checked out branch.
+
+    The commits are listed with a single git command after each fetch.
+    """
+    self._validate()
+
+    if self._commit_index is None:
+      cmd = f"{_REV_LIST_CMD} HEAD"
+      cmd_params = cmd_exec.CommandParameters(cwd=self.get_source_directory())
+      output = cmd_exec.run_command(cmd, cmd_params)
+      commits = [line.strip() for line in output.split('\n') if line.strip()]
+      # Git errors are not hashes, and leave the index empty
+      if 'fatal:' in output:
+        commits = []
+      self._commit_index = commit_index.CommitIndex(commits)
+      log.debug(f"Indexed {len(commits)} commits")
+
+    return self._commit_index
+
+  def get_tag_index(self) -> commit_index.TagIndex:
+    """Return the index of the tags of the repository, listed once after each fetch."""
+    self._validate()
+
+    if self._tag_index is None:
+      if self._shallow:
+        # A shallow fetch has no tags, so they are listed from the origin
+        cmd = "git ls-remote --tags --refs --sort=v:refname origin"
+      else:
+        cmd = "git tag --list --sort v:refname"
+      cmd_params = cmd_exec.CommandParameters(cwd=self.get_source_directory())
+      tag_output = cmd_exec.run_command(cmd, cmd_params)
+
+      # Remote tags are listed as "<hash>\trefs/tags/<tag>"
+      tag_list = [tag.split('refs/tags/')[-1].strip() for tag in tag_output.split('\n') if tag]
+      log.debug(f"Repository tags {tag_list}")
+      self._tag_index = commit_index.TagIndex(tag_list)
+
+    return self._tag_index
+
   def checkout_commit_hash(self) -> bool:
     """Check out the specified commit hash in the source tree.
 
@@ -272,13 +535,7 @@ class SourceTree(object):
       a string containing the hash corresponding to commit at the HEAD of the
         tree.
     """
-    self._validate()
-
-    cmd = ("git rev-list --no-merges --committer='GitHub <noreply@github.com>' "
-           "--max-count=1 HEAD")
-
-    cmd_params = cmd_exec.CommandParameters(cwd=self.get_source_directory())
-    return cmd_exec.run_command(cmd, cmd_params)
+    return self.get_commit_index().get_head()
 
   def get_previous_commit_hash(self, current_commit: str, revisions: int = 2) -> str:
     """Return the specified number of commits behind the current commit hash.
@@ -296,9 +553,7 @@ class SourceTree(object):
     """
     assert current_commit
 
-    if not self.pull():
-      log.debug("Source pull failed. Copying source directory")
-      self.copy_source_directory()
+    self._fetch_once()
 
     log.debug(f"Finding previous commit to current commit: [{current_commit}]")
     if is_tag(current_commit):
@@ -308,8 +563,14 @@ class SourceTree(object):
     if current_commit == 'latest':
       current_commit = self.get_head_hash()
 
-    cmd = "git rev-list --no-merges --committer='GitHub <noreply@github.com>' "
-    cmd += "--max-count={revisions} {commit}".format(revisions=revisions, commit=current_commit)
+    previous_hash = self._get_indexed_ancestor(current_commit, revisions)
+    if previous_hash:
+      log.debug(f"Returning {previous_hash} as the previous commit to "
+                f"{current_commit}")
+      return previous_hash
+
+    # Commits outside of the checked out branch are resolved by git
+    cmd = f"{_REV_LIST_CMD} --max-count={revisions} {current_commit}"
 
     cmd_params = cmd_exec.CommandParameters(cwd=self.get_source_directory())
     hash_list = cmd_exec.run_command(cmd, cmd_params)
@@ -328,6 +589,31 @@ class SourceTree(object):
 
     raise SourceTreeError(f"No commit found prior to {current_commit}")
 
+  def _get_indexed_ancestor(self, commit: str, revisions: int) -> Optional[str]:
+    """Find the ancestor of a commit in the commit index.
+
+    The history of a shallow fetch is deepened until it holds the ancestor,
+    and a commit missing from it is fetched so that git can find its
+    ancestor.
+
+    Args:
+      commit: The hash of the commit
+      revisions: The number of commits listed from the commit
+
+    Returns:
+      the hash of the ancestor, or None if the commit is not indexed
+    """
+    index = self.get_commit_index()
+    if self._shallow and index.resolve(commit) is None:
+      self._fetch_commit(commit, revisions)
+
+    while self._shallow and index.resolve(commit) and not index.has_history(commit, revisions):
+      if not self._deepen(revisions):
+        break
+      index = self.get_commit_index()
+
+    return index.get_ancestor(commit, revisions)
+
   def get_revs_behind_parent_branch(self) -> int:
     """Get the number of commits behind the parent branch. Determine how many commits the current \
       branch on disk is behind the parent branch. If we are up to date, return zero.
@@ -383,16 +669,7 @@ class SourceTree(object):
     Returns:
       a list of tags from the commits
     """
-    self._validate()
-
-    cmd = "git tag --list --sort v:refname"
-    cmd_params = cmd_exec.CommandParameters(cwd=self.get_source_directory())
-    tag_output = cmd_exec.run_command(cmd, cmd_params)
-
-    tag_list = [tag.strip() for tag in tag_output.split('\n') if tag]
-    log.debug(f"Repository tags {tag_list}")
-
-    return tag_list
+    return self.get_tag_index().get_tags()
 
   def get_previous_tag(self, current_tag: str, revisions: int = 1) -> str:
     """Identify a tag a number of revisions behind the current tag.
@@ -418,20 +695,6 @@ class SourceTree(object):
     if not is_tag(current_tag):
       raise SourceTreeError("The tag specified is not the expected format")
 
-    tag_list = self.list_tags()[::-1]
-
-    count_previous_revisions = False
-    for tag in tag_list:
-      if count_previous_revisions:
-        log.debug(f"Walking {revisions} revision(s) back from {current_tag}")
-        revisions -= 1
-
-      if revisions == 0:
-        log.debug(f"Using tag {tag} as ancestor to {current_tag}")
-        return tag
-
-      if tag == current_tag:
-        log.debug(f"Found {tag} in revision list")
-        count_previous_revisions = True
-
-    return ''
+    previous_tag = self.get_tag_index().get_previous_tag(current_tag, revisions)
+    log.debug(f"Using tag [{previous_tag}] as ancestor to {current_tag}")
+    return previous_tag
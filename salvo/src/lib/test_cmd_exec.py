@@ -1,16 +1,18 @@
 """Test command execution needed for executing benchmarks."""
+import os
 import pytest
 import subprocess
 from unittest import mock
 from src.lib import cmd_exec
+from src.lib.common import (cost_accounting, trace)
 
 
 def check_call_side_effect(args, **kwargs):
   """Return output for the check call command.
 
   Args:
-    args: The list of arguments passed to the subprocess.check_call method
-    kwargs: The keyword arguments passed to the subprocess.check_call method.
+    args: The list of arguments passed to the cmd_exec._call method
+    kwargs: The keyword arguments passed to the cmd_exec._call method.
       We are most interestd in stdout and stderr since these are the conduits
       via which we get the command output
   """
@@ -33,7 +35,7 @@ def check_call_side_effect(args, **kwargs):
   raise NotImplementedError(f"Unhandled args={args} and kwargs={kwargs}")
 
 
-@mock.patch('subprocess.check_call')
+@mock.patch('src.lib.cmd_exec._call')
 def test_run_command(mock_check_call):
   """Verify that we can return the output from a check_call call."""
   mock_check_call.side_effect = check_call_side_effect
@@ -48,7 +50,7 @@ def test_run_command(mock_check_call):
   assert output == 'No te hablas una palabra del espanol en stderr'
 
 
-@mock.patch('subprocess.check_call')
+@mock.patch('src.lib.cmd_exec._call')
 def test_run_command_fail(mock_check_call):
   """Verify that a CalledProcessError is bubbled to the caller if the command fails."""
   mock_check_call.side_effect = check_call_side_effect
@@ -64,7 +66,7 @@ def test_run_command_fail(mock_check_call):
   assert f"Command \'{cmd}\' returned non-zero exit status" in str(process_error.value)
 
 
-@mock.patch('subprocess.check_call')
+@mock.patch('src.lib.cmd_exec._call')
 def test_run_check_command_fail(mock_check_call):
   """Verify that a CalledProcessError is bubbled to the caller if the command fails."""
   mock_check_call.side_effect = check_call_side_effect
@@ -80,5 +82,63 @@ def test_run_check_command_fail(mock_check_call):
   assert f"Command \'{cmd}\' returned non-zero exit status" in str(process_error.value)
 
 
+@mock.patch('src.lib.cmd_exec._call')
+def test_process_placement(mock_check_call):
+  """Verify that commands started within a placement are moved to its CPUs and cgroup."""
+  cmd_parameters = cmd_exec.CommandParameters(cwd='/tmp')
+
+  cmd_exec.run_check_command('bazel build //:envoy', cmd_parameters)
+  assert mock_check_call.call_args[0][0] == ['bazel', 'build', '//:envoy']
+  assert not cmd_exec.get_placement_cpus()
+
+  with cmd_exec.process_placement({2, 3, 5}, '/sys/fs/cgroup/salvo_build/cgroup.procs'):
+    cmd_exec.run_check_command('bazel build //:envoy', cmd_parameters)
+    assert cmd_exec.get_placement_cpus() == '2-3,5'
+  assert mock_check_call.call_args[0][0] == [
+      'sh', '-c', 'echo $$ > "$1" && shift && exec "$@"', 'sh',
+      '/sys/fs/cgroup/salvo_build/cgroup.procs', 'taskset', '--cpu-list', '2-3,5', 'bazel', 'build',
+      '//:envoy'
+  ]
+  assert mock_check_call.call_args[1]['name'] == 'bazel'
+  assert 'preexec_fn' not in mock_check_call.call_args[1]
+
+  cmd_exec.run_check_command('bazel build //:envoy', cmd_parameters)
+  assert mock_check_call.call_args[0][0] == ['bazel', 'build', '//:envoy']
+
+
+def test_process_placement_affinity():
+  """Verify that a placed command runs on the CPUs of the placement."""
+  cpu = min(os.sched_getaffinity(0))
+  cmd_parameters = cmd_exec.CommandParameters(cwd='/tmp')
+  with cmd_exec.process_placement({cpu}):
+    output = cmd_exec.run_command("grep Cpus_allowed_list /proc/self/status", cmd_parameters)
+  assert output.split() == ['Cpus_allowed_list:', str(cpu)]
+
+
+def test_run_command_records_usage():
+  """Verify that the resources consumed by a command are recorded in the current phase."""
+  cost_accounting.reset()
+  cmd_parameters = cmd_exec.CommandParameters(cwd='/tmp')
+  with trace.span('build'):
+    output = cmd_exec.run_command(
+        "sh -c 'echo built; i=0; while [ $i -lt 20000 ]; do "
+        "i=$((i+1)); done'", cmd_parameters)
+    with pytest.raises(subprocess.CalledProcessError):
+      cmd_exec.run_check_command("sh -c 'exit 3'", cmd_parameters)
+
+  usages = cost_accounting.get_usages()
+  cost_accounting.reset()
+  trace.reset()
+
+  assert output == 'built\n'
+  assert [(usage.phase, usage.kind, usage.name) for usage in usages] == [
+      ('build', cost_accounting.KIND_PROCESS, 'sh'),
+      ('build', cost_accounting.KIND_PROCESS, 'sh'),
+  ]
+  assert usages[0].cpu_seconds > 0
+  assert usages[0].peak_rss_bytes > 0
+  assert usages[0].wall_seconds > 0
+
+
 if __name__ == '__main__':
   raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,52 @@
+"""Test the indexes of the commits and tags of a source tree."""
+import pytest
+
+from src.lib import commit_index
+
+_COMMITS = ['c0ffee01', 'deadbeef', 'deadb00f', '0badcafe']
+
+
+def test_resolve():
+  """Verify that full and unique abbreviated hashes are resolved."""
+  index = commit_index.CommitIndex(_COMMITS)
+
+  assert len(index) == 4
+  assert index.get_head() == 'c0ffee01'
+  assert index.resolve('0badcafe') == '0badcafe'
+  assert index.resolve('c0ff') == 'c0ffee01'
+  assert index.resolve('deadbe') == 'deadbeef'
+  # Ambiguous, too short and unknown hashes are not resolved
+  assert index.resolve('deadb') is None
+  assert index.resolve('c0f') is None
+  assert index.resolve('feedface') is None
+  assert commit_index.CommitIndex([]).get_head() == ''
+
+
+def test_get_ancestor():
+  """Verify that ancestors are counted from the commit, as with rev-list --max-count."""
+  index = commit_index.CommitIndex(_COMMITS)
+
+  assert index.get_ancestor('c0ffee01', 1) == 'c0ffee01'
+  assert index.get_ancestor('c0ffee01', 2) == 'deadbeef'
+  assert index.get_ancestor('deadbe', 3) == '0badcafe'
+  # The oldest commit ends a history shorter than the revisions
+  assert index.get_ancestor('deadb00f', 10) == '0badcafe'
+  assert index.get_ancestor('feedface', 2) is None
+  assert index.has_history('deadbeef', 3)
+  assert not index.has_history('deadbeef', 4)
+  assert not index.has_history('feedface', 1)
+
+
+def test_get_previous_tag():
+  """Verify that tags are stepped back by version."""
+  index = commit_index.TagIndex(['v1.14.5', 'v1.15.0', 'v1.16.0'])
+
+  assert index.get_tags() == ['v1.14.5', 'v1.15.0', 'v1.16.0']
+  assert index.get_previous_tag('v1.16.0') == 'v1.15.0'
+  assert index.get_previous_tag('v1.16.0', revisions=2) == 'v1.14.5'
+  assert index.get_previous_tag('v1.16.0', revisions=3) == ''
+  assert index.get_previous_tag('v1.17.0') == ''
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
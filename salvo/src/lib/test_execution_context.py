@@ -0,0 +1,55 @@
+"""Test the execution contexts of jobs, builders and benchmarks."""
+import concurrent.futures
+import os
+import tempfile
+import pytest
+
+from src.lib import (cmd_exec, execution_context)
+
+
+def test_derived_contexts():
+  """Verify that deriving a context leaves the original context unchanged."""
+  base = execution_context.ExecutionContext(env={'HOME': '/home/salvo', 'CC': 'gcc'}, cwd='/src')
+
+  derived = base.with_home('/tmp/cache').with_variables({'CXX': 'g++'}).without_variables(['CC'])
+
+  assert derived.get_home() == '/tmp/cache'
+  assert derived.env == {'HOME': '/tmp/cache', 'CXX': 'g++'}
+  assert base.env == {'HOME': '/home/salvo', 'CC': 'gcc'}
+  with pytest.raises(TypeError):
+    derived.env['CC'] = 'clang'
+  assert derived.with_cpus([1, 0]).cpus == frozenset({0, 1})
+  assert derived.get_command_parameters() == cmd_exec.CommandParameters(cwd='/src', env=derived.env)
+  assert derived.with_cwd('/build').get_command_parameters('/out').cwd == '/out'
+
+
+def test_from_process():
+  """Verify that the context of the process is a copy of its environment."""
+  context = execution_context.from_process()
+
+  assert context.env == dict(os.environ)
+  assert context.cwd == os.getcwd()
+  assert context.env is not os.environ
+  with pytest.raises(TypeError):
+    context.env['HOME'] = '/tmp'
+
+
+def test_concurrent_commands():
+  """Verify that commands run concurrently each see the HOME of their own context."""
+  base = execution_context.from_process()
+
+  def run_in_home(home):
+    context = base.with_home(home)
+    with context.placement():
+      return cmd_exec.run_command('sh -c "echo $HOME"', context.get_command_parameters(home))
+
+  with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+      outputs = list(pool.map(run_in_home, [first, second] * 4))
+
+    assert [output.strip() for output in outputs] == [first, second] * 4
+  assert os.environ.get('HOME') == base.get_home()
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,130 @@
+"""Test the planning of a job without executing it."""
+import pytest
+from unittest import mock
+
+import docker
+
+import api.control_pb2 as proto_control
+
+from src.lib import (execution_plan, generate_test_objects, source_manager)
+
+_DOCKER_IMAGE = 'src.lib.docker_management.docker_image.DockerImage'
+
+
+def _get_descriptions(plan):
+  """Return the description of each step in the plan."""
+  return [step.description for step in plan.get_steps()]
+
+
+@mock.patch(_DOCKER_IMAGE)
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_plan_dockerized_benchmark(mock_hashes, mock_have_build_options, mock_docker_image):
+  """Verify that available images are pulled and missing images are built."""
+  job_control = proto_control.JobControl(remote=False, dockerized_benchmark=True)
+  generate_test_objects.generate_environment(job_control)
+  generate_test_objects.generate_images(job_control)
+  generate_test_objects.generate_envoy_source(job_control)
+
+  mock_hashes.return_value = {'v1.16.0', 'deadbeef'}
+  mock_have_build_options.return_value = False
+  mock_docker_image.return_value.list_images.return_value = [
+      'envoyproxy/nighthawk-benchmark-dev:random_benchmark_image_tag'
+  ]
+  mock_docker_image.return_value.is_image_in_registry.side_effect = \
+      lambda image: image != 'envoyproxy/envoy-dev:deadbeef'
+
+  plan = execution_plan.ExecutionPlanner(job_control).create_plan()
+
+  assert _get_descriptions(plan) == [
+      "use local image envoyproxy/nighthawk-benchmark-dev:random_benchmark_image_tag",
+      "pull envoyproxy/nighthawk-dev:random_binary_image_tag",
+      f"clone SRCID_ENVOY from {job_control.source[0].source_url}",
+      "build_envoy for envoyproxy/envoy-dev:deadbeef",
+      "create_docker_image for envoyproxy/envoy-dev:deadbeef",
+      "benchmark envoyproxy/envoy-dev:deadbeef",
+      "pull envoyproxy/envoy:v1.16.0",
+      "benchmark envoyproxy/envoy:v1.16.0",
+  ]
+
+  steps = plan.get_steps()
+  assert steps[3].depends_on == [3]
+  assert steps[3].from_source
+  assert steps[5].depends_on == [1, 2, 5]
+  assert steps[7].depends_on == [1, 2, 6, 7]
+
+
+@mock.patch(_DOCKER_IMAGE)
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_plan_without_docker(mock_hashes, mock_docker_image):
+  """Verify that images are built when docker cannot be queried."""
+  job_control = proto_control.JobControl(remote=False, scavenging_benchmark=True)
+  generate_test_objects.generate_images(job_control)
+
+  mock_hashes.return_value = {'v1.16.0'}
+  mock_docker_image.side_effect = docker.errors.DockerException("daemon not running")
+
+  plan = execution_plan.ExecutionPlanner(job_control).create_plan()
+
+  assert [step.phase for step in plan.get_steps()][-3:] == [
+      'EnvoyBuilder.build_envoy', 'EnvoyBuilder.create_docker_image',
+      'ScavengingBenchmark.execute_benchmark'
+  ]
+
+
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_plan_binary_benchmark(mock_hashes):
+  """Verify that each binary benchmark builds Nighthawk and Envoy."""
+  job_control = proto_control.JobControl(remote=False, binary_benchmark=True)
+  generate_test_objects.generate_envoy_source(job_control)
+  generate_test_objects.generate_nighthawk_source(job_control)
+
+  mock_hashes.return_value = {'jedi'}
+
+  plan = execution_plan.ExecutionPlanner(job_control).create_plan()
+
+  assert [step.phase for step in plan.get_steps()] == [
+      'SourceTree.pull', 'NightHawkBuilder.build_nighthawk_binaries',
+      'NightHawkBuilder.build_nighthawk_benchmarks', 'SourceTree.pull', 'EnvoyBuilder.build_envoy',
+      'BinaryBenchmark.execute_benchmark'
+  ]
+  assert plan.get_steps()[-1].depends_on == [3, 5]
+  assert 'ENVOY_PATH' not in job_control.environment.variables
+
+
+def test_plan_without_benchmark():
+  """Verify that we raise an error if the job control defines no benchmark."""
+  job_control = proto_control.JobControl(remote=False)
+
+  with pytest.raises(execution_plan.ExecutionPlanError) as plan_error:
+    execution_plan.ExecutionPlanner(job_control).create_plan()
+
+  assert str(plan_error.value) == "No benchmark is defined in the job control"
+
+
+def test_format_plan():
+  """Verify that the plan lists each step with its estimate and totals them."""
+  plan = execution_plan.ExecutionPlan("Binary Benchmark")
+  plan.add_step('', "use local image envoy", [])
+  plan.add_step('EnvoyBuilder.build_envoy', "build_envoy jedi", [], from_source=True)
+  plan.add_step('BinaryBenchmark.execute_benchmark', "benchmark Envoy jedi", [2, 1])
+  plan.add_step('DockerImage.pull_image', "pull nighthawk", [])
+
+  estimates = execution_plan.estimate_phase_durations({
+      'EnvoyBuilder.build_envoy': [3600.0, 5400.0, 4000.0],
+      'BinaryBenchmark.execute_benchmark': [600.0],
+  })
+  output = execution_plan.format_plan(plan, estimates).split('\n')
+
+  assert output[0] == "Execution plan for the Binary Benchmark"
+  assert output[3].split() == ['1', 'use', 'local', 'image', 'envoy', '0:00:00', '-']
+  assert output[4].split() == ['2', 'build_envoy', 'jedi', '1:06:40', '-']
+  assert output[5].split() == ['3', 'benchmark', 'Envoy', 'jedi', '0:10:00', '1,', '2']
+  assert output[6].split() == ['4', 'pull', 'nighthawk', 'unknown', '-']
+  assert output[8] == "Estimated duration: 1:16:40"
+  assert output[9] == "1 step(s) have no recorded timings and are not included in the estimate"
+  assert output[10] == "WARNING: 1 step(s) build Envoy from source"
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
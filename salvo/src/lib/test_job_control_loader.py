@@ -366,3 +366,16 @@ def _validate_job_control_object_with_options(job_control):
 
 if __name__ == '__main__':
   raise SystemExit(pytest.main(['-s', '-v', __file__]))
+
+
+def test_parse_control_doc():
+  """Verify that job control documents are parsed from JSON and YAML contents."""
+  job_control = job_ctrl.parse_control_doc('{"remote": true, "binaryBenchmark": true}')
+  assert job_control.remote
+  assert job_control.binary_benchmark
+
+  job_control = job_ctrl.parse_control_doc("remote: false\nscavengingBenchmark: true\n")
+  assert job_control.scavenging_benchmark
+
+  assert job_ctrl.parse_control_doc("unknownField: 1") is None
+  assert job_ctrl.parse_control_doc("just a string") is None
@@ -0,0 +1,124 @@
+"""Test the queue and the HTTP interface of the Salvo server."""
+import http.client
+import json
+import logging
+import pytest
+import threading
+
+from src.lib import job_server
+
+import api.control_pb2 as proto_control
+
+log = logging.getLogger('test_job_server')
+log.setLevel(logging.INFO)
+
+
+def _get_control(output_dir: str) -> proto_control.JobControl:
+  """Return a job control document writing to an output directory."""
+  job_control = proto_control.JobControl(scavenging_benchmark=True)
+  job_control.environment.output_dir = output_dir
+  return job_control
+
+
+def test_jobs_run_by_priority():
+  """Verify that the jobs with the highest priority run first, in the order of submission."""
+  ran = []
+  queue = job_server.JobQueue(lambda control: ran.append(control.environment.output_dir) or 0)
+
+  queue.submit(_get_control('first'))
+  queue.submit(_get_control('urgent'), priority=5)
+  queue.submit(_get_control('second'))
+  cancelled = queue.submit(_get_control('cancelled'))
+  queue.cancel(cancelled.job_id)
+
+  while queue.run_next(timeout=0):
+    pass
+
+  assert ran == ['urgent', 'first', 'second']
+  assert [job.state for job in queue.list_jobs()] == [
+      job_server.STATE_SUCCEEDED, job_server.STATE_SUCCEEDED, job_server.STATE_SUCCEEDED,
+      job_server.STATE_CANCELLED
+  ]
+
+  with pytest.raises(job_server.JobServerError) as server_error:
+    queue.cancel('1')
+  assert str(server_error.value) == "Job [1] is succeeded and cannot be cancelled"
+  with pytest.raises(job_server.JobServerError):
+    queue.get_job('42')
+
+
+def test_failed_job():
+  """Verify that a job raising an error is failed and its error is recorded."""
+
+  def runner(control):
+    raise RuntimeError("No benchmark defined")
+
+  queue = job_server.JobQueue(runner)
+  job = queue.submit(_get_control('output'))
+  assert queue.run_next(timeout=0) is job
+  assert job.state == job_server.STATE_FAILED
+  assert job.exit_status == 1
+  assert job.error == "No benchmark defined"
+
+  events, finished = queue.get_events(job.job_id, 0, timeout=0)
+  assert finished
+  assert [event['state'] for event in events
+         ] == [job_server.STATE_QUEUED, job_server.STATE_RUNNING, job_server.STATE_FAILED]
+  assert events[-1]['result']['error'] == "No benchmark defined"
+
+
+def test_server_streams_job_events():
+  """Verify that jobs are submitted over HTTP and that their progress is streamed."""
+  proceed = threading.Event()
+
+  def runner(control):
+    log.info(f"Benchmarking into {control.environment.output_dir}")
+    proceed.wait(5)
+    return 0
+
+  queue = job_server.JobQueue(runner)
+  server = job_server.JobServer(queue, port=0)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  queue.start()
+  try:
+    connection = http.client.HTTPConnection(job_server.DEFAULT_ADDRESS, server.get_port())
+    connection.request('POST',
+                       '/jobs?priority=2',
+                       body="scavengingBenchmark: true\n"
+                       "environment:\n  outputDir: /tmp/salvo_job\n")
+    response = connection.getresponse()
+    assert response.status == 201
+    job_id = json.loads(response.read())['id']
+
+    connection.request('POST', '/jobs', body="not a job control document")
+    response = connection.getresponse()
+    assert response.status == 400
+    response.read()
+
+    connection.request('GET', f"/jobs/{job_id}/events")
+    response = connection.getresponse()
+    assert response.status == 200
+    assert json.loads(response.readline())['state'] == job_server.STATE_QUEUED
+    assert json.loads(response.readline())['state'] == job_server.STATE_RUNNING
+    assert json.loads(response.readline())['message'] == "Benchmarking into /tmp/salvo_job"
+    proceed.set()
+    events = [json.loads(line) for line in response.read().splitlines()]
+    assert events[-1]['state'] == job_server.STATE_SUCCEEDED
+    assert events[-1]['result']['output_dir'] == '/tmp/salvo_job'
+
+    connection = http.client.HTTPConnection(job_server.DEFAULT_ADDRESS, server.get_port())
+    connection.request('GET', '/jobs')
+    jobs = json.loads(connection.getresponse().read())['jobs']
+    assert [(job['id'], job['priority'], job['exit_status']) for job in jobs] == [(job_id, 2, 0)]
+
+    connection.request('DELETE', f"/jobs/{job_id}")
+    assert connection.getresponse().status == 409
+  finally:
+    proceed.set()
+    server.shutdown()
+    server.server_close()
+    queue.stop()
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
@@ -0,0 +1,102 @@
+"""Test the overlap of builds with benchmarks."""
+import tempfile
+import threading
+import pytest
+from unittest import mock
+
+import api.scheduling_pb2 as proto_scheduling
+
+from src.lib import pipeline
+from src.lib.common import cgroup
+
+
+@pytest.fixture(autouse=True)
+def no_build_cgroup():
+  """Run the builds without creating a cgroup on the host."""
+  with mock.patch.object(cgroup.Cgroup, 'create') as mock_create:
+    mock_create.side_effect = cgroup.CgroupError("not permitted")
+    yield mock_create
+
+
+def test_builds_overlap_benchmarks():
+  """Verify that the next benchmark is prepared while the current one executes."""
+  events = []
+  second_prepared = threading.Event()
+
+  def prepare(name):
+    events.append(f"prepare {name}")
+    if name == 'candidate':
+      second_prepared.set()
+
+  def execute(name):
+    if name == 'baseline':
+      assert second_prepared.wait(5)
+    events.append(f"execute {name}")
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    stages = [
+        pipeline.PipelineStage(lambda n=name: prepare(n), lambda n=name: execute(n), output_dir)
+        for name in ['baseline', 'candidate']
+    ]
+    pipeline.BenchmarkPipeline(proto_scheduling.PipelineOptions()).execute(
+        stages, lambda: events.append("setup"))
+
+  assert events == [
+      "setup", "prepare baseline", "prepare candidate", "execute baseline", "execute candidate"
+  ]
+
+
+def test_build_failure():
+  """Verify that a failed build stops the benchmarks that depend on it."""
+  execute = mock.Mock()
+
+  def fail():
+    raise RuntimeError("bazel build failed")
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    stages = [
+        pipeline.PipelineStage(mock.Mock(), execute, output_dir),
+        pipeline.PipelineStage(fail, execute, output_dir),
+    ]
+    with pytest.raises(RuntimeError) as build_error:
+      pipeline.BenchmarkPipeline(proto_scheduling.PipelineOptions()).execute(stages)
+
+  assert str(build_error.value) == "bazel build failed"
+  execute.assert_called_once()
+
+
+@mock.patch('os.sched_setaffinity')
+@mock.patch('os.sched_getaffinity')
+def test_cpu_fencing(mock_getaffinity, mock_setaffinity):
+  """Verify that builds run on the CPUs not reserved for the benchmarks."""
+  mock_getaffinity.return_value = {0, 1, 2, 3}
+  options = proto_scheduling.PipelineOptions(enabled=True, benchmark_cpus="0-1")
+
+  benchmark_pipeline = pipeline.BenchmarkPipeline(options)
+  assert benchmark_pipeline.get_benchmark_cpus() == "0-1"
+  assert benchmark_pipeline.get_build_cpus() == "2-3"
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    benchmark_pipeline.execute([pipeline.PipelineStage(mock.Mock(), mock.Mock(), output_dir)])
+
+  mock_setaffinity.assert_has_calls([mock.call(0, {0, 1}), mock.call(0, {2, 3})], any_order=True)
+  assert mock_setaffinity.call_args_list[-1] == mock.call(0, {0, 1, 2, 3})
+
+
+@mock.patch('os.sched_getaffinity')
+def test_invalid_benchmark_cpus(mock_getaffinity):
+  """Verify that we raise an error if the benchmark CPUs cannot be fenced."""
+  mock_getaffinity.return_value = {0, 1}
+
+  for cpu_list, message in [
+      ("1-2", "Benchmark CPUs [2] are not available to Salvo"),
+      ("0-1", "No CPUs remain for the builds once CPUs [0-1] are reserved for the benchmarks"),
+  ]:
+    options = proto_scheduling.PipelineOptions(benchmark_cpus=cpu_list)
+    with pytest.raises(pipeline.PipelineError) as pipeline_error:
+      pipeline.BenchmarkPipeline(options)
+    assert str(pipeline_error.value) == message
+
+
+if __name__ == '__main__':
+  raise SystemExit(pytest.main(['-s', '-v', __file__]))
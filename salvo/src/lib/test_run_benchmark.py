@@ -1,13 +1,18 @@
 """Test benchmark running operations."""
+import json
+import os
+import tempfile
 import pytest
 from unittest import mock
 
 import api.control_pb2 as proto_control
 
 from src.lib import (generate_test_objects, source_manager, run_benchmark)
+from src.lib.common import (artifact_store, cgroup, change_points, html_report, metrics_export,
+                            noise_model, noise_monitor, results_db, watchdog)
 from src.lib.docker_management import (docker_image, docker_image_builder)
-from src.lib.benchmark import (scavenging_benchmark, fully_dockerized_benchmark as full_docker,
-                               binary_benchmark as binbench)
+from src.lib.benchmark import (base_benchmark, scavenging_benchmark, fully_dockerized_benchmark as
+                               full_docker, binary_benchmark as binbench)
 
 import logging
 
@@ -97,6 +102,212 @@ def test_execute_using_images_only(mock_hashes_for_benchmarks, mock_have_build_o
   mock_execute.assert_has_calls([mock.call(), mock.call()])
 
 
+@mock.patch('os.symlink')
+@mock.patch.object(scavenging_benchmark.Benchmark, 'execute_benchmark')
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_execute_continues_after_aborted_benchmark(mock_hashes_for_benchmarks,
+                                                   mock_have_build_options, mock_pull_image,
+                                                   mock_execute, mock_symlink):
+  """Verify that an aborted benchmark is recorded and the next benchmark still executes."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+
+  reason = watchdog.FailureReason(watchdog.SIGNAL_ERROR_RATE, 0.5, 0.05, watchdog.SOURCE_NIGHTHAWK,
+                                  "50% errors")
+  mock_execute.side_effect = [base_benchmark.BenchmarkAborted(reason), None]
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+
+  benchmark = run_benchmark.BenchmarkRunner(job_control)
+  benchmark.execute()
+
+  assert mock_execute.call_count == 2
+  assert benchmark.get_failures() == [reason]
+
+
+@mock.patch('os.symlink')
+@mock.patch.object(scavenging_benchmark.Benchmark, 'execute_benchmark')
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_execute_packs_artifacts(mock_hashes_for_benchmarks, mock_have_build_options,
+                                 mock_pull_image, mock_execute, mock_symlink):
+  """Verify that the output directories of the benchmarks are packed once they executed."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.artifact_packing.enabled = True
+
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    job_control.environment.output_dir = output_dir
+    benchmark = run_benchmark.BenchmarkRunner(job_control)
+    for tag in ['tag1', 'tag2']:
+      with open(os.path.join(output_dir, tag, 'nighthawk-human.txt'), 'w') as result_file:
+        result_file.write(f"results for {tag}\n")
+
+    benchmark.execute()
+
+    reader = artifact_store.ArtifactReader(os.path.join(output_dir, 'artifacts'))
+    assert reader.list_runs() == ['tag1', 'tag2']
+    with artifact_store.open_artifact(os.path.join(output_dir, 'tag2'),
+                                      'nighthawk-human.txt') as result_file:
+      assert result_file.read() == "results for tag2\n"
+
+
+@mock.patch('os.symlink')
+@mock.patch.object(docker_image.DockerImage, 'get_image_digest')
+@mock.patch.object(scavenging_benchmark.Benchmark, 'execute_benchmark')
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_execute_records_results(mock_hashes_for_benchmarks, mock_have_build_options,
+                                 mock_pull_image, mock_execute, mock_get_image_digest,
+                                 mock_symlink):
+  """Verify that the results of the benchmarks are recorded, except for aborted benchmarks."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.results_database.enabled = True
+
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+  mock_get_image_digest.return_value = 'sha256:abcd'
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    job_control.environment.output_dir = output_dir
+    benchmark = run_benchmark.BenchmarkRunner(job_control)
+    for tag in ['tag1', 'tag2']:
+      os.makedirs(os.path.join(output_dir, tag, 'test_http_h1'))
+      with open(os.path.join(output_dir, tag, 'test_http_h1', results_db.RESULTS_FILE),
+                'w') as results_file:
+        results_file.write("Counter  Value  Per second\nupstream_cx_total  1  0.03\n")
+    with open(os.path.join(output_dir, 'tag2', watchdog.FAILURE_REPORT_FILE), 'w') as report:
+      report.write("{}")
+
+    benchmark.execute()
+
+    with results_db.ResultsDatabase(os.path.join(output_dir, 'results.db')) as database:
+      results = database.query(metric='counter.upstream_cx_total')
+
+  assert [(r.commit_hash, r.test, r.image_digest, r.value) for r in results
+         ] == [('tag1', 'test_http_h1', 'sha256:abcd', 1.0)]
+
+
+@mock.patch('os.symlink')
+@mock.patch.object(scavenging_benchmark.Benchmark, 'execute_benchmark')
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_execute_writes_report(mock_hashes_for_benchmarks, mock_have_build_options, mock_pull_image,
+                               mock_execute, mock_symlink):
+  """Verify that the report compares the candidate with the baseline."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.images.envoy_image = 'envoyproxy/envoy-dev:tag2'
+  job_control.report.enabled = True
+
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    job_control.environment.output_dir = output_dir
+    benchmark = run_benchmark.BenchmarkRunner(job_control)
+    benchmark.execute()
+
+    with open(os.path.join(output_dir, html_report.REPORT_FILE)) as report_file:
+      assert "tag1 vs tag2" in report_file.read()
+
+
+@mock.patch('os.symlink')
+@mock.patch.object(docker_image.DockerImage, 'get_image_digest')
+@mock.patch.object(scavenging_benchmark.Benchmark, 'execute_benchmark')
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_execute_scores_candidate(mock_hashes_for_benchmarks, mock_have_build_options,
+                                  mock_pull_image, mock_execute, mock_get_image_digest,
+                                  mock_symlink):
+  """Verify that the candidate is scored against the baselines recorded on the same host and the \
+    history is analyzed for change points."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.images.envoy_image = 'envoyproxy/envoy-dev:tag2'
+  job_control.results_database.enabled = True
+  job_control.results_database.host_profile = 'c5.metal'
+  job_control.noise_model.enabled = True
+  job_control.noise_model.min_samples = 1
+  job_control.change_points.enabled = True
+
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+  mock_get_image_digest.return_value = ''
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    job_control.environment.output_dir = output_dir
+    benchmark = run_benchmark.BenchmarkRunner(job_control)
+    for tag, connections in [('tag1', 1), ('tag2', 2)]:
+      os.makedirs(os.path.join(output_dir, tag, 'test_http_h1'))
+      with open(os.path.join(output_dir, tag, 'test_http_h1', results_db.RESULTS_FILE),
+                'w') as results_file:
+        results_file.write(f"Counter  Value  Per second\nupstream_cx_total  {connections}  0.03\n")
+
+    benchmark.execute()
+
+    with results_db.ResultsDatabase(os.path.join(output_dir, 'results.db')) as database:
+      roles = {(r.commit_hash, r.role, r.host_profile) for r in database.query()}
+    with open(os.path.join(output_dir, 'tag2', noise_model.SCORES_FILE)) as scores_file:
+      scores = json.load(scores_file)
+    # Two commits are too few to detect a change
+    with open(os.path.join(output_dir, change_points.REPORT_FILE)) as report_file:
+      assert json.load(report_file) == []
+
+  assert roles == {('tag1', 'baseline', 'c5.metal'), ('tag2', 'candidate', 'c5.metal')}
+  assert [s['metric'] for s in scores['tests']['test_http_h1'] if s['outlier']
+         ] == ['counter.upstream_cx_total']
+
+
+@mock.patch('os.symlink')
+@mock.patch('requests.post')
+@mock.patch.object(scavenging_benchmark.Benchmark, 'execute_benchmark')
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_execute_exports_metrics(mock_hashes_for_benchmarks, mock_have_build_options,
+                                 mock_pull_image, mock_execute, mock_post, mock_symlink):
+  """Verify that the metrics of every version are written and pushed in a single request."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.images.envoy_image = 'envoyproxy/envoy-dev:tag2'
+  job_control.results_database.host_profile = 'c5.metal'
+  job_control.metrics_export.enabled = True
+  job_control.metrics_export.remote_write_url = 'http://localhost:9090/api/v1/write'
+
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+  mock_post.return_value = mock.Mock(status_code=204)
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    job_control.environment.output_dir = output_dir
+    benchmark = run_benchmark.BenchmarkRunner(job_control)
+    for tag in ['tag1', 'tag2']:
+      os.makedirs(os.path.join(output_dir, tag, 'test_http_h1'))
+      with open(os.path.join(output_dir, tag, 'test_http_h1', results_db.RESULTS_FILE),
+                'w') as results_file:
+        results_file.write("Counter  Value  Per second\nupstream_cx_total  1  0.03\n")
+
+    benchmark.execute()
+
+    with open(os.path.join(output_dir, metrics_export.DEFAULT_EXPORT_FILE)) as export_file:
+      exported = export_file.read()
+
+  assert 'commit="tag1",host_profile="c5.metal",role="baseline"' in exported
+  assert 'commit="tag2",host_profile="c5.metal",role="candidate"' in exported
+  mock_post.assert_called_once()
+
+
 def raise_docker_pull_exception(image_name):
   """Raise a docker image pulling error."""
   raise docker_image.DockerImagePullError(f"failed to pull image: {image_name}")
@@ -140,6 +351,69 @@ def test_execute_with_building_envoy_images(mock_hashes_for_benchmarks, mock_hav
   mock_execute.assert_has_calls([mock.call(), mock.call()])
 
 
+@mock.patch('os.symlink')
+@mock.patch.object(noise_monitor.NoiseMonitor, 'write_report')
+@mock.patch.object(cgroup.Cgroup, 'create')
+@mock.patch.object(scavenging_benchmark.Benchmark, 'execute_benchmark')
+@mock.patch(_BUILD_NIGHTHAWK_BENCHMARK_IMAGE_FROM_SOURCE)
+@mock.patch(_BUILD_NIGHTHAWK_IMAGE_FROM_SOURCE)
+@mock.patch(_BUILD_ENVOY_IMAGE_FROM_SOURCE)
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_execute_pipelined_benchmarks(mock_hashes_for_benchmarks, mock_have_build_options,
+                                      mock_pull_image, mock_build_envoy,
+                                      mock_build_nighthawk_binary, mock_build_nighthawk_benchmark,
+                                      mock_execute, mock_create_cgroup, mock_write_report,
+                                      mock_symlink):
+  """Verify that images are built when the benchmarks execute if pipelining is enabled."""
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  generate_test_objects.generate_envoy_source(job_control)
+  job_control.pipeline.enabled = True
+
+  mock_pull_image.side_effect = raise_docker_pull_exception
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+  mock_create_cgroup.side_effect = cgroup.CgroupError("not permitted")
+
+  benchmark = run_benchmark.BenchmarkRunner(job_control)
+  mock_build_envoy.assert_not_called()
+  mock_build_nighthawk_benchmark.assert_not_called()
+
+  benchmark.execute()
+
+  mock_build_nighthawk_benchmark.assert_called_once()
+  mock_build_nighthawk_binary.assert_called_once()
+  mock_build_envoy.assert_has_calls(
+      [mock.call(mock.ANY, 'tag1'), mock.call(mock.ANY, 'tag2')], any_order=True)
+  mock_execute.assert_has_calls([mock.call(), mock.call()])
+  mock_write_report.assert_has_calls([mock.call('tag1'), mock.call('tag2')], any_order=True)
+
+
+@mock.patch.object(docker_image.DockerImage, 'pull_image')
+@mock.patch.object(source_manager.SourceManager, 'have_build_options')
+@mock.patch.object(source_manager.SourceManager, 'get_envoy_hashes_for_benchmark')
+def test_symlink_replaced_for_another_output_dir(mock_hashes_for_benchmarks,
+                                                 mock_have_build_options, mock_pull_image, tmp_path,
+                                                 monkeypatch):
+  """Verify that the link of an image tag is replaced when a later job writes elsewhere."""
+  monkeypatch.chdir(tmp_path)
+  job_control = generate_test_objects.generate_default_job_control()
+  generate_test_objects.generate_images(job_control)
+  job_control.environment.output_dir = str(tmp_path / 'first_job')
+  mock_have_build_options.return_value = False
+  mock_hashes_for_benchmarks.return_value = {'tag1', 'tag2'}
+
+  run_benchmark.BenchmarkRunner(job_control)
+  assert os.readlink('tag1') == str(tmp_path / 'first_job' / 'tag1')
+
+  job_control.environment.output_dir = str(tmp_path / 'second_job')
+  run_benchmark.BenchmarkRunner(job_control)
+  assert os.readlink('tag1') == str(tmp_path / 'second_job' / 'tag1')
+  assert os.readlink('tag2') == str(tmp_path / 'second_job' / 'tag2')
+
+
 def test_benchmark_failure_if_no_benchmark_selected():
   """Verify that we raise an exception if no benchmark is configured to run."""
   # Build a default job control object no benchmark selected
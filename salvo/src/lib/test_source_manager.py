@@ -1,5 +1,7 @@
 """Test source management operations needed for executing benchmarks."""
+import os
 import pytest
+import tempfile
 from unittest import mock
 
 from src.lib import (source_manager, source_tree)
@@ -29,11 +31,10 @@ def _run_command_side_effect(*args):
       'git clone https://github.com/envoyproxy/envoy.git .':
     return 'Mocked output: Cloning into \'.\'...'
 
-  # Second call gets the hash for the HEAD commit
+  # Second call lists the commits of the branch, HEAD first
   elif args[0] == ("git rev-list --no-merges "
-                   "--committer=\'GitHub <noreply@github.com>\' "
-                   "--max-count=1 HEAD"):
-    return 'mocked_hash'
+                   "--committer=\'GitHub <noreply@github.com>\' HEAD"):
+    return "mocked_hash\nmocked_hash_the_sequel"
 
   # Third call gets the 2 commits in the tree starting with a specific hash
   elif args[0] == ("git rev-list --no-merges "
@@ -601,5 +602,57 @@ def test_have_build_options():
   assert bazel_options
 
 
+@mock.patch.object(source_tree.SourceTree, 'refresh')
+def test_source_cache_reuses_trees(mock_refresh):
+  """Verify that the managers of successive jobs share the source trees and build cache."""
+  mock_refresh.return_value = True
+  job_control = proto_control.JobControl(remote=False, scavenging_benchmark=True)
+  _generate_default_envoy_source(job_control)
+  envoy_id = proto_source.SourceRepository.SourceIdentity.SRCID_ENVOY
+
+  with tempfile.TemporaryDirectory() as cache_dir:
+    cache = source_manager.SourceCache(cache_dir)
+    first = source_manager.SourceManager(job_control, cache)
+    cache.start_job()
+    second = source_manager.SourceManager(job_control, cache)
+
+    assert second.get_source_tree(envoy_id) is first.get_source_tree(envoy_id)
+    assert mock_refresh.call_count == 2
+    assert first.get_build_cache_dir() == second.get_build_cache_dir()
+    assert os.path.isdir(first.get_build_cache_dir())
+
+    other_control = proto_control.JobControl()
+    other_control.CopyFrom(job_control)
+    other_control.source[0].source_path = '/another/envoy'
+    third = source_manager.SourceManager(other_control, cache)
+    assert third.get_source_tree(envoy_id) is not first.get_source_tree(envoy_id)
+
+  assert not source_manager.SourceManager(job_control).get_build_cache_dir()
+
+
+@mock.patch.object(source_tree.SourceTree, 'refresh')
+def test_source_cache_leases_trees_per_job(mock_refresh):
+  """Verify that the managers of one job get their own trees, reused at the same commit later."""
+  mock_refresh.return_value = True
+  envoy_id = proto_source.SourceRepository.SourceIdentity.SRCID_ENVOY
+
+  def get_envoy_tree(cache, commit_hash):
+    job_control = proto_control.JobControl(remote=False, binary_benchmark=True)
+    _generate_default_envoy_source(job_control)
+    job_control.source[0].commit_hash = commit_hash
+    return source_manager.SourceManager(job_control, cache).get_source_tree(envoy_id)
+
+  with tempfile.TemporaryDirectory() as cache_dir:
+    cache = source_manager.SourceCache(cache_dir)
+    baseline = get_envoy_tree(cache, 'a' * 40)
+    candidate = get_envoy_tree(cache, 'b' * 40)
+    assert baseline is not candidate
+    assert get_envoy_tree(cache, 'b' * 40) not in [baseline, candidate]
+
+    cache.start_job()
+    assert get_envoy_tree(cache, 'b' * 40) is candidate
+    assert get_envoy_tree(cache, 'a' * 40) is baseline
+
+
 if __name__ == '__main__':
   raise SystemExit(pytest.main(['-s', '-v', __file__]))
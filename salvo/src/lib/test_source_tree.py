@@ -1,9 +1,12 @@
 """Test source_tree operations needed for executing benchmarks."""
+import os
+import tempfile
 from unittest import mock
 import pytest
 import subprocess
 
 from src.lib import (cmd_exec, source_tree, constants)
+from src.lib.common import cost_accounting
 
 import api.source_pb2 as proto_source
 
@@ -190,9 +193,10 @@ def mock_run_command_side_effect(*function_args):
     return git_output
 
   elif function_args[0] == ("git rev-list --no-merges "
-                            "--committer='GitHub <noreply@github.com>' "
-                            "--max-count=1 HEAD"):
-    return 'random_head_hash'
+                            "--committer='GitHub <noreply@github.com>' HEAD"):
+    return ("random_head_hash\n"
+            "fake_commit_hash_1\n"
+            "fake_commit_hash_2\n")
 
   elif function_args[0] == "git status":
     return "Your branch is up to date with \'some_random_branch\'"
@@ -364,6 +368,129 @@ def test_get_previous_commit_fail(mock_check_output):
       str(source_error.value)
 
 
+@mock.patch('src.lib.cmd_exec.run_command')
+def test_get_previous_commit_hash_indexed(mock_run_command):
+  """Verify that the commits are listed once and indexed for repeated lookups."""
+  mock_run_command.side_effect = mock_run_command_side_effect
+  source = _generate_source_tree_from_origin(_DEFAULT_HTTPS_REPO_URL)
+
+  # Abbreviated hashes are resolved from the index
+  assert source.get_previous_commit_hash('random_head') == 'fake_commit_hash_1'
+  assert source.get_previous_commit_hash('fake_commit_hash_1') == 'fake_commit_hash_2'
+  assert source.get_previous_commit_hash('latest', revisions=3) == 'fake_commit_hash_2'
+  assert source.get_head_hash() == 'random_head_hash'
+
+  commands = [call.args[0] for call in mock_run_command.call_args_list]
+  rev_list = "git rev-list --no-merges --committer='GitHub <noreply@github.com>' HEAD"
+  # The source is cloned and the commits listed once for all lookups
+  assert commands.count('git clone {url} .'.format(url=_DEFAULT_HTTPS_REPO_URL)) == 1
+  assert commands.count(rev_list) == 1
+
+  # Cloning the source again rebuilds the index
+  source.pull()
+  source.get_head_hash()
+  commands = [call.args[0] for call in mock_run_command.call_args_list]
+  assert commands.count(rev_list) == 2
+
+
+@mock.patch('src.lib.cmd_exec.run_command')
+def test_pull_blobless(mock_run_command):
+  """Verify that the blob-less strategy clones without file contents and records the fetch."""
+  mock_run_command.side_effect = lambda cmd, _: \
+      "Cloning into '.'" if cmd.startswith('git clone') else mock_run_command_side_effect(cmd)
+  source_repository = proto_source.SourceRepository(
+      identity=proto_source.SourceRepository.SRCID_ENVOY,
+      source_url=_DEFAULT_HTTPS_REPO_URL,
+      fetch_strategy=proto_source.SourceRepository.FETCH_BLOBLESS)
+  source = source_tree.SourceTree(source_repository)
+  cost_accounting.reset()
+
+  assert source.pull()
+
+  mock_run_command.assert_called_with(
+      'git clone --filter=blob:none {url} .'.format(url=_DEFAULT_HTTPS_REPO_URL), mock.ANY)
+  fetch, = cost_accounting.get_fetches()
+  assert (fetch.source, fetch.strategy, fetch.operation) == ('SRCID_ENVOY', 'FETCH_BLOBLESS',
+                                                             'clone')
+  cost_accounting.reset()
+
+
+def _commit_github_history(path, count):
+  """Create a repository whose commits are merged through GitHub, returning them newest first."""
+  env = dict(os.environ,
+             GIT_AUTHOR_NAME='author',
+             GIT_AUTHOR_EMAIL='author@example.com',
+             GIT_COMMITTER_NAME='GitHub',
+             GIT_COMMITTER_EMAIL='noreply@github.com')
+  subprocess.check_call(['git', 'init', '-q', path])
+  for index in range(count):
+    subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', f"commit {index}"],
+                          cwd=path,
+                          env=env)
+  return subprocess.check_output(['git', 'rev-list', 'HEAD'], cwd=path, text=True).split()
+
+
+def test_shallow_fetch_deepens_history():
+  """Verify that a shallow fetch is deepened when a previous commit needs more history."""
+  cost_accounting.reset()
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    commits = _commit_github_history(tmp_dir, 6)
+    source_repository = proto_source.SourceRepository(
+        identity=proto_source.SourceRepository.SRCID_ENVOY,
+        source_url=f"file://{tmp_dir}",
+        fetch_strategy=proto_source.SourceRepository.FETCH_SHALLOW)
+    source = source_tree.SourceTree(source_repository)
+
+    assert source.pull()
+    assert len(source.get_commit_index()) == source_tree.DEFAULT_FETCH_DEPTH
+    assert source.get_head_hash() == commits[0]
+    assert source.get_previous_commit_hash(commits[0]) == commits[1]
+    assert source.get_previous_commit_hash(commits[0], revisions=5) == commits[4]
+
+  fetches = cost_accounting.get_fetches()
+  assert [fetch.operation for fetch in fetches] == ['clone', 'deepen']
+  assert all(fetch.strategy == 'FETCH_SHALLOW' for fetch in fetches)
+  assert all(fetch.fetched_bytes > 0 for fetch in fetches)
+  cost_accounting.reset()
+
+
+def test_refresh_reuses_clone():
+  """Verify that a tree cloned for a job is brought up to date for the next job."""
+  cost_accounting.reset()
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    commits = _commit_github_history(tmp_dir, 2)
+    source_repository = proto_source.SourceRepository(
+        identity=proto_source.SourceRepository.SRCID_ENVOY, source_url=f"file://{tmp_dir}")
+    source = source_tree.SourceTree(source_repository)
+    assert source.pull()
+    assert source.get_head_hash() == commits[0]
+    source_directory = source.get_source_directory()
+
+    commits = _commit_github_history(tmp_dir, 1) + commits
+    next_repository = proto_source.SourceRepository()
+    next_repository.CopyFrom(source_repository)
+    assert source.matches(next_repository)
+    assert source.refresh(next_repository)
+    assert source.get_source_directory() == source_directory
+    assert source.get_head_hash() == commits[0]
+    assert source.get_previous_commit_hash(commits[0]) == commits[1]
+
+  fetches = cost_accounting.get_fetches()
+  assert [fetch.operation for fetch in fetches] == ['clone', 'refresh']
+  cost_accounting.reset()
+
+
+def test_refresh_without_fetch():
+  """Verify that a tree that was never fetched is fetched again on first use."""
+  source_repository = proto_source.SourceRepository(
+      identity=proto_source.SourceRepository.SRCID_ENVOY, source_path='/some/envoy')
+  source = source_tree.SourceTree(source_repository)
+  assert not source.refresh(source_repository)
+  assert not source.matches(
+      proto_source.SourceRepository(identity=proto_source.SourceRepository.SRCID_ENVOY,
+                                    source_path='/another/envoy'))
+
+
 def testget_revs_behind_parent_branch():
   """Verify that we can determine how many commits beind the local source tree lags behind the \
     remote repository."""